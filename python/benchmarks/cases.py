@@ -0,0 +1,178 @@
+# each case builds a synthetic relation of the given number of keys and
+# returns a tuple of (fakes, run function). only the run function is timed.
+from context import convergdb
+from structure import *
+from fakes import *
+from convergdb.add_partitions import update_all_partitions
+from convergdb.batch_control import (
+  aws_api_based_diff,
+  control_query_diff_from_csv,
+  file_estimated_sizing,
+  file_loaded_record_lines,
+  file_sizing,
+  write_control_records
+)
+from convergdb.planner import batch_statistics_record
+from convergdb.spark_partitions import split_indices
+import time
+
+# convergdb loads its modules on first use. the whole driver is loaded up
+# front so that the cases time the driver code and not its imports.
+import convergdb.high_level
+
+# a batch history similar to a relation that has been running for a while
+def planning_history():
+  return [
+    batch_statistics_record(
+      str(20190101000000000 + i),
+      1000,
+      2 * 1024**3,
+      14 * 1024**3,
+      {
+        "duration": 600.0,
+        "output_bytes": 1024**3,
+        "peak_execution_memory": 64 * 1024**2,
+        "spark_partitions": 32
+      }
+    ) for i in range(20)
+  ]
+
+def source_keys(size):
+  return ['data/dt=2019-01-%02d/file-%08d.json.gz' % ((i % 28) + 1, i) for i in range(size)]
+
+def source_bucket(structure):
+  return structure["source_structure"]["storage_bucket"].split('/')[0]
+
+def storage_location(structure):
+  spl = structure["storage_bucket"].split('/', 1)
+  return {'bucket': spl[0], 'prefix': spl[1]}
+
+# keys written by convergdb, spread over days and batches. every tenth
+# key belongs to the batch used by the remove_batch case.
+def storage_keys(structure, size):
+  prefix = storage_location(structure)['prefix']
+  ret = []
+  for i in range(size):
+    if i % 10 == 0:
+      batch = '20190101000000000'
+    else:
+      batch = '2019010%d000000000' % ((i % 8) + 2)
+    ret.append(
+      prefix + '/dt=2019-01-%02d/convergdb_batch_id=%s/part-%08d.parquet' % ((i % 28) + 1, batch, i)
+    )
+  return ret
+
+# half of the available files have already been loaded
+def api_diff(size):
+  structure = structure_1()
+  structure["inventory_source"] = "api"
+  keys = source_keys(size)
+  loaded = [["source_key"]] + [[k] for k in keys[0:(size / 2)]]
+  fakes = fake_services(lambda query: loaded)
+  fakes['s3'].load_keys(
+    source_bucket(structure),
+    dict([(k, 1024) for k in keys])
+  )
+  def run():
+    return len(aws_api_based_diff(structure))
+  return (fakes, run)
+
+def control_query_csv(size):
+  fakes = fake_services()
+  body = '"key","size"\n' + ''.join(
+    ['"' + k + '","1024"\n' for k in source_keys(size)]
+  )
+  fakes['s3'].put_key('results', 'diff.csv', len(body), body)
+  def run():
+    return len(
+      control_query_diff_from_csv(
+        {'bucket': 'results', 'key': 'diff.csv'},
+        'us-west-2'
+      )
+    )
+  return (fakes, run)
+
+def update_partitions(size):
+  structure = structure_1()
+  location = storage_location(structure)
+  fakes = fake_services(
+    tables={'production__ecommerce__inventory.books': ['dt']}
+  )
+  fakes['s3'].load_keys(
+    location['bucket'],
+    dict([(k, 1024) for k in storage_keys(structure, size)])
+  )
+  def run():
+    return len(
+      update_all_partitions(
+        location['bucket'],
+        location['prefix'],
+        structure['region']
+      )
+    )
+  return (fakes, run)
+
+def remove_batch(size):
+  structure = structure_1()
+  location = storage_location(structure)
+  fakes = fake_services()
+  fakes['s3'].load_keys(
+    location['bucket'],
+    dict([(k, 1024) for k in storage_keys(structure, size)])
+  )
+  def run():
+    convergdb.remove_batch(structure, '20190101000000000')
+    return len(fakes['s3'].sizes[location['bucket']])
+  return (fakes, run)
+
+# control records for a batch of the given number of files
+def control_records(size):
+  structure = structure_1()
+  keys = source_keys(size)
+  fakes = fake_services()
+  def run():
+    return write_control_records(
+      structure,
+      '20190101000000000',
+      file_loaded_record_lines(
+        structure,
+        keys,
+        '20190101000000000',
+        time.gmtime(),
+        time.gmtime()
+      )
+    )
+  return (fakes, run)
+
+# sizing and chunk planning for a diff of the given number of files
+def planning(size):
+  diff = [{"key": k, "size": 1024**2} for k in source_keys(size)]
+  history = planning_history()
+  def run():
+    source_bytes = file_sizing(diff)
+    estimated_bytes = file_estimated_sizing(diff, {'gz': 7.0})
+    chunk_size = convergdb.planned_chunk_count(
+      source_bytes,
+      estimated_bytes,
+      len(diff),
+      2,
+      history
+    )
+    spark_partitions = convergdb.planned_spark_partitions(
+      source_bytes,
+      estimated_bytes,
+      2,
+      None,
+      history
+    )
+    return len(split_indices(len(diff), chunk_size))
+  return (fake_services(), run)
+
+benchmark_cases = [
+  ('aws_api_based_diff', api_diff),
+  ('control_query_diff_from_csv', control_query_csv),
+  ('update_all_partitions', update_partitions),
+  ('remove_batch', remove_batch),
+  ('write_control_records', control_records),
+  ('planning', planning)
+]
@@ -0,0 +1,10 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# the benchmark relations are the ones used by the unit tests
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tests')))
+
+os.environ["LOCK_TABLE"] = 'tmp'
+os.environ["LOCK_ID"] = 'tmp'
+
+import convergdb
@@ -0,0 +1,299 @@
+# in-memory stand-ins for the AWS clients used by the driver. they keep
+# enough of the API shape for convergdb to run against them, and count
+# the requests made so that request volume can be compared as well.
+import bisect
+import boto3
+import csv
+import cStringIO
+from contextlib import contextmanager
+
+from context import convergdb
+from convergdb.aws import clear_aws_clients
+
+page_size = 1000
+
+class FakeBody(object):
+  def __init__(self, data):
+    self.data = data
+
+  def read(self):
+    return self.data
+
+class FakePaginator(object):
+  def __init__(self, page_function):
+    self.page_function = page_function
+
+  # pages are requested with the continuation token of the previous page
+  def paginate(self, **params):
+    page = self.page_function(**params)
+    yield page
+    while page.get("NextContinuationToken") or page.get("NextToken"):
+      p = dict(params)
+      if page.get("NextContinuationToken"):
+        p["ContinuationToken"] = page["NextContinuationToken"]
+      else:
+        p["NextToken"] = page["NextToken"]
+      page = self.page_function(**p)
+      yield page
+
+class FakeService(object):
+  def __init__(self):
+    self.calls = {}
+
+  def count(self, operation, n=1):
+    self.calls[operation] = self.calls.get(operation, 0) + n
+
+class FakeS3(FakeService):
+  def __init__(self):
+    FakeService.__init__(self)
+    # bucket -> {key: body}. sizes are kept apart so that large listings
+    # do not need object bodies.
+    self.objects = {}
+    self.sizes = {}
+    self.sorted_keys = {}
+    self.uploads = {}
+
+  def bucket_keys(self, bucket):
+    if bucket not in self.sorted_keys:
+      self.sorted_keys[bucket] = sorted(self.sizes.get(bucket, {}).keys())
+    return self.sorted_keys[bucket]
+
+  def put_key(self, bucket, key, size, body=None):
+    self.sizes.setdefault(bucket, {})[key] = size
+    if body != None:
+      self.objects.setdefault(bucket, {})[key] = body
+    self.sorted_keys.pop(bucket, None)
+
+  # adds many keys at once, from a dict of key to size
+  def load_keys(self, bucket, key_sizes):
+    self.sizes.setdefault(bucket, {}).update(key_sizes)
+    self.sorted_keys.pop(bucket, None)
+
+  def remove_key(self, bucket, key):
+    self.sizes.get(bucket, {}).pop(key, None)
+    self.objects.get(bucket, {}).pop(key, None)
+    self.sorted_keys.pop(bucket, None)
+
+  def list_objects_v2(self, Bucket, Prefix='', StartAfter=None, ContinuationToken=None, Delimiter=None, MaxKeys=page_size):
+    self.count('list_objects_v2')
+    keys = self.bucket_keys(Bucket)
+    after = ContinuationToken or StartAfter
+    if after:
+      i = bisect.bisect_right(keys, after)
+    else:
+      i = bisect.bisect_left(keys, Prefix)
+    contents = []
+    prefixes = []
+    while (i < len(keys)) and keys[i].startswith(Prefix) and (len(contents) + len(prefixes) < MaxKeys):
+      k = keys[i]
+      if Delimiter and (Delimiter in k[len(Prefix):]):
+        common = Prefix + k[len(Prefix):].split(Delimiter, 1)[0] + Delimiter
+        prefixes.append({"Prefix": common})
+        # skips the rest of the keys under the common prefix
+        i = bisect.bisect_left(keys, common + '\xff')
+      else:
+        contents.append({"Key": k, "Size": self.sizes[Bucket][k]})
+        i += 1
+    page = {"KeyCount": len(contents)}
+    if len(contents) > 0:
+      page["Contents"] = contents
+    if len(prefixes) > 0:
+      page["CommonPrefixes"] = prefixes
+    if (i < len(keys)) and keys[i].startswith(Prefix):
+      page["NextContinuationToken"] = keys[i - 1]
+    return page
+
+  def get_paginator(self, operation):
+    return FakePaginator(getattr(self, operation))
+
+  def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+    self.count('get_object')
+    body = self.objects.get(Bucket, {}).get(Key, None)
+    if body == None:
+      raise Exception('NoSuchKey: ' + Key)
+    resp = {"ETag": '"' + str(len(body)) + '"'}
+    if Range and (len(body) > 0):
+      lo, hi = Range.replace('bytes=', '').split('-')
+      hi = min(int(hi), len(body) - 1)
+      resp["ContentRange"] = "bytes %s-%d/%d" % (lo, hi, len(body))
+      body = body[int(lo):(hi + 1)]
+    resp["Body"] = FakeBody(body)
+    return resp
+
+  def put_object(self, Bucket, Key, Body):
+    self.count('put_object')
+    self.put_key(Bucket, Key, len(Body), Body)
+    return {}
+
+  def upload_fileobj(self, fileobj, bucket, key):
+    self.count('upload_fileobj')
+    body = fileobj.read()
+    self.put_key(bucket, key, len(body), body)
+
+  def create_multipart_upload(self, Bucket, Key):
+    self.count('create_multipart_upload')
+    upload_id = str(len(self.uploads) + 1)
+    self.uploads[upload_id] = {}
+    return {"UploadId": upload_id}
+
+  def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+    self.count('upload_part')
+    self.uploads[UploadId][PartNumber] = Body
+    return {"ETag": str(PartNumber)}
+
+  def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+    self.count('complete_multipart_upload')
+    parts = self.uploads.pop(UploadId)
+    body = ''.join([parts[p["PartNumber"]] for p in MultipartUpload["Parts"]])
+    self.put_key(Bucket, Key, len(body), body)
+    return {}
+
+  def abort_multipart_upload(self, Bucket, Key, UploadId):
+    self.count('abort_multipart_upload')
+    self.uploads.pop(UploadId, None)
+    return {}
+
+  def delete_objects(self, Bucket, Delete):
+    self.count('delete_objects')
+    for o in Delete["Objects"]:
+      self.remove_key(Bucket, o["Key"])
+    return {"Deleted": Delete["Objects"]}
+
+  def delete_object(self, Bucket, Key):
+    self.count('delete_object')
+    self.remove_key(Bucket, Key)
+    return {}
+
+class FakeAthena(FakeService):
+  # results_function returns the result rows for a query, header first
+  def __init__(self, s3, results_function):
+    FakeService.__init__(self)
+    self.s3 = s3
+    self.results_function = results_function
+    self.executions = {}
+
+  def start_query_execution(self, QueryString, QueryExecutionContext, ResultConfiguration):
+    self.count('start_query_execution')
+    execution_id = str(len(self.executions) + 1)
+    rows = self.results_function(QueryString)
+    location = ResultConfiguration["OutputLocation"] + execution_id + ".csv"
+    # athena writes the results as a csv file with every value quoted
+    out = cStringIO.StringIO()
+    csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator="\n").writerows(rows)
+    spl = location[5:].split('/', 1)
+    self.s3.put_key(spl[0], spl[1], out.tell(), out.getvalue())
+    self.executions[execution_id] = {"rows": rows, "location": location}
+    return {"QueryExecutionId": execution_id}
+
+  def get_query_execution(self, QueryExecutionId):
+    self.count('get_query_execution')
+    return {
+      "QueryExecution": {
+        "Status": {"State": "SUCCEEDED"},
+        "ResultConfiguration": {
+          "OutputLocation": self.executions[QueryExecutionId]["location"]
+        }
+      }
+    }
+
+  def get_query_results(self, QueryExecutionId, NextToken=None):
+    self.count('get_query_results')
+    rows = self.executions[QueryExecutionId]["rows"]
+    start = int(NextToken or 0)
+    page = {
+      "ResultSet": {
+        "ResultSetMetadata": {
+          "ColumnInfo": [{"Name": c, "Type": "varchar"} for c in rows[0]]
+        },
+        "Rows": [
+          {"Data": [{"VarCharValue": v} for v in r]} for r in rows[start:(start + page_size)]
+        ]
+      }
+    }
+    if start + page_size < len(rows):
+      page["NextToken"] = str(start + page_size)
+    return page
+
+  def get_paginator(self, operation):
+    return FakePaginator(getattr(self, operation))
+
+class FakeGlue(FakeService):
+  # tables is a dict of "database.table" to a list of partition key names
+  def __init__(self, tables):
+    FakeService.__init__(self)
+    self.tables = tables
+    self.partitions = {}
+
+  def get_table(self, DatabaseName, Name):
+    self.count('get_table')
+    return {
+      "Table": {
+        "Name": Name,
+        "PartitionKeys": [
+          {"Name": k, "Type": "string"} for k in self.tables[DatabaseName + '.' + Name]
+        ],
+        "StorageDescriptor": {"Location": "s3://fake/" + Name, "Columns": []}
+      }
+    }
+
+  def create_partition(self, DatabaseName, TableName, PartitionInput):
+    self.count('create_partition')
+    self.partitions[(DatabaseName, TableName, tuple(PartitionInput["Values"]))] = PartitionInput
+    return {}
+
+class FakeDynamoDB(FakeService):
+  def __init__(self):
+    FakeService.__init__(self)
+    self.items = {}
+
+  def put_item(self, TableName, Item, ConditionExpression=None):
+    self.count('put_item')
+    self.items[(TableName, Item["LockID"]["S"])] = Item
+    return {}
+
+  def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+    self.count('delete_item')
+    self.items.pop((TableName, Key["LockID"]["S"]), None)
+    return {}
+
+class FakeNotifications(FakeService):
+  def put_metric_data(self, Namespace, MetricData):
+    self.count('put_metric_data')
+    return {}
+
+  def publish(self, TopicArn, Subject, Message):
+    self.count('publish')
+    return {}
+
+# one fake of each service, sharing a single s3
+def fake_services(results_function=lambda query: [["key"]], tables={}):
+  s3 = FakeS3()
+  return {
+    's3': s3,
+    'athena': FakeAthena(s3, results_function),
+    'glue': FakeGlue(tables),
+    'dynamodb': FakeDynamoDB(),
+    'cloudwatch': FakeNotifications(),
+    'sns': FakeNotifications()
+  }
+
+# replaces boto3.client with a function returning the fakes. processes
+# forked inside the block, such as the partition writers, use them too.
+@contextmanager
+def fake_aws(fakes):
+  original = boto3.client
+  boto3.client = lambda service, *args, **kwargs: fakes[service]
+  clear_aws_clients()
+  try:
+    yield fakes
+  finally:
+    boto3.client = original
+    clear_aws_clients()
+
+# request counts of all fakes, by service and operation
+def request_counts(fakes):
+  ret = {}
+  for service in fakes:
+    for operation, n in fakes[service].calls.items():
+      ret[service + '.' + operation] = n
+  return ret
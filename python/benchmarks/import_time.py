@@ -0,0 +1,113 @@
+# measures how long it takes to import convergdb and some of its modules,
+# each in a fresh python process, and fails when an import is over its
+# budget or imports a module it should not.
+#
+#   python benchmarks/import_time.py
+#   python benchmarks/import_time.py --repeat 10 --budget convergdb=0.02
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+package_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# seconds allowed for each import, and the modules it must not import.
+# planning and diff helpers, and dry runs, are used without spark, so none
+# of them pulls it in.
+default_budgets = {
+  "convergdb": {
+    "seconds": 0.05,
+    "forbidden": ["pyspark", "boto3", "botocore"]
+  },
+  "convergdb.planner": {
+    "seconds": 0.1,
+    "forbidden": ["pyspark", "boto3", "botocore"]
+  },
+  "convergdb.batch_control": {
+    "seconds": 0.1,
+    "forbidden": ["pyspark", "boto3", "botocore"]
+  },
+  "convergdb.dry_run": {
+    "seconds": 0.2,
+    "forbidden": ["pyspark", "boto3", "botocore"]
+  },
+  "convergdb.high_level": {
+    "seconds": 3.0,
+    "forbidden": []
+  }
+}
+
+measure_script = """
+import json, sys, time
+st = time.time()
+__import__(sys.argv[1])
+seconds = time.time() - st
+print json.dumps({"seconds": seconds, "modules": sorted(sys.modules.keys())})
+"""
+
+# one import in a new interpreter, so nothing is already loaded
+def measure_import(module):
+  out = subprocess.check_output(
+    [sys.executable, '-c', measure_script, module],
+    cwd=package_path
+  )
+  return json.loads(out.strip().split("\n")[-1])
+
+def median(values):
+  s = sorted(values)
+  return s[len(s) // 2]
+
+def loaded_forbidden(modules, forbidden):
+  return sorted(
+    [f for f in forbidden if any([(m == f) or m.startswith(f + '.') for m in modules])]
+  )
+
+def parse_budgets(overrides):
+  budgets = json.loads(json.dumps(default_budgets))
+  for o in overrides:
+    module, seconds = o.split('=')
+    budgets.setdefault(module, {"seconds": None, "forbidden": []})["seconds"] = float(seconds)
+  return budgets
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description='convergdb import time budget')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--budget', action='append', default=[], help='module=seconds')
+  parser.add_argument('--output', default=None, help='writes the results as json')
+  return parser.parse_args(argv)
+
+def main(argv):
+  args = parse_args(argv)
+  budgets = parse_budgets(args.budget)
+  results = {}
+  failures = []
+  for module in sorted(budgets):
+    runs = [measure_import(module) for i in range(args.repeat)]
+    seconds = median([r["seconds"] for r in runs])
+    forbidden = loaded_forbidden(runs[0]["modules"], budgets[module]["forbidden"])
+    results[module] = {
+      "seconds": seconds,
+      "budget": budgets[module]["seconds"],
+      "forbidden_imports": forbidden
+    }
+    print "%-30s %8.3fs  budget %6.3fs  %s" % (
+      module,
+      seconds,
+      budgets[module]["seconds"],
+      ' '.join(forbidden)
+    )
+    if (budgets[module]["seconds"] != None) and (seconds > budgets[module]["seconds"]):
+      failures.append(module + " took " + ("%.3f" % seconds) + "s, budget " + str(budgets[module]["seconds"]) + "s")
+    if len(forbidden) > 0:
+      failures.append(module + " imported " + ', '.join(forbidden))
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  for f in failures:
+    print "OVER BUDGET: " + f
+  return 1 if len(failures) > 0 else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+# prints the plan of the next run of a relation without loading anything,
+# optionally with other dpu, container or spark partition settings. needs
+# read access to the source, state and storage of the relation.
+#
+#   python benchmarks/plan.py structure.json
+#   python benchmarks/plan.py structure.json --dpu 20 --spark-partition-count 40
+#   python benchmarks/plan.py structure.json --cores 4 --memory-gb 16 --output plan.json
+import argparse
+import sys
+
+from context import convergdb
+
+def parse_arguments(argv):
+  parser = argparse.ArgumentParser(description='convergdb dry run planner')
+  parser.add_argument('structure', help='a file with the json structure of the relation')
+  parser.add_argument('--dpu', type=int, default=None, help='plans for a glue job with this many dpu')
+  parser.add_argument('--cores', type=int, default=None, help='plans for a container with this many cores')
+  parser.add_argument('--memory-gb', type=float, default=None, help='memory of the container, with --cores')
+  parser.add_argument('--spark-partition-count', type=int, default=None)
+  parser.add_argument('--output', default=None, help='writes the plan as json')
+  return parser.parse_args(argv)
+
+def what_if_resources(args):
+  if args.cores == None:
+    return None
+  return {
+    "cores": args.cores,
+    "memory_bytes": int(args.memory_gb * 1024**3) if args.memory_gb else None
+  }
+
+def print_plan(plan):
+  print("%s: %d files, %d bytes (%d uncompressed estimate), %d files per chunk" % (
+    plan["relation"],
+    plan["file_count"],
+    plan["source_bytes"],
+    plan["estimated_bytes"],
+    plan["files_per_chunk"]
+  ))
+  for i, c in enumerate(plan["chunks"]):
+    print("chunk %4d  %6d files  %14d bytes  %-5s  partitions %-5s  files %-5s  seconds %s" % (
+      i,
+      c["file_count"],
+      c["source_bytes"],
+      c["engine"],
+      c["spark_partitions"],
+      c["estimated_output_files"],
+      c["estimated_seconds"]
+    ))
+  print("estimated seconds: %s, output files: %s, partitions registered per batch: at least %d" % (
+    plan["estimated_seconds"],
+    plan["estimated_output_files"],
+    plan["partitions"]["registrations_per_batch_at_least"]
+  ))
+  if plan["settings"]["run_budget_seconds"] != None:
+    print("run budget of %s seconds fits %d of %d chunks" % (
+      plan["settings"]["run_budget_seconds"],
+      plan["chunks_within_budget"],
+      len(plan["chunks"])
+    ))
+
+def main(argv):
+  args = parse_arguments(argv)
+  with open(args.structure) as f:
+    structure_json = f.read()
+  plan = convergdb.plan_source_to_target(
+    structure_json,
+    dpu=args.dpu,
+    spark_partition_count=args.spark_partition_count,
+    resources=what_if_resources(args)
+  )
+  print_plan(plan)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(convergdb.plan_json(plan))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,75 @@
+# replays a recorded cassette through source_to_target without AWS
+# credentials or network access. spark is left out: data_load returns
+# immediately, so the timing covers the driver work around it.
+#
+#   python benchmarks/replay.py my_run.json.gz
+#   python benchmarks/replay.py my_run.json.gz --profile replay.pstats
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+
+from context import convergdb
+import convergdb.high_level
+
+def no_data_load(*args, **kwargs):
+  return {"duration": 0.0}
+
+def no_bucket_sse(sql_context, bucket):
+  return None
+
+# the recorded structure, without the options that would record or
+# profile the replayed run again.
+def replay_structure_json(cassette):
+  structure = json.loads(cassette["structure"])
+  structure["record_cassette"] = "false"
+  structure["driver_profiling"] = "false"
+  return json.dumps(structure)
+
+def parse_arguments(argv):
+  parser = argparse.ArgumentParser(description='replays a convergdb cassette offline')
+  parser.add_argument('cassette', help='a cassette downloaded from the state bucket')
+  parser.add_argument('--profile', default=None, help='writes cProfile stats to this path')
+  return parser.parse_args(argv)
+
+def main(argv):
+  args = parse_arguments(argv)
+  with open(args.cassette, 'rb') as f:
+    cassette = convergdb.read_cassette(f.read())
+  structure_json = replay_structure_json(cassette)
+  os.environ.setdefault('AWS_DEFAULT_REGION', json.loads(structure_json)["region"])
+  os.environ.setdefault('AWS_ACCESS_KEY_ID', 'replay')
+  os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'replay')
+
+  convergdb.high_level.data_load = no_data_load
+  convergdb.high_level.set_bucket_sse = no_bucket_sse
+  replayer = convergdb.start_replay(cassette)
+
+  profile = cProfile.Profile() if args.profile else None
+  st = time.time()
+  try:
+    if profile:
+      profile.enable()
+    convergdb.source_to_target(None, structure_json)
+  finally:
+    if profile:
+      profile.disable()
+    seconds = time.time() - st
+    convergdb.stop_replay(replayer)
+
+  print("replayed %d recorded calls in %.3fs" % (len(cassette["interactions"]), seconds))
+  if len(replayer["unmatched"]) > 0:
+    print("%d calls had no recorded response: %s" % (
+      len(replayer["unmatched"]),
+      ', '.join(sorted(set(replayer["unmatched"])))
+    ))
+  if profile:
+    profile.dump_stats(args.profile)
+    pstats.Stats(args.profile).sort_stats('cumulative').print_stats(30)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+# runs the driver benchmarks against the in-memory AWS fakes and compares
+# them with a stored baseline. each case runs in its own forked process so
+# that its peak memory can be measured.
+#
+#   python benchmarks/run_benchmarks.py
+#   python benchmarks/run_benchmarks.py --sizes 10000,100000,1000000
+#   python benchmarks/run_benchmarks.py --write-baseline
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+from cases import *
+from fakes import *
+
+default_sizes = [10**4, 10**5]
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# relative slowdown or memory growth reported as a regression
+default_tolerance = 0.5
+
+# differences below this many seconds are treated as timing noise
+noise_seconds = 0.05
+
+def case_key(name, size):
+  return name + ':' + str(size)
+
+# runs in the forked process. driver logging is sent to /dev/null so that
+# it costs what it costs in a job, without filling the terminal.
+def measure_case(case_function, size):
+  fakes, run = case_function(size)
+  devnull = os.open(os.devnull, os.O_WRONLY)
+  stdout = os.dup(1)
+  with fake_aws(fakes):
+    sys.stdout.flush()
+    os.dup2(devnull, 1)
+    try:
+      st = time.time()
+      result = run()
+      seconds = time.time() - st
+    finally:
+      sys.stdout.flush()
+      os.dup2(stdout, 1)
+  return {
+    "size": size,
+    "seconds": seconds,
+    "keys_per_second": size / seconds if seconds > 0 else None,
+    # ru_maxrss is in kilobytes on linux
+    "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    "result": result,
+    "requests": request_counts(fakes)
+  }
+
+def run_case(case_function, size):
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    try:
+      out = json.dumps(measure_case(case_function, size))
+    except Exception as e:
+      out = json.dumps({"error": repr(e)})
+    with os.fdopen(write_fd, 'w') as f:
+      f.write(out)
+    os._exit(0)
+  os.close(write_fd)
+  with os.fdopen(read_fd) as f:
+    out = f.read()
+  os.waitpid(pid, 0)
+  return json.loads(out)
+
+# returns a list of regression descriptions for a measured case
+def regressions(key, measured, baseline, tolerance):
+  ret = []
+  if "error" in measured:
+    return [key + " failed: " + measured["error"]]
+  expected = baseline.get(key, None)
+  if expected == None:
+    return ret
+  allowed_seconds = expected["seconds"] * (1 + tolerance)
+  if (measured["seconds"] > allowed_seconds) and ((measured["seconds"] - expected["seconds"]) > noise_seconds):
+    ret.append(
+      key + " took %.3fs, baseline %.3fs" % (measured["seconds"], expected["seconds"])
+    )
+  if measured["peak_rss_bytes"] > expected["peak_rss_bytes"] * (1 + tolerance):
+    ret.append(
+      key + " peaked at %d MiB, baseline %d MiB" % (measured["peak_rss_bytes"] / 1024**2, expected["peak_rss_bytes"] / 1024**2)
+    )
+  return ret
+
+def report_line(key, measured, baseline):
+  if "error" in measured:
+    return "%-40s error" % key
+  expected = baseline.get(key, None)
+  change = ''
+  if expected != None:
+    change = '%+.0f%%' % (100.0 * (measured["seconds"] - expected["seconds"]) / max(expected["seconds"], 1e-9))
+  return "%-40s %10.3fs %14s keys/s %8d MiB %8s" % (
+    key,
+    measured["seconds"],
+    '%.0f' % measured["keys_per_second"] if measured["keys_per_second"] else '-',
+    measured["peak_rss_bytes"] / 1024**2,
+    change
+  )
+
+def parse_arguments(argv):
+  parser = argparse.ArgumentParser(description='convergdb driver benchmarks')
+  parser.add_argument('--sizes', default=','.join([str(s) for s in default_sizes]))
+  parser.add_argument('--cases', default=None, help='comma separated case names')
+  parser.add_argument('--baseline', default=default_baseline)
+  parser.add_argument('--tolerance', type=float, default=default_tolerance)
+  parser.add_argument('--write-baseline', action='store_true')
+  parser.add_argument('--output', default=None, help='writes the results as json')
+  return parser.parse_args(argv)
+
+def main(argv):
+  args = parse_arguments(argv)
+  sizes = [int(s) for s in args.sizes.split(',')]
+  names = args.cases.split(',') if args.cases else [c[0] for c in benchmark_cases]
+
+  baseline = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+
+  results = {}
+  found = []
+  for name, case_function in benchmark_cases:
+    if name not in names:
+      continue
+    for size in sizes:
+      key = case_key(name, size)
+      results[key] = run_case(case_function, size)
+      print(report_line(key, results[key], baseline))
+      found += regressions(key, results[key], baseline, args.tolerance)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if args.write_baseline:
+    baseline.update(results)
+    with open(args.baseline, 'w') as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+    print("baseline written to " + args.baseline)
+    return 0
+
+  for r in found:
+    print("REGRESSION: " + r)
+  return 1 if len(found) > 0 else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
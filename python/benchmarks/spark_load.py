@@ -0,0 +1,279 @@
+# measures the throughput of the data_load dataframe chain on a local spark
+# with synthetic source files generated from a relation structure. the
+# source and target are on the local filesystem, so s3 plays no part.
+#
+#   python benchmarks/spark_load.py --rows 1000000 --files 16
+#   python benchmarks/spark_load.py --format csv --compression gz --null-rate 0.1
+#   python benchmarks/spark_load.py --structure my_relation.json --depth 4
+import argparse
+import bz2
+import datetime
+import decimal
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from context import convergdb
+from structure import *
+from convergdb.batch_control import batch_id
+from convergdb.resources import (
+  local_master,
+  local_resources,
+  local_spark_settings
+)
+from convergdb.spark import (
+  batch_dataframe,
+  coalesce_expression,
+  csv_param,
+  source_dataframe,
+  write_partitions
+)
+from convergdb.spark_metrics import (
+  batch_job_group,
+  batch_spark_metrics,
+  batch_stage_ids,
+  stage_attempts
+)
+from convergdb.spark_partitions import calculate_spark_partitions
+
+# !SYNTHETIC SOURCE DATA
+
+decimal_re = re.compile(r'decimal\((\d+),\s*(\d+)\)')
+
+# a random value for the cast type of a source attribute, as the string
+# that would appear in the source file.
+def synthetic_value(cast_type, rng):
+  t = cast_type.lower()
+  m = decimal_re.match(t)
+  if m:
+    scale = int(m.group(2))
+    digits = max(1, int(m.group(1)) - scale)
+    return str(
+      decimal.Decimal(rng.randint(0, 10**min(digits, 9) - 1)) / decimal.Decimal(10**scale)
+    )
+  elif t in ['integer', 'int', 'bigint', 'smallint', 'tinyint', 'long']:
+    return str(rng.randint(0, 10**6))
+  elif t in ['double', 'float']:
+    return repr(rng.random() * 10**6)
+  elif t == 'boolean':
+    return rng.choice(['true', 'false'])
+  elif t == 'date':
+    return str(datetime.date(2019, 1, 1) + datetime.timedelta(days=rng.randint(0, 365)))
+  elif t == 'timestamp':
+    return str(datetime.datetime(2019, 1, 1) + datetime.timedelta(seconds=rng.randint(0, 365 * 86400)))
+  else:
+    return 'value %d %s' % (rng.randint(0, 10**6), 'x' * rng.randint(0, 24))
+
+# the path of each source attribute within a json record
+def attribute_path(attribute):
+  return coalesce_expression(attribute).split('.')
+
+def set_path(record, path, value):
+  for p in path[:-1]:
+    record = record.setdefault(p, {})
+  record[path[-1]] = value
+
+# nested fields that are not part of the relation, which spark still has to
+# parse past in every record.
+def noise(depth, rng):
+  record = {"value": rng.randint(0, 10**6)}
+  for i in range(depth):
+    record = {"level_" + str(i): record, "sibling_" + str(i): str(rng.random())}
+  return record
+
+def synthetic_json_record(attributes, rng, null_rate, depth):
+  record = {}
+  for a in attributes:
+    if rng.random() < null_rate:
+      value = None
+    else:
+      value = synthetic_value(a["cast_type"], rng)
+    set_path(record, attribute_path(a), value)
+  if depth > 0:
+    record["convergdb_noise"] = noise(depth, rng)
+  return json.dumps(record)
+
+def synthetic_csv_record(attributes, rng, null_rate, separator, quote):
+  values = []
+  for a in attributes:
+    if rng.random() < null_rate:
+      values.append('')
+    else:
+      v = synthetic_value(a["cast_type"], rng)
+      if (separator in v) or (quote in v):
+        v = quote + v.replace(quote, quote + quote) + quote
+      values.append(v)
+  return separator.join(values)
+
+def open_for_compression(path, compression):
+  if compression == 'gz':
+    return gzip.open(path + '.gz', 'wb')
+  elif compression == 'bz2':
+    return bz2.BZ2File(path + '.bz2', 'wb')
+  else:
+    return open(path, 'wb')
+
+# writes the source files and returns their paths
+def write_source_files(structure, directory, args, rng):
+  source = structure["source_structure"]
+  attributes = source["attributes"]
+  extension = '.' + args.format
+  rows_per_file = int(args.rows / args.files)
+  separator = None
+  quote = None
+  if args.format == 'csv':
+    separator = csv_param(source["csv_separator"]).encode('utf-8')
+    quote = csv_param(source["csv_quote"]).encode('utf-8')
+  for i in range(args.files):
+    path = os.path.join(directory, 'part-%05d%s' % (i, extension))
+    f = open_for_compression(path, args.compression)
+    for r in range(rows_per_file):
+      if args.format == 'csv':
+        line = synthetic_csv_record(attributes, rng, args.null_rate, separator, quote)
+      else:
+        line = synthetic_json_record(attributes, rng, args.null_rate, args.depth)
+      f.write(line + "\n")
+    f.close()
+  return sorted(
+    [os.path.join(directory, f) for f in os.listdir(directory)]
+  )
+
+# !LOCAL SPARK
+
+def local_sql_context():
+  from pyspark import SparkConf, SparkContext
+  from pyspark.sql import SQLContext
+  resources = local_resources()
+  conf = SparkConf().setMaster(local_master(resources)).setAppName("convergdb data_load benchmark")
+  for setting in local_spark_settings(resources):
+    conf.set(setting[0], setting[1])
+  sq = SQLContext(SparkContext(conf = conf))
+  sq.setConf("spark.sql.parquet.writeLegacyFormat", "true")
+  return sq
+
+# run time and records of each completed stage of the batch
+def stage_breakdown(sql_context, batch_id):
+  ret = []
+  for stage_id in batch_stage_ids(sql_context, batch_id):
+    for attempt in stage_attempts(sql_context, stage_id):
+      if attempt.get('status') == 'COMPLETE':
+        ret.append(
+          {
+            "stage_id": stage_id,
+            "name": attempt.get('name', '')[0:60],
+            "tasks": attempt.get('numCompleteTasks', 0),
+            "executor_run_time": attempt.get('executorRunTime', 0),
+            "input_records": attempt.get('inputRecords', 0),
+            "output_records": attempt.get('outputRecords', 0),
+            "shuffle_write_bytes": attempt.get('shuffleWriteBytes', 0)
+          }
+        )
+  return ret
+
+# runs the same chain of dataframes as data_load, against local paths
+def run_load(sql_context, structure, paths, target, spark_partitions):
+  this_batch_id = batch_id(time.gmtime())
+  st = time.time()
+  df = batch_dataframe(
+    source_dataframe(sql_context, structure, paths),
+    structure,
+    this_batch_id,
+    spark_partitions
+  )
+  with batch_job_group(sql_context, this_batch_id):
+    write_partitions(df, structure, target)
+  seconds = time.time() - st
+  return {
+    "batch_id": this_batch_id,
+    "seconds": seconds,
+    "metrics": batch_spark_metrics(sql_context, this_batch_id),
+    "stages": stage_breakdown(sql_context, this_batch_id)
+  }
+
+def benchmark_structure(args):
+  if args.structure:
+    with open(args.structure) as f:
+      structure = json.load(f)
+  else:
+    structure = structure_1()
+  structure["source_structure"]["storage_format"] = args.format
+  if args.format == 'csv':
+    # csv settings of the test relation, for structures that have none
+    for k, v in structure_2()["source_structure"].items():
+      if k.startswith('csv_'):
+        structure["source_structure"].setdefault(k, v)
+  return structure
+
+def parse_arguments(argv):
+  parser = argparse.ArgumentParser(description='convergdb data_load benchmark')
+  parser.add_argument('--structure', default=None, help='relation structure json, the books test relation by default')
+  parser.add_argument('--format', choices=['json', 'csv'], default='json')
+  parser.add_argument('--rows', type=int, default=1000000)
+  parser.add_argument('--files', type=int, default=8)
+  parser.add_argument('--depth', type=int, default=0, help='levels of extra nesting in each json record')
+  parser.add_argument('--null-rate', type=float, default=0.0)
+  parser.add_argument('--compression', choices=['none', 'gz', 'bz2'], default='none')
+  parser.add_argument('--spark-partitions', type=int, default=None)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--keep', action='store_true', help='keeps the generated files')
+  parser.add_argument('--output', default=None, help='writes the results as json')
+  return parser.parse_args(argv)
+
+def main(argv):
+  args = parse_arguments(argv)
+  structure = benchmark_structure(args)
+  work = tempfile.mkdtemp(prefix='convergdb_benchmark_')
+  source_directory = os.path.join(work, 'source')
+  os.makedirs(source_directory)
+  try:
+    st = time.time()
+    paths = write_source_files(structure, source_directory, args, random.Random(args.seed))
+    source_bytes = sum([os.path.getsize(p) for p in paths])
+    print("generated %d rows in %d files, %d bytes, in %.1fs" % (args.rows, len(paths), source_bytes, time.time() - st))
+
+    sql_context = local_sql_context()
+    spark_partitions = args.spark_partitions or calculate_spark_partitions(
+      source_bytes,
+      None,
+      None,
+      local_resources()
+    )
+    result = run_load(
+      sql_context,
+      structure,
+      ['file://' + p for p in paths],
+      'file://' + os.path.join(work, 'target'),
+      spark_partitions
+    )
+    result["rows"] = args.rows
+    result["source_bytes"] = source_bytes
+    result["rows_per_second"] = args.rows / result["seconds"]
+    result["bytes_per_second"] = source_bytes / result["seconds"]
+
+    print("loaded in %.2fs: %.0f rows/s, %.0f bytes/s, %s records written" % (
+      result["seconds"],
+      result["rows_per_second"],
+      result["bytes_per_second"],
+      result["metrics"].get("output_records", '?')
+    ))
+    for s in result["stages"]:
+      print("  stage %(stage_id)4d %(tasks)5d tasks %(executor_run_time)10d ms %(input_records)12d in %(output_records)12d out  %(name)s" % s)
+
+    if args.output:
+      with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+  finally:
+    if args.keep:
+      print("files kept in " + work)
+    else:
+      shutil.rmtree(work)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
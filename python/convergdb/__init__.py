@@ -1,14 +1,64 @@
-from convergdb_logging import *
-
-from batch_control import * # needs to be before the other modules
-from add_partitions import *
-from athena import *
-from cloudwatch import *
-from glue import *
-from locking import *
-from high_level import *
-from s3 import *
-from sns import *
-from spark import *
-from spark_partitions import *
-from state import *
\ No newline at end of file
+# convergdb loads its modules when one of their names is first used, so
+# that importing the package does not import spark or boto3. job scripts
+# only need source_to_target, which loads the whole driver.
+import importlib
+import sys
+import types
+
+# the public api, as the module defining each name
+public_api = {
+  "convergdb_log": "convergdb_logging",
+  "aws_client": "aws",
+  "source_to_target": "high_level",
+  "remove_batch": "high_level",
+  "fan_out_source_to_target": "fan_out",
+  "run_worker": "worker",
+  "sqs_queue": "worker",
+  "file_queue": "worker",
+  "memory_queue": "worker",
+  "queue_from_url": "worker",
+  "lock": "locking",
+  "planned_chunk_count": "planner",
+  "planned_spark_partitions": "planner",
+  "estimated_load_seconds": "planner",
+  "run_budget": "planner",
+  "plan_source_to_target": "dry_run",
+  "plan_json": "dry_run",
+  "start_trace": "tracing",
+  "finish_trace": "tracing",
+  "span": "tracing",
+  "annotate_span": "tracing",
+  "performance_report": "tracing",
+  "start_s3_governor": "s3_governor",
+  "stop_s3_governor": "s3_governor",
+  "s3_governor_counters": "s3_governor",
+  "start_recording": "cassette",
+  "stop_recording": "cassette",
+  "read_cassette": "cassette",
+  "start_replay": "cassette",
+  "stop_replay": "cassette"
+}
+
+__all__ = sorted(public_api.keys())
+
+def load_module(name):
+  return importlib.import_module(__name__ + '.' + name)
+
+# only the public api is resolved here. other names are imported from the
+# module that defines them, e.g. from convergdb.planner import budget_allows.
+# submodules are attributes of the package once they have been imported.
+class LazyPackage(types.ModuleType):
+  def __getattr__(self, name):
+    if not name in public_api:
+      raise AttributeError("module 'convergdb' has no attribute '" + name + "'")
+    return getattr(load_module(public_api[name]), name)
+
+  def __dir__(self):
+    return sorted(set(vars(self).keys() + __all__))
+
+package = LazyPackage(__name__, __doc__)
+package.__dict__.update(globals())
+# the replaced module is kept, because python 2 clears the globals of a
+# module when it is collected, and the functions above still use them.
+package._module = sys.modules[__name__]
+sys.modules[__name__] = package
@@ -1,4 +1,4 @@
-import boto3
+from convergdb.aws import aws_client
 import re
 import functools
 from multiprocessing import Pool
@@ -47,7 +47,7 @@ def memoize(func):
 @memoize
 def get_table_metadata(database_name, table_name, region):
   print "getting metadata for table " + database_name + '.' + table_name
-  client = boto3.client('glue', region_name=region)
+  client = aws_client('glue', region)
   table_metadata = client.get_table(
     DatabaseName=database_name,
     Name=table_name
@@ -117,7 +117,7 @@ def write_partition(params):
     
     storage_descriptor = table_metadata['Table']['StorageDescriptor']
     storage_descriptor['Location'] = location
-    client = boto3.client('glue', region_name=region)
+    client = aws_client('glue', region)
     response = client.create_partition(
         DatabaseName=database,
         TableName=table,
@@ -137,7 +137,7 @@ def write_partition(params):
 def s3_list_objects_for_prefix(bucket, prefix, region):
   print('searching for prefix ' + prefix + ' in bucket ' + bucket)
   ret = []
-  client = boto3.client('s3', region_name = region)
+  client = aws_client('s3', region)
   paginator = client.get_paginator('list_objects_v2')
   page_iterator = paginator.paginate(
     Bucket = bucket,
@@ -171,9 +171,21 @@ def keys_are_valid(s3_keys):
     )
   )
 
-def update_all_partitions(bucket, prefix, region):
-  print 'updating partition information...'
+# number of keys written by the given batch
+def batch_file_count(s3_keys, batch_id):
+  marker = "/convergdb_batch_id=" + batch_id + "/"
+  return len(
+    list(
+      filter(
+        lambda k: ("/" + k).find(marker) > -1,
+        s3_keys
+      )
+    )
+  )
 
+# returns the valid keys found under the prefix, and a dict of the
+# partitions they are in. nothing is registered.
+def storage_partitions(bucket, prefix, region):
   keys = keys_are_valid(
     keys_from_s3_object_list(
       s3_list_objects_for_prefix(
@@ -185,8 +197,6 @@ def update_all_partitions(bucket, prefix, region):
   )
   print 'found ' + str(len(keys)) + ' objects'
   h = {}
-  
-  client = boto3.client('glue', region_name=region)
 
   for k in keys:
     try:
@@ -199,9 +209,16 @@ def update_all_partitions(bucket, prefix, region):
         h[a['partition']] = a
     except Exception as error:
       pass
-  
+
   print 'found ' + str(len(h.keys())) + ' partitions'
-  
+  return (keys, h)
+
+# returns the valid keys found under the prefix.
+def update_all_partitions(bucket, prefix, region):
+  print 'updating partition information...'
+
+  keys, h = storage_partitions(bucket, prefix, region)
+
   partitions = []
   for k in h.keys():
     partitions.append(
@@ -218,3 +235,4 @@ def update_all_partitions(bucket, prefix, region):
   for i in results:
     print i
 
+  return keys
@@ -0,0 +1,535 @@
+# !PYARROW DATA LOAD
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.s3 import get_s3_object, s3_url_to_bucket_prefix, stream_to_s3
+from convergdb.tracing import annotate_span, span
+
+import bz2
+import datetime
+import decimal
+import json
+import re
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+# pyarrow is imported when a batch is small enough to be loaded without
+# spark, so that the jobs of other relations do not pay for it.
+pyarrow = None
+
+def import_pyarrow():
+  global pyarrow
+  try:
+    import pyarrow
+    import pyarrow.parquet
+  except ImportError:
+    pyarrow = None
+  return pyarrow
+
+# batches with an estimated uncompressed size up to fast_load_max_bytes are
+# loaded in the driver with pyarrow instead of spark, which saves the
+# scheduling of spark jobs for relations that load a few megabytes per run.
+# the arrow engine applies the same expressions, casts and null rejection
+# as batch_dataframe, and writes the same partitioned parquet. anything it
+# can not load exactly like spark would, it leaves to spark: this is
+# decided before anything is written, so a batch is never loaded by both.
+
+class ArrowLoadUnsupported(Exception):
+  pass
+
+def fast_load_max_bytes(structure):
+  return int(structure.get("fast_load_max_bytes", 0))
+
+def unsupported(reason):
+  raise ArrowLoadUnsupported(reason)
+
+# !STRUCTURE CHECKS
+
+identifier_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# keys that spark reads and reports in input_file_name without escaping
+plain_path_re = re.compile(r'^s3a://[A-Za-z0-9._\-]+/[A-Za-z0-9/._\-=]+$')
+
+# extensions of compression codecs that hadoop would apply
+other_codec_re = re.compile(r'\.(deflate|snappy|lz4|zst|zstd)$')
+
+integer_types = {
+  'byte': (-2**7, 2**7 - 1),
+  'short': (-2**15, 2**15 - 1),
+  'integer': (-2**31, 2**31 - 1),
+  'long': (-2**63, 2**63 - 1)
+}
+
+decimal_type_re = re.compile(r'^decimal\((\d+),(\d+)\)$')
+
+def supported_cast_type(cast_type):
+  return (cast_type in ['string', 'boolean', 'float', 'double', 'date', 'timestamp']) or (cast_type in integer_types) or (decimal_type_re.match(cast_type) != None)
+
+# partition values that spark writes as their plain string value
+partition_cast_types = ['string', 'boolean', 'date'] + list(integer_types.keys())
+
+def source_expression(attribute):
+  if attribute['expression'] == None:
+    return attribute['name']
+  return attribute['expression']
+
+# the column a target attribute reads, from the source attribute names and
+# convergdb_source_file_name. names resolve without regard to case, as
+# they do in selectExpr.
+def target_column(attribute, source_types):
+  exp = attribute['expression'] or attribute['name']
+  if identifier_re.match(exp) == None:
+    unsupported("target expression " + exp)
+  matches = [n for n in source_types if n.lower() == exp.lower()]
+  if len(matches) != 1:
+    unsupported("target expression " + exp + " does not name one source column")
+  return matches[0]
+
+# columns of the rows written for the batch, in partitionBy order
+def arrow_partition_columns(structure):
+  ret = list(structure["partitions"])
+  if not 'convergdb_batch_id' in ret:
+    ret.append('convergdb_batch_id')
+  return ret
+
+# raises ArrowLoadUnsupported unless the relation can be loaded by the
+# arrow engine. returns the plan of the load.
+def arrow_load_plan(structure):
+  if import_pyarrow() == None:
+    unsupported("pyarrow is not installed")
+  source = structure["source_structure"]
+  if source['storage_format'] != 'json':
+    unsupported(source['storage_format'] + " sources")
+  if structure['storage_format'] != 'parquet':
+    unsupported(structure['storage_format'] + " storage")
+
+  paths = []
+  source_types = OrderedDict()
+  for a in source['attributes']:
+    path = source_expression(a).split('.')
+    if not all([identifier_re.match(p) for p in path]):
+      unsupported("source expression " + source_expression(a))
+    if not supported_cast_type(a['cast_type']):
+      unsupported("cast to " + a['cast_type'])
+    if a['name'].lower() in [n.lower() for n in source_types]:
+      unsupported("source attribute names differ only by case")
+    paths.append(path)
+    source_types[a['name']] = a['cast_type']
+  # a path that is also a struct of another path is read as json text
+  for p in paths:
+    for q in paths:
+      if (len(p) < len(q)) and (q[0:len(p)] == p):
+        unsupported("source expression " + '.'.join(p) + " is a struct")
+  source_types['convergdb_source_file_name'] = 'string'
+
+  columns = []
+  for a in structure['attributes']:
+    column = target_column(a, source_types)
+    if not supported_cast_type(a['cast_type']):
+      unsupported("cast to " + a['cast_type'])
+    if not source_types[column] in ['string', a['cast_type']]:
+      unsupported("cast from " + source_types[column] + " to " + a['cast_type'])
+    columns.append(column)
+
+  target_types = dict([(a['name'], a['cast_type']) for a in structure['attributes']])
+  for p in structure['partitions']:
+    if target_types.get(p, None) not in partition_cast_types:
+      unsupported("partition column " + p)
+
+  return {
+    "paths": paths,
+    "source_types": source_types,
+    "target_columns": columns
+  }
+
+# !READING
+
+# hadoop reads concatenated gzip and bzip2 streams as one file
+def decompress_all(data, new_decompressor):
+  ret = []
+  while len(data) > 0:
+    d = new_decompressor()
+    ret.append(d.decompress(data))
+    if hasattr(d, 'flush'):
+      ret.append(d.flush())
+    data = d.unused_data
+  return ''.join(ret)
+
+def decompressed_source(key, data):
+  if key.endswith('.gz'):
+    return decompress_all(data, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+  elif key.endswith('.bz2'):
+    return decompress_all(data, bz2.BZ2Decompressor)
+  elif other_codec_re.search(key):
+    unsupported("compression of " + key)
+  return data
+
+# marks json numbers with a fraction or exponent. spark writes them as
+# java would print the double, which is left to spark.
+json_float = object()
+
+def reject_json_constant(name):
+  unsupported("json constant " + name)
+
+def parsed_json_line(line):
+  try:
+    record = json.loads(
+      line,
+      parse_float=lambda s: json_float,
+      parse_constant=reject_json_constant
+    )
+  except ValueError:
+    unsupported("malformed json record")
+  if not isinstance(record, dict):
+    unsupported("json record that is not an object")
+  return record
+
+# the string spark reads for a field with a string schema
+def json_leaf_text(value):
+  if value == None:
+    return None
+  elif isinstance(value, bool):
+    return u'true' if value else u'false'
+  elif isinstance(value, (int, long)):
+    return unicode(value)
+  elif isinstance(value, basestring):
+    return value
+  unsupported("json value that spark reads as json text")
+
+def json_path_value(record, path):
+  value = record
+  for p in path:
+    if value == None:
+      return None
+    if not isinstance(value, dict):
+      unsupported("json value that is not a struct")
+    value = value.get(p, None)
+  return json_leaf_text(value)
+
+# source rows of one json file, as lists in the order of the paths
+def json_source_rows(text, paths):
+  ret = []
+  for line in text.splitlines():
+    if line.strip() == '':
+      continue
+    record = parsed_json_line(line)
+    ret.append([json_path_value(record, p) for p in paths])
+  return ret
+
+# !CASTING
+
+integer_text_re = re.compile(r'^[+-]?\d+(\.\d+)?$')
+not_integer_re = re.compile(r'[^0-9+\-.\s]')
+number_text_re = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+date_text_re = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+timestamp_text_re = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})[ T](\d{1,2}):(\d{2}):(\d{2})(\.\d{1,6})?$')
+
+true_strings = ['t', 'true', 'y', 'yes', '1']
+false_strings = ['f', 'false', 'n', 'no', '0']
+
+def cast_boolean(text):
+  if text.strip() != text:
+    unsupported("boolean with surrounding whitespace")
+  if text.lower() in true_strings:
+    return True
+  elif text.lower() in false_strings:
+    return False
+  return None
+
+# spark truncates the fraction and returns null for text that is not a
+# number or does not fit the type.
+def cast_integer(text, cast_type):
+  if integer_text_re.match(text):
+    v = int(text.split('.')[0])
+    low, high = integer_types[cast_type]
+    if (v < low) or (v > high):
+      return None
+    return v
+  if (text == '') or not_integer_re.search(text):
+    return None
+  unsupported("integer text " + text)
+
+def cast_float(text):
+  if number_text_re.match(text):
+    return float(text)
+  if text == '':
+    return None
+  unsupported("floating point text " + text)
+
+def cast_decimal(text, precision, scale):
+  if text == '':
+    return None
+  if not number_text_re.match(text):
+    unsupported("decimal text " + text)
+  with decimal.localcontext() as c:
+    c.prec = 2 * max(precision, 38)
+    try:
+      v = decimal.Decimal(text).quantize(
+        decimal.Decimal(1).scaleb(-scale),
+        rounding=decimal.ROUND_HALF_UP
+      )
+    except decimal.InvalidOperation:
+      return None
+  if v.adjusted() >= precision - scale:
+    return None
+  return v
+
+def cast_date(text):
+  if text == '':
+    return None
+  m = date_text_re.match(text)
+  if m == None:
+    unsupported("date text " + text)
+  try:
+    return datetime.date(*[int(g) for g in m.groups()])
+  except ValueError:
+    unsupported("invalid date " + text)
+
+# timestamps are read as UTC, the time zone of the jobs convergdb creates
+def cast_timestamp(text):
+  if text == '':
+    return None
+  m = date_text_re.match(text)
+  if m != None:
+    fields = [int(g) for g in m.groups()]
+  else:
+    m = timestamp_text_re.match(text)
+    if m == None:
+      unsupported("timestamp text " + text)
+    fields = [int(g) for g in m.groups()[0:6]]
+    if m.group(7) != None:
+      fields.append(int(m.group(7)[1:].ljust(6, '0')))
+  try:
+    return datetime.datetime(*fields)
+  except ValueError:
+    unsupported("invalid timestamp " + text)
+
+def cast_text(text, cast_type):
+  if text == None:
+    return None
+  if cast_type == 'string':
+    return text
+  elif cast_type == 'boolean':
+    return cast_boolean(text)
+  elif cast_type in integer_types:
+    return cast_integer(text, cast_type)
+  elif cast_type in ['float', 'double']:
+    return cast_float(text)
+  elif cast_type == 'date':
+    return cast_date(text)
+  elif cast_type == 'timestamp':
+    return cast_timestamp(text)
+  m = decimal_type_re.match(cast_type)
+  return cast_decimal(text, int(m.group(1)), int(m.group(2)))
+
+# values that are already of the cast type are kept
+def cast_value(value, from_type, cast_type):
+  if from_type == cast_type:
+    return value
+  return cast_text(value, cast_type)
+
+# the null_reject filter. the conditions of reject_filter are joined with
+# or, so a row is kept when any required attribute is not null.
+def kept_row(row, required):
+  if len(required) == 0:
+    return True
+  return any([row[i] != None for i in required])
+
+def required_indices(attributes):
+  return [i for (i, a) in enumerate(attributes) if a["required"] == True]
+
+# !TRANSFORMATION
+
+# the rows written for the batch, from the source rows of each path. rows
+# are lists in the order of the target attributes.
+def arrow_batch_rows(structure, plan, sources):
+  source_attributes = structure["source_structure"]["attributes"]
+  source_required = required_indices(source_attributes)
+  target_required = required_indices(structure["attributes"])
+  names = list(plan["source_types"].keys())
+  target_indices = [names.index(c) for c in plan["target_columns"]]
+  ret = []
+  for (path, rows) in sources:
+    for r in rows:
+      s = [cast_text(r[i], a['cast_type']) for (i, a) in enumerate(source_attributes)]
+      if not kept_row(s, source_required):
+        continue
+      s.append(unicode(path))
+      t = []
+      for (a, i) in zip(structure["attributes"], target_indices):
+        t.append(cast_value(s[i], plan["source_types"][names[i]], a['cast_type']))
+      if kept_row(t, target_required):
+        ret.append(t)
+  return ret
+
+# !PARQUET OUTPUT
+
+# characters that spark escapes in partition folder names
+def escaped_path_character(c):
+  return (ord(c) < 0x20) or (c in '"#%\'*/:=?\\\x7f{[]^')
+
+def escape_path_name(text):
+  return ''.join(
+    [('%%%02X' % ord(c)) if escaped_path_character(c) else c for c in text]
+  )
+
+def partition_value_text(value):
+  if value == None:
+    return None
+  elif isinstance(value, bool):
+    return u'true' if value else u'false'
+  elif isinstance(value, datetime.date):
+    return unicode(value.isoformat())
+  return unicode(value)
+
+def partition_folder(names, values):
+  parts = []
+  for (n, v) in zip(names, values):
+    text = partition_value_text(v)
+    if (text == None) or (text == ''):
+      text = '__HIVE_DEFAULT_PARTITION__'
+    parts.append(n + '=' + escape_path_name(text))
+  return '/'.join(parts)
+
+def arrow_type(cast_type):
+  if cast_type == 'string':
+    return pyarrow.string()
+  elif cast_type == 'boolean':
+    return pyarrow.bool_()
+  elif cast_type == 'byte':
+    return pyarrow.int8()
+  elif cast_type == 'short':
+    return pyarrow.int16()
+  elif cast_type == 'integer':
+    return pyarrow.int32()
+  elif cast_type == 'long':
+    return pyarrow.int64()
+  elif cast_type == 'float':
+    return pyarrow.float32()
+  elif cast_type == 'double':
+    return pyarrow.float64()
+  elif cast_type == 'date':
+    return pyarrow.date32()
+  elif cast_type == 'timestamp':
+    return pyarrow.timestamp('us')
+  m = decimal_type_re.match(cast_type)
+  return pyarrow.decimal128(int(m.group(1)), int(m.group(2)))
+
+# spark keeps its own schema in the parquet metadata, so that spark reads
+# the files back with the same types.
+def spark_schema_json(attributes):
+  return json.dumps(
+    {
+      "type": "struct",
+      "fields": [
+        OrderedDict([("name", a["name"]), ("type", a["cast_type"]), ("nullable", True), ("metadata", {})]) for a in attributes
+      ]
+    },
+    separators=(',', ':')
+  )
+
+# parquet file of the rows, written like spark with the legacy format
+# that the glue jobs use: snappy, and timestamps as int96.
+def parquet_bytes(rows, attributes):
+  arrays = [
+    pyarrow.array([r[i] for r in rows], type=arrow_type(a["cast_type"])) for (i, a) in enumerate(attributes)
+  ]
+  table = pyarrow.Table.from_arrays(
+    arrays,
+    names=[a["name"] for a in attributes]
+  ).replace_schema_metadata(
+    {"org.apache.spark.sql.parquet.row.metadata": spark_schema_json(attributes)}
+  )
+  sink = pyarrow.BufferOutputStream()
+  pyarrow.parquet.write_table(
+    table,
+    sink,
+    compression='snappy',
+    use_deprecated_int96_timestamps=True
+  )
+  return sink.getvalue().to_pybytes()
+
+# a dict of s3 key to parquet bytes, one file for each partition folder
+def arrow_output_files(structure, rows, batch_id, job_id):
+  location = s3_url_to_bucket_prefix("s3://" + structure["storage_bucket"])
+  partitions = arrow_partition_columns(structure)
+  attributes = structure["attributes"] + [{"name": "convergdb_batch_id", "cast_type": "string"}]
+  positions = dict([(a["name"], i) for (i, a) in enumerate(attributes)])
+  data_attributes = [a for a in attributes if not a["name"] in partitions]
+  groups = OrderedDict()
+  for r in rows:
+    r = r + [unicode(batch_id)]
+    folder = partition_folder(partitions, [r[positions[p]] for p in partitions])
+    groups.setdefault(folder, []).append([r[positions[a["name"]]] for a in data_attributes])
+  prefix = location['prefix'].rstrip('/')
+  prefix = prefix + '/' if prefix != '' else ''
+  ret = OrderedDict()
+  for folder in groups:
+    key = prefix + folder + '/part-00000-' + job_id + '.c000.snappy.parquet'
+    ret[key] = parquet_bytes(groups[folder], data_attributes)
+  ret[prefix + '_SUCCESS'] = ''
+  return ret
+
+# !LOAD
+
+# reads and transforms the batch, and returns the files to write. raises
+# ArrowLoadUnsupported when spark has to load the batch.
+def prepare_arrow_load(structure, s3a_paths, batch_id, get_function=get_s3_object):
+  plan = arrow_load_plan(structure)
+  for p in s3a_paths:
+    if plain_path_re.match(p) == None:
+      unsupported("source path " + p)
+  sources = []
+  input_records = 0
+  with span("arrow_read") as s:
+    for p in s3a_paths:
+      location = s3_url_to_bucket_prefix(p)
+      text = decompressed_source(
+        location['prefix'],
+        get_function(location['bucket'], location['prefix'])
+      )
+      rows = json_source_rows(text, plan["paths"])
+      input_records += len(rows)
+      sources.append((p, rows))
+    annotate_span(s, items=input_records)
+  with span("arrow_transform") as s:
+    rows = arrow_batch_rows(structure, plan, sources)
+    files = arrow_output_files(structure, rows, batch_id, str(uuid.uuid4()))
+    annotate_span(s, items=len(rows))
+  return {
+    "files": files,
+    "input_records": input_records,
+    "output_records": len(rows)
+  }
+
+def write_arrow_load(structure, prepared, write_function=stream_to_s3):
+  bucket = structure["storage_bucket"].split('/')[0]
+  with span("write_partitions") as s:
+    for key in prepared["files"]:
+      write_function(bucket, key, prepared["files"][key])
+    annotate_span(s, bytes=sum([len(v) for v in prepared["files"].values()]), items=len(prepared["files"]))
+
+# loads the batch with the arrow engine, and returns metrics like those of
+# data_load. returns None when spark has to load the batch instead.
+def arrow_data_load(structure, s3a_paths, batch_id, total_bytes, get_function=get_s3_object, write_function=stream_to_s3):
+  st = time.time()
+  max_bytes = fast_load_max_bytes(structure)
+  if (max_bytes <= 0) or (total_bytes > max_bytes):
+    return None
+  try:
+    prepared = prepare_arrow_load(structure, s3a_paths, batch_id, get_function)
+  except Exception as e:
+    convergdb_log("loading batch with spark, the arrow engine does not support it: " + str(e))
+    return None
+  convergdb_log("loading batch " + batch_id + " of " + str(total_bytes) + " bytes with the arrow engine")
+  write_arrow_load(structure, prepared, write_function)
+  et = time.time()
+  convergdb_log("arrow data load completed in " + str(et - st) + " seconds")
+  return {
+    "engine": "arrow",
+    "input_records": prepared["input_records"],
+    "output_records": prepared["output_records"],
+    "output_bytes": sum([len(v) for v in prepared["files"].values()]),
+    "spark_partitions": None,
+    "duration": et - st
+  }
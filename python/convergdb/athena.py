@@ -1,21 +1,14 @@
-from convergdb_logging import *
-from batch_control import *
-
-from athena import *
-from cloudwatch import *
-from glue import *
-from s3 import *
-from sns import *
-from spark_partitions import *
-from spark import *
-from state import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+
+import time
 from string import Template
 
 def initiate_athena_query(query, database, s3_output, region, retries=3):
   for retry in range(0, retries):
     try:
       convergdb_log("asynchronously executing: " + query + " on database " + database + " to " + s3_output)
-      client = boto3.client('athena', region_name = region)
+      client = aws_client('athena', region)
       response = client.start_query_execution(
         QueryString=query,
         QueryExecutionContext={
@@ -34,7 +27,7 @@ def initiate_athena_query(query, database, s3_output, region, retries=3):
       convergdb_log("retrying...")
 
 def wait_for_athena_query_execution(execution_id, region, retries = 3):
-  client = boto3.client('athena', region_name = region)
+  client = aws_client('athena', region)
   st = time.time()
   for retry in range(0,retries):
     try:
@@ -116,7 +109,7 @@ def row_to_dict(row, headers):
 def athena_results_to_list(execution_id, region, dict_transform_function=row_to_dict):
   st = time.time()
   ret = []
-  client = boto3.client('athena', region_name = region)
+  client = aws_client('athena', region)
   paginator = client.get_paginator('get_query_results')
   page_iterator = paginator.paginate(
     QueryExecutionId = execution_id
@@ -145,7 +138,7 @@ def athena_query_to_list(query, database, s3_location, region, dict_transform_fu
   )
 
 def athena_results_csv_s3_path(execution_id, region):
-  client = boto3.client('athena', region_name = region)
+  client = aws_client('athena', region)
   resp = client.get_query_execution(
     QueryExecutionId = execution_id
   )
@@ -165,7 +158,7 @@ def athena_table_name(full_relation_name):
   return full_relation_name.split('.')[3]
 
 def athena_describe_table(database, table, region):
-  client = boto3.client('glue', region_name = region)
+  client = aws_client('glue', region)
   t = client.get_table(
     DatabaseName = database,
     Name = table
@@ -0,0 +1,53 @@
+import os
+import threading
+
+# !AWS CLIENTS
+
+# boto3 is imported when the first client is created rather than when
+# convergdb is imported, because it takes longer to import than most of
+# what a planning or diff call needs.
+
+# clients are created once for each process, service and region, and kept
+# for the life of the process. a warm worker runs many relations with the
+# same clients. processes forked for the partition writers create their
+# own, because a client can not be shared across a fork.
+aws_clients = {}
+aws_clients_lock = threading.Lock()
+aws_clients_lock_pid = os.getpid()
+
+# a lock held by another thread when the process forks is never released
+# in the child, so a forked process replaces it before its first use.
+def clients_lock():
+  global aws_clients_lock, aws_clients_lock_pid
+  if aws_clients_lock_pid != os.getpid():
+    aws_clients_lock = threading.Lock()
+    aws_clients_lock_pid = os.getpid()
+  return aws_clients_lock
+
+# clients are slow to create, so they are created outside of the lock. two
+# threads may both create one, and the first to be stored is used.
+def aws_client(service, region=None):
+  key = (os.getpid(), service, region)
+  client = aws_clients.get(key)
+  if client != None:
+    return client
+  client = new_aws_client(service, region)
+  with clients_lock():
+    return aws_clients.setdefault(key, client)
+
+def new_aws_client(service, region=None):
+  import boto3
+  if region == None:
+    return boto3.client(service)
+  return boto3.client(service, region_name=region)
+
+# clients copy the event hooks of the session when they are created, so
+# they are dropped whenever a hook is added to or removed from the session.
+def clear_aws_clients():
+  with clients_lock():
+    aws_clients.clear()
+
+# the boto3 session that aws_client creates its clients from
+def default_session():
+  import boto3
+  return boto3._get_default_session()
@@ -2,16 +2,25 @@
 import time
 import json
 
-from convergdb_logging import *
-
-from athena import *
-from cloudwatch import *
-from glue import *
-from s3 import *
-from sns import *
-from spark_partitions import *
-from spark import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.athena import (
+  athena_describe_table,
+  athena_query_to_list,
+  athena_results_csv_s3_path,
+  has_attribute,
+  run_athena_query,
+  tmp_results_location
+)
+from convergdb.diff_order import last_modified_needed
+from convergdb.s3 import (
+  gzip_records_to_s3,
+  reader_lines,
+  s3_object_reader,
+  s3_search_to_list
+)
 from functools import reduce
+from string import Template
 import re
 
 # !UTILITIES
@@ -27,13 +36,40 @@ def sql_utc_timestamp(utc_time):
 
 def add_control_file(bucket, key, body):
   convergdb_log("adding control file: " + key)
-  client = boto3.client('s3')
+  client = aws_client('s3')
   response = client.put_object(
     Body = body,
     Bucket = bucket,
     Key = key
   )
 
+# !RESOURCE FAILURES
+
+# fragments of error messages that indicate a chunk was too large for the
+# resources available to spark. these chunks can be retried in smaller pieces.
+resource_failure_messages = [
+  'java.lang.OutOfMemoryError',
+  'GC overhead limit exceeded',
+  'ExecutorLostFailure',
+  'exceeding memory limits',
+  'No space left on device'
+]
+
+def is_resource_failure(error, messages=resource_failure_messages):
+  text = str(error)
+  for m in messages:
+    if m in text:
+      return True
+  return False
+
+# chunks at or below this number of files are not split any further
+def minimum_split_file_count(structure):
+  return int(structure.get("minimum_split_file_count", 1))
+
+# true if a failed chunk should be cleaned up and loaded again in two halves
+def can_split_batch(structure, diff, error):
+  return is_resource_failure(error) and (len(diff) > minimum_split_file_count(structure))
+
 # !FILE SIZING AND ESTIMATES
 
 # calculate total size for all files in the list
@@ -71,14 +107,22 @@ def uncompressed_estimate(
   else:
     return file_record["size"]
 
-# returns the total estimated uncompressed size of all files in the list
-def file_estimated_sizing(file_dict_list):
+# returns the total estimated uncompressed size of all files in the list.
+# factors is an optional dict of measured ratios by compression type.
+def file_estimated_sizing(file_dict_list, factors={}):
   if len(file_dict_list) == 0:
     return 0
   else:
     return reduce(
       (lambda a,b: a + b),
-      map(lambda v: uncompressed_estimate(v), file_dict_list)
+      map(
+        lambda v: uncompressed_estimate(
+          v,
+          gz_factor=factors.get('gz', gz_factor),
+          bz2_factor=factors.get('bz2', bz2_factor)
+        ),
+        file_dict_list
+      )
     )
 
 # !FILE LIST HANDLING
@@ -120,7 +164,15 @@ def aws_api_based_diff(structure):
   convergdb_log("retrieving loaded files from the control table...")
   loaded = loaded_files(structure)
   convergdb_log("loaded objects: " + str(len(loaded)))
-  
+
+  d = unloaded_files(available, loaded)
+
+  e = time.time()
+  convergdb_log("AWS API based diff took " + str(e - s) + " seconds")
+  return d
+
+# returns the available files that are not in the loaded dict
+def unloaded_files(available, loaded):
   # regex compiled for efficiency
   folder_match = re.compile(r'\/$')
   
@@ -138,9 +190,6 @@ def aws_api_based_diff(structure):
     else:
       # file needs to be loaded
       d.append(f)
-
-  e = time.time()
-  convergdb_log("AWS API based diff took " + str(e - s) + " seconds")
   return d
 
 # returns a set of available files using the AWS API
@@ -200,44 +249,66 @@ def s3_file_loaded_record(structure, file_path, batch_id, start_time, end_time):
 def control_file_key(structure, batch_id):
   return structure["deployment_id"] + "/state/" + structure["full_relation_name"] + "/control/" + str(batch_id) + ".json.gz"
 
+# the folder holding all control files of the relation, which is the
+# location of the control table.
+def control_folder_key(structure):
+  return structure["deployment_id"] + "/state/" + structure["full_relation_name"] + "/control/"
+
+# generates the records that need to be written into the control table for
+# this batch, one at a time.
+def file_loaded_record_lines(structure, keys_loaded, batch_id, start_time, end_time):
+  for k in keys_loaded:
+    yield json.dumps(
+      s3_file_loaded_record(
+        structure,
+        k,
+        batch_id,
+        start_time,
+        end_time
+      ),
+      sort_keys=True # added for unit testing
+    )
+
 # creates a list of all records that need to be written into the control table
 # for this batch.
 def file_loaded_records(structure, keys_loaded, batch_id, start_time, end_time):
-  recs = []
-  for k in keys_loaded:
-    recs.append(
-      json.dumps(
-        s3_file_loaded_record(
-          structure,
-          k,
-          batch_id,
-          start_time,
-          end_time
-        ),
-        sort_keys=True # added for unit testing
-      )
+  return list(
+    file_loaded_record_lines(
+      structure,
+      keys_loaded,
+      batch_id,
+      start_time,
+      end_time
     )
-  return recs
+  )
 
-# very stateful... writes control records to a gzipped file in S3
+# very stateful... writes control records to a gzipped file in S3. recs may
+# be any iterable, and are compressed and uploaded as they are generated.
+# returns the number of records written.
 def write_control_records(structure, batch_id, recs):
-  convergdb_log("writing " + str(len(recs)) + " control records")
-  gzip_to_s3(
+  key = control_file_key(structure, batch_id)
+  convergdb_log("writing control records to s3://" + structure["state_bucket"] + "/" + key)
+  count = gzip_records_to_s3(
     structure["state_bucket"],
-    control_file_key(structure, batch_id),
-    "\n".join(recs)
+    key,
+    recs
   )
+  convergdb_log("wrote " + str(count) + " control records")
+  return count
 
 # !ATHENA QUERY BASED DIFF
 
 # this function is optimized for the diff queries used by convergdb. it is
-# expected that there are 2 columns in the file, key and size.
+# expected that there are 2 columns in the file, key and size, or 3 when
+# the query selects the last modified time.
 # first row is skipped because the header is included in the results from
-# athena. the last row also requires special handling.
-def control_query_diff_from_csv(csv_path, region):
-  csv = get_s3_object(csv_path['bucket'], csv_path['key'])
+# athena. the last row also requires special handling. the results are
+# read in parallel ranges and parsed a line at a time, without holding
+# another copy of the whole file.
+def control_query_diff_from_csv(csv_path, region, reader_function=s3_object_reader):
+  csv = reader_function(csv_path['bucket'], csv_path['key'])
   ret = []
-  for line in csv.decode('utf-8').split("\n"):
+  for line in reader_lines(csv):
     # this format should be command delimited after removing quotes
     l = line.replace('"','').split(',')
     # last row
@@ -246,12 +317,14 @@ def control_query_diff_from_csv(csv_path, region):
     # header row
     if l[1] == "size":
       continue
-    ret.append(
-      {
-        "key": l[0],
-        "size": int(l[1])
-      }
-    )
+    d = {
+      "key": l[0],
+      "size": int(l[1])
+    }
+    # empty when the inventory has no time for the key
+    if (len(l) > 2) and (l[2] != ''):
+      d["last_modified"] = l[2]
+    ret.append(d)
   return ret
 
 # returns the table that should be used for inventory.
@@ -300,8 +373,9 @@ def inventory_query_function(structure):
   else:
     return streaming_inventory_query
 
-# NEW version
-def aws_athena_based_diff(structure):
+# NEW version. refresh_partitions false leaves the partitions of an s3
+# inventory table as they are, so only the diff query is run.
+def aws_athena_based_diff(structure, refresh_partitions=True):
   # use inventory athena query instead of API based search
   convergdb_log("using athena query based control diff computation...")
   # get attributes of inventory table
@@ -309,7 +383,7 @@ def aws_athena_based_diff(structure):
 
   # s3 based inventory tables require a synchronous
   # partition refresh in order to get the correct information
-  if athena_inventory_type(structure) == 's3':
+  if refresh_partitions and (athena_inventory_type(structure) == 's3'):
     try:
       # wrapped in a try block in case multiple ETL jobs step on each other
       # trying to refresh the partitions at the same time
@@ -360,12 +434,14 @@ def diff_approaches(inventory_source_type, source_structure):
   return x[inventory_source_type]
 
 # calculates the diff between available and loaded files
-def file_diff(structure):
+def file_diff(structure, refresh_partitions=True):
   convergdb_log("computing diff between control table and source data...")
   diff_function = diff_approaches(
     structure["inventory_source"],
     structure["source_structure"]
   )
+  if diff_function == aws_athena_based_diff:
+    return diff_function(structure, refresh_partitions)
   return diff_function(structure)
 
 def where_clause(structure, inventory_attributes):
@@ -394,7 +470,7 @@ def s3_inventory_query(structure, inv_table_function=inventory_table_attributes)
 with i as
   (select
     key,
-    size
+    size$inventory_last_modified
   from
     $inventory_table
   where
@@ -409,7 +485,7 @@ c as
 diff as
   (select
     i.key,
-    i.size,
+    i.size,$diff_last_modified
     c.source_key
   from
     i
@@ -421,19 +497,25 @@ diff as
     c.source_key is null)
 select
   key
-  ,size
+  ,size$select_last_modified
 from
   diff;
 """)
+  attributes = inv_table_function(structure)
+  # last_modified_date is an optional field of s3 inventory reports
+  last_modified = last_modified_needed(structure) and has_attribute(attributes, 'last_modified_date')
   return t.substitute(
     inventory_table = inventory_table(structure),
     predicates = ' and '.join(
       where_clause(
         structure,
-        inv_table_function(structure)
+        attributes
       )
     ),
-    control_table = structure["control_table"]
+    control_table = structure["control_table"],
+    inventory_last_modified = ",\n    last_modified_date as last_modified" if last_modified else "",
+    diff_last_modified = "\n    i.last_modified," if last_modified else "",
+    select_last_modified = "\n  ,last_modified" if last_modified else ""
   )
 
 # creates the sql query for use in athena when streaming inventory
@@ -457,7 +539,7 @@ streaming_inventory as
 (
   select
     "key"
-    ,size
+    ,size$inventory_last_modified
   from
     $inventory_table inv
   where
@@ -478,7 +560,7 @@ control as
 diff as
   (select
     i.key,
-    i.size,
+    i.size,$diff_last_modified
     c.source_key
   from
     streaming_inventory i
@@ -490,10 +572,11 @@ diff as
     c.source_key is null)
 select
   key,
-  size
+  size$select_last_modified
 from
   diff;
 """)
+  last_modified = last_modified_needed(structure)
   return t.substitute(
     inventory_table = inventory_table(structure),
     predicates = ' and '.join(
@@ -502,5 +585,8 @@ from
         inv_table_function(structure)
       )
     ),
-    control_table = structure["control_table"]
+    control_table = structure["control_table"],
+    inventory_last_modified = "\n    ,last_modified_timestamp as last_modified" if last_modified else "",
+    diff_last_modified = "\n    i.last_modified," if last_modified else "",
+    select_last_modified = ",\n  last_modified" if last_modified else ""
   )
\ No newline at end of file
@@ -0,0 +1,343 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import clear_aws_clients, default_session
+from convergdb.s3 import gzip_chunks, stream_to_s3
+from convergdb.state import state_folder_prefix
+
+import base64
+import copy
+import cStringIO
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+from dateutil import parser as date_parser
+
+# !AWS RECORD AND REPLAY
+
+# a cassette holds every AWS request made during a run with its response,
+# in the order they were made. cassettes are recorded through the botocore
+# event hooks of the default boto3 session, so every client that convergdb
+# creates is covered.
+
+cassette_version = 1
+
+# recording can be turned on for every relation of a job with this
+# environment variable, or for one relation in its structure.
+cassette_environment_variable = 'CONVERGDB_RECORD_CASSETTE'
+
+# operations that change AWS rather than read from it. when replayed
+# requests of these kinds do not match the cassette, they succeed with a
+# synthetic response, because their parameters usually contain timestamps.
+write_operation_prefixes = [
+  'Put', 'Delete', 'Create', 'Update', 'Publish', 'Upload',
+  'CompleteMultipart', 'AbortMultipart', 'BatchCreate'
+]
+
+def cassette_recording_enabled(structure, environ=os.environ):
+  flag = structure.get(
+    "record_cassette",
+    environ.get(cassette_environment_variable, "false")
+  )
+  return str(flag).lower() in ["true", "1"]
+
+# literal strings replaced throughout the cassette, as a list of
+# [literal, placeholder] pairs. the same pairs are applied to the structure
+# when replaying, so a redacted cassette replays consistently.
+def cassette_redactions(structure):
+  return structure.get("cassette_redactions", [])
+
+def redact(text, redactions):
+  for r in redactions:
+    text = text.replace(r[0], r[1])
+  return text
+
+# json encoding of botocore responses, which contain datetimes and bytes
+def encode_value(v):
+  if isinstance(v, datetime.datetime):
+    return {"__datetime__": v.isoformat()}
+  elif isinstance(v, dict):
+    return dict([(k, encode_value(v[k])) for k in v])
+  elif isinstance(v, list) or isinstance(v, tuple):
+    return [encode_value(i) for i in v]
+  else:
+    return v
+
+def decode_value(v):
+  if isinstance(v, dict):
+    if "__datetime__" in v:
+      return date_parser.parse(v["__datetime__"])
+    return dict([(k, decode_value(v[k])) for k in v])
+  elif isinstance(v, list):
+    return [decode_value(i) for i in v]
+  else:
+    return v
+
+# request parameters as recorded and matched. bodies and file objects are
+# left out because they can not be compared.
+def request_params(params):
+  ret = {}
+  for k in params:
+    if k != 'Body':
+      ret[k] = params[k]
+  return encode_value(ret)
+
+def interaction_key(service, operation, params):
+  return service + '.' + operation + ' ' + json.dumps(params, sort_keys=True)
+
+def is_write_operation(operation):
+  for p in write_operation_prefixes:
+    if operation.startswith(p):
+      return True
+  return False
+
+# response bodies are written to a temp file as they are recorded, and
+# read back one at a time when the cassette is written, so that a run
+# holds no more of them in memory than it would without recording. the
+# temp file grows by the size of every body read during the run.
+def new_recorder():
+  return {
+    "interactions": [],
+    "bodies": tempfile.TemporaryFile(),
+    "lock": threading.Lock(),
+    "session": None
+  }
+
+# appends a body to the temp file of the recorder. returns its offset.
+def spool_body(recorder, data):
+  with recorder["lock"]:
+    recorder["bodies"].seek(0, 2)
+    offset = recorder["bodies"].tell()
+    recorder["bodies"].write(data)
+  return offset
+
+# the recorded interactions, with the base64 body of each read back from
+# the temp file.
+def recorded_interactions(recorder):
+  for i in recorder["interactions"]:
+    if not "body_offset" in i:
+      yield i
+      continue
+    with recorder["lock"]:
+      recorder["bodies"].seek(i["body_offset"])
+      data = recorder["bodies"].read(i["body_length"])
+    ret = dict(i)
+    del ret["body_offset"]
+    del ret["body_length"]
+    ret["body"] = base64.b64encode(data)
+    yield ret
+
+def record_params_handler(params, context, **kwargs):
+  context['convergdb_params'] = request_params(params)
+
+# records a response. streaming bodies are read, spooled to the temp file
+# of the recorder, and replaced with a new stream so that the caller can
+# still read them.
+def record_response_handler(recorder):
+  def handler(http_response, parsed, model, context, **kwargs):
+    response = {}
+    body = None
+    for k in parsed:
+      # botocore url decodes listed keys before this handler runs. the
+      # encoding type is left out so that replayed keys are not decoded
+      # a second time.
+      if k in ['ResponseMetadata', 'EncodingType']:
+        continue
+      elif isinstance(parsed[k], StreamingBody):
+        data = parsed[k].read()
+        parsed[k] = StreamingBody(io.BytesIO(data), len(data))
+        body = (k, data)
+      else:
+        response[k] = parsed[k]
+    interaction = {
+      "service": model.service_model.service_name,
+      "operation": model.name,
+      "params": context.get('convergdb_params', {}),
+      "status": http_response.status_code,
+      "response": encode_value(copy.deepcopy(response))
+    }
+    if body != None:
+      interaction["body_field"] = body[0]
+      interaction["body_offset"] = spool_body(recorder, body[1])
+      interaction["body_length"] = len(body[1])
+    with recorder["lock"]:
+      recorder["interactions"].append(interaction)
+  return handler
+
+# starts recording every AWS call made through the default boto3 session
+def start_recording(session=None):
+  recorder = new_recorder()
+  recorder["session"] = session or default_session()
+  recorder["response_handler"] = record_response_handler(recorder)
+  recorder["session"].events.register(
+    'before-parameter-build',
+    record_params_handler,
+    unique_id='convergdb-cassette-params'
+  )
+  recorder["session"].events.register(
+    'after-call',
+    recorder["response_handler"],
+    unique_id='convergdb-cassette-record'
+  )
+  clear_aws_clients()
+  return recorder
+
+def stop_recording(recorder):
+  recorder["session"].events.unregister('before-parameter-build', unique_id='convergdb-cassette-params')
+  recorder["session"].events.unregister('after-call', unique_id='convergdb-cassette-record')
+  clear_aws_clients()
+  return recorder
+
+# redacts one interaction, including its object body
+def redacted_interaction(interaction, redactions):
+  if len(redactions) == 0:
+    return json.dumps(interaction)
+  i = dict(interaction)
+  if "body" in i:
+    i["body"] = base64.b64encode(redact(base64.b64decode(i["body"]), redactions))
+  return redact(json.dumps(i), redactions)
+
+# the cassette json, generated one interaction at a time with redactions
+# applied to everything including object bodies.
+def cassette_json_chunks(structure_json, interactions, redactions=[]):
+  yield '{"version": ' + json.dumps(cassette_version)
+  yield ', "structure": ' + redact(json.dumps(structure_json), redactions)
+  yield ', "interactions": ['
+  for i, chunk in enumerate(interactions):
+    if i > 0:
+      yield ', '
+    yield redacted_interaction(chunk, redactions)
+  yield ']}'
+
+# serialized cassette, gzip compressed
+def cassette_bytes(structure_json, interactions, redactions=[]):
+  return ''.join(
+    gzip_chunks(cassette_json_chunks(structure_json, interactions, redactions))
+  )
+
+def read_cassette(data):
+  return json.loads(
+    gzip.GzipFile(None, 'rb', 6, cStringIO.StringIO(data)).read()
+  )
+
+def cassette_key(structure, run_id):
+  return state_folder_prefix(structure) + "/cassettes/" + run_id + ".json.gz"
+
+# uploads the cassette next to the relation state, compressing it as it is
+# written. recording must never cause the run to fail.
+def write_cassette(structure, structure_json, run_id, recorder, write_function=stream_to_s3):
+  try:
+    stop_recording(recorder)
+    key = cassette_key(structure, run_id)
+    convergdb_log("writing " + str(len(recorder["interactions"])) + " recorded AWS calls to s3://" + structure["state_bucket"] + "/" + key)
+    write_function(
+      structure["state_bucket"],
+      key,
+      gzip_chunks(
+        cassette_json_chunks(
+          structure_json,
+          recorded_interactions(recorder),
+          cassette_redactions(structure)
+        )
+      )
+    )
+  except Exception as e:
+    convergdb_log("unable to write cassette: " + str(e))
+  finally:
+    recorder["bodies"].close()
+
+# !REPLAY
+
+# recorded interactions by key, in the order they were recorded
+def replay_index(cassette):
+  index = {}
+  for i in cassette["interactions"]:
+    index.setdefault(
+      interaction_key(i["service"], i["operation"], i["params"]),
+      []
+    ).append(i)
+  return index
+
+# returns the recorded response for a request. a request that was made
+# more often than recorded gets the last recorded response again.
+def replayed_interaction(index, position, service, operation, params):
+  key = interaction_key(service, operation, params)
+  recorded = index.get(key, [])
+  if len(recorded) == 0:
+    return None
+  n = position.get(key, 0)
+  position[key] = n + 1
+  return recorded[min(n, len(recorded) - 1)]
+
+# the fields of write responses that convergdb reads, for writes that are
+# not in the cassette. multipart uploads need an upload id and the etag of
+# every part.
+def synthetic_write_response(operation):
+  if operation == 'CreateMultipartUpload':
+    return {"UploadId": "convergdb-replay"}
+  elif operation in ['UploadPart', 'PutObject']:
+    return {"ETag": '"convergdb-replay"'}
+  return {}
+
+def replayed_response(interaction, operation=None):
+  if interaction == None:
+    return (AWSResponse('', 200, {}, None), synthetic_write_response(operation))
+  parsed = decode_value(interaction["response"])
+  if "body" in interaction:
+    data = base64.b64decode(interaction["body"])
+    parsed[interaction["body_field"]] = StreamingBody(io.BytesIO(data), len(data))
+  parsed["ResponseMetadata"] = {"HTTPStatusCode": interaction["status"]}
+  return (AWSResponse('', interaction["status"], {}, None), parsed)
+
+def replay_call_handler(replayer):
+  def handler(model, context, **kwargs):
+    service = model.service_model.service_name
+    operation = model.name
+    with replayer["lock"]:
+      interaction = replayed_interaction(
+        replayer["index"],
+        replayer["position"],
+        service,
+        operation,
+        context.get('convergdb_params', {})
+      )
+      if interaction == None:
+        replayer["unmatched"].append(service + '.' + operation)
+    if (interaction == None) and (not is_write_operation(operation)):
+      raise Exception("no recorded response for " + service + "." + operation + " " + json.dumps(context.get('convergdb_params', {}), sort_keys=True))
+    return replayed_response(interaction, operation)
+  return handler
+
+# answers every AWS call made through the default boto3 session from the
+# cassette. no request leaves the process.
+def start_replay(cassette, session=None):
+  replayer = {
+    "index": replay_index(cassette),
+    "position": {},
+    "unmatched": [],
+    "lock": threading.Lock(),
+    "session": session or default_session()
+  }
+  replayer["session"].events.register(
+    'before-parameter-build',
+    record_params_handler,
+    unique_id='convergdb-cassette-params'
+  )
+  replayer["session"].events.register(
+    'before-call',
+    replay_call_handler(replayer),
+    unique_id='convergdb-cassette-replay'
+  )
+  clear_aws_clients()
+  return replayer
+
+def stop_replay(replayer):
+  replayer["session"].events.unregister('before-parameter-build', unique_id='convergdb-cassette-params')
+  replayer["session"].events.unregister('before-call', unique_id='convergdb-cassette-replay')
+  clear_aws_clients()
+  return replayer
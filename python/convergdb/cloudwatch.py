@@ -1,5 +1,9 @@
-from convergdb_logging import *
-import boto3
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+import json
+import threading
+import time
+import Queue
 
 def put_cloudwatch_metric(region, namespace, metric, value, unit):
   try:
@@ -11,7 +15,7 @@ def put_cloudwatch_metric(region, namespace, metric, value, unit):
       }
     ]
     convergdb_log("publishing cloudwatch metric: " + str(metric_data) + "to namespace: " + namespace)
-    client = boto3.client('cloudwatch', region_name = region)
+    client = aws_client('cloudwatch', region)
     response = client.put_metric_data(
       Namespace = namespace,
       MetricData = metric_data
@@ -19,3 +23,178 @@ def put_cloudwatch_metric(region, namespace, metric, value, unit):
   except:
     convergdb_log("failed to publish cloudwatch metric: " + str(metric_data) + "to namespace: " + namespace)
 
+# !BUFFERED METRICS
+
+# datums sent with each put_metric_data call
+cloudwatch_batch_size = 20
+
+# datums waiting to be sent by the background sender, as tuples of
+# ((region, namespace), datum). a ('flush', event) tuple sets the event
+# once everything queued before it has been sent.
+metric_queue = Queue.Queue()
+
+metric_sender = {"thread": None}
+metric_sender_lock = threading.Lock()
+
+def metric_dimensions(dimensions):
+  return [
+    {'Name': k, 'Value': str(dimensions[k])} for k in sorted(dimensions.keys())
+  ]
+
+def metric_datum(metric, value, unit, dimensions={}):
+  datum = {
+    'MetricName': metric,
+    'Value': value,
+    'Unit': unit
+  }
+  if len(dimensions) > 0:
+    datum['Dimensions'] = metric_dimensions(dimensions)
+  return datum
+
+# cloudwatch embedded metric format. the log line is turned into a metric
+# by cloudwatch logs, so no api call is made.
+def emf_record(namespace, datum, timestamp_ms):
+  dimensions = datum.get('Dimensions', [])
+  rec = {
+    "_aws": {
+      "Timestamp": timestamp_ms,
+      "CloudWatchMetrics": [
+        {
+          "Namespace": namespace,
+          "Dimensions": [[d['Name'] for d in dimensions]],
+          "Metrics": [{"Name": datum['MetricName'], "Unit": datum['Unit']}]
+        }
+      ]
+    }
+  }
+  for d in dimensions:
+    rec[d['Name']] = d['Value']
+  rec[datum['MetricName']] = datum['Value']
+  return rec
+
+# groups queued datums by region and namespace, in batches that fit in a
+# single put_metric_data call.
+def grouped_metric_data(items, batch_size=cloudwatch_batch_size):
+  groups = {}
+  for destination, datum in items:
+    groups.setdefault(destination, []).append(datum)
+  ret = []
+  for destination in sorted(groups.keys()):
+    data = groups[destination]
+    for i in range(0, len(data), batch_size):
+      ret.append((destination, data[i:i + batch_size]))
+  return ret
+
+def send_metric_data(clients, destination, data):
+  region, namespace = destination
+  try:
+    if region not in clients:
+      clients[region] = aws_client('cloudwatch', region)
+    clients[region].put_metric_data(
+      Namespace = namespace,
+      MetricData = data
+    )
+  except Exception as e:
+    convergdb_log("failed to publish " + str(len(data)) + " cloudwatch metrics to namespace: " + namespace + " " + str(e))
+
+# takes everything that is waiting on the queue without blocking
+def drain_metric_queue(queue, first):
+  items = [first]
+  while True:
+    try:
+      items.append(queue.get_nowait())
+    except Queue.Empty:
+      return items
+
+# runs in the background sender thread
+def metric_sender_loop(queue, send_function=send_metric_data):
+  clients = {}
+  while True:
+    items = drain_metric_queue(queue, queue.get())
+    flushes = [i[1] for i in items if i[0] == 'flush']
+    data = [i for i in items if i[0] != 'flush']
+    for destination, batch in grouped_metric_data(data):
+      send_function(clients, destination, batch)
+    for event in flushes:
+      event.set()
+
+def ensure_metric_sender():
+  with metric_sender_lock:
+    if (metric_sender["thread"] == None) or (not metric_sender["thread"].is_alive()):
+      t = threading.Thread(target=metric_sender_loop, args=(metric_queue,))
+      t.daemon = True
+      t.start()
+      metric_sender["thread"] = t
+
+# queues a metric to be sent in the background, or writes it to the log in
+# embedded metric format. never waits on cloudwatch.
+def buffer_cloudwatch_metric(region, namespace, datum, metric_format='api'):
+  if metric_format == 'emf':
+    print(json.dumps(emf_record(namespace, datum, int(time.time() * 1000))))
+  else:
+    metric_queue.put(((region, namespace), datum))
+    ensure_metric_sender()
+
+# waits for the queued metrics to be sent. returns False if they were not
+# sent within the timeout.
+def flush_cloudwatch_metrics(timeout):
+  if metric_sender["thread"] == None:
+    return True
+  event = threading.Event()
+  metric_queue.put(('flush', event))
+  ensure_metric_sender()
+  sent = event.wait(timeout)
+  if not sent:
+    convergdb_log("cloudwatch metrics were not sent within " + str(timeout) + " seconds")
+  return sent
+
+def cloudwatch_metric_format(structure):
+  return structure.get("cloudwatch_metric_format", "api")
+
+# every batch id is a separate metric in cloudwatch, so the batch
+# dimension is only used when asked for.
+def cloudwatch_batch_dimension(structure):
+  return str(structure.get("cloudwatch_batch_dimension", "false")).lower() == "true"
+
+def relation_dimensions(structure, run_id=None, phase=None):
+  d = {"relation": structure["full_relation_name"]}
+  if phase != None:
+    d["phase"] = phase
+  if (run_id != None) and cloudwatch_batch_dimension(structure):
+    d["batch"] = run_id
+  return d
+
+# buffers a counter for the relation. the counter is also sent without
+# dimensions, as used by the deployment dashboard.
+def relation_metric(structure, metric, value, unit, run_id=None):
+  for dimensions in [{}, relation_dimensions(structure, run_id)]:
+    buffer_cloudwatch_metric(
+      structure["region"],
+      structure["cloudwatch_namespace"],
+      metric_datum(metric, value, unit, dimensions),
+      cloudwatch_metric_format(structure)
+    )
+
+# latency and throughput of each phase, from the totals of a traced run
+def phase_metric_data(structure, totals, run_id=None):
+  data = []
+  for phase in sorted(totals.keys()):
+    t = totals[phase]
+    dimensions = relation_dimensions(structure, run_id, phase)
+    data.append(
+      metric_datum('phase_duration', t["duration"], 'Seconds', dimensions)
+    )
+    if (t["bytes"] > 0) and (t["duration"] > 0):
+      data.append(
+        metric_datum('phase_throughput', t["bytes"] / t["duration"], 'Bytes/Second', dimensions)
+      )
+  return data
+
+def buffer_phase_metrics(structure, totals, run_id=None):
+  for datum in phase_metric_data(structure, totals, run_id):
+    buffer_cloudwatch_metric(
+      structure["region"],
+      structure["cloudwatch_namespace"],
+      datum,
+      cloudwatch_metric_format(structure)
+    )
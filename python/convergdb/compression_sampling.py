@@ -0,0 +1,178 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.batch_control import (
+  bz2_factor,
+  bz2_file_re,
+  gz_factor,
+  gz_file_re
+)
+from convergdb.s3 import dict_to_s3_json, s3_json_to_dict
+from convergdb.state import state_folder_prefix
+
+import bz2
+import random
+import time
+import zlib
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+# !DECOMPRESSION RATIO SAMPLING
+
+# number of files sampled for each compression type. 0 disables sampling.
+def compression_sample_file_count(structure):
+  return int(structure.get("compression_sample_file_count", 8))
+
+# bytes read from the start of each sampled file. bz2 only produces output
+# for complete blocks, so this needs to be larger than one compressed block.
+def compression_sample_bytes(structure):
+  return int(structure.get("compression_sample_kb", 1024)) * 1024
+
+# time allowed for all of the sampling requests
+def compression_sample_seconds(structure):
+  return float(structure.get("compression_sample_seconds", 30))
+
+# age after which the cached ratios are sampled again
+def compression_sample_max_age(structure):
+  return float(structure.get("compression_sample_max_age", 86400))
+
+def compression_type(key):
+  if gz_file_re.match(key):
+    return 'gz'
+  elif bz2_file_re.match(key):
+    return 'bz2'
+  else:
+    return None
+
+# returns a dict of compression type to a random sample of file records
+def sample_files(diff, count, rng=random):
+  by_type = {}
+  for f in diff:
+    t = compression_type(f["key"])
+    if t:
+      by_type.setdefault(t, []).append(f)
+  ret = {}
+  for t in by_type:
+    ret[t] = rng.sample(by_type[t], min(count, len(by_type[t])))
+  return ret
+
+# reads the first byte_count bytes of an object
+def ranged_get(client, bucket, key, byte_count):
+  resp = client.get_object(
+    Bucket=bucket,
+    Key=key,
+    Range="bytes=0-" + str(byte_count - 1)
+  )
+  return resp['Body'].read()
+
+# decompresses as much of the partial data as possible. returns a tuple of
+# (compressed bytes, uncompressed bytes).
+def decompressed_size(data, compression):
+  out = 0
+  remaining = data
+  while len(remaining) > 0:
+    if compression == 'gz':
+      # handles concatenated gzip members
+      d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+      d = bz2.BZ2Decompressor()
+    try:
+      out += len(d.decompress(remaining))
+    except (IOError, EOFError, zlib.error):
+      break
+    remaining = getattr(d, 'unused_data', '')
+  return (len(data), out)
+
+# ratio of uncompressed to compressed bytes for each compression type.
+# samples that produced no output are ignored.
+def sampled_ratios(samples):
+  totals = {}
+  for s in samples:
+    compression, compressed, uncompressed = s
+    if uncompressed > 0:
+      t = totals.setdefault(compression, [0, 0])
+      t[0] += compressed
+      t[1] += uncompressed
+  ret = {}
+  for compression in totals:
+    ret[compression] = float(totals[compression][1]) / float(totals[compression][0])
+  return ret
+
+# fetches and measures all of the sampled files in parallel. returns an empty
+# dict if the sampling does not finish within the time budget.
+def sample_decompression_ratios(bucket, samples, byte_count, seconds):
+  client = aws_client('s3')
+  def measure(item):
+    compression, key = item
+    try:
+      data = ranged_get(client, bucket, key, byte_count)
+      return (compression,) + decompressed_size(data, compression)
+    except Exception as e:
+      convergdb_log("unable to sample " + key + ": " + str(e))
+      return (compression, 0, 0)
+
+  items = []
+  for compression in samples:
+    items += [(compression, f["key"]) for f in samples[compression]]
+  if len(items) == 0:
+    return {}
+
+  pool = ThreadPool(min(16, len(items)))
+  try:
+    return sampled_ratios(
+      pool.map_async(measure, items).get(seconds)
+    )
+  except TimeoutError:
+    convergdb_log("decompression sampling exceeded " + str(seconds) + " seconds")
+    return {}
+  finally:
+    pool.terminate()
+
+# sampled ratios are cached next to the relation state
+def compression_ratios_key(structure):
+  return state_folder_prefix(structure) + "/compression_ratios.json"
+
+def cached_ratios_are_current(cached, max_age, now):
+  return ("sampled_at" in cached) and ((now - cached["sampled_at"]) < max_age)
+
+# fills in the default factors for any compression type that was not sampled
+def with_default_factors(ratios):
+  ret = {'gz': gz_factor, 'bz2': bz2_factor}
+  ret.update(ratios)
+  return ret
+
+# returns a dict of compression type to uncompressed/compressed ratio for the
+# files in the diff, using cached ratios for the relation when current.
+# newly sampled ratios are cached with write_function.
+def compression_factors(structure, diff, write_function=dict_to_s3_json):
+  count = compression_sample_file_count(structure)
+  if count == 0:
+    return with_default_factors({})
+
+  now = time.time()
+  key = compression_ratios_key(structure)
+  cached = s3_json_to_dict(structure["state_bucket"], key)
+  if cached_ratios_are_current(cached, compression_sample_max_age(structure), now):
+    return with_default_factors(cached["ratios"])
+
+  samples = sample_files(diff, count)
+  if len(samples) == 0:
+    return with_default_factors(cached.get("ratios", {}))
+
+  st = time.time()
+  ratios = sample_decompression_ratios(
+    structure["source_structure"]["storage_bucket"].split('/')[0],
+    samples,
+    compression_sample_bytes(structure),
+    compression_sample_seconds(structure)
+  )
+  convergdb_log("sampled decompression ratios " + str(ratios) + " in " + str(time.time() - st) + " seconds")
+  if len(ratios) > 0:
+    write_function(
+      structure["state_bucket"],
+      key,
+      {"sampled_at": now, "ratios": ratios}
+    )
+    return with_default_factors(ratios)
+  else:
+    # stale ratios are still better than the fixed defaults
+    return with_default_factors(cached.get("ratios", {}))
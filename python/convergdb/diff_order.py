@@ -0,0 +1,89 @@
+from convergdb.convergdb_logging import convergdb_log
+
+# !LOAD ORDER
+
+# the diff is loaded in the order of the load_order attribute. "listed"
+# keeps the order of the listing or of the athena results, which is
+# arbitrary for athena. files without a last modified time sort as the
+# oldest. keys break ties, so that every run orders the same diff the same
+# way.
+
+def newest_first_key(d):
+  return (d.get("last_modified") or '', d["key"])
+
+load_orders = {
+  "listed": None,
+  "newest_first": (newest_first_key, True),
+  "oldest_first": (newest_first_key, False),
+  "key": (lambda d: d["key"], False),
+  "size_ascending": (lambda d: (d["size"], d["key"]), False)
+}
+
+def load_order(structure):
+  order = structure.get("load_order", "listed")
+  if not order in load_orders:
+    raise Exception("unknown load_order: " + str(order) + ", expected one of " + ', '.join(sorted(load_orders.keys())))
+  return order
+
+# share of every chunk that is taken from the newest files of the diff,
+# whatever the load order. a run that stops early still loads fresh data.
+def fresh_share(structure):
+  return min(1.0, max(0.0, float(structure.get("load_order_fresh_share", 0))))
+
+# the athena and s3 inventory manifest diffs only read last modified times
+# when the load order uses them.
+def last_modified_needed(structure):
+  return (load_order(structure) in ["newest_first", "oldest_first"]) or (fresh_share(structure) > 0)
+
+def sorted_diff(diff, order):
+  if load_orders[order] == None:
+    return list(diff)
+  key, reverse = load_orders[order]
+  return sorted(diff, key=key, reverse=reverse)
+
+# number of the newest files in each chunk. any share above zero reserves
+# at least one file.
+def fresh_files_per_chunk(chunk_size, share):
+  if share <= 0:
+    return 0
+  return min(chunk_size, max(1, int(chunk_size * share)))
+
+# builds every chunk from the newest files not taken yet, then fills it
+# with the next files in load order.
+def with_fresh_files(ordered, newest, chunk_size, fresh_count):
+  taken = set()
+  ret = []
+  i = 0
+  j = 0
+  while i < len(ordered):
+    n = 0
+    while (n < fresh_count) and (j < len(newest)):
+      if not newest[j]["key"] in taken:
+        taken.add(newest[j]["key"])
+        ret.append(newest[j])
+        n += 1
+      j += 1
+    while (n < chunk_size) and (i < len(ordered)):
+      if not ordered[i]["key"] in taken:
+        taken.add(ordered[i]["key"])
+        ret.append(ordered[i])
+        n += 1
+      i += 1
+  return ret
+
+# the diff in load order, for chunks of chunk_size files taken from its
+# start.
+def ordered_diff(structure, diff, chunk_size):
+  order = load_order(structure)
+  ordered = sorted_diff(diff, order)
+  fresh_count = fresh_files_per_chunk(chunk_size, fresh_share(structure))
+  if (fresh_count == 0) or (order == "newest_first"):
+    convergdb_log("load order: " + order)
+    return ordered
+  convergdb_log("load order: " + order + ", with the " + str(fresh_count) + " newest files remaining in every chunk")
+  return with_fresh_files(
+    ordered,
+    sorted_diff(diff, "newest_first"),
+    chunk_size,
+    fresh_count
+  )
@@ -0,0 +1,218 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.add_partitions import storage_partitions
+from convergdb.arrow_load import (
+  ArrowLoadUnsupported,
+  arrow_load_plan,
+  fast_load_max_bytes
+)
+from convergdb.batch_control import file_estimated_sizing, file_sizing
+from convergdb.compression_sampling import compression_factors
+from convergdb.diff_order import load_order, ordered_diff
+from convergdb.glue import current_job_dpu
+from convergdb.planner import (
+  budgeted_chunk_count,
+  estimated_load_seconds,
+  estimated_output_files,
+  get_batch_statistics,
+  planned_chunk_count,
+  planned_spark_partitions,
+  run_budget
+)
+from convergdb.resources import local_resources
+from convergdb.s3_inventory import inventory_file_diff
+from convergdb.spark_partitions import limited_chunk_count, split_indices
+from convergdb.state import get_sizing_state
+
+import json
+
+# !DRY RUN
+
+# plan_source_to_target runs the diff of a relation and plans its batches
+# as source_to_target would, without loading data or writing any state.
+# the athena diff still runs its query, which writes a result file to the
+# tmp results location, but the partitions of the inventory table are not
+# refreshed. an s3 inventory delivered since the last run is only seen
+# when the manifest reader is enabled.
+# the dpu, container resources and spark partition count can be replaced
+# to see how a change of settings would change the plan. chunks are those
+# of the driver diff: with spark_diff, files are hashed into the same
+# number of chunks instead.
+
+def discard_write(*args):
+  pass
+
+# the diff of a dry run, which leaves the inventory table as it is
+def dry_run_diff(structure):
+  return inventory_file_diff(structure, refresh_partitions=False)
+
+# the target partition columns registered in the catalog
+def partition_columns(structure):
+  return [p for p in structure["partitions"] if p != 'convergdb_batch_id']
+
+# the dpu and resources used for planning: the what-if settings if given,
+# otherwise those of the job, as in source_to_target.
+def planning_resources(structure, dpu=None, resources=None):
+  if dpu != None:
+    return (dpu, None)
+  if resources != None:
+    return (None, resources)
+  if structure["etl_technology"] == 'aws_glue':
+    return (current_job_dpu(structure["etl_job_name"], structure["region"]), None)
+  elif structure["etl_technology"] == 'aws_fargate':
+    return (None, local_resources())
+  return (None, None)
+
+# the engine that loads a batch of the estimated size first. the arrow
+# engine can still leave a batch to spark once it reads the data.
+def planned_engine(structure, estimated_bytes):
+  max_bytes = fast_load_max_bytes(structure)
+  if (max_bytes <= 0) or (estimated_bytes > max_bytes):
+    return "spark"
+  try:
+    arrow_load_plan(structure)
+    return "arrow"
+  except ArrowLoadUnsupported:
+    return "spark"
+
+def chunk_plan(structure, chunk, factors, dpu, spark_partition_count, history, resources):
+  compressed = file_sizing(chunk)
+  estimated = file_estimated_sizing(chunk, factors)
+  engine = planned_engine(structure, estimated)
+  spark_partitions = None
+  output_files = None
+  if engine == "spark":
+    spark_partitions = planned_spark_partitions(
+      compressed,
+      estimated,
+      dpu,
+      spark_partition_count,
+      history,
+      resources
+    )
+    output_files = estimated_output_files(spark_partitions, history)
+  elif len(partition_columns(structure)) == 0:
+    # the arrow engine writes one file for each target partition
+    output_files = 1
+  modified = [d["last_modified"] for d in chunk if d.get("last_modified")]
+  return {
+    "file_count": len(chunk),
+    "first_key": chunk[0]["key"],
+    "last_key": chunk[-1]["key"],
+    "oldest_modified": min(modified) if modified else None,
+    "newest_modified": max(modified) if modified else None,
+    "source_bytes": compressed,
+    "estimated_bytes": estimated,
+    "engine": engine,
+    "spark_partitions": spark_partitions,
+    "estimated_output_files": output_files,
+    "estimated_seconds": estimated_load_seconds(compressed, history)
+  }
+
+# sum of a chunk field, or None if it is not known for every chunk
+def chunk_total(chunks, field):
+  values = [c[field] for c in chunks]
+  if None in values:
+    return None
+  return sum(values)
+
+# the plan of a diff, from everything source_to_target reads before the
+# first batch. existing_partitions is the number of target partitions in
+# storage, which update_all_partitions registers again after each batch.
+def batch_plan(structure, diff, factors, history, sizing, dpu, spark_partition_count, resources, existing_partitions):
+  source_bytes = file_sizing(diff)
+  estimated_bytes = file_estimated_sizing(diff, factors)
+  chunk_size = limited_chunk_count(
+    planned_chunk_count(
+      source_bytes,
+      estimated_bytes,
+      len(diff),
+      dpu,
+      history,
+      resources
+    ),
+    sizing
+  )
+  chunks = []
+  if len(diff) > 0:
+    diff = ordered_diff(structure, diff, chunk_size)
+    for indx in split_indices(len(diff), chunk_size):
+      chunks.append(
+        chunk_plan(
+          structure,
+          diff[indx[0]:(indx[1])],
+          factors,
+          dpu,
+          spark_partition_count,
+          history,
+          resources
+        )
+      )
+  columns = partition_columns(structure)
+  budget = run_budget(structure)
+  return {
+    "relation": structure["full_relation_name"],
+    "settings": {
+      "etl_technology": structure.get("etl_technology"),
+      "dpu": dpu,
+      "resources": resources,
+      "spark_partition_count": spark_partition_count,
+      "run_budget_seconds": budget["seconds"],
+      "load_order": load_order(structure)
+    },
+    "file_count": len(diff),
+    "source_bytes": source_bytes,
+    "estimated_bytes": estimated_bytes,
+    "compression_factors": factors,
+    "history_batches": len(history),
+    "files_per_chunk": chunk_size,
+    "chunks": chunks,
+    "estimated_seconds": chunk_total(chunks, "estimated_seconds"),
+    "estimated_output_files": chunk_total(chunks, "estimated_output_files"),
+    # the time of the diff itself is not counted
+    "chunks_within_budget": budgeted_chunk_count(budget, [c["estimated_seconds"] for c in chunks]),
+    "partitions": {
+      "columns": columns,
+      "existing": existing_partitions,
+      # every batch registers the partitions in storage, including the
+      # ones it adds, whose values depend on the data.
+      "registrations_per_batch_at_least": existing_partitions
+    }
+  }
+
+# number of target partitions in storage. tables without partition
+# columns have none.
+def existing_partition_count(structure):
+  if len(partition_columns(structure)) == 0:
+    return 0
+  keys, partitions = storage_partitions(
+    structure["storage_bucket"].split('/')[0],
+    '/'.join(structure["storage_bucket"].split('/')[1:]),
+    structure['region']
+  )
+  return len(partitions)
+
+# the plan of the next run of the relation. structure is a dict or the
+# json of one. dpu, resources and spark_partition_count replace the
+# settings of the relation for a what-if plan.
+def plan_source_to_target(structure, dpu=None, spark_partition_count=None, resources=None, diff_function=dry_run_diff):
+  if isinstance(structure, basestring):
+    structure = json.loads(structure)
+  dpu, resources = planning_resources(structure, dpu, resources)
+  if spark_partition_count == None:
+    spark_partition_count = structure['spark_partition_count']
+  diff = diff_function(structure)
+  convergdb_log("dry run of " + structure["full_relation_name"] + " with " + str(len(diff)) + " loadable files")
+  return batch_plan(
+    structure,
+    diff,
+    compression_factors(structure, diff, discard_write),
+    get_batch_statistics(structure),
+    get_sizing_state(structure),
+    dpu,
+    spark_partition_count,
+    resources,
+    existing_partition_count(structure)
+  )
+
+def plan_json(plan):
+  return json.dumps(plan, indent=2, sort_keys=True)
@@ -0,0 +1,419 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.arrow_load import plain_path_re
+from convergdb.batch_control import (
+  batch_id,
+  diff_s3a,
+  file_estimated_sizing,
+  file_sizing
+)
+from convergdb.cloudwatch import (
+  buffer_phase_metrics,
+  flush_cloudwatch_metrics,
+  relation_metric
+)
+from convergdb.compression_sampling import compression_factors
+from convergdb.diff_order import ordered_diff
+from convergdb.fingerprint import (
+  get_stored_fingerprint,
+  source_fingerprint,
+  source_fingerprint_enabled,
+  source_unchanged,
+  write_fingerprint
+)
+from convergdb.glue import current_job_dpu
+from convergdb.high_level import (
+  finish_batch,
+  load_batch,
+  recovered_state,
+  report_no_new_data,
+  set_bucket_sse,
+  source_to_target
+)
+from convergdb.locking import lock
+from convergdb.planner import (
+  budget_allows,
+  estimated_load_seconds,
+  get_batch_statistics,
+  planned_chunk_count,
+  planned_spark_partitions,
+  run_budget
+)
+from convergdb.resources import local_resources
+from convergdb.s3_governor import (
+  counter_difference,
+  s3_governor_counters,
+  start_s3_governor
+)
+from convergdb.s3_inventory import inventory_file_diff
+from convergdb.sns import publish_sns_async, wait_for_sns
+from convergdb.spark import (
+  source_dataframe,
+  source_rows_dataframe,
+  target_dataframe,
+  write_batch_dataframe
+)
+from convergdb.spark_diff import spark_diff_enabled
+from convergdb.spark_metrics import batch_job_group
+from convergdb.spark_partitions import limited_chunk_count, split_indices
+from convergdb.state import (
+  get_sizing_state,
+  get_state,
+  state_allows_load,
+  write_load_in_progress
+)
+from convergdb.tracing import (
+  annotate_span,
+  finish_trace,
+  performance_report,
+  phase_totals,
+  span,
+  start_trace,
+  write_performance_report
+)
+
+import json
+import sys
+import time
+from collections import OrderedDict
+
+from pyspark import StorageLevel
+
+# !FAN OUT LOADS
+
+# target relations with the same source relation read the same files, and
+# apply the same source expressions, casts and null rejection to them. a
+# fan out load does that once for each chunk: the source rows are cached
+# in spark, and every target is written from the cache. each target keeps
+# its own diff, batches, control records and state, so a target that is
+# behind the others loads the files it is missing, and a target that
+# fails is loaded on its own like any other relation.
+
+# targets share a scan when their source relations are identical
+def fan_out_key(structure):
+  return json.dumps(structure["source_structure"], sort_keys=True)
+
+# the spark diff keeps the diff of a target in spark, so those targets
+# are loaded on their own.
+def fan_out_supported(structure):
+  return not spark_diff_enabled(structure)
+
+# lists of structures that share a source, in the order they were given
+def fan_out_groups(structures):
+  ret = OrderedDict()
+  for s in structures:
+    key = fan_out_key(s) if fan_out_supported(s) else s["full_relation_name"]
+    ret.setdefault(key, []).append(s)
+  return list(ret.values())
+
+# files of the union of the target diffs, in the order first seen
+def union_diff(diffs):
+  ret = OrderedDict()
+  for diff in diffs:
+    for d in diff:
+      ret.setdefault(d["key"], d)
+  return list(ret.values())
+
+# the part of a target diff that is in a chunk of the union
+def chunk_diff(diff, chunk_keys):
+  return [d for d in diff if d["key"] in chunk_keys]
+
+# rows of the shared scan can be selected by their source file name when
+# spark reports the name exactly as it was given.
+def selectable_paths(s3a_paths):
+  return all([plain_path_re.match(p) != None for p in s3a_paths])
+
+# dpu of a glue job, or the resources of a fargate container
+def job_resources(structure):
+  if structure["etl_technology"] == 'aws_glue':
+    return (current_job_dpu(structure["etl_job_name"], structure["region"]), None)
+  elif structure["etl_technology"] == 'aws_fargate':
+    return (None, local_resources())
+  return (None, None)
+
+# targets with their diffs. targets whose source fingerprint is unchanged
+# since their last complete run are reported and left out.
+def fan_out_targets(structures):
+  ret = []
+  for structure in structures:
+    fingerprint = None
+    if source_fingerprint_enabled(structure):
+      with span("source_fingerprint"):
+        stored_fingerprint = get_stored_fingerprint(structure)
+        fingerprint = source_fingerprint(structure, stored_fingerprint)
+      if source_unchanged(stored_fingerprint, fingerprint):
+        convergdb_log("source unchanged since the last complete run of " + structure["full_relation_name"])
+        report_no_new_data(structure)
+        continue
+    with span("file_diff") as s:
+      diff = inventory_file_diff(structure)
+      annotate_span(s, bytes=file_sizing(diff), items=len(diff))
+    convergdb_log("loadable file count for " + structure["full_relation_name"] + ": " + str(len(diff)))
+    ret.append(
+      {
+        "structure": structure,
+        "diff": diff,
+        "fingerprint": fingerprint,
+        "history": get_batch_statistics(structure)
+      }
+    )
+  return ret
+
+# the smallest chunk planned for any of the targets, so that no target
+# loads a batch larger than it would on its own.
+def fan_out_chunk_count(targets, diff, dpu, resources):
+  source_bytes = file_sizing(diff)
+  with span("compression_factors"):
+    factors = compression_factors(targets[0]["structure"], diff)
+  estimated_bytes = file_estimated_sizing(diff, factors)
+  ret = None
+  for t in targets:
+    c = limited_chunk_count(
+      planned_chunk_count(
+        source_bytes,
+        estimated_bytes,
+        len(diff),
+        dpu,
+        t["history"],
+        resources
+      ),
+      get_sizing_state(t["structure"])
+    )
+    ret = c if ret == None else min(ret, c)
+  return ret
+
+# the tightest run budget of the group
+def group_run_budget(structures):
+  budgets = [run_budget(s) for s in structures]
+  limited = [b for b in budgets if b["seconds"] != None]
+  if len(limited) == 0:
+    return budgets[0]
+  return min(limited, key=lambda b: b["seconds"] - b["reserve"])
+
+# every target writes its own part of a chunk, so the chunk is estimated
+# at the sum of the estimates of the targets that know their throughput.
+def fan_out_chunk_seconds(targets, chunk_keys):
+  estimates = [
+    estimated_load_seconds(file_sizing(chunk_diff(t["diff"], chunk_keys)), t["history"])
+    for t in targets
+  ]
+  known = [e for e in estimates if e != None]
+  if len(known) == 0:
+    return None
+  return sum(known)
+
+# starts a batch of each target that has files in the chunk
+def start_fan_out_batches(targets, chunk_keys, state_function=recovered_state, in_progress_function=write_load_in_progress):
+  ret = []
+  for t in targets:
+    structure = t["structure"]
+    diff = chunk_diff(t["diff"], chunk_keys)
+    if len(diff) == 0:
+      continue
+    current_state = state_function(structure)
+    if not state_allows_load(current_state):
+      convergdb_log(structure["full_relation_name"] + " is in state " + current_state["state"] + ", not loading")
+      continue
+    start_time = time.gmtime()
+    this_batch_id = batch_id(start_time)
+    with span("write_load_in_progress") as s:
+      in_progress_function(structure, this_batch_id, start_time, diff)
+      annotate_span(s, items=len(diff))
+    ret.append(
+      {
+        "target": t,
+        "diff": diff,
+        "batch_id": this_batch_id,
+        "start_time": start_time
+      }
+    )
+  return ret
+
+# writes the batch of a target from the shared source rows. returns the
+# load metrics and the compressed and estimated bytes of the batch.
+def write_fan_out_batch(sql_context, shared, batch, dpu, resources, shared_all):
+  structure = batch["target"]["structure"]
+  st = time.time()
+  s3a_list = diff_s3a(structure, [d["key"] for d in batch["diff"]])
+  rows = shared
+  if not shared_all:
+    rows = shared.filter(shared["convergdb_source_file_name"].isin(s3a_list))
+  compressed = file_sizing(batch["diff"])
+  with span("compression_factors"):
+    factors = compression_factors(structure, batch["diff"])
+  estimate = file_estimated_sizing(batch["diff"], factors)
+  spark_partitions = planned_spark_partitions(
+    compressed,
+    estimate,
+    dpu,
+    structure['spark_partition_count'],
+    batch["target"]["history"],
+    resources
+  )
+  with span("data_load") as s:
+    annotate_span(s, bytes=compressed, items=len(batch["diff"]))
+    convergdb_log("writing " + structure["full_relation_name"] + " from the shared source rows")
+    load_metrics = write_batch_dataframe(
+      sql_context,
+      target_dataframe(rows, structure, batch["batch_id"], spark_partitions),
+      structure,
+      batch["batch_id"] + ' ' + structure["full_relation_name"],
+      compressed,
+      len(batch["diff"]),
+      spark_partitions,
+      st
+    )
+  return (load_metrics, compressed, estimate)
+
+# the source rows of a chunk, cached for the targets to be written from
+def shared_source_rows(sql_context, structure, s3a_list):
+  return source_rows_dataframe(
+    source_dataframe(sql_context, structure, s3a_list),
+    structure
+  ).persist(StorageLevel.MEMORY_AND_DISK)
+
+# loads one chunk of the union diff into every target that needs it
+def load_fan_out_chunk(sql_context, targets, chunk, dpu, resources, start_function=start_fan_out_batches, shared_function=shared_source_rows, write_function=write_fan_out_batch, finish_function=finish_batch, load_function=load_batch):
+  chunk_keys = set([d["key"] for d in chunk])
+  batches = start_function(targets, chunk_keys)
+  if len(batches) == 0:
+    return
+  structure = batches[0]["target"]["structure"]
+  s3a_list = diff_s3a(structure, [d["key"] for d in chunk])
+  convergdb_log("reading " + str(len(chunk)) + " files once for " + str(len(batches)) + " targets")
+
+  # batches that fall back to a load of their own, which removes the
+  # batch in progress and loads it again, splitting it if it is too big.
+  alone = []
+  shared = shared_function(sql_context, structure, s3a_list)
+  try:
+    try:
+      with span("shared_scan") as s:
+        with batch_job_group(sql_context, batches[0]["batch_id"] + ' shared scan'):
+          annotate_span(s, bytes=file_sizing(chunk), items=shared.count())
+    except Exception:
+      convergdb_log("shared scan failed, loading targets on their own: " + str(sys.exc_info()[1]))
+      alone = batches
+      batches = []
+
+    for b in batches:
+      shared_all = len(b["diff"]) == len(chunk)
+      if not (shared_all or selectable_paths(diff_s3a(structure, [d["key"] for d in b["diff"]]))):
+        alone.append(b)
+        continue
+      try:
+        load_metrics, compressed, estimate = write_function(sql_context, shared, b, dpu, resources, shared_all)
+      except Exception:
+        convergdb_log("shared write of " + b["target"]["structure"]["full_relation_name"] + " failed: " + str(sys.exc_info()[1]))
+        alone.append(b)
+        continue
+      # failures after the write are not retried, because the batch may
+      # already be recorded as loaded.
+      finish_function(
+        b["target"]["structure"],
+        b["diff"],
+        b["batch_id"],
+        b["start_time"],
+        load_metrics,
+        compressed,
+        estimate
+      )
+  finally:
+    shared.unpersist()
+
+  for b in alone:
+    with span("load_batch") as s:
+      annotate_span(s, bytes=file_sizing(b["diff"]), items=len(b["diff"]))
+      load_function(sql_context, b["target"]["structure"], b["diff"], None, dpu, resources)
+
+# loads every target of a group from one scan of their source. the group
+# is loaded under the lock of the job, like a single relation.
+@lock
+def load_fan_out_group(sql_context, structures):
+  start_trace("fan_out_source_to_target")
+  outcome = "failure"
+  start_time = time.gmtime()
+  budget = group_run_budget(structures)
+  s3_counters = s3_governor_counters()
+  try:
+    start_s3_governor()
+    for structure in structures:
+      if structure['etl_technology'] == 'aws_fargate':
+        with span("set_bucket_sse"):
+          set_bucket_sse(sql_context, structure["storage_bucket"])
+    with span("resources"):
+      dpu, resources = job_resources(structures[0])
+
+    targets = fan_out_targets(structures)
+    diff = union_diff([t["diff"] for t in targets])
+    convergdb_log("loadable file count for all targets: " + str(len(diff)))
+    # keys of the chunks that did not fit in the run budget
+    deferred_keys = set()
+    loaded = 0
+    if len(diff) > 0:
+      with span("plan_chunks"):
+        chunk_size = fan_out_chunk_count(targets, diff, dpu, resources)
+      convergdb_log("max files per batch: " + str(chunk_size))
+      # the group shares the load order of its first target
+      diff = ordered_diff(structures[0], diff, chunk_size)
+      for indx in split_indices(len(diff), chunk_size):
+        chunk = diff[indx[0]:(indx[1])]
+        chunk_keys = set([d["key"] for d in chunk])
+        if (len(deferred_keys) > 0) or not budget_allows(budget, fan_out_chunk_seconds(targets, chunk_keys), loaded):
+          deferred_keys.update(chunk_keys)
+          continue
+        loaded += 1
+        with span("load_fan_out_chunk") as s:
+          annotate_span(s, bytes=file_sizing(chunk), items=len(chunk))
+          load_fan_out_chunk(sql_context, targets, chunk, dpu, resources)
+    outcome = "success"
+    for t in targets:
+      if len(t["diff"]) == 0:
+        report_no_new_data(t["structure"])
+      deferred_files = len(chunk_diff(t["diff"], deferred_keys))
+      if deferred_files > 0:
+        # the fingerprint is stored once the whole diff is loaded
+        convergdb_log(str(deferred_files) + " files of " + t["structure"]["full_relation_name"] + " deferred to the next run by the run budget")
+        relation_metric(t["structure"], 'deferred_files', deferred_files, 'Count')
+        outcome = "deferred"
+      elif (t["fingerprint"] != None) and state_allows_load(get_state(t["structure"])):
+        # targets in a failure state loaded nothing
+        with span("write_fingerprint"):
+          write_fingerprint(t["structure"], t["fingerprint"])
+  except:
+    for structure in structures:
+      convergdb_log("error in processing relation: " + structure["full_relation_name"] + str(sys.exc_info()[0]))
+      relation_metric(structure, 'batch_failure', 1, 'Count')
+      publish_sns_async(
+        structure["region"],
+        structure["sns_topic"],
+        "FAILURE - ConvergDB - " + structure["full_relation_name"],
+        str(sys.exc_info()[0])
+      )
+    raise
+  finally:
+    # the run is reported to every target of the group
+    root = finish_trace()
+    run_id = batch_id(start_time)
+    s3_requests = counter_difference(s3_counters, s3_governor_counters())
+    for structure in structures:
+      write_performance_report(
+        structure,
+        performance_report(structure, run_id, outcome, root, s3_requests)
+      )
+      buffer_phase_metrics(structure, phase_totals(root), run_id)
+    flush_seconds = float(structures[0].get("metrics_flush_seconds", 30))
+    flush_cloudwatch_metrics(flush_seconds)
+    wait_for_sns(flush_seconds)
+
+# loads the relations of a job script. relations with the same source are
+# loaded together from one scan of the source, the others one at a time.
+# the generated glue and fargate job scripts call source_to_target for
+# each relation, so a job script uses this only when it is edited to.
+def fan_out_source_to_target(sql_context, structure_jsons, run_function=source_to_target, group_function=load_fan_out_group):
+  structures = [json.loads(s) for s in structure_jsons]
+  for group in fan_out_groups(structures):
+    if len(group) == 1:
+      run_function(sql_context, json.dumps(group[0]))
+    else:
+      convergdb_log("loading " + ', '.join([s["full_relation_name"] for s in group]) + " from one scan of their source")
+      group_function(sql_context, group)
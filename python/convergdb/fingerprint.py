@@ -0,0 +1,172 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.athena import athena_describe_table
+from convergdb.batch_control import (
+  athena_inventory_type,
+  aws_api_based_diff,
+  diff_approaches,
+  inventory_table,
+  sql_utc_timestamp
+)
+from convergdb.s3 import (
+  dict_to_s3_json,
+  s3_common_prefixes,
+  s3_json_to_dict,
+  s3_keys_after,
+  s3_url_to_bucket_prefix
+)
+from convergdb.state import state_folder_prefix
+
+import calendar
+import hashlib
+import re
+import time
+
+# !SOURCE FINGERPRINTS
+
+# the fingerprint check is off unless the structure turns it on. control
+# records removed by hand are only reloaded once fingerprint.json is
+# removed as well.
+def source_fingerprint_enabled(structure):
+  return str(structure.get("source_fingerprint", "false")).lower() == "true"
+
+# the type of inventory used by the diff for this relation
+def fingerprint_inventory_type(structure):
+  diff_function = diff_approaches(
+    structure["inventory_source"],
+    structure["source_structure"]
+  )
+  if diff_function == aws_api_based_diff:
+    return 'api'
+  else:
+    return athena_inventory_type(structure)
+
+# s3 location of the table, as a dict with bucket and prefix
+def table_location(table_name, region, describe_function=athena_describe_table):
+  tbl = table_name.split('.', 1)
+  t = describe_function(tbl[0], tbl[1], region)
+  location = t['Table']['StorageDescriptor']['Location']
+  if not location.endswith('/'):
+    location = location + '/'
+  return s3_url_to_bucket_prefix(location)
+
+# latest "dt=" partition from a list of hive partition prefixes
+def latest_dt_partition(prefixes):
+  dts = [p.rstrip('/').split('/')[-1] for p in prefixes]
+  dts = [d for d in dts if d.startswith('dt=')]
+  if len(dts) == 0:
+    return None
+  else:
+    return max(dts)
+
+# s3 inventory is delivered as a new dt partition. the latest partition
+# changes whenever a new inventory has been delivered.
+def s3_inventory_fingerprint(structure):
+  location = table_location(
+    inventory_table(structure),
+    structure["region"]
+  )
+  dt = latest_dt_partition(
+    s3_common_prefixes(location['bucket'], location['prefix'])
+  )
+  if dt == None:
+    return None
+  else:
+    return 's3:' + dt
+
+# !STREAMING INVENTORY LISTINGS
+
+# firehose writes event files under a YYYY/MM/DD/HH/ folder for the hour
+# their records arrived. s3 delivery retries can run for hours, so a file
+# may appear well after newer keys, and sort before the newest key seen.
+firehose_hour_re = re.compile(r'(\d{4})/(\d{2})/(\d{2})/(\d{2})/')
+
+# hours before the newest key seen that are listed again on every run
+def streaming_overlap_hours(structure):
+  return float(structure.get("streaming_inventory_overlap_hours", 24))
+
+# the key that listings of the streaming inventory start after: the folder
+# of the hour overlap_hours before the hour of the watermark. keys without
+# hourly folders are listed after the watermark itself.
+def streaming_listing_start(watermark, overlap_hours):
+  if watermark == None:
+    return None
+  matches = list(firehose_hour_re.finditer(watermark))
+  if len(matches) == 0:
+    return watermark
+  m = matches[-1]
+  hour = calendar.timegm(
+    tuple([int(g) for g in m.groups()]) + (0, 0)
+  ) - int(overlap_hours * 3600)
+  return watermark[:m.start()] + time.strftime('%Y/%m/%d/%H', time.gmtime(hour))
+
+# the newest key of a streaming fingerprint. fingerprints are stored as
+# streaming:<digest>:<newest key>, or as streaming:<newest key> by earlier
+# versions.
+def streaming_fingerprint_watermark(fingerprint):
+  if not (fingerprint and fingerprint.startswith('streaming:')):
+    return None
+  rest = fingerprint[len('streaming:'):]
+  if re.match(r'^[0-9a-f]{32}:', rest):
+    return rest[33:]
+  return rest
+
+# streaming inventory events are written under keys that sort by time, so
+# the newest key is a watermark. keys are listed from the same overlap
+# before the previous watermark as the streaming snapshot, and all of them
+# are part of the fingerprint, so a file delivered late changes it.
+def streaming_inventory_fingerprint(structure, previous, list_function=s3_keys_after):
+  location = s3_url_to_bucket_prefix(
+    structure["source_structure"]["streaming_inventory_output_bucket"]
+  )
+  keys = list_function(
+    location['bucket'],
+    location['prefix'],
+    streaming_listing_start(
+      streaming_fingerprint_watermark(previous),
+      streaming_overlap_hours(structure)
+    )
+  )
+  if len(keys) == 0:
+    return previous
+  digest = hashlib.md5('\n'.join(sorted(keys))).hexdigest()
+  return 'streaming:' + digest + ':' + max(keys)
+
+# returns a string that changes whenever new source data may be available,
+# or None if the source can not be fingerprinted cheaply. a failure here
+# only means that the full diff is performed.
+def source_fingerprint(structure, previous):
+  try:
+    inventory_type = fingerprint_inventory_type(structure)
+    if inventory_type == 's3':
+      return s3_inventory_fingerprint(structure)
+    elif inventory_type == 'streaming':
+      return streaming_inventory_fingerprint(structure, previous)
+    else:
+      # the listing used by the api diff is the expensive part
+      return None
+  except Exception as e:
+    convergdb_log("unable to fingerprint source: " + str(e))
+    return None
+
+def fingerprint_key(structure):
+  return state_folder_prefix(structure) + "/fingerprint.json"
+
+# fingerprint of the source as of the last run that loaded its full diff
+def get_stored_fingerprint(structure):
+  return s3_json_to_dict(
+    structure["state_bucket"],
+    fingerprint_key(structure)
+  ).get("fingerprint", None)
+
+def write_fingerprint(structure, fingerprint):
+  dict_to_s3_json(
+    structure["state_bucket"],
+    fingerprint_key(structure),
+    {
+      "fingerprint": fingerprint,
+      "fingerprint_time": sql_utc_timestamp(time.gmtime())
+    }
+  )
+
+def source_unchanged(stored, current):
+  return (current != None) and (stored == current)
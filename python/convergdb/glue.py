@@ -1,15 +1,15 @@
-from convergdb_logging import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
 
 # !AWS GLUE INTERACTIONS
 import json
-import boto3
 import time
 import cStringIO
 import gzip
 
 # paginator needed
 def get_running_job_id(job_name, region):
-  client = boto3.client("glue", region_name = region)
+  client = aws_client('glue', region)
   next_token = ""
   while next_token != None:
     resp = None
@@ -32,7 +32,7 @@ def get_running_job_id(job_name, region):
 def get_current_job_dpu(job_name, run_id, region):
   try:
     if run_id != '':
-      client = boto3.client("glue", region_name = region)
+      client = aws_client('glue', region)
       resp = client.get_job_run(
         JobName = job_name,
         RunId = run_id
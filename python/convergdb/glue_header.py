@@ -9,7 +9,7 @@ from pyspark.conf import SparkConf
 from pyspark.sql import SQLContext
 from awsglue.job import Job
 
-from convergdb_logging import *
+from convergdb.convergdb_logging import convergdb_log
 
 args = getResolvedOptions(sys.argv, ['JOB_NAME', 'convergdb_lock_table','aws_region'])
 sc = SparkContext()
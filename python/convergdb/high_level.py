@@ -2,65 +2,182 @@ import json
 import sys
 import time
 
-from convergdb_logging import *
-from batch_control import *
-from locking import lock
-
-from athena import *
-from cloudwatch import *
-from glue import *
-from s3 import *
-from sns import *
-from spark_partitions import *
-from spark import *
-from state import *
-from add_partitions import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.arrow_load import arrow_data_load
+from convergdb.add_partitions import batch_file_count, update_all_partitions
+from convergdb.batch_control import (
+  batch_id,
+  can_split_batch,
+  control_file_key,
+  diff_s3a,
+  file_estimated_sizing,
+  file_loaded_record_lines,
+  file_sizing,
+  write_control_records
+)
+from convergdb.cassette import (
+  cassette_recording_enabled,
+  start_recording,
+  write_cassette
+)
+from convergdb.cloudwatch import (
+  buffer_phase_metrics,
+  flush_cloudwatch_metrics,
+  relation_metric
+)
+from convergdb.compression_sampling import compression_factors
+from convergdb.diff_order import load_order, ordered_diff
+from convergdb.fingerprint import (
+  get_stored_fingerprint,
+  source_fingerprint,
+  source_fingerprint_enabled,
+  source_unchanged,
+  write_fingerprint
+)
+from convergdb.glue import current_job_dpu
+from convergdb.locking import lock
+from convergdb.planner import (
+  batch_statistics_record,
+  budgeted_chunk_count,
+  budgeted_chunks,
+  estimated_load_seconds,
+  get_batch_statistics,
+  planned_chunk_count,
+  planned_spark_partitions,
+  record_batch_statistics,
+  run_budget
+)
+from convergdb.profiling import (
+  driver_profiling_enabled,
+  finish_profile,
+  start_profile,
+  write_profile
+)
+from convergdb.resources import local_resources
+from convergdb.s3 import delete_s3_objects
+from convergdb.s3_governor import (
+  counter_difference,
+  s3_governor_counters,
+  start_s3_governor
+)
+from convergdb.s3_inventory import inventory_file_diff
+from convergdb.sns import publish_sns_async, wait_for_sns
+from convergdb.spark import data_load
+from convergdb.spark_diff import (
+  finish_spark_diff,
+  spark_diff_chunk_count,
+  spark_diff_chunks,
+  spark_diff_enabled,
+  spark_file_diff,
+  summary_estimated_bytes
+)
+from convergdb.spark_metrics import buffer_spark_metrics
+from convergdb.spark_partitions import (
+  limited_chunk_count,
+  split_file_count,
+  split_indices
+)
+from convergdb.state import (
+  data_files_for_batch,
+  get_sizing_state,
+  get_state,
+  record_chunk_file_count,
+  state_allows_load,
+  write_load_in_progress,
+  write_success
+)
+from convergdb.streaming_snapshot import diff_inventory_function
+from convergdb.tracing import (
+  annotate_span,
+  finish_trace,
+  performance_report,
+  phase_totals,
+  span,
+  start_trace,
+  write_performance_report
+)
+
 
 # !HIGH LEVEL INTERACTIONS
 
 def remove_batch(structure, old_batch_id):
-  convergdb_log("removing batch: " + old_batch_id)
-  # first identify all data files to be deleted
-  delete_data_files = data_files_for_batch(
-    structure,
-    old_batch_id
-  )
-
-  s3 = boto3.client('s3')
-
-  if len(delete_data_files):
-    indices = split_indices(
-      len(delete_data_files),
-      1000
+  with span("remove_batch") as removal:
+    convergdb_log("removing batch: " + old_batch_id)
+    # first identify all data files to be deleted
+    delete_data_files = data_files_for_batch(
+      structure,
+      old_batch_id
     )
+    annotate_span(removal, items=len(delete_data_files))
 
-    for indx in indices:
-      delete_these = list(
-        map(
-          lambda fname: {"Key" : fname },
-          delete_data_files[indx[0]:(indx[1])]
-        )
+    s3 = aws_client('s3')
+
+    if len(delete_data_files):
+      indices = split_indices(
+        len(delete_data_files),
+        1000
       )
-      bucket = structure["storage_bucket"].split('/')[0]
-      convergdb_log("deleting " + str(len(delete_these)) + " objects from failed batch: " + str(old_batch_id))
-      s3.delete_objects(
-        Bucket=bucket,
-        Delete={'Objects': delete_these}
+
+      for indx in indices:
+        delete_these = delete_data_files[indx[0]:(indx[1])]
+        bucket = structure["storage_bucket"].split('/')[0]
+        convergdb_log("deleting " + str(len(delete_these)) + " objects from failed batch: " + str(old_batch_id))
+        with span("delete_objects") as s:
+          delete_s3_objects(s3, bucket, delete_these)
+          annotate_span(s, items=len(delete_these))
+
+    convergdb_log("removing control logs for batch: " + old_batch_id)
+    # delete control file for the given batch
+    s3.delete_object(
+      Bucket = structure["state_bucket"].split('/')[0],
+      Key = control_file_key(
+        structure,
+        old_batch_id
       )
+    )
+
+# cleans up a chunk that failed for lack of resources, then loads the same
+# files as two smaller chunks. each half is split again if it fails for the
+# same reason, down to minimum_split_file_count.
+def split_failed_batch(sql_context, structure, diff, source_map_func, dpu, failed_batch_id, failed_start_time, resources=None):
+  convergdb_log("chunk of " + str(len(diff)) + " files ran out of resources in batch: " + failed_batch_id)
+  remove_batch(
+    structure,
+    failed_batch_id
+  )
+  # clears the load_in_progress state left by the failed chunk
+  write_success(
+    structure,
+    failed_batch_id,
+    failed_start_time,
+    time.gmtime()
+  )
 
-  convergdb_log("removing control logs for batch: " + old_batch_id)
-  # delete control file for the given batch
-  s3.delete_object(
-    Bucket = structure["state_bucket"].split('/')[0],
-    Key = control_file_key(
+  split_size = split_file_count(len(diff))
+  convergdb_log("retrying chunk as splits of " + str(split_size) + " files")
+  for indx in split_indices(len(diff), split_size):
+    load_batch(
+      sql_context,
       structure,
-      old_batch_id
+      diff[indx[0]:(indx[1])],
+      source_map_func,
+      dpu,
+      resources
     )
+
+  # later runs start with chunks that are known to fit
+  record_chunk_file_count(
+    structure,
+    split_size
   )
 
-def load_batch(sql_context, structure, diff, source_map_func, dpu):
+# the state of the relation, after removing any batch left in progress by
+# an earlier run.
+def recovered_state(structure):
   # get the current state for this table.
-  current_state = get_state(structure)
+  with span("get_state"):
+    current_state = get_state(structure)
 
   # first let's perform any clean up from previous runs
   if current_state["state"] == "load_in_progress":
@@ -71,16 +188,143 @@ def load_batch(sql_context, structure, diff, source_map_func, dpu):
         current_state["batch_id"]
       )
       # write success state
-      write_success(
-        structure,
-        current_state["batch_id"],
-        this_start_time,
-        time.gmtime()
+      with span("write_success"):
+        write_success(
+          structure,
+          current_state["batch_id"],
+          this_start_time,
+          time.gmtime()
+        )
+      with span("get_state"):
+        current_state = get_state(structure)
+  return current_state
+
+# everything that follows the data load of a batch: partitions, control
+# records, state, statistics, metrics and notifications.
+def finish_batch(structure, diff, this_batch_id, this_start_time, load_metrics, bytes_to_load_compressed, bytes_to_load_uncompressed_estimate):
+  # refresh partitions
+  # msck_repair_table(structure)
+  with span("update_all_partitions") as s:
+    storage_keys = update_all_partitions(
+      structure["storage_bucket"].split('/')[0],
+      '/'.join(structure["storage_bucket"].split('/')[1:]),
+      structure['region']
+    )
+    annotate_span(s, items=len(storage_keys))
+  # spark does not report the number of files it wrote
+  load_metrics["files_written"] = batch_file_count(storage_keys, this_batch_id)
+
+  this_end_time = time.gmtime()
+
+  # these are the control records for the current diff. they are
+  # generated as they are written.
+  flr = file_loaded_record_lines(
+    structure,
+    [d["key"] for d in diff],
+    this_batch_id,
+    this_start_time,
+    this_end_time
+  )
+
+  # write control records
+  with span("write_control_records") as s:
+    record_count = write_control_records(
+      structure,
+      this_batch_id,
+      flr
+    )
+    annotate_span(s, items=record_count)
+
+  # write success state, including what spark did for the batch
+  with span("write_success"):
+    write_success(
+      structure,
+      this_batch_id,
+      this_start_time,
+      this_end_time,
+      load_metrics
+    )
+
+  # statistics used to plan later batches
+  with span("record_batch_statistics"):
+    record_batch_statistics(
+      structure,
+      batch_statistics_record(
+        this_batch_id,
+        len(diff),
+        bytes_to_load_compressed,
+        bytes_to_load_uncompressed_estimate,
+        load_metrics
       )
-      current_state = get_state(structure)
+    )
+
+  # metrics and notifications are sent in the background
+  with span("cloudwatch") as s:
+    # log cloudwatch metrics
+    relation_metric(
+      structure,
+      'batch_success',
+      1,
+      'Count',
+      this_batch_id
+    )
+
+    # log cloudwatch metrics
+    relation_metric(
+      structure,
+      'source_data_processed_uncompressed_estimate',
+      bytes_to_load_uncompressed_estimate,
+      'Bytes',
+      this_batch_id
+    )
+
+    # log cloudwatch metrics
+    relation_metric(
+      structure,
+      'source_data_processed',
+      bytes_to_load_compressed,
+      'Bytes',
+      this_batch_id
+    )
+
+    # log cloudwatch metrics
+    relation_metric(
+      structure,
+      'source_files_processed',
+      len(diff),
+      'Count',
+      this_batch_id
+    )
+    annotate_span(s, items=4)
+
+    buffer_spark_metrics(
+      structure,
+      load_metrics,
+      this_batch_id
+    )
+
+  # send sns success message
+  with span("sns"):
+    publish_sns_async(
+      structure["region"],
+      structure["sns_topic"],
+      "SUCCESS - ConvergDB - " + structure["full_relation_name"],
+      "files processed: " + str(len(diff)) + "\n" +
+      "bytes processed: " + str(bytes_to_load_uncompressed_estimate) + "\n"# +
+      "bytes processed (uncompressed estimate): " + str(bytes_to_load_uncompressed_estimate) + "\n"
+    )
+
+# resources describes the local cpu and memory when there is no dpu.
+def load_batch(sql_context, structure, diff, source_map_func, dpu, resources=None):
+  current_state = recovered_state(structure)
+
+  # statistics from recent batches are used to plan spark partitions
+  with span("get_batch_statistics") as s:
+    history = get_batch_statistics(structure)
+    annotate_span(s, items=len(history))
 
   # only proceed if not in a failure state
-  if (current_state["state"] in ["success", "unknown"]):
+  if state_allows_load(current_state):
     this_start_time = time.gmtime()
 
     # generate a timestamp sortable batch_id
@@ -95,131 +339,112 @@ def load_batch(sql_context, structure, diff, source_map_func, dpu):
 
     # only load if there are files
     if len(s3a_list) > 0:
-      write_load_in_progress(
-        structure,
-        this_batch_id,
-        this_start_time,
-        diff
-      )
+      with span("write_load_in_progress") as s:
+        write_load_in_progress(
+          structure,
+          this_batch_id,
+          this_start_time,
+          diff
+        )
+        annotate_span(s, items=len(diff))
 
       bytes_to_load_compressed = file_sizing(diff)
       convergdb_log("compressed byte size for this batch: " + str(bytes_to_load_compressed))
 
-      bytes_to_load_uncompressed_estimate = file_estimated_sizing(diff)
+      with span("compression_factors"):
+        factors = compression_factors(structure, diff)
+      bytes_to_load_uncompressed_estimate = file_estimated_sizing(
+        diff,
+        factors
+      )
       convergdb_log("uncompressed byte estimate for this batch: " + str(bytes_to_load_uncompressed_estimate))
-      data_load(
-        sql_context,
-        structure,
-        s3a_list,
-        None,
-        this_batch_id,
-
-        # the following are used in calculating the number of spark partitions
+      spark_partitions = planned_spark_partitions(
+        bytes_to_load_compressed,
         bytes_to_load_uncompressed_estimate,
-        len(diff),
         dpu, # None unless this is an aws_glue job
-        structure['spark_partition_count'] # override if not None
+        structure['spark_partition_count'], # override if not None
+        history,
+        resources
       )
 
-      # refresh partitions
-      # msck_repair_table(structure)
-      update_all_partitions(
-        structure["storage_bucket"].split('/')[0],
-        '/'.join(structure["storage_bucket"].split('/')[1:]),
-        structure['region']
-      )
-
-      this_end_time = time.gmtime()
-
-      # these are the control records for the current diff
-      flr = file_loaded_records(
+      try:
+        with span("data_load") as s:
+          annotate_span(s, bytes=bytes_to_load_compressed, items=len(diff))
+          # small batches are loaded without spark when the relation allows
+          load_metrics = arrow_data_load(
+            structure,
+            s3a_list,
+            this_batch_id,
+            bytes_to_load_uncompressed_estimate
+          )
+          if load_metrics == None:
+            load_metrics = data_load(
+              sql_context,
+              structure,
+              s3a_list,
+              None,
+              this_batch_id,
+
+              # the following are used in calculating the number of spark partitions
+              bytes_to_load_uncompressed_estimate,
+              len(diff),
+              dpu, # None unless this is an aws_glue job
+              structure['spark_partition_count'], # override if not None
+              spark_partitions
+            )
+      except Exception as e:
+        if can_split_batch(structure, diff, e):
+          with span("split_failed_batch") as s:
+            annotate_span(s, bytes=bytes_to_load_compressed, items=len(diff))
+            split_failed_batch(
+              sql_context,
+              structure,
+              diff,
+              source_map_func,
+              dpu,
+              this_batch_id,
+              this_start_time,
+              resources
+            )
+          return
+        else:
+          raise
+
+      finish_batch(
         structure,
-        diff_paths,
+        diff,
         this_batch_id,
         this_start_time,
-        this_end_time
-      )
-
-      # write control records
-      write_control_records(
-        structure,
-        this_batch_id,
-        flr
-      )
-
-      # write success state
-      write_success(
-        structure,
-        this_batch_id,
-        this_start_time,
-        this_end_time
-      )
-
-      # log cloudwatch metrics
-      put_cloudwatch_metric(
-        structure["region"],
-        structure['cloudwatch_namespace'],
-        'batch_success',
-        1,
-        'Count'
-      )
-
-      # log cloudwatch metrics
-      put_cloudwatch_metric(
-        structure["region"],
-        structure['cloudwatch_namespace'],
-        'source_data_processed_uncompressed_estimate',
-        bytes_to_load_uncompressed_estimate,
-        'Bytes'
-      )
-
-      # log cloudwatch metrics
-      put_cloudwatch_metric(
-        structure["region"],
-        structure['cloudwatch_namespace'],
-        'source_data_processed',
+        load_metrics,
         bytes_to_load_compressed,
-        'Bytes'
-      )
-
-      # log cloudwatch metrics
-      put_cloudwatch_metric(
-        structure["region"],
-        structure['cloudwatch_namespace'],
-        'source_files_processed',
-        len(diff),
-        'Count'
-      )
-
-      # send sns success message
-      publish_sns(
-        structure["region"],
-        structure["sns_topic"],
-        "SUCCESS - ConvergDB - " + structure["full_relation_name"],
-        "files processed: " + str(len(diff)) + "\n" +
-        "bytes processed: " + str(bytes_to_load_uncompressed_estimate) + "\n"# +
-        "bytes processed (uncompressed estimate): " + str(bytes_to_load_uncompressed_estimate) + "\n"
+        bytes_to_load_uncompressed_estimate
       )
     else:
-      convergdb_log("no new data to load for relation: " + structure["full_relation_name"])
+      report_no_new_data(structure)
 
-      # log cloudwatch metrics
-      put_cloudwatch_metric(
-        structure["region"],
-        structure['cloudwatch_namespace'],
-        'batch_success',
-        1,
-        'Count'
-      )
+# reports a successful run that found nothing to load
+def report_no_new_data(structure):
+  convergdb_log("no new data to load for relation: " + structure["full_relation_name"])
 
-      publish_sns(
-        structure["region"],
-        structure["sns_topic"],
-        "SUCCESS - ConvergDB - " + structure["full_relation_name"],
-        "files processed: " + str(0) + "\n" +
-        "bytes processed: " + str(0) + "\n"# +
-        "bytes processed (uncompressed estimate): " + str(0) + "\n"
-      )
+  # log cloudwatch metrics
+  with span("cloudwatch") as s:
+    relation_metric(
+      structure,
+      'batch_success',
+      1,
+      'Count'
+    )
+    annotate_span(s, items=1)
+
+  with span("sns"):
+    publish_sns_async(
+      structure["region"],
+      structure["sns_topic"],
+      "SUCCESS - ConvergDB - " + structure["full_relation_name"],
+      "files processed: " + str(0) + "\n" +
+      "bytes processed: " + str(0) + "\n"# +
+      "bytes processed (uncompressed estimate): " + str(0) + "\n"
+    )
 
 # set s3 encrption in hadoop configuration
 def sse_config(sql_context, sse_algorithm, kms_master_key_id):
@@ -238,7 +463,7 @@ def set_bucket_sse(sql_context, bucket):
   try:
     sse_algorithm = ""
     kms_master_key_id = ""
-    s3 = boto3.client('s3')
+    s3 = aws_client('s3')
     bucket = bucket.split('/')[0]
     response = s3.get_bucket_encryption(Bucket = bucket)
     
@@ -259,79 +484,199 @@ def set_bucket_sse(sql_context, bucket):
       raise
 
 # high level procedure transforms data from the source to the target,
-# using idempotent producer/consumer ETL pattern.
+# using idempotent producer/consumer ETL pattern. every phase is timed,
+# and a performance report is written for the run whatever the outcome.
 @lock
 def source_to_target(sql_context, structure_json):
+  start_trace("source_to_target")
+  outcome = "failure"
+  profile = None
+  recorder = None
   try:
     # first parse the json representation of the structure into a dict
     structure = json.loads(structure_json)
     # start time is used for batch_id
     start_time = time.gmtime()
+    # read by the performance report, so it is set before anything
+    # else can fail.
+    s3_counters = s3_governor_counters()
+    budget = run_budget(structure)
+
+    # paces s3 requests and retries throttled ones
+    start_s3_governor()
+
+    # cpu and memory profile of the python driver, when turned on
+    if driver_profiling_enabled(structure):
+      convergdb_log("profiling the driver for this run")
+      profile = start_profile()
+
+    # every AWS response of the run, so that it can be replayed offline
+    if cassette_recording_enabled(structure):
+      convergdb_log("recording AWS calls for this run")
+      recorder = start_recording()
 
     # set storage bucket encrption for aws_fargate
     if structure['etl_technology'] == 'aws_fargate':
-      set_bucket_sse(sql_context, structure["storage_bucket"])
+      with span("set_bucket_sse"):
+        set_bucket_sse(sql_context, structure["storage_bucket"])
 
     dpu = None
+    resources = None
     # determine the number of DPUs applied to the current run
-    if structure["etl_technology"] == 'aws_glue':
-      dpu = current_job_dpu(
-        structure["etl_job_name"],
-        structure["region"]
-      )
-      convergdb_log("dpu for current_job: " + str(dpu))
-    elif structure["etl_technology"] == 'aws_fargate':
-      dpu = None
+    with span("resources"):
+      if structure["etl_technology"] == 'aws_glue':
+        dpu = current_job_dpu(
+          structure["etl_job_name"],
+          structure["region"]
+        )
+        convergdb_log("dpu for current_job: " + str(dpu))
+      elif structure["etl_technology"] == 'aws_fargate':
+        dpu = None
+        # cpu and memory of this container, as used to configure spark
+        resources = local_resources()
+
+    # compare a cheap fingerprint of the source with the one stored by
+    # the last complete run, and skip the diff when nothing has changed.
+    fingerprint = None
+    if source_fingerprint_enabled(structure):
+      with span("source_fingerprint"):
+        stored_fingerprint = get_stored_fingerprint(structure)
+        fingerprint = source_fingerprint(structure, stored_fingerprint)
+      convergdb_log("source fingerprint: " + str(fingerprint))
+      if source_unchanged(stored_fingerprint, fingerprint):
+        convergdb_log("source unchanged since the last complete run")
+        report_no_new_data(structure)
+        outcome = "unchanged"
+        return
 
     # gets a list of files from the diff process
     # this process may be API based or s3 inventory based
-    diff = file_diff(
-      structure
-    )
-    convergdb_log("loadable file count: " + str(len(diff)))
-
-    source_bytes = file_sizing(diff)
-    convergdb_log("total loadable bytes (compressed): " + str(source_bytes))
-
-    chunk_size = calculate_chunk_count(
-      source_bytes,
-      len(diff),
-      dpu
-    )
+    distributed = None
+    with span("file_diff") as s:
+      if spark_diff_enabled(structure):
+        # the diff stays in spark. only a sample of it is on the driver,
+        # which is enough for compression sampling.
+        distributed = spark_file_diff(
+          sql_context,
+          structure,
+          diff_inventory_function(structure)
+        )
+        diff = distributed["sample"]
+        file_count = distributed["summary"]["file_count"]
+        source_bytes = distributed["summary"]["bytes"]
+      else:
+        diff = inventory_file_diff(
+          structure
+        )
+        file_count = len(diff)
+        source_bytes = file_sizing(diff)
+      convergdb_log("loadable file count: " + str(file_count))
+      convergdb_log("total loadable bytes (compressed): " + str(source_bytes))
+      annotate_span(s, bytes=source_bytes, items=file_count)
+
+    # measured decompression ratios for the files in this diff
+    with span("compression_factors"):
+      factors = compression_factors(structure, diff)
+    if distributed != None:
+      estimated_bytes = summary_estimated_bytes(distributed["summary"], factors)
+    else:
+      estimated_bytes = file_estimated_sizing(
+        diff,
+        factors
+      )
+    convergdb_log("total loadable bytes (uncompressed estimate): " + str(estimated_bytes))
+
+    with span("plan_chunks"):
+      history = get_batch_statistics(structure)
+      chunk_size = planned_chunk_count(
+        source_bytes,
+        estimated_bytes,
+        file_count,
+        dpu,
+        history,
+        resources
+      )
+      chunk_size = limited_chunk_count(
+        chunk_size,
+        get_sizing_state(structure)
+      )
     convergdb_log("max files per batch: " + str(chunk_size))
-
-    # tuples of (lo, hi) index ranges for arrays.
-    # note that these are correct, unlike python indexes.
-    indices = split_indices(
-      len(diff),
-      chunk_size
-    )
-    convergdb_log("number of splits for this run: " + str(len(indices)))
-
-    for indx in indices:
-      convergdb_log("processing split for index range: " + str(indx[0]) + ":" + str(indx[1]))
-      this_diff = diff[indx[0]:(indx[1])]
-      load_batch(
-        sql_context,
-        structure,
-        this_diff,
-        None,
-        dpu
+    convergdb_log("estimated load time from recent batches: " + str(estimated_load_seconds(source_bytes, history)) + " seconds")
+
+    if distributed != None:
+      # files are hashed into chunks, and each chunk is collected
+      # from spark just before it is loaded.
+      chunk_count = spark_diff_chunk_count(file_count, chunk_size)
+      convergdb_log("number of splits for this run: " + str(chunk_count))
+      if load_order(structure) != "listed":
+        convergdb_log("load_order is not applied to spark diff chunks")
+      chunks = spark_diff_chunks(distributed, chunk_count)
+      chunk_bytes = [source_bytes / max(1, chunk_count)] * chunk_count
+    else:
+      diff = ordered_diff(structure, diff, chunk_size)
+      # tuples of (lo, hi) index ranges for arrays.
+      # note that these are correct, unlike python indexes.
+      indices = split_indices(
+        len(diff),
+        chunk_size
       )
+      convergdb_log("number of splits for this run: " + str(len(indices)))
+      chunks = [diff[indx[0]:(indx[1])] for indx in indices]
+      chunk_bytes = [file_sizing(c) for c in chunks]
+
+    if budget["seconds"] != None:
+      convergdb_log("run budget of " + str(budget["seconds"]) + " seconds fits " + str(budgeted_chunk_count(budget, [estimated_load_seconds(b, history) for b in chunk_bytes])) + " of " + str(len(chunk_bytes)) + " splits")
+
+    # files in chunks that did not fit in the run budget
+    deferred_files = file_count
+    estimate = lambda c: estimated_load_seconds(file_sizing(c), history)
+    for this_diff in budgeted_chunks(budget, chunks, estimate):
+      deferred_files -= len(this_diff)
+      convergdb_log("processing split of " + str(len(this_diff)) + " files")
+      with span("load_batch") as s:
+        annotate_span(s, bytes=file_sizing(this_diff), items=len(this_diff))
+        load_batch(
+          sql_context,
+          structure,
+          this_diff,
+          None,
+          dpu,
+          resources
+        )
+
+    if distributed != None:
+      finish_spark_diff(distributed)
+    if deferred_files > 0:
+      # the next run loads the rest of the diff, so the fingerprint
+      # of this source is not stored.
+      convergdb_log(str(deferred_files) + " files deferred to the next run by the run budget")
+      relation_metric(structure, 'deferred_files', deferred_files, 'Count')
+      outcome = "deferred"
+    elif not state_allows_load(get_state(structure)):
+      # load_batch skips every chunk of a relation in a failure state,
+      # so the diff is still to be loaded once the state is cleared.
+      convergdb_log("relation state does not allow loading, the fingerprint is not stored")
+      outcome = "skipped"
+    else:
+      # every file in the diff is loaded, so later runs can skip
+      # the diff until the fingerprint changes.
+      if fingerprint != None:
+        with span("write_fingerprint"):
+          write_fingerprint(structure, fingerprint)
+      outcome = "success"
   except:
     if 'structure' in vars():
       convergdb_log("error in processing relation: " + structure["full_relation_name"] + str(sys.exc_info()[0]))
       # log cloudwatch metrics
-      put_cloudwatch_metric(
-        structure["region"],
-        structure['cloudwatch_namespace'],
+      relation_metric(
+        structure,
         'batch_failure',
         1,
         'Count'
       )
 
       # send sns success message
-      publish_sns(
+      publish_sns_async(
         structure["region"],
         structure["sns_topic"],
         "FAILURE - ConvergDB - " + structure["full_relation_name"],
@@ -341,3 +686,27 @@ def source_to_target(sql_context, structure_json):
     else:
       convergdb_log("error in processing relation")
       raise
+  finally:
+    root = finish_trace()
+    if 'start_time' in vars():
+      run_id = batch_id(start_time)
+      write_performance_report(
+        structure,
+        performance_report(
+          structure,
+          run_id,
+          outcome,
+          root,
+          counter_difference(s3_counters, s3_governor_counters())
+        )
+      )
+      buffer_phase_metrics(structure, phase_totals(root), run_id)
+      if profile != None:
+        write_profile(structure, run_id, finish_profile(profile))
+      if recorder != None:
+        write_cassette(structure, structure_json, run_id, recorder)
+      # the process may exit after this run, so the background
+      # metrics and notifications are given time to finish.
+      flush_seconds = float(structure.get("metrics_flush_seconds", 30))
+      flush_cloudwatch_metrics(flush_seconds)
+      wait_for_sns(flush_seconds)
@@ -1,5 +1,6 @@
 from __future__ import print_function
-from convergdb_logging import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.resources import local_master, local_resources, local_spark_settings
 
 # header will differ in glue
 import time
@@ -10,7 +11,11 @@ import boto3
 from pyspark import SparkConf, SparkContext
 from pyspark.sql import SQLContext
 
-conf = SparkConf().setMaster("local").setAppName("glue testing")
+# spark is sized to the cpu and memory limits of this container
+resources = local_resources()
+conf = SparkConf().setMaster(local_master(resources)).setAppName("glue testing")
+for setting in local_spark_settings(resources):
+  conf.set(setting[0], setting[1])
 sc = SparkContext(conf = conf)
 
 if os.environ.get('AWS_SESSION_TOKEN'):
@@ -1,21 +1,28 @@
-import boto3
 import os
 import time
 import uuid
 
-from convergdb_logging import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.s3 import client_error_code
 from functools import wraps
 
 def dynamodb_client():
   if os.environ.has_key('AWS_GLUE_REGION'):
-    return boto3.client('dynamodb', region_name=os.environ['AWS_GLUE_REGION'])
+    return aws_client('dynamodb', os.environ['AWS_GLUE_REGION'])
   else:
-    return boto3.client('dynamodb')
+    return aws_client('dynamodb')
 
-lock_table = os.environ['LOCK_TABLE']
-lock_id = os.environ['LOCK_ID']
+# the lock table and the id of the job holding the lock are set in the
+# environment by the job script, which may happen after convergdb is
+# imported, so they are read when the lock is taken.
+def current_lock_table(environ=os.environ):
+  return environ.get('LOCK_TABLE', None)
 
-def acquire_lock(owner_id):
+def current_lock_id(environ=os.environ):
+  return environ.get('LOCK_ID', None)
+
+def acquire_lock(owner_id, lock_table, lock_id):
     put_params = {
         'TableName': lock_table,
         'Item': {
@@ -36,7 +43,7 @@ def acquire_lock(owner_id):
     convergdb_log("Lock acquired: [" + lock_id + "]")
 
 
-def release_lock(owner_id):
+def release_lock(owner_id, lock_table, lock_id):
     delete_params = {
         'TableName': lock_table,
         'ConditionExpression': 'OwnerID = :OwnerID',
@@ -57,12 +64,18 @@ def release_lock(owner_id):
     dynamodb_client().delete_item(**delete_params)
     convergdb_log("Lock released: [" + lock_id + "]")
 
+# the lock is held by another run, which is not a failure of this one
+def is_lock_conflict(error):
+  return client_error_code(error) == 'ConditionalCheckFailedException'
+
 def lock(function):
 
     @wraps(function)
     def wrapper(*args, **kwargs):
 
         # Validate environment variables exist
+        lock_table = current_lock_table()
+        lock_id = current_lock_id()
         assert lock_table != None
         assert lock_id != None
 
@@ -71,7 +84,7 @@ def lock(function):
         
         err = None
         try:
-            acquire_lock(owner_id)
+            acquire_lock(owner_id, lock_table, lock_id)
             # LOCKED at this point. Single execution in progress here.
             # - Business logic should be resilient to partial or subsequent
             #   execution (but not concurrent execution).
@@ -82,7 +95,7 @@ def lock(function):
         finally:
             # release the lock
             # if this fails.. it will raise an exception
-            release_lock(owner_id)
+            release_lock(owner_id, lock_table, lock_id)
             
             # raise previous exception
             if err:
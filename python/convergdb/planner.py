@@ -0,0 +1,234 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.s3 import dict_to_s3_json, s3_json_to_dict
+from convergdb.spark_partitions import (
+  available_memory_in_this_cluster,
+  calculate_chunk_count,
+  calculate_spark_partitions,
+  output_partition_target,
+  planning_core_count
+)
+from convergdb.state import state_folder_prefix
+
+import math
+import time
+
+# !BATCH STATISTICS
+
+# statistics for recent batches are kept next to the relation state.
+def batch_statistics_key(structure):
+  return state_folder_prefix(structure) + "/batch_statistics.json"
+
+# number of recent batches used when learning the behavior of a relation
+def batch_statistics_window(structure):
+  return int(structure.get("batch_statistics_window", 20))
+
+# returns a list of batch statistics records, oldest first
+def get_batch_statistics(structure):
+  return s3_json_to_dict(
+    structure["state_bucket"],
+    batch_statistics_key(structure)
+  ).get("batches", [])
+
+def write_batch_statistics(structure, history):
+  dict_to_s3_json(
+    structure["state_bucket"],
+    batch_statistics_key(structure),
+    {"batches": history}
+  )
+
+# creates the statistics record for one batch. load_metrics is the dict
+# returned by data_load.
+def batch_statistics_record(batch_id, file_count, input_bytes, input_bytes_estimate, load_metrics):
+  return {
+    "batch_id": batch_id,
+    "file_count": file_count,
+    "input_bytes": input_bytes,
+    "input_bytes_estimate": input_bytes_estimate,
+    "output_bytes": load_metrics.get("output_bytes"),
+    "input_records": load_metrics.get("input_records"),
+    "output_records": load_metrics.get("output_records"),
+    "peak_executor_memory": load_metrics.get("peak_execution_memory"),
+    "spark_partitions": load_metrics.get("spark_partitions"),
+    "duration": load_metrics.get("duration"),
+    "engine": load_metrics.get("engine", "spark"),
+    "files_written": load_metrics.get("files_written")
+  }
+
+# appends a record to the history, keeping only the most recent window.
+def appended_batch_statistics(history, record, window):
+  return (history + [record])[-window:]
+
+# statistics are only used for planning, so a failure to record them
+# never fails the batch.
+def record_batch_statistics(structure, record):
+  try:
+    write_batch_statistics(
+      structure,
+      appended_batch_statistics(
+        get_batch_statistics(structure),
+        record,
+        batch_statistics_window(structure)
+      )
+    )
+  except Exception as e:
+    convergdb_log("unable to record batch statistics: " + str(e))
+
+# !LEARNED RATIOS
+
+# sum of numerator over sum of denominator for the records where
+# both values are known. returns None if there are no such records.
+def ratio_of_sums(history, numerator, denominator):
+  usable = [h for h in history if h.get(numerator) and h.get(denominator)]
+  if len(usable) == 0:
+    return None
+  else:
+    return float(sum([h[numerator] for h in usable])) / float(sum([h[denominator] for h in usable]))
+
+# bytes written to the target for each compressed source byte
+def observed_output_ratio(history):
+  return ratio_of_sums(history, "output_bytes", "input_bytes")
+
+# batches loaded by spark. batches loaded by the arrow engine say nothing
+# about the throughput of spark.
+def spark_batches(history):
+  return [h for h in history if h.get("engine", "spark") == "spark"]
+
+# files written for each spark partition. a task writes one file for each
+# target partition that its rows fall in.
+def observed_files_per_spark_partition(history):
+  return ratio_of_sums(spark_batches(history), "files_written", "spark_partitions")
+
+# compressed source bytes loaded per second
+def observed_throughput(history):
+  return ratio_of_sums(spark_batches(history), "input_bytes", "duration")
+
+# executor memory needed for each compressed source byte. peak memory is
+# reported per task, and each spark partition is a task in the write stage.
+def observed_expansion_ratio(history):
+  usable = [
+    h for h in history
+    if h.get("peak_executor_memory") and h.get("spark_partitions") and h.get("input_bytes")
+  ]
+  if len(usable) == 0:
+    return None
+  else:
+    return float(
+      sum([h["peak_executor_memory"] * h["spark_partitions"] for h in usable])
+    ) / float(
+      sum([h["input_bytes"] for h in usable])
+    )
+
+# estimated seconds to load the given number of compressed bytes.
+# returns None if the throughput of the relation is not known yet.
+def estimated_load_seconds(compressed_bytes, history):
+  throughput = observed_throughput(history)
+  if throughput == None:
+    return None
+  else:
+    return compressed_bytes / throughput
+
+# !PLANNING
+
+# number of files per chunk. uses the memory observed in recent batches,
+# falling back to calculate_chunk_count with the estimated uncompressed
+# bytes when there is no history.
+def planned_chunk_count(compressed_bytes, estimated_bytes, file_count, dpu, history, resources=None):
+  ratio = observed_expansion_ratio(history)
+  if ratio == None:
+    convergdb_log("no batch history with memory metrics... using estimated uncompressed size")
+    return max(1, calculate_chunk_count(estimated_bytes, file_count, dpu, resources))
+  convergdb_log("observed memory expansion ratio: " + str(ratio))
+  chunks = int(
+    max(
+      1,
+      compressed_bytes * ratio / available_memory_in_this_cluster(dpu, resources)
+    )
+  )
+  return max(1, file_count / chunks)
+
+# number of spark partitions for a batch. uses the output size observed in
+# recent batches, falling back to calculate_spark_partitions when there is
+# no history. the spark_partition_count override is for glue jobs, where it
+# always wins. fargate and local runs (no dpu) ignore it.
+def planned_spark_partitions(compressed_bytes, estimated_bytes, dpu, spark_partition_count, history, resources=None):
+  ratio = observed_output_ratio(history)
+  if (spark_partition_count and dpu) or (ratio == None):
+    return calculate_spark_partitions(
+      estimated_bytes,
+      dpu,
+      spark_partition_count,
+      resources
+    )
+  convergdb_log("observed output ratio: " + str(ratio))
+  partitions = output_partition_target(
+    planning_core_count(dpu, resources),
+    compressed_bytes * ratio
+  )
+  convergdb_log("job will be run with " + str(partitions) + " partitions")
+  return int(partitions)
+
+# number of files a batch written with the given spark partitions is
+# expected to produce. without history, each spark partition is expected
+# to write a single file.
+def estimated_output_files(spark_partitions, history):
+  ratio = observed_files_per_spark_partition(history)
+  if ratio == None:
+    return spark_partitions
+  return int(math.ceil(spark_partitions * ratio))
+
+# !RUN BUDGET
+
+# seconds a run may take from its start, from run_budget_seconds. the
+# time needed at the end of the run to flush metrics is kept in reserve.
+# seconds is None when the relation has no budget.
+def run_budget(structure, clock=time.time):
+  seconds = float(structure.get("run_budget_seconds", 0))
+  return {
+    "seconds": seconds if seconds > 0 else None,
+    "reserve": float(structure.get("metrics_flush_seconds", 30)),
+    "started": clock(),
+    "clock": clock
+  }
+
+def budget_seconds_left(budget):
+  return budget["seconds"] - budget["reserve"] - (budget["clock"]() - budget["started"])
+
+# number of chunks, in load order, whose estimated load times fit in the
+# seconds left. chunks without an estimate are expected to fit, and the
+# first chunk is always loaded.
+def budgeted_chunk_count(budget, estimates):
+  if budget["seconds"] == None:
+    return len(estimates)
+  left = budget_seconds_left(budget)
+  ret = 0
+  for e in estimates:
+    left -= e or 0
+    if (left < 0) and (ret > 0):
+      break
+    ret += 1
+  return ret
+
+# checked before each chunk, so that the run stops between chunks instead
+# of being killed in one. without throughput history, only a spent budget
+# stops the run. the first chunk of a run is always loaded, so that a
+# relation whose chunks take longer than its budget still makes progress.
+def budget_allows(budget, estimate, chunks_loaded):
+  if budget["seconds"] == None:
+    return True
+  left = budget_seconds_left(budget)
+  if (left <= 0) or ((estimate != None) and (estimate > left)):
+    if chunks_loaded == 0:
+      convergdb_log("run budget: " + str(int(left)) + " seconds left, first chunk estimated at " + str(estimate) + " seconds... loading it anyway")
+      return True
+    convergdb_log("run budget: " + str(int(left)) + " seconds left, next chunk estimated at " + str(estimate) + " seconds... deferring the rest of the diff")
+    return False
+  return True
+
+# the chunks that fit in the run budget, in load order
+def budgeted_chunks(budget, chunks, estimate_function):
+  loaded = 0
+  for chunk in chunks:
+    if not budget_allows(budget, estimate_function(chunk), loaded):
+      return
+    loaded += 1
+    yield chunk
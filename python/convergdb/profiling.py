@@ -0,0 +1,116 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.s3 import stream_to_s3
+from convergdb.state import state_folder_prefix
+from convergdb.tracing import span_end_hooks
+
+import cProfile
+import cStringIO
+import json
+import marshal
+import os
+import pstats
+import resource
+
+# tracemalloc is only available from python 3.4
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# !DRIVER PROFILING
+
+# profiling can be turned on for every relation of a job with this
+# environment variable, or for one relation in its structure.
+profile_environment_variable = 'CONVERGDB_PROFILE'
+
+# number of functions listed in the text summary
+profile_summary_limit = 50
+
+def driver_profiling_enabled(structure, environ=os.environ):
+  flag = structure.get(
+    "driver_profiling",
+    environ.get(profile_environment_variable, "false")
+  )
+  return str(flag).lower() in ["true", "1"]
+
+# python heap usage when tracemalloc is tracing. otherwise the peak
+# resident size of the driver process, which is all that python 2 offers.
+def memory_usage():
+  if (tracemalloc != None) and tracemalloc.is_tracing():
+    current, peak = tracemalloc.get_traced_memory()
+    return {"source": "tracemalloc", "current_bytes": current, "peak_bytes": peak}
+  else:
+    # ru_maxrss is in kilobytes on linux
+    return {
+      "source": "getrusage",
+      "current_bytes": None,
+      "peak_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+# memory usage at the end of a traced phase
+def memory_snapshot(s):
+  ret = memory_usage()
+  ret["phase"] = s["name"]
+  ret["end"] = s["start"] + s["duration"]
+  return ret
+
+# starts profiling the driver. memory is recorded at every phase boundary.
+def start_profile():
+  profile = {
+    "profiler": cProfile.Profile(),
+    "snapshots": []
+  }
+  profile["hook"] = lambda s: profile["snapshots"].append(memory_snapshot(s))
+  if tracemalloc != None:
+    tracemalloc.start()
+  span_end_hooks.append(profile["hook"])
+  profile["profiler"].enable()
+  return profile
+
+def finish_profile(profile):
+  profile["profiler"].disable()
+  if profile["hook"] in span_end_hooks:
+    span_end_hooks.remove(profile["hook"])
+  profile["snapshots"].append(
+    memory_snapshot({"name": "finish", "start": 0.0, "duration": 0.0})
+  )
+  if tracemalloc != None:
+    tracemalloc.stop()
+  return profile
+
+# the slowest functions by cumulative time, as printed by pstats
+def profile_summary(profiler, limit=profile_summary_limit):
+  out = cStringIO.StringIO()
+  stats = pstats.Stats(profiler, stream=out)
+  stats.sort_stats('cumulative').print_stats(limit)
+  return out.getvalue()
+
+# the uploaded files, by suffix. the pstats file is in the format written
+# by dump_stats, so it can be loaded with pstats or snakeviz.
+def profile_artifacts(profile):
+  profiler = profile["profiler"]
+  profiler.create_stats()
+  return {
+    "pstats": marshal.dumps(profiler.stats),
+    "txt": profile_summary(profiler),
+    "memory.json": json.dumps(profile["snapshots"])
+  }
+
+def profile_key(structure, run_id, suffix):
+  return state_folder_prefix(structure) + "/profiles/" + run_id + "." + suffix
+
+# uploads the profile next to the relation state. profiling must never
+# cause the run to fail.
+def write_profile(structure, run_id, profile, write_function=stream_to_s3):
+  try:
+    artifacts = profile_artifacts(profile)
+    for suffix in sorted(artifacts.keys()):
+      key = profile_key(structure, run_id, suffix)
+      convergdb_log("writing driver profile to s3://" + structure["state_bucket"] + "/" + key)
+      write_function(
+        structure["state_bucket"],
+        key,
+        artifacts[suffix]
+      )
+  except Exception as e:
+    convergdb_log("unable to write driver profile: " + str(e))
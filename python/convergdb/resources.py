@@ -0,0 +1,104 @@
+from convergdb.convergdb_logging import convergdb_log
+
+import multiprocessing
+
+# !EXECUTION RESOURCES
+
+# portion of the container memory given to the spark driver jvm. the rest
+# is left for python, off heap buffers and the operating system.
+driver_memory_portion = 0.75
+
+# returns the stripped content of a file, or None if it can not be read.
+def read_resource_file(path):
+  try:
+    with open(path) as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+# cgroup v2 cpu.max contains "<quota> <period>", with "max" for no limit.
+def cgroup_v2_cpu_limit(content):
+  if content == None:
+    return None
+  values = content.split()
+  if (len(values) != 2) or (values[0] == 'max'):
+    return None
+  return float(values[0]) / float(values[1])
+
+# cgroup v1 uses a quota of -1 for no limit.
+def cgroup_v1_cpu_limit(quota, period):
+  if (quota == None) or (period == None) or (int(quota) <= 0):
+    return None
+  return float(quota) / float(period)
+
+# cpu limit of this container, or None if there is no limit.
+def cgroup_cpu_limit(read_function=read_resource_file):
+  v2 = cgroup_v2_cpu_limit(
+    read_function('/sys/fs/cgroup/cpu.max')
+  )
+  if v2 != None:
+    return v2
+  return cgroup_v1_cpu_limit(
+    read_function('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'),
+    read_function('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+  )
+
+# memory limit of this container, or None if there is no limit. cgroup v1
+# reports a very large number when there is no limit.
+def cgroup_memory_limit(read_function=read_resource_file):
+  for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+    content = read_function(path)
+    if content and (content != 'max') and (int(content) < 2**60):
+      return int(content)
+  return None
+
+# total memory of the host from /proc/meminfo
+def physical_memory(read_function=read_resource_file):
+  content = read_function('/proc/meminfo')
+  if content:
+    for line in content.split("\n"):
+      if line.startswith('MemTotal:'):
+        return int(line.split()[1]) * 1024
+  return None
+
+# describes the cpu cores and memory available to this process. the same
+# description is used to configure spark and to plan the batches.
+def local_resources(read_function=read_resource_file, cpu_count=None):
+  cores = cpu_count or multiprocessing.cpu_count()
+  limit = cgroup_cpu_limit(read_function)
+  if limit != None:
+    cores = min(cores, max(1, int(limit)))
+  memory = cgroup_memory_limit(read_function)
+  if memory == None:
+    memory = physical_memory(read_function)
+  ret = {
+    "cores": cores,
+    "memory_bytes": memory
+  }
+  convergdb_log("local resources: " + str(ret))
+  return ret
+
+def local_master(resources):
+  return "local[" + str(resources["cores"]) + "]"
+
+# spark and s3a settings for a single node spark application, sized
+# from the resource description.
+def local_spark_settings(resources):
+  cores = resources["cores"]
+  settings = [
+    ("spark.sql.shuffle.partitions", str(cores * 2)),
+    ("spark.default.parallelism", str(cores * 2)),
+    ("spark.hadoop.fs.s3a.connection.maximum", str(max(15, cores * 8))),
+    ("spark.hadoop.fs.s3a.threads.max", str(max(10, cores * 4))),
+    ("spark.hadoop.fs.s3a.fast.upload", "true"),
+    ("spark.hadoop.fs.s3a.fast.upload.buffer", "disk"),
+    ("spark.hadoop.fs.s3a.fast.upload.active.blocks", str(max(4, cores * 2)))
+  ]
+  if resources["memory_bytes"]:
+    settings.append(
+      (
+        "spark.driver.memory",
+        str(int(resources["memory_bytes"] * driver_memory_portion / (1024**2))) + "m"
+      )
+    )
+  return settings
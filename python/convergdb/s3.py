@@ -1,28 +1,159 @@
-from convergdb_logging import *
-from convergdb.batch_control import *
-from convergdb.athena import *
-from convergdb.cloudwatch import *
-from convergdb.glue import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.s3_governor import (
+  backoff_seconds,
+  count,
+  s3_governor,
+  s3_governor_max_attempts,
+  throttle_error_codes
+)
 
 import sys
 import json
-import boto3
+import codecs
+import datetime
+import itertools
+import mmap
+import tempfile
+import threading
 import time
 import cStringIO
 import gzip
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# !STREAMING UPLOADS
+
+# bytes buffered before a part is uploaded. s3 requires every part but the
+# last to be at least 5 MiB.
+stream_part_size = 8 * 1024**2
+
+# parts uploaded at the same time. at most this many parts, plus the one
+# being filled, are held in memory.
+stream_upload_threads = 4
+
+# gzip compresses a sequence of strings as they are produced
+def gzip_chunks(chunks, level=6):
+  c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  for chunk in chunks:
+    out = c.compress(chunk)
+    if out:
+      yield out
+  yield c.flush()
+
+# the records with the separator between them, as "separator".join would
+def separated(records, separator="\n"):
+  first = True
+  for r in records:
+    if not first:
+      yield separator
+    first = False
+    yield r
+
+# groups a sequence of strings into parts of at least part_size bytes
+def upload_parts(chunks, part_size):
+  buffer = []
+  size = 0
+  for chunk in chunks:
+    if isinstance(chunk, unicode):
+      chunk = chunk.encode('utf-8')
+    buffer.append(chunk)
+    size += len(chunk)
+    if size >= part_size:
+      yield ''.join(buffer)
+      buffer = []
+      size = 0
+  if size > 0:
+    yield ''.join(buffer)
+
+# uploads a string, or a sequence of strings, without holding all of it in
+# memory. content that fits in one part is written with a single put, and
+# anything larger with a multipart upload whose parts are sent in parallel.
+# returns the number of bytes written.
+def stream_to_s3(bucket, key, chunks, part_size=stream_part_size, threads=stream_upload_threads, client=None):
+  if isinstance(chunks, basestring):
+    chunks = [chunks]
+  if client == None:
+    client = aws_client('s3')
+  parts = upload_parts(chunks, part_size)
+  first = next(parts, '')
+  second = next(parts, None)
+  if second == None:
+    client.put_object(Bucket=bucket, Key=key, Body=first)
+    return len(first)
+
+  upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+  def upload(number, body):
+    resp = client.upload_part(
+      Bucket=bucket,
+      Key=key,
+      UploadId=upload_id,
+      PartNumber=number,
+      Body=body
+    )
+    return {"PartNumber": number, "ETag": resp["ETag"]}
+
+  pool = ThreadPool(threads)
+  try:
+    pending = []
+    uploaded = []
+    total = 0
+    for number, body in enumerate(itertools.chain([first, second], parts), 1):
+      total += len(body)
+      pending.append(pool.apply_async(upload, (number, body)))
+      # waits for the oldest part, so memory stays bounded
+      if len(pending) >= threads:
+        uploaded.append(pending.pop(0).get())
+    for p in pending:
+      uploaded.append(p.get())
+    client.complete_multipart_upload(
+      Bucket=bucket,
+      Key=key,
+      UploadId=upload_id,
+      MultipartUpload={"Parts": uploaded}
+    )
+    convergdb_log("wrote " + str(total) + " bytes in " + str(len(uploaded)) + " parts to s3://" + bucket + "/" + key)
+    return total
+  except:
+    error = sys.exc_info()
+    try:
+      client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except Exception as e:
+      convergdb_log("unable to abort upload to s3://" + bucket + "/" + key + ": " + str(e))
+    raise error[0], error[1], error[2]
+  finally:
+    pool.terminate()
+
+# writes the records as gzipped lines. returns the number of records.
+def gzip_records_to_s3(bucket, key, records, separator="\n"):
+  count = [0]
+  def counted():
+    for r in records:
+      count[0] += 1
+      yield r
+  stream_to_s3(
+    bucket,
+    key,
+    gzip_chunks(separated(counted(), separator))
+  )
+  return count[0]
 
 # !S3 INTERACTIONS
 def gzip_to_s3(bucket, key, body):
   convergdb_log("writing to s3://" + bucket + "/" + key)
-  buffer = cStringIO.StringIO()
-  writer = gzip.GzipFile(None, 'wb', 6, buffer)
-  writer.write(body)
-  writer.close()
-  buffer.seek(0)
-  s3 = boto3.client('s3')
-  s3.upload_fileobj(buffer, bucket, key)
+  stream_to_s3(bucket, key, gzip_chunks([body]))
   convergdb_log("writing to s3://" + bucket + "/" + key + "complete!")
 
+# last modified times are kept as utc text in the "2019-01-01 00:00:00.000"
+# form of athena results, which sorts in time order. s3 listings and orc or
+# parquet inventories give datetimes, csv inventories give iso 8601 text.
+def last_modified_text(value):
+  if (value == None) or (value == ''):
+    return None
+  if isinstance(value, datetime.datetime):
+    return time.strftime('%Y-%m-%d %H:%M:%S', value.utctimetuple()) + '.%03d' % (value.microsecond / 1000)
+  return value.replace('T', ' ').rstrip('Z')[:23]
+
 def append_s3_search_results_to_dict(target, search_results):
   for s3_object in search_results:
     target[s3_object["Key"]] = s3_object["Size"]
@@ -33,6 +164,7 @@ def append_s3_search_results_to_list(target, search_results):
       { 
         "key": s3_object["Key"],
         "size": int(s3_object["Size"]),
+        "last_modified": last_modified_text(s3_object.get("LastModified"))
       }
     )
 
@@ -71,7 +203,7 @@ def s3_search_to_dict(bucket, prefix):
   # this is the return hash
   available = {}
   # connect to s3.. create a paginator.. get the pages
-  s3_client = boto3.client('s3')
+  s3_client = aws_client('s3')
   paginator = s3_client.get_paginator('list_objects_v2')
   page_iterator = paginator.paginate(
     Bucket=bucket,
@@ -91,7 +223,7 @@ def s3_search_to_dict(bucket, prefix):
 def s3_search_to_list(bucket, prefix):
   convergdb_log("searching s3://" + bucket + "/" + prefix + " ...")
   available = []
-  s3_client = boto3.client('s3')
+  s3_client = aws_client('s3')
   paginator = s3_client.get_paginator('list_objects_v2')
   page_iterator = paginator.paginate(
     Bucket=bucket,
@@ -107,40 +239,220 @@ def s3_search_to_list(bucket, prefix):
   convergdb_log("found " + str(len(available)) + " available S3 objects")
   return available
   
+# returns the "folders" directly below the prefix, such as hive partitions
+def s3_common_prefixes(bucket, prefix):
+  ret = []
+  s3_client = aws_client('s3')
+  paginator = s3_client.get_paginator('list_objects_v2')
+  page_iterator = paginator.paginate(
+    Bucket=bucket,
+    Prefix=prefix,
+    Delimiter='/'
+  )
+  for page in page_iterator:
+    for p in page.get("CommonPrefixes", []):
+      ret.append(p["Prefix"])
+  return ret
+
+# true if there is at least one key under the prefix
+def s3_prefix_has_keys(bucket, prefix):
+  s3_client = aws_client('s3')
+  resp = s3_client.list_objects_v2(
+    Bucket=bucket,
+    Prefix=prefix,
+    MaxKeys=1
+  )
+  return len(resp.get("Contents", [])) > 0
+
+# all keys under the prefix, without sizes
+def s3_keys(bucket, prefix):
+  return [f["key"] for f in s3_search_to_list(bucket, prefix)]
+
+# all keys under the prefix that sort after start_after, in order
+def s3_keys_after(bucket, prefix, start_after):
+  ret = []
+  s3_client = aws_client('s3')
+  paginator = s3_client.get_paginator('list_objects_v2')
+  params = {
+    "Bucket": bucket,
+    "Prefix": prefix
+  }
+  if start_after:
+    params["StartAfter"] = start_after
+  for page in paginator.paginate(**params):
+    for o in page.get("Contents", []):
+      ret.append(o["Key"])
+  return ret
+
+# error codes of delete_objects that are worth retrying for a single key
+retryable_delete_error_codes = throttle_error_codes + ['InternalError']
+
+# deletes up to 1000 keys with one delete_objects request. delete_objects
+# succeeds even when some of the keys could not be deleted, so keys that
+# failed with a retryable error are sent again after a backoff. raises if
+# any key could not be deleted.
+def delete_s3_objects(client, bucket, keys, governor=s3_governor, sleep=time.sleep):
+  attempts = 0
+  while len(keys) > 0:
+    attempts += 1
+    resp = client.delete_objects(
+      Bucket=bucket,
+      Delete={'Objects': [{"Key": k} for k in keys]}
+    )
+    errors = resp.get('Errors', [])
+    failed = [e for e in errors if not e['Code'] in retryable_delete_error_codes]
+    if (len(failed) > 0) or ((len(errors) > 0) and (attempts >= s3_governor_max_attempts)):
+      e = (failed + errors)[0]
+      raise Exception(
+        "unable to delete " + str(len(errors)) + " objects from " + bucket + ", first error " + e['Code'] + " for " + e['Key']
+      )
+    keys = [e['Key'] for e in errors]
+    if len(keys) > 0:
+      convergdb_log("retrying delete of " + str(len(keys)) + " objects from " + bucket)
+      count(governor, "delete_retries", len(keys))
+      sleep(backoff_seconds(attempts))
+
+# deletes the keys in requests of up to 1000 keys
+def delete_s3_keys(bucket, keys):
+  s3_client = aws_client('s3')
+  for i in range(0, len(keys), 1000):
+    delete_s3_objects(s3_client, bucket, keys[i:(i + 1000)])
+
+# splits an s3://bucket/prefix url into bucket and prefix
+def s3_url_to_bucket_prefix(url):
+  spl = url.replace('s3://', '', 1).replace('s3a://', '', 1).split('/', 1)
+  return {
+    'bucket': spl[0],
+    'prefix': spl[1] if len(spl) > 1 else ''
+  }
+
 def write_s3_object(bucket, key, content):
-  s3 = boto3.client('s3')
+  s3 = aws_client('s3')
   resp = s3.put_object(
     Bucket = bucket,
     Key = key,
     Body = content
   )
 
-# returns an empty string if the object is not found.
-def get_s3_object(bucket, key):
-  resp = {}
+# !RANGED READS
+
+# objects are read in ranges of this size. an object that fits in the first
+# range is read with a single request.
+ranged_get_part_size = 8 * 1024**2
+
+# ranges requested at the same time
+ranged_get_threads = 8
+
+# objects larger than this are written to a temp file, which is returned
+# memory mapped, instead of being held in memory.
+ranged_get_spool_size = 64 * 1024**2
+
+# total object size from a "bytes 0-99/1234" content range
+def content_range_size(resp):
+  content_range = resp.get("ContentRange", None)
+  if content_range:
+    return int(content_range.split('/')[-1])
+  return None
+
+# inclusive (first, last) byte ranges from start to the end of the object
+def byte_ranges(start, size, part_size):
+  return [(o, min(o + part_size, size) - 1) for o in range(start, size, part_size)]
+
+def range_header(byte_range):
+  return "bytes=%d-%d" % byte_range
+
+def client_error_code(e):
+  return getattr(e, 'response', {}).get('Error', {}).get('Code', None)
+
+# returns a file-like object with the contents of an object. the first range
+# tells the object size, and the remaining ranges are fetched in parallel.
+# every range must come from the same version of the object. objects larger
+# than spool_size are returned as a read only mmap of a temp file, which
+# supports read(n), readline() and slicing.
+def s3_object_reader(bucket, key, part_size=ranged_get_part_size, threads=ranged_get_threads, spool_size=ranged_get_spool_size, client=None):
+  if client == None:
+    client = aws_client('s3')
   try:
-    s3 = boto3.client('s3')
-    resp = s3.get_object(
+    resp = client.get_object(
       Bucket=bucket,
-      Key=key
+      Key=key,
+      Range=range_header((0, part_size - 1))
     )
+  except Exception as e:
+    # ranges can not be satisfied for empty objects
+    if client_error_code(e) == 'InvalidRange':
+      return cStringIO.StringIO('')
+    raise
+  first = resp['Body'].read()
+  size = content_range_size(resp)
+  if (size == None) or (size <= len(first)):
+    return cStringIO.StringIO(first)
+
+  ranges = byte_ranges(len(first), size, part_size)
+  def fetch(byte_range):
+    return client.get_object(
+      Bucket=bucket,
+      Key=key,
+      Range=range_header(byte_range),
+      IfMatch=resp['ETag']
+    )['Body'].read()
+
+  pool = ThreadPool(min(threads, len(ranges)))
+  try:
+    if (spool_size != None) and (size > spool_size):
+      f = tempfile.TemporaryFile()
+      f.write(first)
+      lock = threading.Lock()
+      def fetch_to_file(byte_range):
+        data = fetch(byte_range)
+        with lock:
+          f.seek(byte_range[0])
+          f.write(data)
+      pool.map(fetch_to_file, ranges)
+      f.flush()
+      # the mapping stays valid after the file is closed
+      ret = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      f.close()
+      return ret
+    else:
+      return cStringIO.StringIO(first + ''.join(pool.map(fetch, ranges)))
+  finally:
+    pool.terminate()
+
+# the utf-8 lines of a reader, read a block at a time. like split("\n"),
+# the last line is empty when the content ends with a newline.
+def reader_lines(reader, block_size=ranged_get_part_size):
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  rest = u''
+  while True:
+    block = reader.read(block_size)
+    if block == '':
+      break
+    lines = (rest + decoder.decode(block)).split(u"\n")
+    rest = lines.pop()
+    for l in lines:
+      yield l
+  yield rest + decoder.decode('', True)
+
+# returns an empty string if the object is not found.
+def get_s3_object(bucket, key):
+  try:
+    return s3_object_reader(bucket, key, spool_size=None).read()
   except:
     # I don't like this but I am not sure why standard
     # python exception handling doesn't work here.
     if sys.exc_info()[0].__name__ == 'NoSuchKey':
-      None
+      return ''
     else:
       raise
-  if 'Body' in resp:
-    return resp['Body'].read()
-  else:
-    return ''
 
+# the json is encoded as it is uploaded, which matters for state files that
+# list every object of a batch.
 def dict_to_s3_json(bucket, key, d):
-  write_s3_object(
+  stream_to_s3(
     bucket,
     key,
-    json.dumps(d)
+    json.JSONEncoder().iterencode(d)
   )
 
 def s3_json_to_dict(bucket, key):
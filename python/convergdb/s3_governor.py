@@ -0,0 +1,182 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import clear_aws_clients, default_session
+
+import random
+import threading
+import time
+
+# !S3 REQUEST GOVERNOR
+
+# the governor paces the S3 requests of the process with a token bucket for
+# each bucket and top level prefix, which is how S3 scales request rates.
+# the rate of a prefix is halved whenever S3 responds with SlowDown, and
+# grows back by a fixed amount with each successful request (AIMD).
+# throttled requests are retried by botocore after the delay returned by
+# the governor. it is installed through the event hooks of the default
+# boto3 session, so every S3 client that convergdb creates is covered.
+
+# S3 supports at least 3500 writes per second per prefix
+s3_maximum_request_rate = 3500.0
+s3_minimum_request_rate = 5.0
+s3_rate_increase = 1.0
+s3_rate_decrease = 0.5
+
+# attempts of a throttled request, including the first one
+s3_governor_max_attempts = 10
+s3_backoff_base_seconds = 0.1
+s3_backoff_max_seconds = 20.0
+
+throttle_error_codes = [
+  'SlowDown',
+  'ServiceUnavailable',
+  'Throttling',
+  'ThrottlingException',
+  'RequestLimitExceeded',
+  'TooManyRequests'
+]
+
+def new_governor():
+  return {
+    "lock": threading.Lock(),
+    "buckets": {},
+    "counters": {
+      "requests": 0,
+      "throttles": 0,
+      "retries": 0,
+      "delete_retries": 0
+    },
+    "session": None
+  }
+
+# the governor shared by every relation run in this process
+s3_governor = new_governor()
+
+# pacing key of a request: the bucket and the first folder of the key
+def governor_prefix(params):
+  key = params.get('Key', params.get('Prefix', None))
+  if key == None:
+    objects = params.get('Delete', {}).get('Objects', [])
+    key = objects[0]['Key'] if len(objects) > 0 else ''
+  return params.get('Bucket', '') + '/' + key.split('/')[0]
+
+def new_token_bucket(rate, now):
+  return {
+    "rate": rate,
+    "tokens": rate,
+    "updated": now
+  }
+
+def token_bucket(governor, prefix, now):
+  if not prefix in governor["buckets"]:
+    governor["buckets"][prefix] = new_token_bucket(s3_maximum_request_rate, now)
+  return governor["buckets"][prefix]
+
+# takes a token from the bucket of the prefix, and returns the number of
+# seconds to wait before the request is sent. tokens are taken even when
+# none are available, so that waiting requests are spaced out.
+def take_token(governor, prefix, now):
+  with governor["lock"]:
+    b = token_bucket(governor, prefix, now)
+    b["tokens"] = min(b["rate"], b["tokens"] + (now - b["updated"]) * b["rate"])
+    b["updated"] = now
+    b["tokens"] -= 1.0
+    if b["tokens"] >= 0:
+      return 0.0
+    return -b["tokens"] / b["rate"]
+
+def request_succeeded(governor, prefix, now):
+  with governor["lock"]:
+    b = token_bucket(governor, prefix, now)
+    b["rate"] = min(s3_maximum_request_rate, b["rate"] + s3_rate_increase)
+
+def request_throttled(governor, prefix, now):
+  with governor["lock"]:
+    b = token_bucket(governor, prefix, now)
+    b["rate"] = max(s3_minimum_request_rate, b["rate"] * s3_rate_decrease)
+    b["tokens"] = min(b["tokens"], 0.0)
+    governor["counters"]["throttles"] += 1
+    return b["rate"]
+
+def count(governor, name, n=1):
+  with governor["lock"]:
+    governor["counters"][name] += n
+
+def is_throttle_response(response):
+  if response == None:
+    return False
+  http_response, parsed = response
+  code = parsed.get('Error', {}).get('Code', None)
+  return (code in throttle_error_codes) or (http_response.status_code == 503)
+
+# exponential backoff with full jitter
+def backoff_seconds(attempts, rand=random.random):
+  return rand() * min(s3_backoff_max_seconds, s3_backoff_base_seconds * (2 ** attempts))
+
+def governor_params_handler(governor, clock=time.time, sleep=time.sleep):
+  def handler(params, context, **kwargs):
+    prefix = governor_prefix(params)
+    context['convergdb_s3_prefix'] = prefix
+    count(governor, "requests")
+    wait = take_token(governor, prefix, clock())
+    if wait > 0:
+      sleep(wait)
+  return handler
+
+# called by botocore after each attempt. returns the seconds to sleep
+# before a throttled request is retried, or None to leave the response to
+# the default retry handler.
+def governor_retry_handler(governor, clock=time.time):
+  def handler(response, attempts, request_dict, **kwargs):
+    prefix = request_dict.get('context', {}).get('convergdb_s3_prefix', None)
+    if prefix == None:
+      return None
+    if not is_throttle_response(response):
+      if response != None:
+        request_succeeded(governor, prefix, clock())
+      return None
+    rate = request_throttled(governor, prefix, clock())
+    if attempts >= s3_governor_max_attempts:
+      convergdb_log("s3 requests to " + prefix + " are still throttled after " + str(attempts) + " attempts")
+      return None
+    count(governor, "retries")
+    return max(backoff_seconds(attempts), take_token(governor, prefix, clock()))
+  return handler
+
+# installs the governor on the default boto3 session. clients created
+# afterwards are governed, so the cached clients are dropped. installing
+# it again has no effect, and the clients stay warm.
+def start_s3_governor(governor=s3_governor, session=None):
+  with governor["lock"]:
+    if governor["session"] != None:
+      return governor
+    governor["session"] = session or default_session()
+  governor["session"].events.register(
+    'before-parameter-build.s3',
+    governor_params_handler(governor),
+    unique_id='convergdb-s3-governor-params'
+  )
+  # registered first, so that throttles are not retried by the default
+  # handler with its shorter backoff.
+  governor["session"].events.register_first(
+    'needs-retry.s3',
+    governor_retry_handler(governor),
+    unique_id='convergdb-s3-governor-retry'
+  )
+  clear_aws_clients()
+  return governor
+
+def stop_s3_governor(governor=s3_governor):
+  if governor["session"] != None:
+    governor["session"].events.unregister('before-parameter-build.s3', unique_id='convergdb-s3-governor-params')
+    governor["session"].events.unregister('needs-retry.s3', unique_id='convergdb-s3-governor-retry')
+    governor["session"] = None
+    clear_aws_clients()
+  return governor
+
+def s3_governor_counters(governor=s3_governor):
+  with governor["lock"]:
+    return dict(governor["counters"])
+
+# the counters of a run, from the counters at its start and end
+def counter_difference(start, end):
+  return dict([(k, end.get(k, 0) - start.get(k, 0)) for k in end])
@@ -0,0 +1,266 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.batch_control import (
+  control_folder_key,
+  file_diff,
+  inventory_table,
+  unloaded_files
+)
+from convergdb.diff_order import last_modified_needed
+from convergdb.fingerprint import (
+  fingerprint_inventory_type,
+  latest_dt_partition,
+  table_location
+)
+from convergdb.s3 import (
+  get_s3_object,
+  last_modified_text,
+  reader_lines,
+  s3_common_prefixes,
+  s3_keys,
+  s3_object_reader
+)
+
+import csv
+import gzip
+import json
+import re
+import time
+from multiprocessing.pool import ThreadPool
+
+# pyarrow is only needed for orc and parquet inventories. some builds of
+# pyarrow have no orc support, which leaves parquet inventories readable.
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+try:
+  import pyarrow.orc
+  pyarrow_orc = pyarrow.orc
+except ImportError:
+  pyarrow_orc = None
+
+# !S3 INVENTORY MANIFEST READER
+
+# the manifest reader lists the available files from the latest s3
+# inventory delivery itself, and the loaded files from the control records,
+# so the diff needs no athena queries. it is used when the structure sets
+# s3_inventory_reader to "manifest". the athena diff is used when the
+# manifest can not be read.
+def manifest_reader_enabled(structure):
+  if structure.get("s3_inventory_reader", "athena") != "manifest":
+    return False
+  return fingerprint_inventory_type(structure) == 's3'
+
+# number of inventory and control files read at the same time
+def manifest_reader_threads(structure):
+  return int(structure.get("s3_inventory_reader_threads", 8))
+
+# s3 inventory tables point at the hive/ folder of an inventory
+# configuration. each dt=YYYY-MM-DD-HH-MM partition there belongs to the
+# delivery in the YYYY-MM-DDTHH-MMZ folder next to it.
+def manifest_key(location, dt):
+  if not location['prefix'].endswith('hive/'):
+    raise Exception("s3 inventory table location is not a hive/ folder: " + location['prefix'])
+  parts = dt.replace('dt=', '', 1).split('-')
+  folder = '-'.join(parts[0:3]) + 'T' + '-'.join(parts[3:5]) + 'Z'
+  return location['prefix'][0:-len('hive/')] + folder + '/manifest.json'
+
+def manifest_destination_bucket(manifest):
+  return manifest["destinationBucket"].split(':::')[-1]
+
+# inventory column names in the snake case used by orc and parquet
+# inventories, from the "Bucket, Key, IsLatest" style of csv file schemas.
+def inventory_column_name(name):
+  return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name.strip()).lower()
+
+def manifest_csv_columns(manifest):
+  return [inventory_column_name(c) for c in manifest["fileSchema"].split(',')]
+
+# the inventory columns used by the diff. orc and parquet inventories are
+# read with only these columns.
+inventory_columns = [
+  'bucket',
+  'key',
+  'size',
+  'last_modified_date',
+  'is_latest',
+  'is_delete_marker'
+]
+
+def inventory_flag(value):
+  return str(value).lower() == 'true'
+
+# key, size and last modified time of the inventory rows that match the
+# predicates of the athena diff's where_clause. rows are lists in the
+# order of columns.
+def loadable_inventory_rows(rows, columns, bucket, prefix, last_modified=True):
+  i_bucket = columns.index('bucket')
+  i_key = columns.index('key')
+  i_size = columns.index('size')
+  i_modified = columns.index('last_modified_date') if (last_modified and ('last_modified_date' in columns)) else None
+  i_latest = columns.index('is_latest') if 'is_latest' in columns else None
+  i_delete = columns.index('is_delete_marker') if 'is_delete_marker' in columns else None
+  ret = []
+  for r in rows:
+    if (r[i_bucket] != bucket) or (not r[i_key].startswith(prefix)):
+      continue
+    if (i_latest != None) and (not inventory_flag(r[i_latest])):
+      continue
+    if (i_delete != None) and inventory_flag(r[i_delete]):
+      continue
+    d = {
+      "key": r[i_key],
+      "size": int(r[i_size] or 0)
+    }
+    # an optional field of s3 inventory reports
+    if i_modified != None:
+      d["last_modified"] = last_modified_text(r[i_modified])
+    ret.append(d)
+  return ret
+
+# the non empty lines of a gzipped reader, decompressed as they are read
+def gzip_lines(reader):
+  for l in reader_lines(gzip.GzipFile(fileobj=reader, mode='rb')):
+    if l != u'':
+      yield l
+
+# rows of an orc or parquet inventory file, with only the given columns,
+# read a stripe or row group at a time.
+def arrow_inventory_rows(reader, file_format, names):
+  if file_format == 'ORC':
+    f = pyarrow_orc.ORCFile(reader)
+    batches = (f.read_stripe(i, columns=names) for i in range(f.nstripes))
+  else:
+    f = pyarrow.parquet.ParquetFile(reader)
+    batches = (f.read_row_group(i, columns=names) for i in range(f.num_row_groups))
+  for b in batches:
+    columns = dict(
+      [(b.schema.names[i], b.column(i).to_pylist()) for i in range(b.num_columns)]
+    )
+    for r in zip(*[columns[n] for n in names]):
+      yield r
+
+# rows and column names of one inventory file. rows are generated as the
+# file is read, so that a whole file is never held decompressed.
+def inventory_file_rows(reader, file_format, csv_columns):
+  if file_format == 'CSV':
+    return (
+      csv.reader(l.encode('utf-8') for l in gzip_lines(reader)),
+      csv_columns
+    )
+  if pyarrow == None:
+    raise Exception("pyarrow is required to read " + file_format + " s3 inventory files")
+  if file_format == 'ORC':
+    if pyarrow_orc == None:
+      raise Exception("pyarrow with orc support is required to read ORC s3 inventory files")
+    schema = pyarrow_orc.ORCFile(reader).schema
+  else:
+    schema = pyarrow.parquet.ParquetFile(reader).schema
+  names = [n for n in schema.names if inventory_column_name(n) in inventory_columns]
+  return (
+    arrow_inventory_rows(reader, file_format, names),
+    [inventory_column_name(n) for n in names]
+  )
+
+# reads every inventory file of the manifest in parallel, and returns the
+# loadable files of the source location. the loadable files of each
+# inventory file are added to the result as soon as that file is read.
+def manifest_available_files(manifest, structure, threads):
+  s = structure["source_structure"]["storage_bucket"].split('/', 1)
+  bucket = s[0]
+  prefix = s[1] if len(s) == 2 else ''
+  file_format = manifest["fileFormat"]
+  destination = manifest_destination_bucket(manifest)
+  csv_columns = manifest_csv_columns(manifest) if file_format == 'CSV' else None
+  last_modified = last_modified_needed(structure)
+  client = aws_client('s3')
+  def read(f):
+    rows, columns = inventory_file_rows(
+      s3_object_reader(destination, f["key"], client=client),
+      file_format,
+      csv_columns
+    )
+    return loadable_inventory_rows(rows, columns, bucket, prefix, last_modified)
+
+  files = manifest["files"]
+  if len(files) == 0:
+    return []
+  pool = ThreadPool(min(threads, len(files)))
+  try:
+    ret = []
+    for r in pool.imap(read, files):
+      ret += r
+    return ret
+  finally:
+    pool.terminate()
+
+# source keys in one gzipped file of control records
+def control_file_source_keys(reader):
+  return [json.loads(l)["source_key"] for l in gzip_lines(reader) if l.strip() != '']
+
+# returns a dict with the files already loaded as keys, like loaded_files,
+# read from the control records instead of the control table.
+def control_folder_loaded_files(structure, threads):
+  bucket = structure["state_bucket"]
+  keys = s3_keys(bucket, control_folder_key(structure))
+  client = aws_client('s3')
+  def read(key):
+    return control_file_source_keys(
+      s3_object_reader(bucket, key, client=client)
+    )
+
+  ret = {}
+  if len(keys) == 0:
+    return ret
+  pool = ThreadPool(min(threads, len(keys)))
+  try:
+    for source_keys in pool.imap(read, keys):
+      for k in source_keys:
+        ret[k] = None
+    return ret
+  finally:
+    pool.terminate()
+
+# performs the diff between the latest s3 inventory delivery and the
+# control records without athena.
+def manifest_based_diff(structure):
+  convergdb_log("using s3 inventory manifest based control diff computation...")
+  s = time.time()
+  threads = manifest_reader_threads(structure)
+  location = table_location(
+    inventory_table(structure),
+    structure["region"]
+  )
+  dt = latest_dt_partition(
+    s3_common_prefixes(location['bucket'], location['prefix'])
+  )
+  if dt == None:
+    raise Exception("no s3 inventory partitions found")
+  key = manifest_key(location, dt)
+  content = get_s3_object(location['bucket'], key)
+  if content == '':
+    raise Exception("no s3 inventory manifest at s3://" + location['bucket'] + "/" + key)
+  manifest = json.loads(content)
+  convergdb_log("reading " + str(len(manifest["files"])) + " " + manifest["fileFormat"] + " s3 inventory files for " + dt)
+
+  available = manifest_available_files(manifest, structure, threads)
+  convergdb_log("available file count: " + str(len(available)))
+  loaded = control_folder_loaded_files(structure, threads)
+  convergdb_log("loaded objects: " + str(len(loaded)))
+
+  d = unloaded_files(available, loaded)
+  convergdb_log("s3 inventory manifest based diff took " + str(time.time() - s) + " seconds")
+  return d
+
+# calculates the diff between available and loaded files, reading the s3
+# inventory manifest directly when the structure asks for it.
+def inventory_file_diff(structure, refresh_partitions=True):
+  if manifest_reader_enabled(structure):
+    try:
+      return manifest_based_diff(structure)
+    except Exception as e:
+      convergdb_log("unable to read the s3 inventory manifest, using athena: " + str(e))
+  return file_diff(structure, refresh_partitions)
@@ -1,11 +1,13 @@
-from convergdb_logging import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
 
-import boto3
+import threading
+import time
 
 def publish_sns(region, topic_arn, subject, message):
   try:
     convergdb_log("publishing sns subject: " + str(subject) + " to topic: " + str(topic_arn) + "...")
-    client = boto3.client('sns', region_name = region)
+    client = aws_client('sns', region)
     response = client.publish(
       TopicArn = topic_arn,
       Subject = subject,
@@ -13,4 +15,32 @@ def publish_sns(region, topic_arn, subject, message):
     )
     convergdb_log("sns message sent successfully!")
   except:
-    pass
\ No newline at end of file
+    pass
+
+# messages being published in the background
+pending_sns = []
+
+# publishes the message from a background thread so the caller does not
+# wait on sns.
+def publish_sns_async(region, topic_arn, subject, message, publish_function=publish_sns):
+  t = threading.Thread(
+    target=publish_function,
+    args=(region, topic_arn, subject, message)
+  )
+  t.daemon = True
+  t.start()
+  pending_sns.append(t)
+  return t
+
+# waits up to timeout seconds in total for the background messages.
+# returns False if any of them are still being sent.
+def wait_for_sns(timeout, clock=time.time):
+  deadline = clock() + timeout
+  while len(pending_sns) > 0:
+    t = pending_sns[0]
+    t.join(max(0.0, deadline - clock()))
+    if t.is_alive():
+      convergdb_log("sns messages were not sent within " + str(timeout) + " seconds")
+      return False
+    pending_sns.pop(0)
+  return True
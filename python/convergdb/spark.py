@@ -1,7 +1,8 @@
 # !PYSPARK FUNCTIONS
-from convergdb_logging import *
-
-from convergdb.spark_partitions import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.spark_metrics import batch_job_group, batch_spark_metrics
+from convergdb.spark_partitions import calculate_spark_partitions
+from convergdb.tracing import annotate_span, span
 
 import time
 
@@ -34,37 +35,30 @@ def nestable_source_schema(structure):
     )
   )
 
-# creates all of the functional rdd/dataframe layers then
-# triggers the actual data transformation.
-def data_load(sql_context, structure, s3a_paths, source_map_func, batch_id, total_bytes, file_count, dpu, spark_partition_count):
-  convergdb_log("starting data load for " + structure["full_relation_name"])
-  st = time.time()
-
-  # determine the number of spark partitions to use for this batch.
-  spark_partitions = calculate_spark_partitions(
-    total_bytes,
-    dpu,
-    spark_partition_count
-  )
-
-  # create a data frame from the source data.
-  # dataframe will be all strings at this point.
+# creates a data frame from the source data.
+# dataframe will be all strings at this point.
+def source_dataframe(sql_context, structure, paths):
   d1 = None
-  
+
   if structure['source_structure']['storage_format'] == 'json':
     d1 = json_file_to_df(
       sql_context,
-      s3a_paths,
+      paths,
       nestable_source_schema(structure)
     )
   elif structure['source_structure']['storage_format'] == 'csv':
     d1 = csv_file_to_df(
       sql_context,
-      s3a_paths,
+      paths,
       csv_source_schema(structure),
       structure
     )
+  return d1
 
+# the source rows of the relation: source expressions, casting and null
+# rejection applied to the source dataframe, with the source file name.
+# targets that share a source relation share these rows.
+def source_rows_dataframe(d1, structure):
   d3 = None
 
   if structure['source_structure']['storage_format'] == 'json':
@@ -91,7 +85,10 @@ def data_load(sql_context, structure, s3a_paths, source_map_func, batch_id, tota
   )
 
   d6 = source_file_name(d5)
+  return d6
 
+# the target layers, from the source rows to the rows written for the batch
+def target_dataframe(d6, structure, batch_id, spark_partitions):
   # apply expressions from target relation
   d7 = apply_expressions(
     d6,
@@ -119,11 +116,55 @@ def data_load(sql_context, structure, s3a_paths, source_map_func, batch_id, tota
     d10,
     batch_id
   )
+  return d11
+
+# creates all of the functional rdd/dataframe layers that turn the source
+# dataframe into the rows written for the batch. nothing is executed.
+def batch_dataframe(d1, structure, batch_id, spark_partitions):
+  return target_dataframe(
+    source_rows_dataframe(d1, structure),
+    structure,
+    batch_id,
+    spark_partitions
+  )
 
+# creates all of the functional rdd/dataframe layers then
+# triggers the actual data transformation. returns a dict of
+# metrics describing the load.
+def data_load(sql_context, structure, s3a_paths, source_map_func, batch_id, total_bytes, file_count, dpu, spark_partition_count, spark_partitions=None):
+  convergdb_log("starting data load for " + structure["full_relation_name"])
+  st = time.time()
+
+  # determine the number of spark partitions to use for this batch,
+  # unless they were already planned by the caller.
+  if spark_partitions == None:
+    spark_partitions = calculate_spark_partitions(
+      total_bytes,
+      dpu,
+      spark_partition_count
+    )
+
+  d11 = batch_dataframe(
+    source_dataframe(sql_context, structure, s3a_paths),
+    structure,
+    batch_id,
+    spark_partitions
+  )
+  return write_batch_dataframe(sql_context, d11, structure, batch_id, total_bytes, file_count, spark_partitions, st)
+
+# writes the rows of a batch and returns the metrics of the load. the spark
+# jobs are tagged with job_group, which is the batch_id unless several
+# relations write batches in the same second.
+def write_batch_dataframe(sql_context, d11, structure, job_group, total_bytes, file_count, spark_partitions, st):
   # output a plan for reference
-  d11.explain(True)
+  with span("explain"):
+    d11.explain(True)
 
-  write_partitions(d11, structure)
+  # spark jobs for this batch are tagged so their metrics can be collected
+  with batch_job_group(sql_context, job_group):
+    with span("write_partitions") as s:
+      annotate_span(s, bytes=total_bytes, items=file_count)
+      write_partitions(d11, structure)
 
   et = time.time()
 
@@ -131,6 +172,13 @@ def data_load(sql_context, structure, s3a_paths, source_map_func, batch_id, tota
   convergdb_log("bytes loaded: " + str(total_bytes) + " (compressed)")
   convergdb_log("files loaded: " + str(file_count))
 
+  with span("spark_metrics"):
+    metrics = batch_spark_metrics(sql_context, job_group)
+  metrics["engine"] = "spark"
+  metrics["spark_partitions"] = spark_partitions
+  metrics["duration"] = et - st
+  return metrics
+
 
 # accepts a dataframe object, and a dict for a given attribute (column).
 # returns a dataframe column reference with casting applied.
@@ -205,16 +253,20 @@ def target_partitions(structure):
   return partition_by
 
 
-# performs the actual write out of the data into S3.
-# if the data is partitioned, the partitions will be created in this step.
-def write_partitions(df, structure):
+def storage_location(structure):
+  return "s3a://" + structure["storage_bucket"]
+
+# performs the actual write out of the data into S3, or to the given
+# location. if the data is partitioned, the partitions will be created
+# in this step.
+def write_partitions(df, structure, location=None):
   convergdb_log("executing job and writing to target storage...")
   df.write.partitionBy(
     target_partitions(structure)
   ).format(
     structure["storage_format"]
   ).save(
-    "s3a://" + structure["storage_bucket"],
+    location or storage_location(structure),
     mode="append"
   )
 
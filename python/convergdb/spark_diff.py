@@ -0,0 +1,282 @@
+# !SPARK BASED DIFF
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.athena import athena_describe_table
+from convergdb.batch_control import (
+  bz2_factor,
+  control_folder_key,
+  gz_factor,
+  inventory_table
+)
+from convergdb.compression_sampling import compression_sample_file_count
+from convergdb.fingerprint import (
+  fingerprint_inventory_type,
+  latest_dt_partition,
+  table_location
+)
+from convergdb.s3 import (
+  get_s3_object,
+  s3_common_prefixes,
+  s3_keys,
+  s3_prefix_has_keys,
+  s3_url_to_bucket_prefix
+)
+from convergdb.spark_partitions import split_indices
+
+import time
+
+from pyspark.sql.functions import col, expr, lit, struct, when
+from pyspark.sql.functions import count as sql_count
+from pyspark.sql.functions import max as sql_max
+from pyspark.sql.functions import sum as sql_sum
+from pyspark.sql.types import StructType, StructField, StringType, LongType
+
+# the spark diff reads the inventory and the control records as dataframes
+# and joins them on the cluster. the driver only collects aggregates, a
+# small sample for compression sampling, and the files of one chunk at a
+# time. it is used instead of the athena diff when the structure sets
+# spark_diff to "true". relations using the api diff are not affected.
+def spark_diff_enabled(structure):
+  if str(structure.get("spark_diff", "false")).lower() != "true":
+    return False
+  return fingerprint_inventory_type(structure) in ['s3', 'streaming']
+
+# !INVENTORY DATAFRAMES
+
+def string_schema(names):
+  return StructType(
+    [StructField(n, StringType(), True) for n in names]
+  )
+
+# spark reader format for an inventory table, from its serde
+def inventory_data_format(table):
+  serde = table['Table']['StorageDescriptor'].get('SerdeInfo', {}).get('SerializationLibrary', '').lower()
+  if 'orc' in serde:
+    return 'orc'
+  elif 'parquet' in serde:
+    return 'parquet'
+  else:
+    return 'csv'
+
+# s3 inventory tables in athena point at symlink files, which list the
+# data files of each delivery one url per line.
+def symlink_paths(text):
+  return [
+    l.strip().replace('s3://', 's3a://', 1) for l in text.split("\n") if l.strip() != ''
+  ]
+
+# data files of the latest s3 inventory delivery. tables without symlink
+# files are read from the partition folder itself.
+def s3_inventory_paths(location, dt, key_function=s3_keys, get_function=get_s3_object):
+  prefix = location['prefix'] + dt + '/'
+  keys = key_function(location['bucket'], prefix)
+  symlinks = [k for k in keys if k.endswith('symlink.txt')]
+  if len(symlinks) == 0:
+    return ['s3a://' + location['bucket'] + '/' + prefix]
+  ret = []
+  for k in symlinks:
+    ret += symlink_paths(get_function(location['bucket'], k))
+  return ret
+
+# filters the inventory down to the current objects in the source location,
+# in the same way as the where_clause of the athena diff.
+def inventory_filter(df, structure):
+  s = structure["source_structure"]["storage_bucket"].split('/', 1)
+  df = df.where(col("bucket") == s[0])
+  if len(s) == 2:
+    df = df.where(col("key").startswith(s[1]))
+  if 'is_latest' in df.columns:
+    df = df.where(col("is_latest").cast("boolean") == True)
+  if 'is_delete_marker' in df.columns:
+    df = df.where(col("is_delete_marker").cast("boolean") == False)
+  return df
+
+# key and size of every object in the latest s3 inventory delivery
+def s3_inventory_dataframe(sql_context, structure, describe_function=athena_describe_table):
+  inv_table = inventory_table(structure)
+  tbl = inv_table.split('.', 1)
+  table = describe_function(tbl[0], tbl[1], structure["region"])
+  location = table_location(inv_table, structure["region"], describe_function)
+  dt = latest_dt_partition(
+    s3_common_prefixes(location['bucket'], location['prefix'])
+  )
+  if dt == None:
+    raise Exception("no s3 inventory partitions found for " + inv_table)
+  paths = s3_inventory_paths(location, dt)
+  data_format = inventory_data_format(table)
+  convergdb_log("reading " + str(len(paths)) + " " + data_format + " s3 inventory paths for " + dt)
+  if data_format == 'csv':
+    df = sql_context.read.csv(
+      paths,
+      schema=string_schema(
+        [c['Name'] for c in table['Table']['StorageDescriptor']['Columns']]
+      )
+    )
+  elif data_format == 'orc':
+    df = sql_context.read.orc(paths)
+  else:
+    df = sql_context.read.parquet(paths)
+  return inventory_filter(df, structure).select(
+    col("key"),
+    col("size").cast("long").alias("size")
+  )
+
+streaming_inventory_schema = StructType(
+  [
+    StructField("last_modified_timestamp", StringType(), True),
+    StructField("bucket", StringType(), True),
+    StructField("key", StringType(), True),
+    StructField("size", LongType(), True),
+    StructField("e_tag", StringType(), True),
+    StructField("sequencer", StringType(), True)
+  ]
+)
+
+# key, sequencer and size of the latest event for every key
+def latest_inventory_events(df):
+  # the struct compares by sequencer first, like max(sequencer) in athena
+  return df.groupBy("key").agg(
+    sql_max(struct(col("sequencer"), col("size"))).alias("latest")
+  ).select(
+    col("key"),
+    col("latest.sequencer").alias("sequencer"),
+    col("latest.size").alias("size")
+  )
+
+# key and size of the latest event for every key in the streaming inventory
+def streaming_inventory_dataframe(sql_context, structure):
+  location = s3_url_to_bucket_prefix(
+    structure["source_structure"]["streaming_inventory_output_bucket"]
+  )
+  df = sql_context.read.json(
+    's3a://' + location['bucket'] + '/' + location['prefix'],
+    schema=streaming_inventory_schema
+  )
+  return latest_inventory_events(inventory_filter(df, structure)).select(
+    col("key"),
+    col("size")
+  )
+
+def inventory_dataframe(sql_context, structure):
+  if fingerprint_inventory_type(structure) == 's3':
+    return s3_inventory_dataframe(sql_context, structure)
+  else:
+    return streaming_inventory_dataframe(sql_context, structure)
+
+# !CONTROL DATAFRAME
+
+# source keys of every loaded file, read from the control records that
+# back the control table.
+def control_dataframe(sql_context, structure):
+  key = control_folder_key(structure)
+  schema = string_schema(["source_key"])
+  if not s3_prefix_has_keys(structure["state_bucket"], key):
+    # nothing has been loaded yet
+    return sql_context.createDataFrame([], schema)
+  return sql_context.read.json(
+    's3a://' + structure["state_bucket"] + '/' + key,
+    schema=schema
+  )
+
+# !DIFF AND CHUNK PLANNING
+
+# the diff as a dataframe of key, size and compression type. folders that
+# appear as objects are left out, as in the api diff.
+def diff_dataframe(inventory_df, control_df):
+  return inventory_df.join(
+    control_df,
+    inventory_df["key"] == control_df["source_key"],
+    "left_anti"
+  ).where(
+    ~col("key").endswith('/')
+  ).withColumn(
+    "compression",
+    when(col("key").endswith('.gz'), lit('gz')).when(col("key").endswith('.bz2'), lit('bz2')).otherwise(lit('none'))
+  )
+
+# file count and bytes by compression type, from the collected aggregate
+# rows of the diff.
+def diff_summary(rows):
+  by_type = {}
+  for r in rows:
+    by_type[r["compression"]] = {
+      "file_count": int(r["file_count"]),
+      "bytes": int(r["bytes"] or 0)
+    }
+  return {
+    "file_count": sum([by_type[t]["file_count"] for t in by_type]),
+    "bytes": sum([by_type[t]["bytes"] for t in by_type]),
+    "by_type": by_type
+  }
+
+# estimated uncompressed bytes of the diff, as file_estimated_sizing
+# would calculate it from the full list.
+def summary_estimated_bytes(summary, factors={}):
+  default_factors = {'gz': gz_factor, 'bz2': bz2_factor, 'none': 1}
+  ret = 0
+  for t in summary["by_type"]:
+    ret += summary["by_type"][t]["bytes"] * factors.get(t, default_factors.get(t, 1))
+  return ret
+
+# fraction of each compression type collected for compression sampling.
+# a few times the sample count is collected so that the random choice of
+# sample_files still has something to choose from.
+def sample_fractions(summary, count):
+  ret = {}
+  for t in summary["by_type"]:
+    n = summary["by_type"][t]["file_count"]
+    if (t != 'none') and (n > 0):
+      ret[t] = min(1.0, 4.0 * count / n)
+  return ret
+
+# number of chunks for a diff, given the planned number of files per chunk
+def spark_diff_chunk_count(file_count, chunk_size):
+  if file_count == 0:
+    return 0
+  return len(split_indices(file_count, chunk_size))
+
+# performs the diff in spark. returns a dict with the persisted diff
+# dataframe, its summary, and a sample of file records.
+def spark_file_diff(sql_context, structure, inventory_function=inventory_dataframe):
+  convergdb_log("using spark based control diff computation...")
+  s = time.time()
+  diff_df = diff_dataframe(
+    inventory_function(sql_context, structure),
+    control_dataframe(sql_context, structure)
+  ).persist()
+
+  summary = diff_summary(
+    diff_df.groupBy("compression").agg(
+      sql_count(lit(1)).alias("file_count"),
+      sql_sum(col("size")).alias("bytes")
+    ).collect()
+  )
+
+  sample = []
+  fractions = sample_fractions(summary, compression_sample_file_count(structure))
+  if len(fractions) > 0:
+    sample = [
+      {"key": r["key"], "size": int(r["size"])} for r in diff_df.sampleBy("compression", fractions).select("key", "size").collect()
+    ]
+
+  convergdb_log("spark based diff took " + str(time.time() - s) + " seconds")
+  return {
+    "dataframe": diff_df,
+    "summary": summary,
+    "sample": sample
+  }
+
+# yields the file records of each chunk. files are assigned to chunks by a
+# hash of the key, so only one chunk is collected on the driver at a time.
+def spark_diff_chunks(distributed, chunk_count):
+  if chunk_count == 0:
+    return
+  df = distributed["dataframe"].withColumn(
+    "convergdb_chunk",
+    expr("pmod(hash(key), " + str(chunk_count) + ")")
+  )
+  for i in range(chunk_count):
+    rows = df.where(col("convergdb_chunk") == i).select("key", "size").collect()
+    yield [{"key": r["key"], "size": int(r["size"])} for r in rows]
+
+def finish_spark_diff(distributed):
+  distributed["dataframe"].unpersist()
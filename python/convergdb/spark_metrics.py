@@ -0,0 +1,269 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.cloudwatch import (
+  buffer_cloudwatch_metric,
+  cloudwatch_metric_format,
+  metric_datum,
+  relation_dimensions
+)
+
+import json
+import time
+from contextlib import contextmanager
+
+# !SPARK EXECUTION METRICS
+
+# stage level fields of the spark status store that are summed across all
+# stages of a batch, mapped to the names used by convergdb. the fields are
+# named as in the spark monitoring REST API.
+stage_total_fields = {
+  'inputBytes': 'input_bytes',
+  'inputRecords': 'input_records',
+  'outputBytes': 'output_bytes',
+  'outputRecords': 'output_records',
+  'shuffleReadBytes': 'shuffle_read_bytes',
+  'shuffleWriteBytes': 'shuffle_write_bytes',
+  'memoryBytesSpilled': 'memory_bytes_spilled',
+  'diskBytesSpilled': 'disk_bytes_spilled',
+  'executorRunTime': 'executor_run_time'
+}
+
+# stage states that the status store may still change
+unsettled_stage_states = ['ACTIVE', 'PENDING']
+
+# milliseconds to wait for spark to deliver the events of a batch
+listener_wait_millis = 10000
+
+# times the stages of a batch are read again while some are unsettled
+stage_read_retries = 3
+
+def spark_context(sql_context):
+  return sql_context._sc
+
+# the scala spark context, for the driver APIs that pyspark does not wrap
+def jvm_spark_context(sql_context):
+  return spark_context(sql_context)._jsc.sc()
+
+def scala_list(seq):
+  return [seq.apply(i) for i in range(seq.size())]
+
+# tags every spark job started from this thread with the batch_id, so that
+# the stages belonging to the batch can be found after the write.
+def set_batch_job_group(sql_context, batch_id):
+  spark_context(sql_context).setJobGroup(
+    batch_id,
+    "convergdb batch " + batch_id
+  )
+
+# pyspark has no clearJobGroup, so the java spark context is used
+def clear_batch_job_group(sql_context):
+  spark_context(sql_context)._jsc.clearJobGroup()
+
+# tags the spark jobs started in the block with the batch_id. the tag is
+# cleared afterwards, so that later jobs of the driver thread, such as the
+# collects of the spark diff, are not counted as part of the batch.
+@contextmanager
+def batch_job_group(sql_context, batch_id):
+  set_batch_job_group(sql_context, batch_id)
+  try:
+    yield
+  finally:
+    clear_batch_job_group(sql_context)
+
+def batch_stage_ids(sql_context, batch_id):
+  tracker = spark_context(sql_context).statusTracker()
+  ret = []
+  for job_id in tracker.getJobIdsForGroup(batch_id):
+    info = tracker.getJobInfo(job_id)
+    if info:
+      ret += list(info.stageIds)
+  return sorted(set(ret))
+
+# the status store is filled from the spark listener bus, which runs behind
+# the jobs. waits until the events of the jobs that have finished are
+# delivered, or until the timeout.
+def wait_for_listener_bus(sql_context, timeout_millis=listener_wait_millis):
+  try:
+    jvm_spark_context(sql_context).listenerBus().waitUntilEmpty(timeout_millis)
+  except Exception as e:
+    convergdb_log("spark listener bus not empty after " + str(timeout_millis) + " ms: " + str(e))
+
+# returns a list with one dict per attempt of the given stage, read from the
+# status store of the driver. this works without the spark ui.
+def stage_attempts(sql_context, stage_id):
+  try:
+    attempts = scala_list(
+      jvm_spark_context(sql_context).statusStore().stageData(int(stage_id), False)
+    )
+  except Exception:
+    # the status store has no record of the stage yet
+    return []
+  ret = []
+  for a in attempts:
+    attempt = {
+      'status': a.status().toString(),
+      'attemptId': a.attemptId(),
+      'name': a.name(),
+      'numCompleteTasks': a.numCompleteTasks()
+    }
+    for f in stage_total_fields:
+      attempt[f] = getattr(a, f)()
+    ret.append(attempt)
+  return ret
+
+# returns the median and max of the task metrics for a stage attempt
+def stage_task_summary(sql_context, stage_id, attempt_id):
+  gateway = spark_context(sql_context)._gateway
+  quantiles = gateway.new_array(gateway.jvm.double, 2)
+  quantiles[0] = 0.5
+  quantiles[1] = 1.0
+  summary = jvm_spark_context(sql_context).statusStore().taskSummary(
+    int(stage_id),
+    int(attempt_id),
+    quantiles
+  )
+  if not summary.isDefined():
+    return {}
+  return {
+    'executorRunTime': scala_list(summary.get().executorRunTime()),
+    'peakExecutionMemory': scala_list(summary.get().peakExecutionMemory())
+  }
+
+# a stage is settled once the status store has recorded it, and none of its
+# attempts is still running or waiting to run.
+def stage_settled(attempts):
+  return (len(attempts) > 0) and (
+    len([a for a in attempts if a.get('status') in unsettled_stage_states]) == 0
+  )
+
+# attempts of each stage of a batch, by stage id. unsettled stages are read
+# again after the listener bus has had more time.
+def batch_stage_attempts(sql_context, stage_ids, attempts_function=stage_attempts, wait_function=wait_for_listener_bus, retries=stage_read_retries, sleep=time.sleep):
+  ret = {}
+  for attempt in range(retries + 1):
+    if attempt > 0:
+      sleep(1)
+      wait_function(sql_context)
+    for stage_id in stage_ids:
+      if not stage_settled(ret.get(stage_id, [])):
+        ret[stage_id] = attempts_function(sql_context, stage_id)
+    if len(unsettled_stage_ids(ret)) == 0:
+      break
+  return ret
+
+def unsettled_stage_ids(stage_attempts_by_id):
+  return sorted(
+    [i for i in stage_attempts_by_id if not stage_settled(stage_attempts_by_id[i])]
+  )
+
+# sums the stage_total_fields across a list of stage attempts
+def stage_totals(stages):
+  ret = {}
+  for f in stage_total_fields:
+    ret[stage_total_fields[f]] = sum(
+      [s.get(f, 0) for s in stages]
+    )
+  return ret
+
+# largest value of the top quantile for the given field
+# across a list of task summaries.
+def summary_max(summaries, field):
+  values = [s[field][-1] for s in summaries if len(s.get(field, [])) > 0]
+  if len(values) == 0:
+    return None
+  else:
+    return max(values)
+
+# ratio of the slowest task to the median task, for the most skewed stage.
+# stages with a median run time of zero are too small to be meaningful.
+def task_time_skew(summaries):
+  ratios = []
+  for s in summaries:
+    run_time = s.get('executorRunTime', [])
+    if (len(run_time) > 1) and (run_time[0] > 0):
+      ratios.append(float(run_time[-1]) / float(run_time[0]))
+  if len(ratios) == 0:
+    return None
+  else:
+    return max(ratios)
+
+# collects the metrics for all completed stages of a batch. metrics are
+# informational only, so a failure here never fails the load. stages that
+# are still unsettled after the retries are left out with a warning, since
+# the planner learns from these metrics.
+def batch_spark_metrics(sql_context, batch_id, attempts_function=stage_attempts, summary_function=stage_task_summary, wait_function=wait_for_listener_bus, sleep=time.sleep):
+  try:
+    wait_function(sql_context)
+    attempts = batch_stage_attempts(
+      sql_context,
+      batch_stage_ids(sql_context, batch_id),
+      attempts_function,
+      wait_function,
+      stage_read_retries,
+      sleep
+    )
+    unsettled = unsettled_stage_ids(attempts)
+    if len(unsettled) > 0:
+      convergdb_log("warning: partial spark metrics for batch " + batch_id + ", stages not complete: " + str(unsettled))
+    stages = []
+    summaries = []
+    for stage_id in sorted(attempts):
+      for attempt in attempts[stage_id]:
+        if attempt.get('status') == 'COMPLETE':
+          stages.append(attempt)
+          summaries.append(
+            summary_function(
+              sql_context,
+              stage_id,
+              attempt['attemptId']
+            )
+          )
+    ret = stage_totals(stages)
+    ret['peak_execution_memory'] = summary_max(summaries, 'peakExecutionMemory')
+    ret['task_time_skew'] = task_time_skew(summaries)
+    convergdb_log("spark metrics for batch " + batch_id + ": " + json.dumps(ret, sort_keys=True))
+    return ret
+  except Exception as e:
+    convergdb_log("warning: unable to collect spark metrics for batch " + batch_id + ": " + str(e))
+    return {}
+
+# !SPARK METRICS IN CLOUDWATCH
+
+# metrics of each batch sent to cloudwatch, with their units
+spark_cloudwatch_units = [
+  ('input_records', 'Count'),
+  ('output_records', 'Count'),
+  ('output_bytes', 'Bytes'),
+  ('files_written', 'Count'),
+  ('shuffle_write_bytes', 'Bytes'),
+  ('memory_bytes_spilled', 'Bytes'),
+  ('disk_bytes_spilled', 'Bytes'),
+  ('task_time_skew', 'None')
+]
+
+def spark_cloudwatch_metrics_enabled(structure):
+  return str(structure.get("spark_cloudwatch_metrics", "false")).lower() == "true"
+
+def spark_metric_data(structure, metrics, batch_id):
+  data = []
+  for name, unit in spark_cloudwatch_units:
+    if metrics.get(name, None) != None:
+      data.append(
+        metric_datum(
+          'spark_' + name,
+          metrics[name],
+          unit,
+          relation_dimensions(structure, batch_id)
+        )
+      )
+  return data
+
+# queues the spark metrics of a batch, if enabled for the relation
+def buffer_spark_metrics(structure, metrics, batch_id):
+  if spark_cloudwatch_metrics_enabled(structure):
+    for datum in spark_metric_data(structure, metrics, batch_id):
+      buffer_cloudwatch_metric(
+        structure["region"],
+        structure["cloudwatch_namespace"],
+        datum,
+        cloudwatch_metric_format(structure)
+      )
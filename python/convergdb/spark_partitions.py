@@ -1,5 +1,6 @@
-from convergdb_logging import *
+from convergdb.convergdb_logging import convergdb_log
 
+import math
 import time
 
 # !SPARK PARTITION HANDLING
@@ -51,13 +52,25 @@ def loadable_file_size(available, diff):
   convergdb_log("source data total " + str(size) + " bytes")
   return size
 
-def coalesce_partition_target(core_count, estimated_source_bytes):
-  max_partitions_per_core = 2
-  target_compression_factor = 3
-  target_file_size = 256*(1024**2)
+max_partitions_per_core = 2
+target_file_size = 256*(1024**2)
+
+# number of cores used when planning spark partitions. resources is the
+# local resource description, used when there is no dpu.
+def planning_core_count(dpu, resources=None):
+  if dpu:
+    return cores_per_dpu(dpu)
+  elif resources:
+    return resources["cores"]
+  else:
+    return 1
+
+# partition count that writes output files close to target_file_size,
+# limited to max_partitions_per_core for each core.
+def output_partition_target(core_count, estimated_output_bytes):
   max_partitions = core_count * max_partitions_per_core
   partition_count = round(
-    float(estimated_source_bytes) / float(target_compression_factor) / float(target_file_size)
+    float(estimated_output_bytes) / float(target_file_size)
   )
   partition_count = min(
     [
@@ -68,7 +81,14 @@ def coalesce_partition_target(core_count, estimated_source_bytes):
   convergdb_log("calculated partition target: " + str(partition_count))
   return partition_count
 
-def calculate_spark_partitions(total_bytes, dpu, spark_partition_count):
+def coalesce_partition_target(core_count, estimated_source_bytes):
+  target_compression_factor = 3
+  return output_partition_target(
+    core_count,
+    float(estimated_source_bytes) / float(target_compression_factor)
+  )
+
+def calculate_spark_partitions(total_bytes, dpu, spark_partition_count, resources=None):
   partitions = None
   if dpu:
     convergdb_log("AWS Glue DPU from current run_id: " + str(dpu))
@@ -78,30 +98,52 @@ def calculate_spark_partitions(total_bytes, dpu, spark_partition_count):
     else:
       convergdb_log("calculating partitions based on dpu and data size")
       partitions = coalesce_partition_target(
-        cores_per_dpu(dpu),
+        planning_core_count(dpu),
         total_bytes
       )
+  elif resources:
+    convergdb_log("using " + str(resources["cores"]) + " local CPU cores")
+    partitions = coalesce_partition_target(
+      planning_core_count(dpu, resources),
+      total_bytes
+    )
   else:
     convergdb_log("assuming single CPU core in AWS Fargate")
     partitions = coalesce_partition_target(
-      1,
+      planning_core_count(dpu),
       total_bytes
     )
   convergdb_log("job will be run with " + str(partitions) + " partitions")
   return int(partitions)
 
-def available_memory_in_this_cluster(dpu):
+def available_memory_in_this_cluster(dpu, resources=None):
   usable_portion = 0.25
   if dpu:
     bytes_per_dpu = 16 * (1024**3) # 16GB
     return int(dpu * bytes_per_dpu * usable_portion)
+  elif resources and resources["memory_bytes"]:
+    return int(usable_portion * resources["memory_bytes"])
   else:
     return int(usable_portion * 4 * (1024**3))
 
-def calculate_chunk_count(batch_uncompressed_bytes, batch_file_count, dpu):
+def calculate_chunk_count(batch_uncompressed_bytes, batch_file_count, dpu, resources=None):
   return batch_file_count / int(
     max(
       1,
-      batch_uncompressed_bytes / available_memory_in_this_cluster(dpu)
+      batch_uncompressed_bytes / available_memory_in_this_cluster(dpu, resources)
     )
   )
+
+# applies the chunk limit learned from previous resource failures.
+# sizing is the dict stored in the relation sizing state.
+def limited_chunk_count(chunk_count, sizing):
+  limit = sizing.get("max_chunk_file_count", None)
+  if limit and (limit < chunk_count):
+    convergdb_log("applying learned limit of " + str(limit) + " files per chunk")
+    return limit
+  else:
+    return chunk_count
+
+# number of files in each half of a chunk that is being split
+def split_file_count(file_count):
+  return int(math.ceil(file_count / 2.0))
@@ -1,13 +1,5 @@
-from convergdb_logging import *
-from batch_control import *
-
-from athena import *
-from cloudwatch import *
-from glue import *
-from s3 import *
-from sns import *
-from spark_partitions import *
-from spark import *
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.s3 import dict_to_s3_json, s3_json_to_dict, s3_search_to_dict
 
 import time
 import json
@@ -27,6 +19,11 @@ def get_state(structure):
   convergdb_log("current state: " + r["state"])
   return r
 
+# batches are only loaded after a success, or on the first run. other
+# states are left for an operator to clear.
+def state_allows_load(state):
+  return state["state"] in ["success", "unknown"]
+
 def data_files_for_batch(structure, batch_id):
   convergdb_log("searching for data files leftover from batch: " + batch_id)
   spl = structure["storage_bucket"].split("/", 1)
@@ -54,8 +51,9 @@ def state_folder_prefix(structure):
 def current_state_key(structure):
   return state_folder_prefix(structure) + "/state.json"
 
-def state_success(batch_id, start_time, end_time, structure, state_time=sql_utc_timestamp(time.gmtime())):
-  return {
+# metrics describes what spark did for the batch, when available.
+def state_success(batch_id, start_time, end_time, structure, state_time=sql_utc_timestamp(time.gmtime()), metrics=None):
+  ret = {
     "state" : "success",
     "state_time" : state_time,
     "batch_id": batch_id,
@@ -63,6 +61,9 @@ def state_success(batch_id, start_time, end_time, structure, state_time=sql_utc_
     "end_time" : end_time,
     "structure" : structure
   }
+  if metrics != None:
+    ret["metrics"] = metrics
+  return ret
 
 def state_load_in_progress(structure, batch_id, start_time, source_objects, state_time=sql_utc_timestamp(time.gmtime())):
   return {
@@ -74,7 +75,7 @@ def state_load_in_progress(structure, batch_id, start_time, source_objects, stat
     "structure" : structure
   }
 
-def write_success(structure, batch_id, start_time, end_time):
+def write_success(structure, batch_id, start_time, end_time, metrics=None):
   dict_to_s3_json(
     structure["state_bucket"],
     current_state_key(structure),
@@ -82,7 +83,9 @@ def write_success(structure, batch_id, start_time, end_time):
       batch_id,
       sql_utc_timestamp(start_time),
       sql_utc_timestamp(end_time),
-      structure
+      structure,
+      sql_utc_timestamp(time.gmtime()),
+      metrics
     )
   )
 
@@ -97,3 +100,41 @@ def write_load_in_progress(structure, batch_id, start_time, source_objects):
       source_objects
     )
   )
+
+# !RELATION SIZING
+
+# sizing information learned for this relation is kept apart from state.json
+# because the state file is rewritten with every batch.
+def sizing_state_key(structure):
+  return state_folder_prefix(structure) + "/sizing.json"
+
+def get_sizing_state(structure):
+  return s3_json_to_dict(
+    structure["state_bucket"],
+    sizing_state_key(structure)
+  )
+
+def write_sizing_state(structure, sizing):
+  dict_to_s3_json(
+    structure["state_bucket"],
+    sizing_state_key(structure),
+    sizing
+  )
+
+# returns the sizing dict with the chunk file limit lowered to file_count.
+# the limit is never raised, because a larger chunk has already failed.
+def lowered_chunk_file_count(sizing, file_count):
+  ret = dict(sizing)
+  current = ret.get("max_chunk_file_count", None)
+  if (current == None) or (file_count < current):
+    ret["max_chunk_file_count"] = file_count
+  return ret
+
+# stores the number of files per chunk that loaded successfully after
+# an oversized chunk was split.
+def record_chunk_file_count(structure, file_count):
+  sizing = get_sizing_state(structure)
+  lowered = lowered_chunk_file_count(sizing, file_count)
+  if lowered != sizing:
+    convergdb_log("storing max files per chunk: " + str(file_count))
+    write_sizing_state(structure, lowered)
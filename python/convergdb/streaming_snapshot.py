@@ -0,0 +1,204 @@
+# !STREAMING INVENTORY SNAPSHOT
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.batch_control import batch_id, sql_utc_timestamp
+from convergdb.fingerprint import (
+  fingerprint_inventory_type,
+  streaming_listing_start,
+  streaming_overlap_hours
+)
+from convergdb.s3 import (
+  delete_s3_keys,
+  dict_to_s3_json,
+  s3_json_to_dict,
+  s3_keys,
+  s3_keys_after,
+  s3_url_to_bucket_prefix
+)
+from convergdb.spark_diff import (
+  inventory_dataframe,
+  inventory_filter,
+  latest_inventory_events,
+  streaming_inventory_schema
+)
+from convergdb.state import state_folder_prefix
+
+import time
+
+from pyspark.sql.functions import col, expr
+
+# the snapshot holds the latest key, sequencer and size of every object in
+# the streaming inventory as parquet, so that the spark diff does not need
+# to reduce the full event history on every run. each run merges only the
+# event files that were delivered since the previous run.
+#
+# rows are hash partitioned by key, because keys below a source prefix share
+# their leading characters. a run rewrites only the partitions that new
+# events fall into, each under a new version folder. the pointer file lists
+# the current version folder of every partition, and is written last, so a
+# failed run leaves the previous snapshot in place.
+def streaming_snapshot_enabled(structure):
+  if str(structure.get("streaming_inventory_snapshot", "false")).lower() != "true":
+    return False
+  return fingerprint_inventory_type(structure) == 'streaming'
+
+def streaming_snapshot_partition_count(structure):
+  return int(structure.get("streaming_snapshot_partitions", 16))
+
+def snapshot_pointer_key(structure):
+  return state_folder_prefix(structure) + "/streaming_snapshot.json"
+
+def snapshot_folder_key(structure):
+  return state_folder_prefix(structure) + "/streaming_snapshot/"
+
+def snapshot_version_key(structure, version):
+  return snapshot_folder_key(structure) + "version=" + version + "/"
+
+def get_snapshot_pointer(structure):
+  return s3_json_to_dict(
+    structure["state_bucket"],
+    snapshot_pointer_key(structure)
+  )
+
+# event files are listed from overlap_hours before the newest event file
+# merged, so that files delivered late by firehose are still merged.
+def snapshot_listing_start(pointer, overlap_hours):
+  return streaming_listing_start(pointer.get("watermark", None), overlap_hours)
+
+# listed event files that have not been merged yet. the pointer keeps the
+# keys merged within the overlap, so they are not read again.
+def unmerged_keys(pointer, listed_keys):
+  merged = set(pointer.get("merged_keys", []))
+  return [k for k in listed_keys if not k in merged]
+
+# the pointer after merging the event files in new_keys. partitions is a
+# dict of partition number to the folder holding that partition's rows.
+# merged keys that the next listing starts after are no longer kept.
+def updated_snapshot_pointer(pointer, new_keys, partition_count, version_key, touched, overlap_hours):
+  partitions = dict(pointer.get("partitions", {}))
+  for p in touched:
+    partitions[str(p)] = version_key + "key_partition=" + str(p) + "/"
+  watermark = pointer.get("watermark", None)
+  if len(new_keys) > 0:
+    watermark = max([watermark] + new_keys)
+  start = streaming_listing_start(watermark, overlap_hours)
+  merged = set(pointer.get("merged_keys", []) + new_keys)
+  return {
+    "watermark": watermark,
+    "merged_keys": sorted([k for k in merged if (start == None) or (k > start)]),
+    "partition_count": partition_count,
+    "partitions": partitions,
+    "updated": sql_utc_timestamp(time.gmtime())
+  }
+
+# keys under the snapshot folder that no current partition refers to
+def unreferenced_snapshot_keys(keys, pointer):
+  current = pointer.get("partitions", {}).values()
+  ret = []
+  for k in keys:
+    if not any([k.startswith(p) for p in current]):
+      ret.append(k)
+  return ret
+
+def key_partition_expression(partition_count):
+  return expr("pmod(hash(key), " + str(partition_count) + ")")
+
+def snapshot_paths(structure, pointer):
+  return [
+    's3a://' + structure["state_bucket"] + '/' + p for p in sorted(pointer.get("partitions", {}).values())
+  ]
+
+# merges the newly delivered events into the snapshot and returns the new
+# pointer. the partition count of an existing snapshot is kept.
+def update_streaming_snapshot(sql_context, structure, run_id):
+  s = time.time()
+  pointer = get_snapshot_pointer(structure)
+  partition_count = int(pointer.get("partition_count", streaming_snapshot_partition_count(structure)))
+  location = s3_url_to_bucket_prefix(
+    structure["source_structure"]["streaming_inventory_output_bucket"]
+  )
+  overlap_hours = streaming_overlap_hours(structure)
+  new_keys = unmerged_keys(
+    pointer,
+    s3_keys_after(
+      location['bucket'],
+      location['prefix'],
+      snapshot_listing_start(pointer, overlap_hours)
+    )
+  )
+  convergdb_log("merging " + str(len(new_keys)) + " streaming inventory files into the snapshot")
+  if len(new_keys) == 0:
+    return pointer
+
+  events = latest_inventory_events(
+    inventory_filter(
+      sql_context.read.json(
+        ['s3a://' + location['bucket'] + '/' + k for k in new_keys],
+        schema=streaming_inventory_schema
+      ),
+      structure
+    )
+  ).withColumn(
+    "key_partition",
+    key_partition_expression(partition_count)
+  ).persist()
+
+  touched = sorted([r["key_partition"] for r in events.select("key_partition").distinct().collect()])
+  merged = events.select("key", "sequencer", "size")
+  previous = [
+    's3a://' + structure["state_bucket"] + '/' + pointer["partitions"][str(p)] for p in touched if str(p) in pointer.get("partitions", {})
+  ]
+  if len(previous) > 0:
+    merged = merged.union(
+      sql_context.read.parquet(*previous).select("key", "sequencer", "size")
+    )
+
+  version_key = snapshot_version_key(structure, run_id)
+  if len(touched) > 0:
+    latest_inventory_events(merged).withColumn(
+      "key_partition",
+      key_partition_expression(partition_count)
+    ).repartition(
+      col("key_partition")
+    ).write.partitionBy(
+      "key_partition"
+    ).parquet(
+      's3a://' + structure["state_bucket"] + '/' + version_key
+    )
+  events.unpersist()
+
+  updated = updated_snapshot_pointer(pointer, new_keys, partition_count, version_key, touched, overlap_hours)
+  dict_to_s3_json(
+    structure["state_bucket"],
+    snapshot_pointer_key(structure),
+    updated
+  )
+
+  # replaced partitions are removed once the pointer no longer refers to them
+  stale = unreferenced_snapshot_keys(
+    s3_keys(structure["state_bucket"], snapshot_folder_key(structure)),
+    updated
+  )
+  if len(stale) > 0:
+    delete_s3_keys(structure["state_bucket"], stale)
+  convergdb_log("updated " + str(len(touched)) + " snapshot partitions in " + str(time.time() - s) + " seconds")
+  return updated
+
+# key and size of every object in the streaming inventory, read from the
+# snapshot after it has been brought up to date.
+def streaming_snapshot_dataframe(sql_context, structure):
+  pointer = update_streaming_snapshot(
+    sql_context,
+    structure,
+    batch_id(time.gmtime())
+  )
+  paths = snapshot_paths(structure, pointer)
+  if len(paths) == 0:
+    return sql_context.createDataFrame([], streaming_inventory_schema).select("key", "size")
+  return sql_context.read.parquet(*paths).select("key", "size")
+
+# the inventory read by the spark diff
+def diff_inventory_function(structure):
+  if streaming_snapshot_enabled(structure):
+    return streaming_snapshot_dataframe
+  else:
+    return inventory_dataframe
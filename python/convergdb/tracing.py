@@ -0,0 +1,131 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.s3 import stream_to_s3
+from convergdb.state import state_folder_prefix
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# !PHASE TRACING
+
+# each thread traces at most one relation run at a time
+trace_local = threading.local()
+
+# functions called with each span as it ends, such as the profiler
+span_end_hooks = []
+
+def new_span(name, start):
+  return {
+    "name": name,
+    "start": start,
+    "duration": None,
+    "bytes": None,
+    "items": None,
+    "children": []
+  }
+
+# the trace for the current thread, or None outside of a run
+def current_trace():
+  return getattr(trace_local, 'trace', None)
+
+# starts a new trace for a relation run. any unfinished trace is discarded.
+def start_trace(name, clock=time.time):
+  root = new_span(name, 0.0)
+  trace_local.trace = {
+    "started_at": clock(),
+    "root": root,
+    "stack": [root]
+  }
+  return trace_local.trace
+
+# ends the current trace and returns the root span, or None if no trace
+# was started.
+def finish_trace(clock=time.time):
+  trace = current_trace()
+  trace_local.trace = None
+  if trace == None:
+    return None
+  trace["root"]["duration"] = clock() - trace["started_at"]
+  return trace["root"]
+
+# times the enclosed block as a child of the innermost open span. the
+# yielded dict can be given "bytes" and "items" by the block. spans are
+# discarded when there is no current trace.
+@contextmanager
+def span(name, clock=time.time):
+  trace = current_trace()
+  st = clock()
+  if trace == None:
+    s = new_span(name, 0.0)
+  else:
+    s = new_span(name, st - trace["started_at"])
+    trace["stack"][-1]["children"].append(s)
+    trace["stack"].append(s)
+  try:
+    yield s
+  except:
+    s["error"] = True
+    raise
+  finally:
+    s["duration"] = clock() - st
+    if (trace != None) and (trace["stack"][-1] is s):
+      trace["stack"].pop()
+    for hook in list(span_end_hooks):
+      hook(s)
+
+# sets bytes and items on a span, leaving the other unchanged when None
+def annotate_span(s, bytes=None, items=None):
+  if bytes != None:
+    s["bytes"] = bytes
+  if items != None:
+    s["items"] = items
+  return s
+
+# totals for each span name across the whole tree
+def phase_totals(root):
+  totals = {}
+  def visit(s):
+    for c in s["children"]:
+      t = totals.setdefault(
+        c["name"],
+        {"count": 0, "duration": 0.0, "bytes": 0, "items": 0}
+      )
+      t["count"] += 1
+      t["duration"] += c["duration"] or 0.0
+      t["bytes"] += c["bytes"] or 0
+      t["items"] += c["items"] or 0
+      visit(c)
+  visit(root)
+  return totals
+
+# s3_requests holds the request, throttle and retry counts of the s3
+# governor during the run.
+def performance_report(structure, run_id, outcome, root, s3_requests=None):
+  return {
+    "full_relation_name": structure["full_relation_name"],
+    "run_id": run_id,
+    "outcome": outcome,
+    "duration": root["duration"],
+    "phases": phase_totals(root),
+    "s3_requests": s3_requests or {},
+    "spans": root
+  }
+
+# reports are kept next to the relation state, one per run
+def performance_report_key(structure, run_id):
+  return state_folder_prefix(structure) + "/performance/" + run_id + ".json"
+
+# logs the report and writes it to the state bucket. the report must
+# never cause the run to fail.
+def write_performance_report(structure, report, write_function=stream_to_s3):
+  try:
+    body = json.dumps(report)
+    convergdb_log("performance report: " + body)
+    write_function(
+      structure["state_bucket"],
+      performance_report_key(structure, report["run_id"]),
+      body
+    )
+  except Exception as e:
+    convergdb_log("unable to write performance report: " + str(e))
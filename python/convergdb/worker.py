@@ -0,0 +1,317 @@
+from convergdb.convergdb_logging import convergdb_log
+from convergdb.aws import aws_client
+from convergdb.high_level import source_to_target
+from convergdb.locking import is_lock_conflict
+
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# !WARM WORKER
+
+# a cold fargate run starts a container and a spark context, imports the
+# package and loads one job. for relations that are loaded every few
+# minutes, that start is most of the run. a worker stays up instead: it
+# takes relation triggers from a queue and runs source_to_target for each
+# one with the spark context, modules and AWS clients of earlier runs.
+#
+# each run takes the same lock, and reads and writes the same state, as
+# a cold run of the relation would. a trigger is removed from the queue
+# only when its run succeeds.
+#
+# a trigger is a json object naming a relation that was registered with
+# the worker, or carrying the whole structure:
+#
+#   {"relation": "production.ecommerce.inventory.books"}
+#   {"structure": {...}, "lock_id": "nightly_batch"}
+#
+# the lock id is that of the worker process (LOCK_ID) unless the trigger
+# has its own.
+
+# seconds that a receive waits for a trigger
+worker_wait_seconds = 20
+
+# seconds that an sqs trigger stays hidden from other workers. the worker
+# extends it every half of that while the run is in progress, so runs may
+# take longer.
+sqs_visibility_seconds = 300
+
+# seconds before a trigger whose relation was locked by another run is
+# retried
+lock_retry_seconds = 30
+
+# !QUEUES
+
+# queues are dicts with a kind, and receive_message, delete_message and
+# release_message work with all of them. messages are dicts with an id
+# and the body of the trigger.
+
+# an SQS queue. triggers that fail are left on the queue, and are retried
+# once their visibility timeout has passed, or moved to the dead letter
+# queue of the redrive policy.
+def sqs_queue(queue_url, region=None, visibility_seconds=sqs_visibility_seconds):
+  return {
+    "kind": "sqs",
+    "url": queue_url,
+    "region": region,
+    "visibility_seconds": visibility_seconds
+  }
+
+# a folder of trigger files, read in name order. a file is moved to the
+# processing folder while its run is in progress, so that workers sharing
+# the folder do not run it twice, and to the failed folder if it fails.
+def file_queue(path):
+  return {
+    "kind": "file",
+    "path": path
+  }
+
+# a queue of trigger bodies held in memory, for tests and local runs
+def memory_queue(bodies=[]):
+  return {
+    "kind": "memory",
+    "messages": [{"id": str(i), "body": b} for (i, b) in enumerate(bodies)],
+    "in_flight": {},
+    "failed": []
+  }
+
+# the queue of a url: an SQS queue url, or file:// and a folder
+def queue_from_url(url, region=None):
+  if url.startswith('file://'):
+    return file_queue(url[len('file://'):])
+  return sqs_queue(url, region)
+
+def file_queue_folder(queue, name):
+  return os.path.join(queue["path"], name)
+
+def receive_sqs_message(queue, wait_seconds):
+  params = {
+    "QueueUrl": queue["url"],
+    "MaxNumberOfMessages": 1,
+    "WaitTimeSeconds": wait_seconds,
+    "VisibilityTimeout": queue["visibility_seconds"]
+  }
+  response = aws_client('sqs', queue["region"]).receive_message(**params)
+  return [
+    {"id": m["ReceiptHandle"], "body": m["Body"]} for m in response.get("Messages", [])
+  ]
+
+def receive_file_message(queue):
+  processing = file_queue_folder(queue, 'processing')
+  if not os.path.isdir(processing):
+    os.makedirs(processing)
+  for name in sorted(os.listdir(queue["path"])):
+    source = file_queue_folder(queue, name)
+    if name.startswith('.') or not os.path.isfile(source):
+      continue
+    try:
+      # another worker took the file first
+      os.rename(source, os.path.join(processing, name))
+    except OSError:
+      continue
+    with open(os.path.join(processing, name)) as f:
+      return [{"id": name, "body": f.read()}]
+  return []
+
+def receive_memory_message(queue):
+  if len(queue["messages"]) == 0:
+    return []
+  m = queue["messages"].pop(0)
+  queue["in_flight"][m["id"]] = m
+  return [m]
+
+# at most one message. the sqs queue waits up to wait_seconds for one,
+# the other queues return at once.
+def receive_message(queue, wait_seconds=worker_wait_seconds):
+  if queue["kind"] == "sqs":
+    return receive_sqs_message(queue, wait_seconds)
+  elif queue["kind"] == "file":
+    return receive_file_message(queue)
+  return receive_memory_message(queue)
+
+# removes a message whose run succeeded
+def delete_message(queue, message):
+  if queue["kind"] == "sqs":
+    aws_client('sqs', queue["region"]).delete_message(
+      QueueUrl=queue["url"],
+      ReceiptHandle=message["id"]
+    )
+  elif queue["kind"] == "file":
+    os.remove(os.path.join(file_queue_folder(queue, 'processing'), message["id"]))
+  else:
+    del queue["in_flight"][message["id"]]
+
+# gives back a message whose run failed
+def release_message(queue, message):
+  if queue["kind"] == "file":
+    failed = file_queue_folder(queue, 'failed')
+    if not os.path.isdir(failed):
+      os.makedirs(failed)
+    os.rename(
+      os.path.join(file_queue_folder(queue, 'processing'), message["id"]),
+      os.path.join(failed, message["id"])
+    )
+  elif queue["kind"] == "memory":
+    queue["failed"].append(queue["in_flight"].pop(message["id"]))
+
+# puts back a message whose relation was locked by another run, to be
+# run again later
+def retry_message(queue, message):
+  if queue["kind"] == "sqs":
+    change_message_visibility(queue, message, lock_retry_seconds)
+  elif queue["kind"] == "file":
+    os.rename(
+      os.path.join(file_queue_folder(queue, 'processing'), message["id"]),
+      file_queue_folder(queue, message["id"])
+    )
+  else:
+    queue["messages"].append(queue["in_flight"].pop(message["id"]))
+
+def change_message_visibility(queue, message, seconds):
+  aws_client('sqs', queue["region"]).change_message_visibility(
+    QueueUrl=queue["url"],
+    ReceiptHandle=message["id"],
+    VisibilityTimeout=int(seconds)
+  )
+
+# keeps an sqs message hidden from other workers while its run is in
+# progress. without it, a run longer than the visibility timeout would
+# be delivered again, and its receipt handle would no longer delete it.
+@contextmanager
+def visibility_heartbeat(queue, message, extend_function=change_message_visibility):
+  if queue["kind"] != "sqs":
+    yield
+    return
+  done = threading.Event()
+  def extend():
+    while not done.wait(queue["visibility_seconds"] / 2.0):
+      try:
+        extend_function(queue, message, queue["visibility_seconds"])
+      except Exception:
+        convergdb_log("unable to extend the visibility of a trigger: " + str(sys.exc_info()[1]))
+  t = threading.Thread(target=extend)
+  t.daemon = True
+  t.start()
+  try:
+    yield
+  finally:
+    done.set()
+    t.join()
+
+# !TRIGGERS
+
+# structure json of each relation the worker loads, by full relation name
+def worker_structures(structure_jsons):
+  return dict(
+    [(json.loads(s)["full_relation_name"], s) for s in structure_jsons]
+  )
+
+# the structure json and lock id of a trigger
+def trigger_run(structures, body):
+  trigger = json.loads(body)
+  if "structure" in trigger:
+    structure_json = json.dumps(trigger["structure"])
+  elif trigger.get("relation", None) in structures:
+    structure_json = structures[trigger["relation"]]
+  else:
+    raise Exception("trigger for unknown relation: " + str(trigger.get("relation", None)))
+  return (structure_json, trigger.get("lock_id", None))
+
+# sets the lock id that source_to_target locks for the length of a run
+@contextmanager
+def lock_environment(lock_id, environ=os.environ):
+  previous = environ.get('LOCK_ID', None)
+  if lock_id != None:
+    environ['LOCK_ID'] = lock_id
+  try:
+    yield
+  finally:
+    if previous != None:
+      environ['LOCK_ID'] = previous
+    elif 'LOCK_ID' in environ:
+      del environ['LOCK_ID']
+
+# !WORKER LOOP
+
+def new_worker(queue, structures):
+  return {
+    "queue": queue,
+    "structures": structures,
+    "runs": 0,
+    "failures": 0,
+    "lock_conflicts": 0,
+    "stopping": False
+  }
+
+# the worker finishes its current run and stops when the container is
+# asked to stop. returns the handlers that were replaced.
+def stop_on_signal(worker, signals):
+  def handler(signum, frame):
+    convergdb_log("worker received signal " + str(signum) + ", stopping after the current run")
+    worker["stopping"] = True
+  return [(s, signal.signal(s, handler)) for s in signals]
+
+# runs the trigger of a message, and deletes, retries or releases the
+# message. returns "success", "locked" or "failure".
+def run_message(worker, sql_context, message, run_function=source_to_target):
+  st = time.time()
+  try:
+    structure_json, lock_id = trigger_run(worker["structures"], message["body"])
+    with visibility_heartbeat(worker["queue"], message):
+      with lock_environment(lock_id):
+        run_function(sql_context, structure_json)
+  except Exception as e:
+    if is_lock_conflict(e):
+      worker["lock_conflicts"] += 1
+      convergdb_log("relation is locked by another run, the trigger will be retried")
+      retry_message(worker["queue"], message)
+      return "locked"
+    worker["failures"] += 1
+    convergdb_log("worker run failed: " + str(sys.exc_info()[1]))
+    release_message(worker["queue"], message)
+    return "failure"
+  finally:
+    worker["runs"] += 1
+    convergdb_log("worker run " + str(worker["runs"]) + " took " + str(time.time() - st) + " seconds")
+  delete_message(worker["queue"], message)
+  return "success"
+
+def worker_done(worker, max_runs, idle_seconds, idle_since, now):
+  if worker["stopping"]:
+    return True
+  if (max_runs != None) and (worker["runs"] >= max_runs):
+    return True
+  return (idle_seconds != None) and (now - idle_since >= idle_seconds)
+
+# runs source_to_target for each trigger on the queue, until max_runs
+# triggers have run, no trigger has arrived for idle_seconds, or one of
+# the signals is received. structure_jsons are the relations that triggers
+# can name. signals can only be handled in the main thread. returns the
+# worker, with its run and failure counts.
+def run_worker(sql_context, queue, structure_jsons=[], max_runs=None, idle_seconds=None, wait_seconds=worker_wait_seconds, signals=[signal.SIGTERM, signal.SIGINT], run_function=source_to_target, clock=time.time, sleep=time.sleep):
+  worker = new_worker(queue, worker_structures(structure_jsons))
+  previous_handlers = stop_on_signal(worker, signals)
+  convergdb_log("worker started for " + str(len(worker["structures"])) + " relations")
+  idle_since = clock()
+  try:
+    while not worker_done(worker, max_runs, idle_seconds, idle_since, clock()):
+      messages = receive_message(queue, wait_seconds)
+      if len(messages) == 0:
+        # the sqs queue has already waited for a message
+        if queue["kind"] != "sqs":
+          sleep(1)
+        continue
+      outcomes = [run_message(worker, sql_context, m, run_function) for m in messages]
+      if "locked" in outcomes:
+        # the file and memory queues would hand the trigger back at once
+        sleep(1)
+      idle_since = clock()
+  finally:
+    for (s, h) in previous_handlers:
+      signal.signal(s, h)
+  convergdb_log("worker stopped after " + str(worker["runs"]) + " runs, " + str(worker["failures"]) + " failed, " + str(worker["lock_conflicts"]) + " locked")
+  return worker
@@ -1,6 +1,19 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.add_partitions import (
+  batch_file_count,
+  convergdb_database_name,
+  convergdb_database_path,
+  convergdb_table_name,
+  key_is_valid,
+  keys_are_valid,
+  keys_from_s3_object_list,
+  partition_path,
+  partition_values,
+  partition_values_from_key,
+  regexes
+)
 import re
 
 def test_regexes():
@@ -14,20 +27,20 @@ def test_regexes():
     re.compile('part2\\=.*')
   ]
   
-  assert expected == convergdb.regexes(input)
+  assert expected == regexes(input)
 
 def test_convergdb_database_name():
-  assert 'env__db__schema' == convergdb.convergdb_database_name(
+  assert 'env__db__schema' == convergdb_database_name(
     '12345678/env.db.schema.table/part=1/file.json'
   )
 
 def test_convergdb_database_path():
-  assert 'env.db.schema' == convergdb.convergdb_database_path(
+  assert 'env.db.schema' == convergdb_database_path(
     '12345678/env.db.schema.table/part=1/file.json'
   )
 
 def test_convergdb_table_name():
-  assert 'table' == convergdb.convergdb_table_name(
+  assert 'table' == convergdb_table_name(
     '12345678/env.db.schema.table/part=1/file.json'
   )
 
@@ -35,20 +48,20 @@ def test_partition_values():
   partition_kvp = ['part1=1', 'foo=bar']
   partition_fields = ['part1','foo']
   
-  assert ['1', 'bar'] == convergdb.partition_values(
+  assert ['1', 'bar'] == partition_values(
     partition_kvp,
     partition_fields
   )
 
 def test_partition_values_from_key():
   key = '12345678/env.db.schema.table/part1=1/part2=2/file.json'
-  regexes = convergdb.regexes(
+  key_regexes = regexes(
     ['part1', 'part2']
   )
   expected = ['part1=1', 'part2=2']
-  assert expected == convergdb.partition_values_from_key(
+  assert expected == partition_values_from_key(
     key,
-    regexes
+    key_regexes
   )
   
 def test_memoize(): # can't be tested
@@ -60,7 +73,7 @@ def test_get_table_metadata(): # NEEDS INTEGRATION TEST
 def test_partition_path():
   key = '12345678/env.db.schema.table/part1=1/part2=2/file.json'
   expected = '12345678/env.db.schema.table/part1=1/part2=2/'
-  assert expected == convergdb.partition_path(key, ['part1=1','part2=2'])
+  assert expected == partition_path(key, ['part1=1','part2=2'])
   
 def test_analyze_s3_key(): # NEEDS INTEGRATION TEST
   pass
@@ -76,11 +89,11 @@ def test_keys_from_s3_object_list():
     {'Key': 'uno', 'Size': 100},
     {'Key': 'dos', 'Size': 1000}
   ]
-  assert ['uno', 'dos'] == convergdb.keys_from_s3_object_list(input)
+  assert ['uno', 'dos'] == keys_from_s3_object_list(input)
 
 def test_key_is_valid():
-  assert True  == convergdb.key_is_valid('path/is/okay')
-  assert False == convergdb.key_is_valid('path/_temporary/not_okay')
+  assert True  == key_is_valid('path/is/okay')
+  assert False == key_is_valid('path/_temporary/not_okay')
   
 def test_keys_are_valid():
   key_list = [
@@ -88,7 +101,18 @@ def test_keys_are_valid():
     'path/_temporary/not_okay'
   ]
   
-  assert ['path/is/okay'] == convergdb.keys_are_valid(key_list)
+  assert ['path/is/okay'] == keys_are_valid(key_list)
+
+def test_batch_file_count():
+  keys = [
+    'prefix/dt=2019-01-01/convergdb_batch_id=20190101000000000/part-0.parquet',
+    'prefix/dt=2019-01-02/convergdb_batch_id=20190101000000000/part-1.parquet',
+    'prefix/dt=2019-01-01/convergdb_batch_id=20181231000000000/part-0.parquet',
+    'convergdb_batch_id=20190101000000000/part-2.parquet',
+    'prefix/convergdb_batch_id=201901010000000001/part-0.parquet'
+  ]
+  assert 3 == batch_file_count(keys, '20190101000000000')
+  assert 0 == batch_file_count([], '20190101000000000')
 
 def test_update_all_partitions(): # NEEDS INTEGRATION TEST
   pass
\ No newline at end of file
@@ -0,0 +1,192 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.arrow_load import (
+  ArrowLoadUnsupported,
+  arrow_batch_rows,
+  arrow_data_load,
+  arrow_load_plan,
+  cast_text,
+  decompressed_source,
+  escape_path_name,
+  import_pyarrow,
+  json_source_rows,
+  kept_row,
+  partition_folder
+)
+
+import datetime
+import decimal
+import gzip
+import io
+import json
+
+def arrow_structure():
+  s = structure_1()
+  s["fast_load_max_bytes"] = "1000000"
+  s["source_structure"]["attributes"] = [
+    {"name": "item_number", "required": False, "expression": None, "data_type": "integer", "cast_type": "integer"},
+    {"name": "title", "required": False, "expression": None, "data_type": "varchar", "cast_type": "string"},
+    {"name": "price", "required": False, "expression": "detail.price", "data_type": "varchar", "cast_type": "string"},
+    {"name": "stock", "required": True, "expression": None, "data_type": "integer", "cast_type": "integer"}
+  ]
+  s["attributes"] = [
+    {"name": "item_number", "required": False, "expression": "item_number", "data_type": "integer", "cast_type": "integer"},
+    {"name": "title", "required": False, "expression": "title", "data_type": "varchar", "cast_type": "string"},
+    {"name": "price", "required": False, "expression": "price", "data_type": "decimal(10,2)", "cast_type": "decimal(10,2)"},
+    {"name": "part_id", "required": False, "expression": "title", "data_type": "varchar", "cast_type": "string"},
+    {"name": "source_file", "required": False, "expression": "convergdb_source_file_name", "data_type": "varchar", "cast_type": "string"}
+  ]
+  return s
+
+requires_pyarrow = pytest.mark.skipif(
+  import_pyarrow() == None,
+  reason="pyarrow is not installed"
+)
+
+@requires_pyarrow
+def test_arrow_load_plan():
+  p = arrow_load_plan(arrow_structure())
+  assert [['item_number'], ['title'], ['detail', 'price'], ['stock']] == p["paths"]
+  assert ['item_number', 'title', 'price', 'title', 'convergdb_source_file_name'] == p["target_columns"]
+  assert 'string' == p["source_types"]["convergdb_source_file_name"]
+
+@requires_pyarrow
+def test_arrow_load_plan_unsupported():
+  # sql expressions are left to spark
+  with pytest.raises(ArrowLoadUnsupported):
+    arrow_load_plan(structure_1())
+
+  s = arrow_structure()
+  s["source_structure"]["storage_format"] = "csv"
+  with pytest.raises(ArrowLoadUnsupported):
+    arrow_load_plan(s)
+
+  # integers are not cast to strings
+  s = arrow_structure()
+  s["attributes"][1]["expression"] = "item_number"
+  with pytest.raises(ArrowLoadUnsupported):
+    arrow_load_plan(s)
+
+  s = arrow_structure()
+  s["source_structure"]["attributes"][1]["expression"] = "detail"
+  with pytest.raises(ArrowLoadUnsupported):
+    arrow_load_plan(s)
+
+def test_cast_text():
+  assert True == cast_text(u'Yes', 'boolean')
+  assert None == cast_text(u'maybe', 'boolean')
+  assert 12 == cast_text(u'12.9', 'integer')
+  assert None == cast_text(u'abc', 'integer')
+  assert None == cast_text(u'1e3', 'integer')
+  assert None == cast_text(u'128', 'byte')
+  assert 1.5 == cast_text(u'1.5', 'double')
+  assert decimal.Decimal('1.24') == cast_text(u'1.235', 'decimal(10,2)')
+  assert None == cast_text(u'123456789012', 'decimal(10,2)')
+  assert datetime.date(2019, 1, 2) == cast_text(u'2019-01-02', 'date')
+  assert datetime.datetime(2019, 1, 2, 3, 4, 5, 500000) == cast_text(u'2019-01-02 03:04:05.5', 'timestamp')
+  assert None == cast_text(None, 'timestamp')
+  assert None == cast_text(u'', 'date')
+  # text that spark may read differently is left to spark
+  with pytest.raises(ArrowLoadUnsupported):
+    cast_text(u' 12', 'integer')
+  with pytest.raises(ArrowLoadUnsupported):
+    cast_text(u'2019-02-30', 'date')
+  with pytest.raises(ArrowLoadUnsupported):
+    cast_text(u'NaN', 'double')
+
+def test_json_source_rows():
+  text = '{"a": 1, "b": {"c": true}}\n\n{"a": "x", "b": null}\n'
+  assert [[u'1', u'true'], [u'x', None]] == json_source_rows(text, [['a'], ['b', 'c']])
+  with pytest.raises(ArrowLoadUnsupported):
+    json_source_rows('{"a": 1.5}', [['a']])
+  with pytest.raises(ArrowLoadUnsupported):
+    json_source_rows('{"a": [1]}', [['a']])
+  with pytest.raises(ArrowLoadUnsupported):
+    json_source_rows('{"a": ', [['a']])
+
+def test_kept_row():
+  assert kept_row([None, None], [])
+  assert kept_row([None, 1], [0, 1])
+  assert not kept_row([None, 1], [0])
+
+def test_partition_folder():
+  assert 'a%2Fb%3Dc' == escape_path_name('a/b=c')
+  assert 'p=x/d=2019-01-02/n=__HIVE_DEFAULT_PARTITION__' == partition_folder(
+    ['p', 'd', 'n'],
+    [u'x', datetime.date(2019, 1, 2), u'']
+  )
+
+def test_decompressed_source():
+  b = io.BytesIO()
+  for t in ['a\n', 'b\n']:
+    f = gzip.GzipFile(fileobj=b, mode='wb')
+    f.write(t)
+    f.close()
+  # concatenated members are read as one file
+  assert 'a\nb\n' == decompressed_source('x.json.gz', b.getvalue())
+  assert 'a\n' == decompressed_source('x.json', 'a\n')
+  with pytest.raises(ArrowLoadUnsupported):
+    decompressed_source('x.json.snappy', '')
+
+@requires_pyarrow
+def test_arrow_batch_rows():
+  s = arrow_structure()
+  p = arrow_load_plan(s)
+  rows = [
+    [u'1', u'b', u'1.5', u'3'],
+    # rejected, stock is required
+    [u'2', u'c', u'2.5', None]
+  ]
+  assert [[1, u'b', decimal.Decimal('1.50'), u'b', u's3a://bucket/a.json']] == arrow_batch_rows(
+    s,
+    p,
+    [(u's3a://bucket/a.json', rows)]
+  )
+
+def test_arrow_data_load_threshold():
+  s = arrow_structure()
+  s["fast_load_max_bytes"] = "0"
+  assert None == arrow_data_load(s, [], "1", 10, lambda b, k: '', lambda b, k, d: None)
+  s["fast_load_max_bytes"] = "5"
+  assert None == arrow_data_load(s, [], "1", 10, lambda b, k: '', lambda b, k, d: None)
+
+@requires_pyarrow
+def test_arrow_data_load():
+  import pyarrow.parquet
+  s = arrow_structure()
+  source = {
+    "a.json": '{"item_number": 1, "title": "x/y", "detail": {"price": "1.5"}, "stock": 2}\n{"item_number": 2, "title": "z", "stock": 1}\n{"item_number": 3}\n'
+  }
+  written = {}
+  def write(bucket, key, data):
+    written[bucket + '/' + key] = data
+
+  m = arrow_data_load(
+    s,
+    ['s3a://source-bucket/a.json'],
+    '20190101000000000',
+    100,
+    lambda b, k: source[k],
+    write
+  )
+  assert "arrow" == m["engine"]
+  assert 3 == m["input_records"]
+  assert 2 == m["output_records"]
+
+  prefix = s["storage_bucket"] + '/'
+  assert '' == written[prefix + '_SUCCESS']
+  folders = sorted(['/'.join(k.split('/')[:-1]) for k in written if k.endswith('.parquet')])
+  assert [
+    prefix + 'part_id=x%2Fy/convergdb_batch_id=20190101000000000',
+    prefix + 'part_id=z/convergdb_batch_id=20190101000000000'
+  ] == folders
+
+  key = [k for k in written if k.startswith(prefix + 'part_id=x%2Fy/')][0]
+  t = pyarrow.parquet.read_table(pyarrow.BufferReader(written[key]))
+  assert ['item_number', 'title', 'price', 'source_file'] == t.schema.names
+  assert [1] == t.column('item_number').to_pylist()
+  assert [decimal.Decimal('1.50')] == t.column('price').to_pylist()
+  assert [u's3a://source-bucket/a.json'] == t.column('source_file').to_pylist()
+  spark_schema = json.loads(t.schema.metadata["org.apache.spark.sql.parquet.row.metadata"])
+  assert ['integer', 'string', 'decimal(10,2)', 'string'] == [f["type"] for f in spark_schema["fields"]]
@@ -1,6 +1,15 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.athena import (
+  athena_database_name,
+  athena_table_name,
+  column_headers,
+  control_query_row_to_dict,
+  has_attribute,
+  row_to_dict,
+  tmp_results_location
+)
 
 def test_initiate_athena_query():
   pass
@@ -42,7 +51,7 @@ def test_column_headers():
     {"name": "col3", "type": "varchar(20)"}
   ]
   
-  t = convergdb.column_headers(input)
+  t = column_headers(input)
   assert t == expected
 
 def test_control_query_row_to_dict():
@@ -64,7 +73,7 @@ def test_control_query_row_to_dict():
   
   expected = {"key": "test_key", "size": 100}
   
-  t = convergdb.control_query_row_to_dict(test_row, headers)
+  t = control_query_row_to_dict(test_row, headers)
   assert t == expected
 
 def test_row_to_dict():
@@ -86,7 +95,7 @@ def test_row_to_dict():
   
   expected = {"key": "test_key", "size": "100"}
   
-  t = convergdb.row_to_dict(test_row, headers)
+  t = row_to_dict(test_row, headers)
   assert t == expected
 
 def test_athena_results_to_list():
@@ -98,16 +107,16 @@ def test_athena_query_to_list():
   pass
 
 def test_tmp_results_location():
-  t = convergdb.tmp_results_location(structure_1())
+  t = tmp_results_location(structure_1())
   
   assert t == 's3://convergdb-admin-e969ca618e222a58/e969ca618e222a58/tmp/'
 
 def test_athena_database_name():
-  t = convergdb.athena_database_name('prod.dom.sch.rel')
+  t = athena_database_name('prod.dom.sch.rel')
   assert t == 'prod__dom__sch'
 
 def test_athena_table_name():
-  t = convergdb.athena_table_name('prod.dom.sch.rel')
+  t = athena_table_name('prod.dom.sch.rel')
   assert t == 'rel'
 
 def test_athena_describe_table():
@@ -120,10 +129,10 @@ def test_has_attribute():
     {"Name": "hello", "Type":"varchar(20)","Comment":""}
   ]
   
-  t = convergdb.has_attribute(attributes, 'turkey')
+  t = has_attribute(attributes, 'turkey')
   assert t == True
   
-  t = convergdb.has_attribute(attributes, 'chicken')
+  t = has_attribute(attributes, 'chicken')
   assert t == False
 
 def test_msck_repair_table():
@@ -0,0 +1,65 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.aws import clear_aws_clients, clients_lock
+from convergdb.s3_governor import new_governor
+
+import boto3
+import os
+import signal
+
+def test_aws_client_cached():
+  clear_aws_clients()
+  c = convergdb.aws_client('s3', 'us-west-2')
+  assert c is convergdb.aws_client('s3', 'us-west-2')
+  assert not c is convergdb.aws_client('s3', 'us-east-1')
+  assert (os.getpid(), 's3', 'us-west-2') in convergdb.aws.aws_clients
+  clear_aws_clients()
+  assert not c is convergdb.aws_client('s3', 'us-west-2')
+  clear_aws_clients()
+
+def test_clients_lock_after_fork():
+  import convergdb.aws
+  lock = clients_lock()
+  assert lock is clients_lock()
+  lock.acquire()
+  try:
+    # as in a child forked while another thread held the lock
+    convergdb.aws.aws_clients_lock_pid = -1
+    assert not lock is clients_lock()
+    clear_aws_clients()
+  finally:
+    lock.release()
+
+def test_aws_client_forked_child():
+  clear_aws_clients()
+  convergdb.aws_client('s3', 'us-west-2')
+  lock = clients_lock()
+  lock.acquire()
+  try:
+    pid = os.fork()
+    if pid == 0:
+      # the child creates its own client without waiting for the lock.
+      # the alarm ends a child that deadlocks.
+      signal.alarm(10)
+      convergdb.aws_client('s3', 'us-west-2')
+      os._exit(0)
+    assert (pid, 0) == os.waitpid(pid, 0)
+  finally:
+    lock.release()
+  clear_aws_clients()
+
+def test_governor_clears_clients():
+  session = boto3.session.Session(
+    aws_access_key_id='test',
+    aws_secret_access_key='test',
+    region_name='us-west-2'
+  )
+  c = convergdb.aws_client('s3', 'us-west-2')
+  g = convergdb.start_s3_governor(new_governor(), session)
+  try:
+    # created before the governor was installed, so it is not governed
+    assert not c is convergdb.aws_client('s3', 'us-west-2')
+  finally:
+    convergdb.stop_s3_governor(g)
+  clear_aws_clients()
@@ -1,18 +1,45 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.batch_control import (
+  aws_api_based_diff,
+  aws_athena_based_diff,
+  batch_id,
+  can_split_batch,
+  control_file_key,
+  control_folder_key,
+  control_query_diff_from_csv,
+  control_table_database_name,
+  control_table_name,
+  diff_approaches,
+  diff_s3a,
+  file_estimated_sizing,
+  file_list_to_s3a,
+  file_loaded_records,
+  file_sizing,
+  inventory_table,
+  is_resource_failure,
+  minimum_split_file_count,
+  s3_file_loaded_record,
+  s3_inventory_query,
+  sql_utc_timestamp,
+  streaming_inventory_query,
+  uncompressed_estimate,
+  unloaded_files,
+  where_clause
+)
 import json
 import time
 
 
 def test_batch_id():
-  t = convergdb.batch_id(
+  t = batch_id(
     (2018, 12, 31, 23, 59, 59, 0, 0, 0)
   )
   assert t == '20181231235959000'
 
 def test_sql_utc_timestamp():
-  t = convergdb.sql_utc_timestamp(
+  t = sql_utc_timestamp(
     (2018, 12, 31, 23, 59, 59, 0, 0, 0)
   )
   assert t == '2018-12-31 23:59:59.000'
@@ -21,14 +48,41 @@ def test_add_control_file():
   # writes to s3... no test
   pass
 
+def test_is_resource_failure():
+  assert is_resource_failure(
+    Exception("An error occurred while calling o123.save.\n: java.lang.OutOfMemoryError: Java heap space")
+  )
+  assert is_resource_failure(
+    Exception("ExecutorLostFailure (executor 3 exited caused by one of the running tasks)")
+  )
+  assert not is_resource_failure(
+    Exception("Path does not exist: s3a://bucket/key")
+  )
+
+def test_minimum_split_file_count():
+  assert 1 == minimum_split_file_count({})
+  assert 8 == minimum_split_file_count({"minimum_split_file_count": 8})
+
+def test_can_split_batch():
+  oom = Exception("java.lang.OutOfMemoryError: GC overhead limit exceeded")
+  diff = [{"key": "a.gz", "size": 1}, {"key": "b.gz", "size": 1}]
+
+  assert can_split_batch({}, diff, oom)
+
+  # single file can not be split
+  assert not can_split_batch({}, diff[0:1], oom)
+
+  # failures unrelated to resources are not retried
+  assert not can_split_batch({}, diff, Exception("AccessDenied"))
+
 def test_file_sizing():
   # empty list means size 0
-  t = convergdb.file_sizing(
+  t = file_sizing(
     []
   )
   assert t == 0
 
-  t = convergdb.file_sizing(
+  t = file_sizing(
     [
       {
         "key": "a.gz",
@@ -47,7 +101,7 @@ def test_file_sizing():
   assert t == 300
 
 def test_uncompressed_estimate():
-  t = convergdb.uncompressed_estimate(
+  t = uncompressed_estimate(
       {
         "key": "a.gz",
         "size": 100
@@ -55,7 +109,7 @@ def test_uncompressed_estimate():
   )
   assert t == 700
 
-  t = convergdb.uncompressed_estimate(
+  t = uncompressed_estimate(
       {
         "key": "a.bz2",
         "size": 100
@@ -63,7 +117,7 @@ def test_uncompressed_estimate():
   )
   assert t == 1000
 
-  t = convergdb.uncompressed_estimate(
+  t = uncompressed_estimate(
       {
         "key": "a.json",
         "size": 100
@@ -72,7 +126,7 @@ def test_uncompressed_estimate():
   assert t == 100
 
 def test_file_estimated_sizing():
-  t = convergdb.file_estimated_sizing(
+  t = file_estimated_sizing(
     [
       {
         "key": "a.json",
@@ -93,7 +147,7 @@ def test_file_estimated_sizing():
 def test_file_list_to_s3a():
   key_list = ['key1','key2','key3']
   bucket = 'some-bucket'
-  t = convergdb.file_list_to_s3a(key_list, bucket)
+  t = file_list_to_s3a(key_list, bucket)
 
   assert t == [
     's3a://some-bucket/key1',
@@ -103,7 +157,7 @@ def test_file_list_to_s3a():
 
 def test_diff_s3a():
   key_list = ['key1','key2','key3']
-  t = convergdb.diff_s3a(
+  t = diff_s3a(
     structure_1(),
     key_list
   )
@@ -115,11 +169,11 @@ def test_diff_s3a():
   assert expected == t
 
 def test_control_table_database_name():
-  t = convergdb.control_table_database_name(structure_1())
+  t = control_table_database_name(structure_1())
   assert t == 'convergdb_control_e969ca618e222a58'
 
 def test_control_table_name():
-  t = convergdb.control_table_name(structure_1())
+  t = control_table_name(structure_1())
   assert t == 'production__ecommerce__inventory__books'
 
 def test_aws_api_based_diff():
@@ -127,6 +181,17 @@ def test_aws_api_based_diff():
   # needs functional refactor
   pass
 
+def test_unloaded_files():
+  available = [
+    {"key": "a.json", "size": 1},
+    {"key": "b.json", "size": 2},
+    {"key": "folder/", "size": 0}
+  ]
+  assert [{"key": "b.json", "size": 2}] == unloaded_files(
+    available,
+    {"a.json": None}
+  )
+
 def test_available_files():
   # performs s3 search
   # needs functional refactoring
@@ -138,7 +203,7 @@ def test_loaded_files():
   pass
 
 def test_s3_file_loaded_record():
-  t = convergdb.s3_file_loaded_record(
+  t = s3_file_loaded_record(
     structure_1(),
     'path/to/file',
     '20181231235959000',
@@ -160,14 +225,17 @@ def test_s3_file_loaded_record():
   }
 
 def test_control_file_key():
-  t = convergdb.control_file_key(
+  t = control_file_key(
     structure_1(),
     '20181231235959000'
   )
   assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/control/20181231235959000.json.gz"
 
+def test_control_folder_key():
+  assert "e969ca618e222a58/state/production.ecommerce.inventory.books/control/" == control_folder_key(structure_1())
+
 def test_file_loaded_records():
-  t = convergdb.file_loaded_records(
+  t = file_loaded_records(
     structure_1(),
     ['key1','key2'],
     '20181231235959000',
@@ -188,7 +256,25 @@ def test_write_control_records():
   pass
 
 def test_control_query_diff_from_csv():
-  pass
+  import cStringIO
+  def reader(bucket, key):
+    assert (bucket, key) == ('results', 'diff.csv')
+    return cStringIO.StringIO('"key","size"\n"a/b.json","10"\n"a/c.json","20"\n')
+  assert [{"key": u"a/b.json", "size": 10}, {"key": u"a/c.json", "size": 20}] == control_query_diff_from_csv(
+    {'bucket': 'results', 'key': 'diff.csv'},
+    'us-west-2',
+    reader
+  )
+
+def test_control_query_diff_from_csv_last_modified():
+  import cStringIO
+  def reader(bucket, key):
+    return cStringIO.StringIO('"key","size","last_modified"\n"a/b.json","10","2019-01-01 00:00:00.000"\n"a/c.json","20",\n')
+  assert [{"key": u"a/b.json", "size": 10, "last_modified": u"2019-01-01 00:00:00.000"}, {"key": u"a/c.json", "size": 20}] == control_query_diff_from_csv(
+    {'bucket': 'results', 'key': 'diff.csv'},
+    'us-west-2',
+    reader
+  )
 
 def test_inventory_table():
   # default, streaming_inventory = true
@@ -200,7 +286,7 @@ def test_inventory_table():
       "streaming_inventory_table": "inventory.table"
     }
   }
-  assert "inventory.table" == convergdb.inventory_table(test_structure1)
+  assert "inventory.table" == inventory_table(test_structure1)
 
   # s3, streaming_inventory = true (ignored)
   test_structure2 = {
@@ -211,7 +297,7 @@ def test_inventory_table():
       "streaming_inventory_table": "inventory.table"
     }
   }
-  assert "s3_inventory.table_name" == convergdb.inventory_table(test_structure2)
+  assert "s3_inventory.table_name" == inventory_table(test_structure2)
 
   # streaming
   test_structure3 = {
@@ -222,7 +308,7 @@ def test_inventory_table():
       "streaming_inventory_table": "inventory.table"
     }
   }
-  assert "inventory.table" == convergdb.inventory_table(test_structure3)
+  assert "inventory.table" == inventory_table(test_structure3)
 
   # default, streaming inventory = false
   test_structure4 = {
@@ -233,7 +319,7 @@ def test_inventory_table():
       "streaming_inventory_table": "inventory.table"
     }
   }
-  assert "s3_inventory.table_name" == convergdb.inventory_table(test_structure4)
+  assert "s3_inventory.table_name" == inventory_table(test_structure4)
 
 def test_athena_inventory_type():
   pass
@@ -253,15 +339,15 @@ def test_diff_approaches():
     "streaming_inventory": "false"
   }
   
-  assert convergdb.aws_api_based_diff == convergdb.diff_approaches(
+  assert aws_api_based_diff == diff_approaches(
     'api',
     t
   )
-  assert convergdb.aws_athena_based_diff == convergdb.diff_approaches(
+  assert aws_athena_based_diff == diff_approaches(
     's3',
     t
   )
-  assert convergdb.aws_athena_based_diff == convergdb.diff_approaches(
+  assert aws_athena_based_diff == diff_approaches(
     'streaming',
     t
   )
@@ -271,7 +357,7 @@ def test_diff_approaches():
     "inventory_table": "database.table",
     "streaming_inventory": "false"
   }
-  assert convergdb.aws_athena_based_diff == convergdb.diff_approaches(
+  assert aws_athena_based_diff == diff_approaches(
     'default',
     t
   )
@@ -281,7 +367,7 @@ def test_diff_approaches():
     "inventory_table": "",
     "streaming_inventory": "true"
   }
-  assert convergdb.aws_athena_based_diff == convergdb.diff_approaches(
+  assert aws_athena_based_diff == diff_approaches(
     'default',
     t
   )
@@ -302,7 +388,7 @@ def test_where_clause():
     {"Name":"encryption_status","Type":"string"}
   ]
 
-  t = convergdb.where_clause(structure_1(), inv_attributes)
+  t = where_clause(structure_1(), inv_attributes)
 
   assert t == [
     '"bucket"=' + chr(39) + 'demo-source-us-west-2.beyondsoft.us' + chr(39),
@@ -324,7 +410,7 @@ def test_where_clause():
     {"Name":"is_delete_marker","Type":"boolean"}
   ]
 
-  t = convergdb.where_clause(structure_1(), inv_attributes)
+  t = where_clause(structure_1(), inv_attributes)
 
   assert t == [
     '"bucket"=' + chr(39) + 'demo-source-us-west-2.beyondsoft.us' + chr(39),
@@ -374,7 +460,7 @@ from
   def inv_attr_function_stub(a):
     return []
 
-  t = convergdb.s3_inventory_query(
+  t = s3_inventory_query(
     structure_1(),
     inv_attr_function_stub
   )
@@ -439,8 +525,43 @@ from
   def inv_attr_function_stub(a):
     return []
 
-  t = convergdb.streaming_inventory_query(
+  t = streaming_inventory_query(
     structure_2(),
     inv_attr_function_stub
   )
   assert expected == t
+
+def test_inventory_queries_last_modified():
+  s = structure_1()
+  s["load_order"] = "newest_first"
+  attributes = [{"Name": "last_modified_date", "Type": "timestamp"}]
+  q = s3_inventory_query(s, lambda a: attributes)
+  assert "last_modified_date as last_modified" in q
+  assert q.endswith("  ,size\n  ,last_modified\nfrom\n  diff;\n")
+  # the field is optional in s3 inventory reports
+  assert not "last_modified" in s3_inventory_query(s, lambda a: [])
+  s = structure_2()
+  s["load_order_fresh_share"] = "0.1"
+  q = streaming_inventory_query(s, lambda a: [])
+  assert ",last_modified_timestamp as last_modified" in q
+  assert q.endswith("  size,\n  last_modified\nfrom\n  diff;\n")
+
+def test_file_estimated_sizing_with_factors():
+  t = file_estimated_sizing(
+    [
+      {
+        "key": "a.json",
+        "size": 100
+      },
+      {
+        "key": "b.bz2",
+        "size": 100
+      },
+      {
+        "key": "c.gz",
+        "size": 100
+      }
+    ],
+    {'gz': 3, 'bz2': 5}
+  )
+  assert t == 900
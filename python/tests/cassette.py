@@ -0,0 +1,197 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.cassette import (
+  cassette_bytes,
+  cassette_key,
+  cassette_recording_enabled,
+  decode_value,
+  encode_value,
+  interaction_key,
+  is_write_operation,
+  recorded_interactions,
+  redact,
+  replay_index,
+  replayed_interaction,
+  request_params
+)
+from convergdb.s3 import stream_to_s3
+import base64
+import boto3
+import datetime
+import json
+
+from dateutil.tz import tzutc
+
+def test_cassette_recording_enabled():
+  assert not cassette_recording_enabled({}, {})
+  assert cassette_recording_enabled({"record_cassette": "true"}, {})
+  assert cassette_recording_enabled({}, {"CONVERGDB_RECORD_CASSETTE": "1"})
+
+def test_redact():
+  assert 'BUCKET/PREFIX/a.gz' == redact(
+    'my-bucket/secret/a.gz',
+    [['my-bucket', 'BUCKET'], ['secret', 'PREFIX']]
+  )
+
+def test_encode_value():
+  t = datetime.datetime(2019, 1, 1, 0, 0, 0, tzinfo=tzutc())
+  encoded = encode_value({"a": [t], "b": 1})
+  assert encoded == {"a": [{"__datetime__": "2019-01-01T00:00:00+00:00"}], "b": 1}
+  assert decode_value(json.loads(json.dumps(encoded))) == {"a": [t], "b": 1}
+
+def test_request_params():
+  assert {"Bucket": "b", "Key": "k"} == request_params(
+    {"Bucket": "b", "Key": "k", "Body": "data"}
+  )
+
+def test_interaction_key():
+  assert 's3.GetObject {"Bucket": "b", "Key": "k"}' == interaction_key(
+    's3',
+    'GetObject',
+    {"Key": "k", "Bucket": "b"}
+  )
+
+def test_is_write_operation():
+  assert is_write_operation('PutObject')
+  assert is_write_operation('DeleteObjects')
+  assert not is_write_operation('GetObject')
+  assert not is_write_operation('ListObjectsV2')
+
+def test_cassette_bytes():
+  interactions = [
+    {
+      "service": "s3",
+      "operation": "GetObject",
+      "params": {"Bucket": "my-bucket", "Key": "secret/a.json"},
+      "status": 200,
+      "response": {},
+      "body_field": "Body",
+      "body": base64.b64encode('{"key": "secret/b.json"}')
+    }
+  ]
+  t = convergdb.read_cassette(
+    cassette_bytes(
+      '{"storage_bucket": "my-bucket"}',
+      interactions,
+      [['my-bucket', 'BUCKET'], ['secret', 'PREFIX']]
+    )
+  )
+  assert t["version"] == 1
+  assert t["structure"] == '{"storage_bucket": "BUCKET"}'
+  assert t["interactions"][0]["params"] == {"Bucket": "BUCKET", "Key": "PREFIX/a.json"}
+  assert base64.b64decode(t["interactions"][0]["body"]) == '{"key": "PREFIX/b.json"}'
+
+def test_cassette_key():
+  t = cassette_key(
+    structure_1(),
+    '20190101000000000'
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/cassettes/20190101000000000.json.gz"
+
+def test_replayed_interaction():
+  cassette = {
+    "interactions": [
+      {"service": "s3", "operation": "GetObject", "params": {"Key": "a"}, "response": {"n": 1}},
+      {"service": "s3", "operation": "GetObject", "params": {"Key": "a"}, "response": {"n": 2}}
+    ]
+  }
+  index = replay_index(cassette)
+  position = {}
+  assert 1 == replayed_interaction(index, position, 's3', 'GetObject', {"Key": "a"})["response"]["n"]
+  assert 2 == replayed_interaction(index, position, 's3', 'GetObject', {"Key": "a"})["response"]["n"]
+  # the last response is repeated
+  assert 2 == replayed_interaction(index, position, 's3', 'GetObject', {"Key": "a"})["response"]["n"]
+  assert None == replayed_interaction(index, position, 's3', 'GetObject', {"Key": "b"})
+
+def test_record_and_replay():
+  cassette = {
+    "interactions": [
+      {
+        "service": "s3",
+        "operation": "ListObjectsV2",
+        "params": {"Bucket": "b", "EncodingType": "url", "Prefix": "p/"},
+        "status": 200,
+        "response": {
+          "KeyCount": 1,
+          "Contents": [
+            {"Key": "p/a+b.gz", "Size": 10, "LastModified": {"__datetime__": "2019-01-01T00:00:00+00:00"}}
+          ]
+        }
+      },
+      {
+        "service": "s3",
+        "operation": "GetObject",
+        "params": {"Bucket": "b", "Key": "p/a.gz"},
+        "status": 200,
+        "response": {},
+        "body_field": "Body",
+        "body": base64.b64encode("content")
+      },
+      {
+        "service": "s3",
+        "operation": "GetObject",
+        "params": {"Bucket": "b", "Key": "missing"},
+        "status": 404,
+        "response": {"Error": {"Code": "NoSuchKey", "Message": "missing"}}
+      }
+    ]
+  }
+  session = boto3.session.Session(
+    aws_access_key_id='replay',
+    aws_secret_access_key='replay',
+    region_name='us-west-2'
+  )
+  replayer = convergdb.start_replay(cassette, session)
+  # recording the replayed run should give the same cassette
+  recorder = convergdb.start_recording(session)
+  try:
+    client = session.client('s3')
+    listing = client.list_objects_v2(Bucket='b', Prefix='p/')
+    # keys are recorded url decoded and are not decoded again
+    assert listing["Contents"][0]["Key"] == "p/a+b.gz"
+    assert listing["Contents"][0]["LastModified"] == datetime.datetime(2019, 1, 1, tzinfo=tzutc())
+    assert client.get_object(Bucket='b', Key='p/a.gz')["Body"].read() == "content"
+    with pytest.raises(client.exceptions.NoSuchKey):
+      client.get_object(Bucket='b', Key='missing')
+    # unmatched writes succeed, unmatched reads fail
+    client.put_object(Bucket='b', Key='new', Body='x')
+    with pytest.raises(Exception):
+      client.get_object(Bucket='b', Key='other')
+  finally:
+    convergdb.stop_recording(recorder)
+    convergdb.stop_replay(replayer)
+
+  assert replayer["unmatched"] == ['s3.PutObject', 's3.GetObject']
+  # bodies are kept in the temp file of the recorder, not in memory
+  assert not "body" in recorder["interactions"][1]
+  recorded = list(recorded_interactions(recorder))
+  assert [i["operation"] for i in recorded] == ['ListObjectsV2', 'GetObject', 'GetObject', 'PutObject']
+  assert recorded[0]["params"] == {"Bucket": "b", "EncodingType": "url", "Prefix": "p/"}
+  assert recorded[0]["response"] == cassette["interactions"][0]["response"]
+  assert recorded[1]["body"] == cassette["interactions"][1]["body"]
+  assert recorded[2]["status"] == 404
+
+def test_replay_multipart_write():
+  session = boto3.session.Session(
+    aws_access_key_id='replay',
+    aws_secret_access_key='replay',
+    region_name='us-west-2'
+  )
+  replayer = convergdb.start_replay({"interactions": []}, session)
+  try:
+    # state and control writes larger than a part use a multipart upload,
+    # whose keys contain the time of the run and never match on replay.
+    written = stream_to_s3(
+      'b',
+      'state/20190101000000000.json',
+      ['x' * 10, 'y' * 10],
+      part_size=8,
+      client=session.client('s3')
+    )
+  finally:
+    convergdb.stop_replay(replayer)
+  assert 20 == written
+  assert 's3.CreateMultipartUpload' == replayer["unmatched"][0]
+  assert 's3.CompleteMultipartUpload' == replayer["unmatched"][-1]
+  assert 2 == replayer["unmatched"].count('s3.UploadPart')
@@ -1,7 +1,153 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.cloudwatch import (
+  cloudwatch_batch_dimension,
+  cloudwatch_metric_format,
+  drain_metric_queue,
+  emf_record,
+  grouped_metric_data,
+  metric_datum,
+  metric_dimensions,
+  metric_sender_loop,
+  phase_metric_data,
+  relation_dimensions
+)
+import Queue
+import threading
 
 def test_put_cloudwatch_metric():
   # should be refactored to make the input params testable
-  pass
\ No newline at end of file
+  pass
+
+def test_metric_dimensions():
+  assert metric_dimensions({"relation": "a.b.c.d", "phase": "data_load"}) == [
+    {'Name': 'phase', 'Value': 'data_load'},
+    {'Name': 'relation', 'Value': 'a.b.c.d'}
+  ]
+
+def test_metric_datum():
+  assert metric_datum('batch_success', 1, 'Count') == {
+    'MetricName': 'batch_success',
+    'Value': 1,
+    'Unit': 'Count'
+  }
+  assert metric_datum('batch_success', 1, 'Count', {"relation": "a"}) == {
+    'MetricName': 'batch_success',
+    'Value': 1,
+    'Unit': 'Count',
+    'Dimensions': [{'Name': 'relation', 'Value': 'a'}]
+  }
+
+def test_emf_record():
+  t = emf_record(
+    'convergdb/e969ca618e222a58',
+    metric_datum('phase_duration', 2.5, 'Seconds', {"relation": "a", "phase": "file_diff"}),
+    1546300800000
+  )
+  assert t == {
+    "_aws": {
+      "Timestamp": 1546300800000,
+      "CloudWatchMetrics": [
+        {
+          "Namespace": 'convergdb/e969ca618e222a58',
+          "Dimensions": [['phase', 'relation']],
+          "Metrics": [{"Name": 'phase_duration', "Unit": 'Seconds'}]
+        }
+      ]
+    },
+    "phase": "file_diff",
+    "relation": "a",
+    "phase_duration": 2.5
+  }
+
+def test_grouped_metric_data():
+  a = ('us-west-2', 'ns_a')
+  b = ('us-east-1', 'ns_b')
+  items = [(a, 1), (b, 2), (a, 3), (a, 4)]
+  assert grouped_metric_data(items, 2) == [
+    (b, [2]),
+    (a, [1, 3]),
+    (a, [4])
+  ]
+
+def test_drain_metric_queue():
+  q = Queue.Queue()
+  q.put(2)
+  q.put(3)
+  assert drain_metric_queue(q, 1) == [1, 2, 3]
+  assert q.empty()
+
+def test_metric_sender_loop():
+  sent = []
+  def send_stub(clients, destination, data):
+    sent.append((destination, data))
+
+  q = Queue.Queue()
+  t = threading.Thread(target=metric_sender_loop, args=(q, send_stub))
+  t.daemon = True
+  t.start()
+  event = threading.Event()
+  q.put((('us-west-2', 'ns'), {'MetricName': 'a'}))
+  q.put(('flush', event))
+  assert event.wait(5)
+  assert sent == [(('us-west-2', 'ns'), [{'MetricName': 'a'}])]
+
+def test_cloudwatch_metric_format():
+  assert cloudwatch_metric_format({}) == 'api'
+  assert cloudwatch_metric_format({"cloudwatch_metric_format": "emf"}) == 'emf'
+
+def test_cloudwatch_batch_dimension():
+  assert not cloudwatch_batch_dimension({})
+  assert cloudwatch_batch_dimension({"cloudwatch_batch_dimension": "true"})
+
+def test_relation_dimensions():
+  t = structure_1()
+  assert relation_dimensions(t, '20190101000000000') == {
+    "relation": "production.ecommerce.inventory.books"
+  }
+  assert relation_dimensions(t, None, 'data_load') == {
+    "relation": "production.ecommerce.inventory.books",
+    "phase": "data_load"
+  }
+  t["cloudwatch_batch_dimension"] = "true"
+  assert relation_dimensions(t, '20190101000000000', 'data_load') == {
+    "relation": "production.ecommerce.inventory.books",
+    "phase": "data_load",
+    "batch": '20190101000000000'
+  }
+
+def test_relation_metric():
+  # queues metrics for the background sender
+  pass
+
+def test_phase_metric_data():
+  totals = {
+    "file_diff": {"count": 1, "duration": 2.0, "bytes": 100, "items": 5},
+    "write_success": {"count": 1, "duration": 0.5, "bytes": 0, "items": 0}
+  }
+  relation = {'Name': 'relation', 'Value': 'production.ecommerce.inventory.books'}
+  assert phase_metric_data(structure_1(), totals) == [
+    {
+      'MetricName': 'phase_duration',
+      'Value': 2.0,
+      'Unit': 'Seconds',
+      'Dimensions': [{'Name': 'phase', 'Value': 'file_diff'}, relation]
+    },
+    {
+      'MetricName': 'phase_throughput',
+      'Value': 50.0,
+      'Unit': 'Bytes/Second',
+      'Dimensions': [{'Name': 'phase', 'Value': 'file_diff'}, relation]
+    },
+    {
+      'MetricName': 'phase_duration',
+      'Value': 0.5,
+      'Unit': 'Seconds',
+      'Dimensions': [{'Name': 'phase', 'Value': 'write_success'}, relation]
+    }
+  ]
+
+def test_flush_cloudwatch_metrics():
+  # waits on the background sender
+  pass
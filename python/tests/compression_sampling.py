@@ -0,0 +1,121 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.compression_sampling import (
+  cached_ratios_are_current,
+  compression_factors,
+  compression_ratios_key,
+  compression_sample_bytes,
+  compression_sample_file_count,
+  compression_sample_max_age,
+  compression_sample_seconds,
+  compression_type,
+  decompressed_size,
+  sample_files,
+  sampled_ratios,
+  with_default_factors
+)
+import bz2
+import gzip
+import random
+import StringIO
+
+def gzip_bytes(data):
+  buf = StringIO.StringIO()
+  writer = gzip.GzipFile(None, 'wb', 6, buf)
+  writer.write(data)
+  writer.close()
+  return buf.getvalue()
+
+def test_compression_sample_settings():
+  assert 8 == compression_sample_file_count({})
+  assert 1024 * 1024 == compression_sample_bytes({})
+  assert 30.0 == compression_sample_seconds({})
+  assert 86400.0 == compression_sample_max_age({})
+
+  s = {
+    "compression_sample_file_count": 2,
+    "compression_sample_kb": 64,
+    "compression_sample_seconds": 5,
+    "compression_sample_max_age": 60
+  }
+  assert 2 == compression_sample_file_count(s)
+  assert 64 * 1024 == compression_sample_bytes(s)
+  assert 5.0 == compression_sample_seconds(s)
+  assert 60.0 == compression_sample_max_age(s)
+
+def test_compression_type():
+  assert 'gz' == compression_type('path/a.json.gz')
+  assert 'bz2' == compression_type('path/a.json.bz2')
+  assert None == compression_type('path/a.json')
+
+def test_sample_files():
+  diff = [
+    {"key": "a.gz", "size": 1},
+    {"key": "b.gz", "size": 1},
+    {"key": "c.gz", "size": 1},
+    {"key": "d.bz2", "size": 1},
+    {"key": "e.json", "size": 1}
+  ]
+  t = sample_files(diff, 2, random.Random(1))
+  assert sorted(t.keys()) == ['bz2', 'gz']
+  assert len(t['gz']) == 2
+  assert t['bz2'] == [{"key": "d.bz2", "size": 1}]
+
+def test_ranged_get():
+  # reads from s3
+  pass
+
+def test_decompressed_size():
+  data = 'abcdefgh' * 10000
+
+  compressed = gzip_bytes(data)
+  assert (len(compressed), len(data)) == decompressed_size(compressed, 'gz')
+
+  # concatenated members are all counted
+  assert (2 * len(compressed), 2 * len(data)) == decompressed_size(compressed + compressed, 'gz')
+
+  # partial data decompresses as far as possible
+  partial = decompressed_size(gzip_bytes(data * 10)[0:100], 'gz')
+  assert partial[0] == 100
+  assert partial[1] > 100
+
+  compressed = bz2.compress(data)
+  assert (len(compressed), len(data)) == decompressed_size(compressed, 'bz2')
+
+def test_sampled_ratios():
+  t = sampled_ratios(
+    [
+      ('gz', 100, 500),
+      ('gz', 100, 700),
+      ('bz2', 100, 0)
+    ]
+  )
+  assert t == {'gz': 6.0}
+
+def test_sample_decompression_ratios():
+  # reads from s3
+  pass
+
+def test_compression_ratios_key():
+  t = compression_ratios_key(
+    structure_1()
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/compression_ratios.json"
+
+def test_cached_ratios_are_current():
+  assert not cached_ratios_are_current({}, 60, 1000)
+  assert cached_ratios_are_current({"sampled_at": 990}, 60, 1000)
+  assert not cached_ratios_are_current({"sampled_at": 900}, 60, 1000)
+
+def test_with_default_factors():
+  assert {'gz': 7, 'bz2': 10} == with_default_factors({})
+  assert {'gz': 3.5, 'bz2': 10} == with_default_factors({'gz': 3.5})
+
+def test_compression_factors():
+  # sampling disabled
+  t = compression_factors(
+    {"compression_sample_file_count": 0},
+    []
+  )
+  assert {'gz': 7, 'bz2': 10} == t
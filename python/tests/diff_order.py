@@ -0,0 +1,62 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.diff_order import (
+  fresh_files_per_chunk,
+  last_modified_needed,
+  load_order,
+  ordered_diff,
+  sorted_diff
+)
+
+def diff_1():
+  return [
+    {"key": "c", "size": 30, "last_modified": "2019-01-03 00:00:00.000"},
+    {"key": "a", "size": 20, "last_modified": "2019-01-01 00:00:00.000"},
+    {"key": "e", "size": 10},
+    {"key": "b", "size": 50, "last_modified": "2019-01-05 00:00:00.000"},
+    {"key": "d", "size": 40, "last_modified": "2019-01-04 00:00:00.000"}
+  ]
+
+def keys(diff):
+  return [d["key"] for d in diff]
+
+def ordered_structure(order, share=None):
+  s = structure_1()
+  s["load_order"] = order
+  if share != None:
+    s["load_order_fresh_share"] = share
+  return s
+
+def test_load_order():
+  assert "listed" == load_order(structure_1())
+  assert "key" == load_order(ordered_structure("key"))
+  with pytest.raises(Exception):
+    load_order(ordered_structure("random"))
+
+def test_last_modified_needed():
+  assert not last_modified_needed(structure_1())
+  assert not last_modified_needed(ordered_structure("size_ascending"))
+  assert last_modified_needed(ordered_structure("oldest_first"))
+  assert last_modified_needed(ordered_structure("key", "0.25"))
+
+def test_sorted_diff():
+  assert ["c", "a", "e", "b", "d"] == keys(sorted_diff(diff_1(), "listed"))
+  assert ["b", "d", "c", "a", "e"] == keys(sorted_diff(diff_1(), "newest_first"))
+  # files without a last modified time are the oldest
+  assert ["e", "a", "c", "d", "b"] == keys(sorted_diff(diff_1(), "oldest_first"))
+  assert ["a", "b", "c", "d", "e"] == keys(sorted_diff(diff_1(), "key"))
+  assert ["e", "a", "c", "d", "b"] == keys(sorted_diff(diff_1(), "size_ascending"))
+
+def test_fresh_files_per_chunk():
+  assert 0 == fresh_files_per_chunk(10, 0.0)
+  assert 1 == fresh_files_per_chunk(10, 0.01)
+  assert 2 == fresh_files_per_chunk(10, 0.25)
+  assert 10 == fresh_files_per_chunk(10, 1.0)
+
+def test_ordered_diff():
+  assert ["e", "a", "c", "d", "b"] == keys(ordered_diff(ordered_structure("oldest_first"), diff_1(), 2))
+  # every chunk of two starts with the newest file not loaded yet
+  assert ["b", "e", "d", "a", "c"] == keys(ordered_diff(ordered_structure("oldest_first", "0.5"), diff_1(), 2))
+  assert ["b", "a", "c", "d", "e"] == keys(ordered_diff(ordered_structure("key", "0.1"), diff_1(), 3))
+  assert [] == ordered_diff(ordered_structure("key", "0.1"), [], 3)
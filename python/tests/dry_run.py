@@ -0,0 +1,105 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.compression_sampling import with_default_factors
+from convergdb.dry_run import (
+  batch_plan,
+  partition_columns,
+  planned_engine,
+  planning_resources
+)
+
+import json
+
+def diff_1():
+  return [{"key": "source/" + str(i) + ".json.gz", "size": 1000} for i in range(10)]
+
+def history_1():
+  return [
+    {
+      "input_bytes": 1000,
+      "output_bytes": 2000,
+      "spark_partitions": 4,
+      "files_written": 8,
+      "duration": 10.0,
+      "peak_executor_memory": 500
+    }
+  ]
+
+def plan_1(structure, history=[], sizing={}, dpu=2, spark_partition_count=None, resources=None):
+  return batch_plan(
+    structure,
+    diff_1(),
+    with_default_factors({}),
+    history,
+    sizing,
+    dpu,
+    spark_partition_count,
+    resources,
+    3
+  )
+
+def test_partition_columns():
+  s = structure_1()
+  s["partitions"] = ["part_id", "convergdb_batch_id"]
+  assert ["part_id"] == partition_columns(s)
+
+def test_planning_resources():
+  # what-if settings replace those of the job
+  assert (10, None) == planning_resources(structure_1(), 10, None)
+  r = {"cores": 4, "memory_bytes": 2**34}
+  assert (None, r) == planning_resources(structure_1(), None, r)
+
+def test_batch_plan():
+  p = plan_1(structure_1(), sizing={"max_chunk_file_count": 4})
+  assert 10 == p["file_count"]
+  assert 10000 == p["source_bytes"]
+  assert 4 == p["files_per_chunk"]
+  assert [4, 4, 2] == [c["file_count"] for c in p["chunks"]]
+  assert "source/4.json.gz" == p["chunks"][1]["first_key"]
+  assert "source/7.json.gz" == p["chunks"][1]["last_key"]
+  assert ["spark"] * 3 == [c["engine"] for c in p["chunks"]]
+  assert "listed" == p["settings"]["load_order"]
+  assert all([c["spark_partitions"] >= 1 for c in p["chunks"]])
+  # without history, neither the time nor the file count is known
+  assert None == p["estimated_seconds"]
+  assert sum([c["spark_partitions"] for c in p["chunks"]]) == p["estimated_output_files"]
+  assert {"columns": ["part_id"], "existing": 3, "registrations_per_batch_at_least": 3} == p["partitions"]
+
+def test_batch_plan_what_if():
+  p = plan_1(structure_1(), history=history_1(), spark_partition_count=7)
+  assert [7] * len(p["chunks"]) == [c["spark_partitions"] for c in p["chunks"]]
+  # two files were written for each spark partition
+  assert [14] * len(p["chunks"]) == [c["estimated_output_files"] for c in p["chunks"]]
+  assert 100.0 == p["estimated_seconds"]
+  assert 7 == p["settings"]["spark_partition_count"]
+
+def test_batch_plan_budget():
+  s = structure_1()
+  p = plan_1(s, history=history_1())
+  assert len(p["chunks"]) == p["chunks_within_budget"]
+  s["run_budget_seconds"] = "90"
+  s["metrics_flush_seconds"] = "0"
+  p = plan_1(s, history=history_1(), sizing={"max_chunk_file_count": 4})
+  # chunks of 40, 40 and 20 seconds at 100 bytes per second
+  assert 2 == p["chunks_within_budget"]
+  assert 90.0 == p["settings"]["run_budget_seconds"]
+
+def test_batch_plan_empty_diff():
+  p = batch_plan(structure_1(), [], {}, [], {}, 2, None, None, 0)
+  assert [] == p["chunks"]
+  assert 0 == p["estimated_output_files"]
+
+def test_planned_engine():
+  s = structure_1()
+  assert "spark" == planned_engine(s, 10)
+  # target expressions that are sql are left to spark
+  s["fast_load_max_bytes"] = "100"
+  assert "spark" == planned_engine(s, 10)
+
+def test_plan_json():
+  p = plan_1(structure_1())
+  assert p == json.loads(convergdb.plan_json(p))
+
+def test_plan_source_to_target(): # NEEDS INTEGRATION TEST
+  pass
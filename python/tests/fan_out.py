@@ -0,0 +1,184 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.fan_out import (
+  chunk_diff,
+  fan_out_chunk_seconds,
+  fan_out_groups,
+  fan_out_key,
+  fan_out_source_to_target,
+  group_run_budget,
+  load_fan_out_chunk,
+  selectable_paths,
+  start_fan_out_batches,
+  union_diff
+)
+
+import json
+
+def target(name, partitions=[]):
+  s = structure_1()
+  s["full_relation_name"] = name
+  s["partitions"] = partitions
+  return s
+
+def test_fan_out_groups():
+  a = target("production.ecommerce.inventory.books")
+  b = target("production.ecommerce.inventory.books_by_author", ["author"])
+  c = structure_2()
+  # the spark diff keeps its diff in spark, so it is loaded on its own
+  d = target("production.ecommerce.inventory.books_spark_diff")
+  d["spark_diff"] = "true"
+  assert fan_out_key(a) == fan_out_key(b)
+  assert fan_out_key(a) != fan_out_key(c)
+  assert [[a, b], [c], [d]] == fan_out_groups([a, c, b, d])
+
+def test_union_diff():
+  a = [{"key": "1", "size": 1}, {"key": "2", "size": 2}]
+  b = [{"key": "2", "size": 2}, {"key": "3", "size": 3}]
+  assert ["1", "2", "3"] == [d["key"] for d in union_diff([a, b])]
+  assert [] == union_diff([[], []])
+
+def test_chunk_diff():
+  diff = [{"key": "1"}, {"key": "2"}, {"key": "3"}]
+  assert [{"key": "1"}, {"key": "3"}] == chunk_diff(diff, set(["1", "3", "4"]))
+
+def test_selectable_paths():
+  assert selectable_paths(["s3a://bucket/a/b=1/c.json.gz"])
+  assert not selectable_paths(["s3a://bucket/a b.json", "s3a://bucket/c.json"])
+
+def test_group_run_budget():
+  a = target("production.ecommerce.inventory.books")
+  b = target("production.ecommerce.inventory.books_by_author")
+  assert None == group_run_budget([a, b])["seconds"]
+  b["run_budget_seconds"] = "600"
+  a["run_budget_seconds"] = "900"
+  assert 600.0 == group_run_budget([a, b])["seconds"]
+
+def test_fan_out_chunk_seconds():
+  history = [{"input_bytes": 100, "duration": 1.0}]
+  targets = [
+    {"diff": [{"key": "1", "size": 100}, {"key": "2", "size": 200}], "history": history},
+    {"diff": [{"key": "2", "size": 200}], "history": history},
+    {"diff": [{"key": "2", "size": 200}], "history": []}
+  ]
+  assert 1.0 == fan_out_chunk_seconds(targets, set(["1"]))
+  assert 4.0 == fan_out_chunk_seconds(targets, set(["2"]))
+  assert None == fan_out_chunk_seconds(targets[2:], set(["2"]))
+
+# state and control records of the targets, kept in memory in place of s3
+class Store(object):
+  def __init__(self, states={}, fail_write=[]):
+    self.states = dict(states)
+    self.control_records = {}
+    self.fail_write = fail_write
+    self.alone = []
+    self.unpersisted = False
+
+  def state(self, structure):
+    return {"state": self.states.get(structure["full_relation_name"], "success")}
+
+  def in_progress(self, structure, batch_id, start_time, diff):
+    self.states[structure["full_relation_name"]] = "load_in_progress"
+
+  def start(self, targets, chunk_keys):
+    return start_fan_out_batches(targets, chunk_keys, self.state, self.in_progress)
+
+  def shared(self, sql_context, structure, s3a_list):
+    store = self
+    class Rows(object):
+      def count(self):
+        return len(s3a_list)
+      def unpersist(self):
+        store.unpersisted = True
+    return Rows()
+
+  def write(self, sql_context, shared, batch, dpu, resources, shared_all):
+    if batch["target"]["structure"]["full_relation_name"] in self.fail_write:
+      raise Exception("write failed")
+    return ({}, 0, 0)
+
+  def finish(self, structure, diff, batch_id, start_time, load_metrics, compressed, estimate):
+    name = structure["full_relation_name"]
+    self.control_records[name] = self.control_records.get(name, []) + [d["key"] for d in diff]
+    self.states[name] = "success"
+
+  def load(self, sql_context, structure, diff, source_map_func, dpu, resources):
+    self.alone.append((structure["full_relation_name"], [d["key"] for d in diff]))
+
+# a sql context that only records the spark job groups
+class SqlContext(object):
+  def __init__(self):
+    self._sc = self
+    self._jsc = self
+    self.job_groups = []
+
+  def setJobGroup(self, group_id, description):
+    self.job_groups.append(group_id)
+
+  def clearJobGroup(self):
+    self.job_groups.append(None)
+
+def fan_out_chunk(store, targets, chunk):
+  sql_context = SqlContext()
+  load_fan_out_chunk(sql_context, targets, chunk, 2, None, store.start, store.shared, store.write, store.finish, store.load)
+  return sql_context
+
+def test_start_fan_out_batches():
+  a = target("production.ecommerce.inventory.books")
+  b = target("production.ecommerce.inventory.books_by_author")
+  c = target("production.ecommerce.inventory.books_by_title")
+  store = Store({c["full_relation_name"]: "failure"})
+  targets = [
+    {"structure": a, "diff": [{"key": "1"}, {"key": "2"}]},
+    {"structure": b, "diff": [{"key": "3"}]},
+    {"structure": c, "diff": [{"key": "1"}]}
+  ]
+  batches = store.start(targets, set(["1", "2"]))
+  # the target without files in the chunk and the failed target are not started
+  assert [a] == [x["target"]["structure"] for x in batches]
+  assert [{"key": "1"}, {"key": "2"}] == batches[0]["diff"]
+  assert "load_in_progress" == store.states[a["full_relation_name"]]
+  assert not store.states.has_key(b["full_relation_name"])
+  assert "failure" == store.states[c["full_relation_name"]]
+
+def test_load_fan_out_chunk():
+  a = target("production.ecommerce.inventory.books")
+  b = target("production.ecommerce.inventory.books_by_author")
+  c = target("production.ecommerce.inventory.books_by_title")
+  store = Store(fail_write=[c["full_relation_name"]])
+  targets = [
+    {"structure": a, "diff": [{"key": "a/1.json", "size": 1}, {"key": "a/2.json", "size": 1}]},
+    # a target that is behind the others loads only the files it is missing
+    {"structure": b, "diff": [{"key": "a/2.json", "size": 1}]},
+    {"structure": c, "diff": [{"key": "a/1.json", "size": 1}]}
+  ]
+  sql_context = fan_out_chunk(store, targets, targets[0]["diff"])
+  # the shared scan is tagged, and the tag is cleared for the writes
+  assert 2 == len(sql_context.job_groups)
+  assert None == sql_context.job_groups[-1]
+  assert {
+    a["full_relation_name"]: ["a/1.json", "a/2.json"],
+    b["full_relation_name"]: ["a/2.json"]
+  } == store.control_records
+  assert "success" == store.states[a["full_relation_name"]]
+  assert "success" == store.states[b["full_relation_name"]]
+  # the target whose shared write failed is loaded on its own
+  assert [(c["full_relation_name"], ["a/1.json"])] == store.alone
+  assert "load_in_progress" == store.states[c["full_relation_name"]]
+  assert store.unpersisted
+
+def test_fan_out_source_to_target():
+  a = target("production.ecommerce.inventory.books")
+  b = target("production.ecommerce.inventory.books_by_author")
+  c = structure_2()
+  runs = []
+  groups = []
+  fan_out_source_to_target(
+    None,
+    [json.dumps(a), json.dumps(c), json.dumps(b)],
+    lambda sql_context, structure_json: runs.append(json.loads(structure_json)["full_relation_name"]),
+    lambda sql_context, group: groups.append([s["full_relation_name"] for s in group])
+  )
+  assert [c["full_relation_name"]] == runs
+  assert [[a["full_relation_name"], b["full_relation_name"]]] == groups
@@ -0,0 +1,120 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.fingerprint import (
+  fingerprint_inventory_type,
+  fingerprint_key,
+  latest_dt_partition,
+  source_fingerprint_enabled,
+  source_unchanged,
+  streaming_fingerprint_watermark,
+  streaming_inventory_fingerprint,
+  streaming_listing_start,
+  streaming_overlap_hours,
+  table_location
+)
+
+def test_source_fingerprint_enabled():
+  # off unless the structure turns it on
+  assert not source_fingerprint_enabled({})
+  assert source_fingerprint_enabled({"source_fingerprint": "true"})
+  assert not source_fingerprint_enabled({"source_fingerprint": "false"})
+  assert not source_fingerprint_enabled({"source_fingerprint": False})
+
+def test_fingerprint_inventory_type():
+  assert 's3' == fingerprint_inventory_type(structure_1())
+  assert 'streaming' == fingerprint_inventory_type(structure_2())
+
+  t = structure_1()
+  t["inventory_source"] = "api"
+  assert 'api' == fingerprint_inventory_type(t)
+
+def test_table_location():
+  def describe_stub(database, table, region):
+    assert database == 's3_inventory'
+    assert table == 'production__ecommerce__inventory__books_source'
+    return {
+      'Table': {
+        'StorageDescriptor': {
+          'Location': 's3://inventory-bucket/source-bucket/config/hive'
+        }
+      }
+    }
+
+  t = table_location(
+    's3_inventory.production__ecommerce__inventory__books_source',
+    'us-west-2',
+    describe_stub
+  )
+  assert t == {'bucket': 'inventory-bucket', 'prefix': 'source-bucket/config/hive/'}
+
+def test_latest_dt_partition():
+  assert None == latest_dt_partition([])
+  assert 'dt=2019-01-02-00-00' == latest_dt_partition(
+    [
+      'source-bucket/config/hive/dt=2018-12-31-00-00/',
+      'source-bucket/config/hive/dt=2019-01-02-00-00/',
+      'source-bucket/config/hive/dt=2019-01-01-00-00/',
+      'source-bucket/config/hive/other/'
+    ]
+  )
+
+def test_streaming_overlap_hours():
+  assert 24.0 == streaming_overlap_hours({})
+  assert 2.0 == streaming_overlap_hours({"streaming_inventory_overlap_hours": "2"})
+
+def test_streaming_listing_start():
+  assert None == streaming_listing_start(None, 24)
+  w = "inv/2019/01/02/10/stream-1-2019-01-02-10-59-00-abc"
+  assert "inv/2019/01/02/08" == streaming_listing_start(w, 2)
+  # the overlap can cross days, months and years
+  assert "inv/2018/12/31/23" == streaming_listing_start("inv/2019/01/01/00/a", 1)
+  # the listing includes the folders of the start hour
+  assert "inv/2019/01/02/08/a" > streaming_listing_start(w, 2)
+  # keys without hourly folders are listed after the watermark
+  assert "inv/a" == streaming_listing_start("inv/a", 24)
+
+def test_s3_inventory_fingerprint():
+  # reads glue and s3
+  pass
+
+def test_streaming_fingerprint_watermark():
+  assert None == streaming_fingerprint_watermark(None)
+  assert None == streaming_fingerprint_watermark("s3:dt=2019-01-01")
+  assert "inv/a" == streaming_fingerprint_watermark("streaming:inv/a")
+  assert "inv/a:b" == streaming_fingerprint_watermark("streaming:" + "0" * 32 + ":inv/a:b")
+
+def test_streaming_inventory_fingerprint():
+  s = structure_2()
+  s["streaming_inventory_overlap_hours"] = "2"
+  listed = {}
+  keys = ["inv/2019/01/02/09/a", "inv/2019/01/02/10/b"]
+  def list_stub(bucket, prefix, start_after):
+    listed["start_after"] = start_after
+    return [k for k in keys if (start_after == None) or (k > start_after)]
+  first = streaming_inventory_fingerprint(s, None, list_stub)
+  assert None == listed["start_after"]
+  assert "inv/2019/01/02/10/b" == streaming_fingerprint_watermark(first)
+  # nothing new
+  assert first == streaming_inventory_fingerprint(s, first, list_stub)
+  assert listed["start_after"].endswith("2019/01/02/08")
+  # a late file that sorts before the newest key changes the fingerprint
+  keys.insert(1, "inv/2019/01/02/09/late")
+  second = streaming_inventory_fingerprint(s, first, list_stub)
+  assert first != second
+  assert "inv/2019/01/02/10/b" == streaming_fingerprint_watermark(second)
+  # an empty listing keeps the previous fingerprint
+  assert first == streaming_inventory_fingerprint(s, first, lambda b, p, st: [])
+
+def test_fingerprint_key():
+  t = fingerprint_key(
+    structure_1()
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/fingerprint.json"
+
+def test_source_unchanged():
+  assert source_unchanged('s3:dt=2019-01-01-00-00', 's3:dt=2019-01-01-00-00')
+  assert not source_unchanged('s3:dt=2019-01-01-00-00', 's3:dt=2019-01-02-00-00')
+  assert not source_unchanged(None, 's3:dt=2019-01-01-00-00')
+  # no fingerprint means the diff always runs
+  assert not source_unchanged(None, None)
@@ -13,3 +13,9 @@ def test_load_batch():
 
 def test_source_to_target():
   pass
+
+def test_recovered_state():
+  pass
+
+def test_finish_batch():
+  pass
@@ -0,0 +1,12 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.locking import current_lock_id, current_lock_table
+
+def test_current_lock_table():
+  assert 'locks' == current_lock_table({"LOCK_TABLE": "locks"})
+  assert None == current_lock_table({})
+
+def test_current_lock_id():
+  assert 'job' == current_lock_id({"LOCK_ID": "job"})
+  assert None == current_lock_id({})
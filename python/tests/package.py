@@ -0,0 +1,40 @@
+from context import convergdb
+from structure import *
+import pytest
+import json
+import os
+import subprocess
+import sys
+
+package_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def imported_modules(statement):
+  out = subprocess.check_output(
+    [sys.executable, '-c', statement + "; import sys, json; print json.dumps(sorted(sys.modules.keys()))"],
+    cwd=package_path
+  )
+  return json.loads(out.strip().split("\n")[-1])
+
+def test_import_does_not_load_spark_or_boto3():
+  modules = imported_modules("import convergdb")
+  assert not 'pyspark' in modules
+  assert not 'boto3' in modules
+  assert not 'convergdb.high_level' in modules
+
+def test_helpers_do_not_load_spark():
+  modules = imported_modules("from convergdb.spark_partitions import split_indices; from convergdb.planner import planned_chunk_count")
+  assert not 'pyspark' in modules
+  assert not 'boto3' in modules
+
+def test_public_api():
+  for name in convergdb.__all__:
+    assert callable(getattr(convergdb, name))
+  assert convergdb.source_to_target is convergdb.high_level.source_to_target
+
+def test_only_public_api():
+  # helpers are imported from their modules
+  with pytest.raises(AttributeError):
+    convergdb.split_indices
+  with pytest.raises(AttributeError):
+    convergdb.no_such_name
+  assert sorted(convergdb.__all__) == [n for n in dir(convergdb) if n in convergdb.__all__]
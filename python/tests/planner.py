@@ -0,0 +1,263 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.planner import (
+  appended_batch_statistics,
+  batch_statistics_key,
+  batch_statistics_record,
+  batch_statistics_window,
+  budget_allows,
+  budgeted_chunk_count,
+  budgeted_chunks,
+  estimated_output_files,
+  observed_expansion_ratio,
+  observed_files_per_spark_partition,
+  observed_output_ratio,
+  observed_throughput,
+  ratio_of_sums,
+  spark_batches
+)
+
+def history_1():
+  return [
+    {
+      "batch_id": "20181231235959000",
+      "file_count": 10,
+      "input_bytes": 1000,
+      "input_bytes_estimate": 7000,
+      "output_bytes": 2000,
+      "input_records": 100,
+      "output_records": 100,
+      "peak_executor_memory": 500,
+      "spark_partitions": 4,
+      "duration": 10.0
+    },
+    {
+      "batch_id": "20190101000000000",
+      "file_count": 10,
+      "input_bytes": 3000,
+      "input_bytes_estimate": 21000,
+      "output_bytes": 6000,
+      "input_records": 300,
+      "output_records": 300,
+      "peak_executor_memory": None,
+      "spark_partitions": 4,
+      "duration": 30.0
+    }
+  ]
+
+def test_batch_statistics_key():
+  t = batch_statistics_key(
+    structure_1()
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/batch_statistics.json"
+
+def test_batch_statistics_window():
+  assert 20 == batch_statistics_window({})
+  assert 5 == batch_statistics_window({"batch_statistics_window": 5})
+
+def test_get_batch_statistics():
+  # reads from s3
+  pass
+
+def test_batch_statistics_record():
+  t = batch_statistics_record(
+    "20181231235959000",
+    10,
+    1000,
+    7000,
+    {
+      "output_bytes": 2000,
+      "input_records": 100,
+      "output_records": 90,
+      "peak_execution_memory": 500,
+      "spark_partitions": 4,
+      "duration": 10.0,
+      "shuffle_read_bytes": 0
+    }
+  )
+  assert t == {
+    "batch_id": "20181231235959000",
+    "file_count": 10,
+    "input_bytes": 1000,
+    "input_bytes_estimate": 7000,
+    "output_bytes": 2000,
+    "input_records": 100,
+    "output_records": 90,
+    "peak_executor_memory": 500,
+    "spark_partitions": 4,
+    "duration": 10.0,
+    "engine": "spark",
+    "files_written": None
+  }
+
+def test_appended_batch_statistics():
+  assert [1, 2, 3] == appended_batch_statistics([1, 2], 3, 5)
+  assert [2, 3] == appended_batch_statistics([1, 2], 3, 2)
+  assert [3] == appended_batch_statistics([], 3, 2)
+
+def test_ratio_of_sums():
+  assert None == ratio_of_sums([], "output_bytes", "input_bytes")
+  assert 2.0 == ratio_of_sums(history_1(), "output_bytes", "input_bytes")
+
+def test_observed_output_ratio():
+  assert 2.0 == observed_output_ratio(history_1())
+
+def test_observed_throughput():
+  assert 100.0 == observed_throughput(history_1())
+  # batches loaded by the arrow engine are not counted
+  h = history_1() + [{"input_bytes": 1000, "duration": 0.1, "engine": "arrow"}]
+  assert 100.0 == observed_throughput(h)
+  assert 2 == len(spark_batches(h))
+
+def test_estimated_output_files():
+  assert 4 == estimated_output_files(4, history_1())
+  h = [{"spark_partitions": 4, "files_written": 10}]
+  assert 2.5 == observed_files_per_spark_partition(h)
+  assert 8 == estimated_output_files(3, h)
+
+def test_observed_expansion_ratio():
+  # only the first batch has memory metrics
+  assert 2.0 == observed_expansion_ratio(history_1())
+  assert None == observed_expansion_ratio(history_1()[1:])
+
+def test_estimated_load_seconds():
+  assert 50.0 == convergdb.estimated_load_seconds(5000, history_1())
+  assert None == convergdb.estimated_load_seconds(5000, [])
+
+def test_planned_chunk_count():
+  # falls back to calculate_chunk_count on the uncompressed estimate
+  # without history. 1GB is usable without dpu.
+  assert 100 == convergdb.planned_chunk_count(
+    300 * (1024**2),
+    2 * (1024**3),
+    200,
+    None,
+    []
+  )
+
+  assert 1000 == convergdb.planned_chunk_count(
+    1000 * (10**3),
+    1000 * (10**3),
+    1000,
+    1,
+    []
+  )
+
+  # 4GB of source data expands to 8GB of memory. 4GB is usable on 1 dpu.
+  history = [
+    {
+      "input_bytes": 1000,
+      "peak_executor_memory": 500,
+      "spark_partitions": 4
+    }
+  ]
+  assert 500 == convergdb.planned_chunk_count(
+    4 * (1024**3),
+    28 * (1024**3),
+    1000,
+    1,
+    history
+  )
+
+  # never less than one file per chunk
+  assert 1 == convergdb.planned_chunk_count(
+    400 * (1024**3),
+    400 * (1024**3),
+    10,
+    1,
+    history
+  )
+
+def test_planned_spark_partitions():
+  # falls back to calculate_spark_partitions without history
+  assert 8 == convergdb.planned_spark_partitions(
+    30*(1024**3),
+    30*(1024**3),
+    1,
+    None,
+    []
+  )
+
+  # output is twice the compressed input... 512MB is 2 files of 256MB
+  assert 2 == convergdb.planned_spark_partitions(
+    256*(1024**2),
+    7*256*(1024**2),
+    1,
+    None,
+    history_1()
+  )
+
+  # override is always applied to a glue job
+  assert 400 == convergdb.planned_spark_partitions(
+    256*(1024**2),
+    7*256*(1024**2),
+    2,
+    400,
+    history_1()
+  )
+
+  # the override is for glue jobs, so a run without dpu uses the history
+  assert 2 == convergdb.planned_spark_partitions(
+    256*(1024**2),
+    7*256*(1024**2),
+    None,
+    400,
+    history_1()
+  )
+
+class Clock(object):
+  def __init__(self, times):
+    self.times = times
+
+  def __call__(self):
+    return self.times.pop(0)
+
+def budget_structure(seconds):
+  s = structure_1()
+  s["run_budget_seconds"] = seconds
+  s["metrics_flush_seconds"] = "10"
+  return s
+
+def test_run_budget():
+  b = convergdb.run_budget(structure_1(), Clock([100.0]))
+  assert None == b["seconds"]
+  assert 30.0 == b["reserve"]
+  assert 100.0 == b["started"]
+  # every chunk is loaded without a budget
+  assert 3 == budgeted_chunk_count(b, [10, 10, 10])
+  assert budget_allows(b, 1000, 1)
+
+def test_budgeted_chunk_count():
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0, 20.0]))
+  # 70 seconds left once the 20 seconds spent and 10 in reserve are taken
+  assert 2 == budgeted_chunk_count(b, [30, 40, 10])
+
+def test_budgeted_chunk_count_unknown():
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0, 0.0]))
+  assert 3 == budgeted_chunk_count(b, [None, None, None])
+
+def test_budget_allows():
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0, 50.0, 50.0, 50.0, 95.0]))
+  assert budget_allows(b, 40, 1)
+  assert not budget_allows(b, 41, 1)
+  assert budget_allows(b, None, 1)
+  # a spent budget stops the run even without an estimate
+  assert not budget_allows(b, None, 1)
+
+def test_budget_allows_first_chunk():
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0, 95.0, 95.0]))
+  # every run loads at least one chunk, even when it does not fit
+  assert budget_allows(b, 1000, 0)
+  assert not budget_allows(b, 1000, 1)
+
+def test_budgeted_chunks():
+  # the first chunk is estimated at more than the whole budget, and takes
+  # that long to load
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0, 0.0, 200.0]))
+  chunks = [[200], [10], [10]]
+  assert [[200]] == list(budgeted_chunks(b, chunks, lambda c: c[0]))
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0, 0.0]))
+  assert 1 == budgeted_chunk_count(b, [200, 10, 10])
+  b = convergdb.run_budget(budget_structure("100"), Clock([0.0]))
+  assert [] == list(budgeted_chunks(b, [], lambda c: c[0]))
@@ -0,0 +1,66 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.profiling import (
+  driver_profiling_enabled,
+  finish_profile,
+  memory_snapshot,
+  memory_usage,
+  profile_artifacts,
+  profile_key,
+  start_profile,
+  write_profile
+)
+from convergdb.tracing import span_end_hooks
+
+def test_driver_profiling_enabled():
+  assert not driver_profiling_enabled({}, {})
+  assert driver_profiling_enabled({"driver_profiling": "true"}, {})
+  assert driver_profiling_enabled({}, {"CONVERGDB_PROFILE": "1"})
+  # the structure takes precedence over the environment
+  assert not driver_profiling_enabled({"driver_profiling": "false"}, {"CONVERGDB_PROFILE": "true"})
+
+def test_memory_usage():
+  t = memory_usage()
+  assert t["source"] in ["tracemalloc", "getrusage"]
+  assert t["peak_bytes"] > 0
+
+def test_memory_snapshot():
+  t = memory_snapshot({"name": "file_diff", "start": 1.0, "duration": 2.5})
+  assert t["phase"] == "file_diff"
+  assert t["end"] == 3.5
+
+def test_profile():
+  convergdb.start_trace('run')
+  profile = start_profile()
+  with convergdb.span('phase'):
+    sorted(range(1000))
+  finish_profile(profile)
+  convergdb.finish_trace()
+
+  assert len(span_end_hooks) == 0
+  assert [s["phase"] for s in profile["snapshots"]] == ['phase', 'finish']
+
+  artifacts = profile_artifacts(profile)
+  assert sorted(artifacts.keys()) == ['memory.json', 'pstats', 'txt']
+  assert 'cumulative' in artifacts["txt"]
+
+def test_profile_key():
+  t = profile_key(
+    structure_1(),
+    '20190101000000000',
+    'pstats'
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/profiles/20190101000000000.pstats"
+
+def test_write_profile():
+  written = []
+  def write_stub(bucket, key, body):
+    written.append(key)
+  profile = finish_profile(start_profile())
+  write_profile(structure_1(), '20190101000000000', profile, write_stub)
+  assert written == [
+    "e969ca618e222a58/state/production.ecommerce.inventory.books/profiles/20190101000000000.memory.json",
+    "e969ca618e222a58/state/production.ecommerce.inventory.books/profiles/20190101000000000.pstats",
+    "e969ca618e222a58/state/production.ecommerce.inventory.books/profiles/20190101000000000.txt"
+  ]
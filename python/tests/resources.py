@@ -0,0 +1,103 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.resources import (
+  cgroup_cpu_limit,
+  cgroup_memory_limit,
+  cgroup_v1_cpu_limit,
+  cgroup_v2_cpu_limit,
+  local_master,
+  local_resources,
+  local_spark_settings,
+  physical_memory,
+  read_resource_file
+)
+
+def files_stub(files):
+  def read_function(path):
+    return files.get(path, None)
+  return read_function
+
+def test_read_resource_file():
+  assert None == read_resource_file('/path/does/not/exist')
+
+def test_cgroup_v2_cpu_limit():
+  assert None == cgroup_v2_cpu_limit(None)
+  assert None == cgroup_v2_cpu_limit('max 100000')
+  assert 4.0 == cgroup_v2_cpu_limit('400000 100000')
+
+def test_cgroup_v1_cpu_limit():
+  assert None == cgroup_v1_cpu_limit(None, None)
+  assert None == cgroup_v1_cpu_limit('-1', '100000')
+  assert 2.0 == cgroup_v1_cpu_limit('200000', '100000')
+
+def test_cgroup_cpu_limit():
+  assert 4.0 == cgroup_cpu_limit(
+    files_stub({'/sys/fs/cgroup/cpu.max': '400000 100000'})
+  )
+  assert 0.5 == cgroup_cpu_limit(
+    files_stub(
+      {
+        '/sys/fs/cgroup/cpu/cpu.cfs_quota_us': '50000',
+        '/sys/fs/cgroup/cpu/cpu.cfs_period_us': '100000'
+      }
+    )
+  )
+  assert None == cgroup_cpu_limit(files_stub({}))
+
+def test_cgroup_memory_limit():
+  assert 8589934592 == cgroup_memory_limit(
+    files_stub({'/sys/fs/cgroup/memory.max': '8589934592'})
+  )
+  assert None == cgroup_memory_limit(
+    files_stub({'/sys/fs/cgroup/memory.max': 'max'})
+  )
+  # cgroup v1 without a limit
+  assert None == cgroup_memory_limit(
+    files_stub({'/sys/fs/cgroup/memory/memory.limit_in_bytes': '9223372036854771712'})
+  )
+
+def test_physical_memory():
+  assert 16 * (1024**3) == physical_memory(
+    files_stub({'/proc/meminfo': 'MemTotal:       16777216 kB\nMemFree:         1024 kB'})
+  )
+
+def test_local_resources():
+  # 4 vcpu fargate task with 8GB
+  t = local_resources(
+    files_stub(
+      {
+        '/sys/fs/cgroup/cpu.max': '400000 100000',
+        '/sys/fs/cgroup/memory.max': '8589934592'
+      }
+    ),
+    16
+  )
+  assert t == {"cores": 4, "memory_bytes": 8589934592}
+
+  # fractional cpu is at least one core
+  t = local_resources(
+    files_stub(
+      {
+        '/sys/fs/cgroup/cpu.max': '25000 100000',
+        '/proc/meminfo': 'MemTotal:       1048576 kB'
+      }
+    ),
+    2
+  )
+  assert t == {"cores": 1, "memory_bytes": 1024**3}
+
+def test_local_master():
+  assert "local[4]" == local_master({"cores": 4, "memory_bytes": None})
+
+def test_local_spark_settings():
+  t = dict(local_spark_settings({"cores": 4, "memory_bytes": 8 * (1024**3)}))
+  assert t["spark.driver.memory"] == "6144m"
+  assert t["spark.sql.shuffle.partitions"] == "8"
+  assert t["spark.hadoop.fs.s3a.connection.maximum"] == "32"
+  assert t["spark.hadoop.fs.s3a.threads.max"] == "16"
+  assert t["spark.hadoop.fs.s3a.fast.upload"] == "true"
+
+  # driver memory is left to spark when memory is unknown
+  t = dict(local_spark_settings({"cores": 1, "memory_bytes": None}))
+  assert "spark.driver.memory" not in t
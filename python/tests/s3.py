@@ -1,6 +1,19 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.s3 import (
+  byte_ranges,
+  content_range_size,
+  gzip_chunks,
+  last_modified_text,
+  reader_lines,
+  s3_object_reader,
+  s3_url_to_bucket_prefix,
+  separated,
+  stream_to_s3,
+  upload_parts
+)
+import cStringIO
 
 
 # too much state... must refactor
@@ -8,6 +21,17 @@ import pytest
 def test_gzip_to_s3():
   pass
 
+def test_last_modified_text():
+  import datetime
+  from dateutil.tz import tzutc, tzoffset
+  assert None == last_modified_text(None)
+  assert None == last_modified_text('')
+  assert "2019-01-01 00:00:00.000" == last_modified_text("2019-01-01T00:00:00.000Z")
+  assert "2019-01-01 00:00:00.000" == last_modified_text("2019-01-01 00:00:00.000")
+  assert "2019-01-01 00:00:01.250" == last_modified_text(datetime.datetime(2019, 1, 1, 0, 0, 1, 250000, tzinfo=tzutc()))
+  assert "2019-01-01 00:00:00.000" == last_modified_text(datetime.datetime(2019, 1, 1, 1, 0, 0, tzinfo=tzoffset(None, 3600)))
+  assert "2019-01-01 00:00:00.000" == last_modified_text(datetime.datetime(2019, 1, 1))
+
 def test_append_s3_search_results_to_dict():
   pass
 
@@ -30,4 +54,136 @@ def test_dict_to_s3_json():
   pass
 
 def test_s3_json_to_dict():
-  pass
\ No newline at end of file
+  pass
+def test_s3_common_prefixes():
+  pass
+
+def test_s3_url_to_bucket_prefix():
+  assert {'bucket': 'bucket', 'prefix': 'a/b/'} == s3_url_to_bucket_prefix('s3://bucket/a/b/')
+  assert {'bucket': 'bucket', 'prefix': ''} == s3_url_to_bucket_prefix('s3://bucket')
+  assert {'bucket': 'bucket', 'prefix': 'a'} == s3_url_to_bucket_prefix('bucket/a')
+
+def test_s3_prefix_has_keys():
+  pass
+
+def test_s3_keys_after():
+  pass
+
+def test_delete_s3_keys():
+  pass
+
+def test_gzip_chunks():
+  import zlib
+  data = ''.join(gzip_chunks(['abc', 'def', '']))
+  assert 'abcdef' == zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def test_separated():
+  assert "a\nb\nc" == ''.join(separated(['a', 'b', 'c']))
+  assert "" == ''.join(separated([]))
+
+def test_upload_parts():
+  assert ['abc', 'de'] == list(upload_parts(['a', 'bc', 'd', 'e'], 3))
+  assert [] == list(upload_parts([], 3))
+  assert ['\xc3\xa9'] == list(upload_parts([u'\xe9'], 3))
+
+class StreamClient(object):
+  def __init__(self, fail_part=None):
+    self.calls = []
+    self.fail_part = fail_part
+
+  def put_object(self, Bucket, Key, Body):
+    self.calls.append(('put_object', Body))
+
+  def create_multipart_upload(self, Bucket, Key):
+    self.calls.append(('create_multipart_upload',))
+    return {"UploadId": "u1"}
+
+  def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+    if PartNumber == self.fail_part:
+      raise Exception("part failed")
+    self.calls.append(('upload_part', PartNumber, Body))
+    return {"ETag": "e" + str(PartNumber)}
+
+  def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+    self.calls.append(('complete_multipart_upload', MultipartUpload["Parts"]))
+
+  def abort_multipart_upload(self, Bucket, Key, UploadId):
+    self.calls.append(('abort_multipart_upload',))
+
+def test_stream_to_s3_single_part():
+  client = StreamClient()
+  assert 3 == stream_to_s3('b', 'k', 'abc', 5, 2, client)
+  assert [('put_object', 'abc')] == client.calls
+  client = StreamClient()
+  assert 0 == stream_to_s3('b', 'k', iter([]), 5, 2, client)
+  assert [('put_object', '')] == client.calls
+
+def test_stream_to_s3_multipart():
+  client = StreamClient()
+  assert 9 == stream_to_s3('b', 'k', iter(['abc', 'def', 'ghi']), 3, 2, client)
+  parts = sorted([c for c in client.calls if c[0] == 'upload_part'])
+  assert [('upload_part', 1, 'abc'), ('upload_part', 2, 'def'), ('upload_part', 3, 'ghi')] == parts
+  assert ('complete_multipart_upload', [
+    {"PartNumber": 1, "ETag": "e1"},
+    {"PartNumber": 2, "ETag": "e2"},
+    {"PartNumber": 3, "ETag": "e3"}
+  ]) == client.calls[-1]
+
+def test_stream_to_s3_abort():
+  client = StreamClient(fail_part=2)
+  with pytest.raises(Exception):
+    stream_to_s3('b', 'k', iter(['abc', 'def', 'ghi']), 3, 2, client)
+  assert ('abort_multipart_upload',) == client.calls[-1]
+
+def test_gzip_records_to_s3():
+  pass
+
+def test_content_range_size():
+  assert 1234 == content_range_size({"ContentRange": "bytes 0-99/1234"})
+  assert None == content_range_size({})
+
+def test_byte_ranges():
+  assert [(3, 5), (6, 8), (9, 9)] == byte_ranges(3, 10, 3)
+  assert [] == byte_ranges(10, 10, 3)
+
+class RangeClient(object):
+  def __init__(self, body):
+    self.body = body
+    self.ranges = []
+
+  def get_object(self, Bucket, Key, Range, IfMatch=None):
+    self.ranges.append(Range)
+    if len(self.body) == 0:
+      e = Exception("InvalidRange")
+      e.response = {"Error": {"Code": "InvalidRange"}}
+      raise e
+    lo, hi = [int(x) for x in Range.replace('bytes=', '').split('-')]
+    hi = min(hi, len(self.body) - 1)
+    return {
+      "ETag": '"1"',
+      "ContentRange": "bytes %d-%d/%d" % (lo, hi, len(self.body)),
+      "Body": cStringIO.StringIO(self.body[lo:(hi + 1)])
+    }
+
+def test_s3_object_reader():
+  # fits in the first range
+  client = RangeClient('abc')
+  assert 'abc' == s3_object_reader('b', 'k', 4, 2, None, client).read()
+  assert ['bytes=0-3'] == client.ranges
+  # read in ranges, in memory
+  client = RangeClient('abcdefghij')
+  assert 'abcdefghij' == s3_object_reader('b', 'k', 4, 2, None, client).read()
+  assert ['bytes=0-3', 'bytes=4-7', 'bytes=8-9'] == sorted(client.ranges)
+  # spooled to a memory mapped temp file
+  client = RangeClient("line 1\nline 2\nline 3\n")
+  reader = s3_object_reader('b', 'k', 4, 3, 8, client)
+  assert ["line 1\n", "line 2\n", "line 3\n"] == list(iter(reader.readline, ''))
+  assert "line 1\nline 2\nline 3\n" == reader[:]
+  # empty objects can not be ranged
+  assert '' == s3_object_reader('b', 'k', 4, 2, None, RangeClient('')).read()
+
+def test_reader_lines():
+  r = cStringIO.StringIO("a\nb\xc3\xa9\nc\n")
+  assert [u"a", u"b\xe9", u"c", u""] == list(reader_lines(r, 3))
+  r = cStringIO.StringIO("a\nb")
+  assert [u"a", u"b"] == list(reader_lines(r, 2))
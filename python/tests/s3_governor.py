@@ -0,0 +1,142 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.s3 import delete_s3_objects
+from convergdb.s3_governor import (
+  counter_difference,
+  governor_prefix,
+  governor_retry_handler,
+  is_throttle_response,
+  new_governor,
+  new_token_bucket,
+  request_succeeded,
+  request_throttled,
+  s3_governor_max_attempts,
+  s3_maximum_request_rate,
+  s3_minimum_request_rate,
+  s3_rate_increase,
+  take_token
+)
+import boto3
+
+from botocore.awsrequest import AWSResponse
+
+def test_governor_prefix():
+  assert 'b/p' == governor_prefix({"Bucket": "b", "Key": "p/a.gz"})
+  assert 'b/p' == governor_prefix({"Bucket": "b", "Prefix": "p/"})
+  assert 'b/' == governor_prefix({"Bucket": "b"})
+  assert 'b/d' == governor_prefix(
+    {"Bucket": "b", "Delete": {"Objects": [{"Key": "d/1"}, {"Key": "e/2"}]}}
+  )
+
+def test_take_token():
+  g = new_governor()
+  g["buckets"]["b/p"] = new_token_bucket(2.0, 0.0)
+  assert 0.0 == take_token(g, "b/p", 0.0)
+  assert 0.0 == take_token(g, "b/p", 0.0)
+  # waiting requests are spaced out at the rate
+  assert 0.5 == take_token(g, "b/p", 0.0)
+  assert 1.0 == take_token(g, "b/p", 0.0)
+  # tokens refill over time, up to one second of requests
+  assert 0.0 == take_token(g, "b/p", 10.0)
+  assert 2.0 == g["buckets"]["b/p"]["tokens"] + 1.0
+
+def test_aimd():
+  g = new_governor()
+  assert s3_maximum_request_rate / 2 == request_throttled(g, "b/p", 0.0)
+  request_succeeded(g, "b/p", 0.0)
+  assert g["buckets"]["b/p"]["rate"] == s3_maximum_request_rate / 2 + s3_rate_increase
+  for i in range(100):
+    request_throttled(g, "b/p", 0.0)
+  assert g["buckets"]["b/p"]["rate"] == s3_minimum_request_rate
+  assert 101 == g["counters"]["throttles"]
+  # other prefixes are not affected
+  take_token(g, "b/q", 0.0)
+  assert g["buckets"]["b/q"]["rate"] == s3_maximum_request_rate
+
+class Status(object):
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+def test_is_throttle_response():
+  assert not is_throttle_response(None)
+  assert not is_throttle_response((Status(200), {}))
+  assert is_throttle_response((Status(503), {}))
+  assert is_throttle_response((Status(400), {"Error": {"Code": "SlowDown"}}))
+  assert not is_throttle_response((Status(404), {"Error": {"Code": "NoSuchKey"}}))
+
+def test_governor_retry_handler():
+  g = new_governor()
+  handler = governor_retry_handler(g, lambda: 0.0)
+  request = {"context": {"convergdb_s3_prefix": "b/p"}}
+  throttled = (Status(503), {"Error": {"Code": "SlowDown"}})
+  assert handler(throttled, 1, request) >= 0.0
+  assert 1 == g["counters"]["retries"]
+  assert None == handler(throttled, s3_governor_max_attempts, request)
+  assert 1 == g["counters"]["retries"]
+  assert 2 == g["counters"]["throttles"]
+  assert None == handler((Status(200), {}), 1, request)
+  # requests that did not pass through the governor are left alone
+  assert None == handler(throttled, 1, {"context": {}})
+
+def test_counter_difference():
+  assert {"requests": 2, "throttles": 0} == counter_difference(
+    {"requests": 1, "throttles": 3},
+    {"requests": 3, "throttles": 3}
+  )
+
+class DeleteClient(object):
+  def __init__(self, responses):
+    self.responses = responses
+    self.calls = []
+
+  def delete_objects(self, Bucket, Delete):
+    self.calls.append([o["Key"] for o in Delete["Objects"]])
+    return self.responses.pop(0)
+
+def test_delete_s3_objects():
+  g = new_governor()
+  client = DeleteClient(
+    [
+      {"Errors": [{"Key": "b", "Code": "SlowDown", "Message": ""}]},
+      {}
+    ]
+  )
+  delete_s3_objects(client, "bucket", ["a", "b"], g, lambda s: None)
+  assert [["a", "b"], ["b"]] == client.calls
+  assert 1 == g["counters"]["delete_retries"]
+
+  client = DeleteClient(
+    [{"Errors": [{"Key": "b", "Code": "AccessDenied", "Message": ""}]}]
+  )
+  with pytest.raises(Exception):
+    delete_s3_objects(client, "bucket", ["a", "b"], g, lambda s: None)
+  assert [["a", "b"]] == client.calls
+
+class Raw(object):
+  def __init__(self, body):
+    self.body = body
+
+  def stream(self, **kwargs):
+    yield self.body
+
+def test_governed_client_retries_slow_down():
+  session = boto3.session.Session(
+    aws_access_key_id='test',
+    aws_secret_access_key='test',
+    region_name='us-west-2'
+  )
+  statuses = [503, 503, 200]
+  def send(request, **kwargs):
+    status = statuses.pop(0)
+    body = '<Error><Code>SlowDown</Code><Message>slow</Message></Error>' if status == 503 else ''
+    return AWSResponse(request.url, status, {}, Raw(body))
+  session.events.register('before-send.s3', send)
+  g = convergdb.start_s3_governor(new_governor(), session)
+  try:
+    session.client('s3').put_object(Bucket='b', Key='p/a', Body='x')
+  finally:
+    convergdb.stop_s3_governor(g)
+  assert [] == statuses
+  assert {"requests": 1, "throttles": 2, "retries": 2, "delete_retries": 0} == convergdb.s3_governor_counters(g)
+  assert g["buckets"]["b/p"]["rate"] == s3_maximum_request_rate / 4 + s3_rate_increase
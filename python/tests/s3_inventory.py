@@ -0,0 +1,170 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.batch_control import file_loaded_records
+from convergdb.s3_inventory import (
+  control_file_source_keys,
+  gzip_lines,
+  inventory_column_name,
+  inventory_file_rows,
+  loadable_inventory_rows,
+  manifest_csv_columns,
+  manifest_destination_bucket,
+  manifest_key,
+  manifest_reader_enabled,
+  manifest_reader_threads
+)
+import time
+
+import cStringIO
+import gzip
+
+pyarrow = convergdb.s3_inventory.pyarrow
+
+requires_pyarrow = pytest.mark.skipif(
+  pyarrow == None,
+  reason="pyarrow is not installed"
+)
+
+def gzipped(text):
+  buffer = cStringIO.StringIO()
+  writer = gzip.GzipFile(None, 'wb', 6, buffer)
+  writer.write(text)
+  writer.close()
+  return buffer.getvalue()
+
+def test_manifest_reader_enabled():
+  s = structure_1()
+  assert not manifest_reader_enabled(s)
+  s["s3_inventory_reader"] = "manifest"
+  assert manifest_reader_enabled(s)
+  # only s3 inventories have a manifest
+  s = structure_2()
+  s["s3_inventory_reader"] = "manifest"
+  assert not manifest_reader_enabled(s)
+
+def test_manifest_reader_threads():
+  s = structure_1()
+  assert 8 == manifest_reader_threads(s)
+  s["s3_inventory_reader_threads"] = "2"
+  assert 2 == manifest_reader_threads(s)
+
+def test_manifest_key():
+  location = {'bucket': 'inv', 'prefix': 'source/config/hive/'}
+  assert 'source/config/2019-01-02T01-00Z/manifest.json' == manifest_key(
+    location,
+    'dt=2019-01-02-01-00'
+  )
+  with pytest.raises(Exception):
+    manifest_key({'bucket': 'inv', 'prefix': 'source/'}, 'dt=2019-01-02-01-00')
+
+def test_manifest_destination_bucket():
+  assert 'inv' == manifest_destination_bucket({"destinationBucket": "arn:aws:s3:::inv"})
+
+def test_inventory_column_name():
+  assert 'bucket' == inventory_column_name('Bucket')
+  assert 'is_delete_marker' == inventory_column_name(' IsDeleteMarker')
+  assert 'is_latest' == inventory_column_name('is_latest')
+
+def test_manifest_csv_columns():
+  assert ['bucket', 'key', 'version_id', 'is_latest', 'is_delete_marker', 'size'] == manifest_csv_columns(
+    {"fileSchema": "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size"}
+  )
+
+def test_loadable_inventory_rows():
+  columns = ['bucket', 'key', 'is_latest', 'is_delete_marker', 'size']
+  rows = [
+    ['b', 'data/a.json', 'true', 'false', '10'],
+    ['b', 'data/old.json', 'false', 'false', '10'],
+    ['b', 'data/deleted.json', 'true', 'true', ''],
+    ['b', 'other/c.json', 'true', 'false', '10'],
+    ['x', 'data/d.json', 'true', 'false', '10']
+  ]
+  assert [{"key": "data/a.json", "size": 10}] == loadable_inventory_rows(rows, columns, 'b', 'data/')
+  # orc and parquet values are typed, and the flags are optional
+  assert [{"key": "data/a.json", "size": 10}] == loadable_inventory_rows(
+    [('b', 'data/a.json', 10)],
+    ['bucket', 'key', 'size'],
+    'b',
+    ''
+  )
+  assert [] == loadable_inventory_rows(
+    [('b', 'data/a.json', False, True, 10)],
+    columns,
+    'b',
+    ''
+  )
+
+def test_loadable_inventory_rows_last_modified():
+  columns = ['bucket', 'key', 'size', 'last_modified_date']
+  rows = [['b', 'data/a.json', '10', '2019-01-01T00:00:00.000Z']]
+  assert [{"key": "data/a.json", "size": 10, "last_modified": "2019-01-01 00:00:00.000"}] == loadable_inventory_rows(rows, columns, 'b', '')
+  # left out unless the load order uses it
+  assert [{"key": "data/a.json", "size": 10}] == loadable_inventory_rows(rows, columns, 'b', '', False)
+
+def test_inventory_file_rows():
+  rows, columns = inventory_file_rows(
+    cStringIO.StringIO(gzipped('"b","data/a,b.json","1"\n"b","data/c.json","2"\n')),
+    'CSV',
+    ['bucket', 'key', 'size']
+  )
+  assert columns == ['bucket', 'key', 'size']
+  assert [['b', 'data/a,b.json', '1'], ['b', 'data/c.json', '2']] == list(rows)
+
+@requires_pyarrow
+def test_inventory_file_rows_parquet():
+  t = pyarrow.Table.from_arrays(
+    [
+      pyarrow.array(['b', 'b', 'b']),
+      pyarrow.array(['data/a.json', 'data/b.json', 'data/c.json']),
+      pyarrow.array([1, 2, 3]),
+      pyarrow.array(['STANDARD', 'STANDARD', 'GLACIER']),
+      pyarrow.array([True, False, True])
+    ],
+    ['bucket', 'key', 'size', 'storage_class', 'is_latest']
+  )
+  buffer = pyarrow.BufferOutputStream()
+  # a row group for each row, which are read one at a time
+  pyarrow.parquet.write_table(t, buffer, row_group_size=1)
+  rows, columns = inventory_file_rows(
+    pyarrow.BufferReader(buffer.getvalue()),
+    'PARQUET',
+    None
+  )
+  # columns that the diff does not use are not read
+  assert ['bucket', 'key', 'size', 'is_latest'] == columns
+  assert [
+    {"key": "data/a.json", "size": 1},
+    {"key": "data/c.json", "size": 3}
+  ] == loadable_inventory_rows(rows, columns, 'b', 'data/')
+
+def test_gzip_lines():
+  assert [u'a', u'b'] == list(gzip_lines(cStringIO.StringIO(gzipped("a\n\nb\n"))))
+
+def test_control_file_source_keys():
+  recs = file_loaded_records(
+    structure_1(),
+    ['a.json', 'b.json'],
+    '20181231235959000',
+    time.gmtime(),
+    time.gmtime()
+  )
+  assert ['a.json', 'b.json'] == control_file_source_keys(
+    cStringIO.StringIO(gzipped("\n".join(recs)))
+  )
+
+def test_manifest_available_files():
+  # reads s3
+  pass
+
+def test_control_folder_loaded_files():
+  # reads s3
+  pass
+
+def test_manifest_based_diff():
+  # reads s3
+  pass
+
+def test_inventory_file_diff():
+  # falls back to the athena diff
+  pass
@@ -1,7 +1,17 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.sns import pending_sns, publish_sns_async, wait_for_sns
 
 # need to refactor
 def test_publish_sns():
-  pass
\ No newline at end of file
+  pass
+
+def test_publish_sns_async():
+  published = []
+  def publish_stub(region, topic_arn, subject, message):
+    published.append((region, topic_arn, subject, message))
+  publish_sns_async('us-west-2', 'arn', 'subject', 'message', publish_stub)
+  assert wait_for_sns(5)
+  assert published == [('us-west-2', 'arn', 'subject', 'message')]
+  assert len(pending_sns) == 0
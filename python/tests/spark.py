@@ -4,6 +4,27 @@ from context import convergdb
 from structure import *
 from pyspark_fixtures import *
 import pytest
+from convergdb.spark import (
+  append_to_schema_dict,
+  apply_casting,
+  apply_expressions,
+  apply_housekeeping_fields,
+  casted_attribute,
+  coalesce_expression,
+  csv_file_to_df,
+  csv_param,
+  csv_source_schema,
+  dict_to_spark_schema,
+  expression_text,
+  expressions_to_schema_dict,
+  json_file_to_df,
+  nestable_source_schema,
+  null_reject,
+  reject_filter,
+  source_file_name,
+  storage_location,
+  target_partitions
+)
 import os
 
 from pyspark.sql.functions import lit
@@ -19,20 +40,20 @@ def test_data_load():
 def test_csv_source_schema():
   from pyspark.sql.types import StructType, StructField, StringType
   expected = books_csv_schema()
-  t = convergdb.csv_source_schema(
+  t = csv_source_schema(
     structure_2()
   )
   assert expected == t
 
 def test_coalesce_expression():
-  assert 'a' == convergdb.coalesce_expression(
+  assert 'a' == coalesce_expression(
     {
       'expression': None,
       'name': 'a'
     }
   )
 
-  assert 'a.b' == convergdb.coalesce_expression(
+  assert 'a.b' == coalesce_expression(
     {
       'expression': 'a.b',
       'name': 'a'
@@ -42,7 +63,7 @@ def test_coalesce_expression():
 def test_nestable_source_schema():
   from pyspark.sql.types import StructType, StructField, StringType
   expected = books_json_schema()
-  t = convergdb.nestable_source_schema(
+  t = nestable_source_schema(
     structure_1()
   )
   for i in t:
@@ -51,7 +72,7 @@ def test_nestable_source_schema():
 @pytest.mark.usefixtures("sql_context")
 def test_casted_attribute(sql_context):
   df = books_as_row(sql_context)
-  test = convergdb.casted_attribute(
+  test = casted_attribute(
     df,
     {'name': 'title','cast_type': 'varchar(100)'}
   )
@@ -64,7 +85,7 @@ def test_json_file_to_df(sql_context):
     books_json_path(), 
     schema=books_json_schema()
   ).collect()
-  test = convergdb.json_file_to_df(
+  test = json_file_to_df(
     sql_context,
     [books_json_path()],
     books_json_schema()
@@ -78,7 +99,7 @@ def test_csv_file_to_df(sql_context):
     schema=books_csv_schema()
   ).collect()
   
-  test = convergdb.csv_file_to_df(
+  test = csv_file_to_df(
     sql_context,
     [books_csv_path()],
     books_csv_schema(),
@@ -90,7 +111,7 @@ def test_csv_file_to_df(sql_context):
 @pytest.mark.usefixtures("sql_context")
 def test_apply_casting(sql_context):
   # create the testable structure
-  test = convergdb.apply_casting(
+  test = apply_casting(
     books_as_row(sql_context),
     structure_1()['source_structure']
   ).collect()
@@ -124,7 +145,7 @@ def test_expression_text():
   ]
   
   for test_case in test_cases:
-    assert test_case["expected"] == convergdb.expression_text(test_case)
+    assert test_case["expected"] == expression_text(test_case)
 
 @pytest.mark.usefixtures("sql_context")
 def test_apply_expressions(sql_context):
@@ -136,7 +157,7 @@ def test_apply_expressions(sql_context):
     "stock as stock"
   ).collect()
   
-  test = convergdb.apply_expressions(
+  test = apply_expressions(
     books_as_row(sql_context),
     structure_1()["source_structure"]
   ).collect()
@@ -150,7 +171,7 @@ def test_source_file_name(sql_context):
     input_file_name()
   ).collect()
   
-  test = convergdb.source_file_name(
+  test = source_file_name(
     books_as_row(sql_context)
   ).collect()
   
@@ -158,21 +179,26 @@ def test_source_file_name(sql_context):
  
 def test_target_partitions():
   expected = ["part_id", "convergdb_batch_id"]
-  test = convergdb.target_partitions(structure_1())
+  test = target_partitions(structure_1())
   assert test == expected
   
   struc2 = structure_1()
   struc2["partitions"] == ["part_id", "convergdb_batch_id"]
-  test = convergdb.target_partitions(struc2)
+  test = target_partitions(struc2)
   assert test == expected  
   
+def test_storage_location():
+  assert "s3a://convergdb-data-e969ca618e222a58/e969ca618e222a58/production.ecommerce.inventory.books" == storage_location(
+    structure_1()
+  )
+
 def test_write_partitions():
   # depends on S3 - needs refactor
   pass
       
 def test_reject_filter():
   expected = "stock is not null"
-  test = convergdb.reject_filter(
+  test = reject_filter(
     structure_1()["source_structure"]
   )
   assert test == expected
@@ -180,7 +206,7 @@ def test_reject_filter():
 @pytest.mark.usefixtures("sql_context")
 def test_null_reject(sql_context):
   expected = 2
-  test = convergdb.null_reject(
+  test = null_reject(
     books_as_row(sql_context),
     structure_1()["source_structure"]
   ).count()
@@ -193,7 +219,7 @@ def test_apply_housekeeping_fields(sql_context):
     lit("1000")
   ).collect()
   
-  test = convergdb.apply_housekeeping_fields(
+  test = apply_housekeeping_fields(
     books_as_row(sql_context),
     "1000"
   ).collect()
@@ -207,7 +233,7 @@ def test_csv_param():
   ]
   
   for t in tests:
-    assert t[1] == convergdb.csv_param(t[0])
+    assert t[1] == csv_param(t[0])
 
 def test_expressions_to_schema_dict():
   expressions = ['data.a', 'data.b.c']
@@ -220,27 +246,27 @@ def test_expressions_to_schema_dict():
     }
   }
   
-  assert expected == convergdb.expressions_to_schema_dict(expressions)
+  assert expected == expressions_to_schema_dict(expressions)
   
 def test_append_to_schema_dict():
   d = {}
   expected = {'a': {}}
-  convergdb.append_to_schema_dict(d, 'a')
+  append_to_schema_dict(d, 'a')
   assert expected == d
   
   # this test is progressive
   expected = {'a': {'b': {}}}
-  convergdb.append_to_schema_dict(d, 'a.b')
+  append_to_schema_dict(d, 'a.b')
   assert expected == d
   
    # this test is progressive
   expected = {'a': {'b': {'c': {}}}}
-  convergdb.append_to_schema_dict(d, 'a.b.c')
+  append_to_schema_dict(d, 'a.b.c')
   assert expected == d 
   
    # this test is progressive
   expected = {'a': {'b': {'c': {}}, 'd': {}}}
-  convergdb.append_to_schema_dict(d, 'a.d')
+  append_to_schema_dict(d, 'a.d')
   assert expected == d 
   
 def test_dict_to_spark_schema():
@@ -251,7 +277,7 @@ def test_dict_to_spark_schema():
       StructField('a', StringType(), True)
     ]
   )
-  assert expected == convergdb.dict_to_spark_schema(d)
+  assert expected == dict_to_spark_schema(d)
   
   d = {'a': {'b': {}}}
   expected = StructType(
@@ -263,7 +289,7 @@ def test_dict_to_spark_schema():
       ), True)
     ]
   )
-  assert expected == convergdb.dict_to_spark_schema(d)
+  assert expected == dict_to_spark_schema(d)
   
   d = {'a': {'b': {'c': {}}}}
   expected = StructType(
@@ -279,4 +305,4 @@ def test_dict_to_spark_schema():
       ), True)
     ]
   )
-  assert expected == convergdb.dict_to_spark_schema(d)
\ No newline at end of file
+  assert expected == dict_to_spark_schema(d)
\ No newline at end of file
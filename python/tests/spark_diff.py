@@ -0,0 +1,142 @@
+from context import convergdb
+from structure import *
+from pyspark_fixtures import *
+from convergdb.batch_control import file_estimated_sizing
+from convergdb.spark_diff import (
+  diff_dataframe,
+  diff_summary,
+  inventory_data_format,
+  inventory_filter,
+  s3_inventory_paths,
+  sample_fractions,
+  spark_diff_chunk_count,
+  spark_diff_chunks,
+  spark_diff_enabled,
+  summary_estimated_bytes,
+  symlink_paths
+)
+import pytest
+
+from pyspark.sql import Row
+
+def test_spark_diff_enabled():
+  s = structure_1()
+  assert not spark_diff_enabled(s)
+  s["spark_diff"] = "true"
+  assert spark_diff_enabled(s)
+  s = structure_2()
+  s["spark_diff"] = "true"
+  assert spark_diff_enabled(s)
+  # the api diff lists the source itself
+  s = structure_1()
+  s["spark_diff"] = "true"
+  s["inventory_source"] = "api"
+  assert not spark_diff_enabled(s)
+
+def test_inventory_data_format():
+  def table(serde):
+    return {"Table": {"StorageDescriptor": {"SerdeInfo": {"SerializationLibrary": serde}}}}
+  assert 'orc' == inventory_data_format(table('org.apache.hadoop.hive.ql.io.orc.OrcSerde'))
+  assert 'parquet' == inventory_data_format(table('org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'))
+  assert 'csv' == inventory_data_format(table('org.apache.hadoop.hive.serde2.OpenCSVSerde'))
+  assert 'csv' == inventory_data_format({"Table": {"StorageDescriptor": {}}})
+
+def test_symlink_paths():
+  assert ['s3a://inv/data/a.csv.gz', 's3a://inv/data/b.csv.gz'] == symlink_paths(
+    "s3://inv/data/a.csv.gz\ns3://inv/data/b.csv.gz\n"
+  )
+  assert [] == symlink_paths("")
+
+def test_s3_inventory_paths():
+  location = {'bucket': 'inv', 'prefix': 'src/config/hive/'}
+  def keys(bucket, prefix):
+    assert prefix == 'src/config/hive/dt=2019-01-02-00-00/'
+    return [prefix + 'symlink.txt']
+  def get(bucket, key):
+    return "s3://inv/src/config/data/a.csv.gz\n"
+  assert ['s3a://inv/src/config/data/a.csv.gz'] == s3_inventory_paths(
+    location,
+    'dt=2019-01-02-00-00',
+    keys,
+    get
+  )
+  # no symlinks, so the partition is read as it is
+  assert ['s3a://inv/src/config/hive/dt=2019-01-02-00-00/'] == s3_inventory_paths(
+    location,
+    'dt=2019-01-02-00-00',
+    lambda b, p: [p + 'part-0.parquet'],
+    get
+  )
+
+def test_diff_summary():
+  t = diff_summary(
+    [
+      {"compression": "gz", "file_count": 3, "bytes": 300},
+      {"compression": "none", "file_count": 1, "bytes": None}
+    ]
+  )
+  assert t == {
+    "file_count": 4,
+    "bytes": 300,
+    "by_type": {
+      "gz": {"file_count": 3, "bytes": 300},
+      "none": {"file_count": 1, "bytes": 0}
+    }
+  }
+
+def test_summary_estimated_bytes():
+  summary = {
+    "by_type": {
+      "gz": {"file_count": 1, "bytes": 10},
+      "bz2": {"file_count": 1, "bytes": 10},
+      "none": {"file_count": 1, "bytes": 10}
+    }
+  }
+  assert 180 == summary_estimated_bytes(summary)
+  assert 130 == summary_estimated_bytes(summary, {'gz': 2, 'bz2': 10})
+  # matches the estimate from the full list
+  diff = [{"key": "a.gz", "size": 10}, {"key": "b.bz2", "size": 10}, {"key": "c", "size": 10}]
+  assert file_estimated_sizing(diff) == summary_estimated_bytes(summary)
+
+def test_sample_fractions():
+  summary = {
+    "by_type": {
+      "gz": {"file_count": 1000, "bytes": 10},
+      "bz2": {"file_count": 2, "bytes": 10},
+      "none": {"file_count": 100, "bytes": 10}
+    }
+  }
+  assert {'gz': 0.032, 'bz2': 1.0} == sample_fractions(summary, 8)
+
+def test_spark_diff_chunk_count():
+  assert 0 == spark_diff_chunk_count(0, 100)
+  assert 1 == spark_diff_chunk_count(10, 100)
+  assert 3 == spark_diff_chunk_count(250, 100)
+
+def test_inventory_filter(sql_context):
+  df = sql_context.createDataFrame(
+    [
+      Row(bucket='fakedata-2018-02-15.beyondsoft.us', key='a.json', is_latest='true', is_delete_marker='false'),
+      Row(bucket='fakedata-2018-02-15.beyondsoft.us', key='b.json', is_latest='false', is_delete_marker='false'),
+      Row(bucket='fakedata-2018-02-15.beyondsoft.us', key='c.json', is_latest='true', is_delete_marker='true'),
+      Row(bucket='other', key='d.json', is_latest='true', is_delete_marker='false')
+    ]
+  )
+  s = structure_1()
+  s["source_structure"]["storage_bucket"] = 'fakedata-2018-02-15.beyondsoft.us'
+  assert ['a.json'] == [r["key"] for r in inventory_filter(df, s).collect()]
+
+def test_diff_dataframe_and_chunks(sql_context):
+  inventory = sql_context.createDataFrame(
+    [Row(key='f' + str(i) + '.json.gz', size=i) for i in range(100)] + [Row(key='folder/', size=0)]
+  )
+  control = sql_context.createDataFrame(
+    [Row(source_key='f' + str(i) + '.json.gz') for i in range(0, 100, 2)]
+  )
+  diff_df = diff_dataframe(inventory, control)
+  distributed = {"dataframe": diff_df}
+  chunks = list(spark_diff_chunks(distributed, 4))
+  assert 4 == len(chunks)
+  keys = sorted([f["key"] for c in chunks for f in c])
+  assert keys == sorted(['f' + str(i) + '.json.gz' for i in range(1, 100, 2)])
+  assert set(['gz']) == set([r["compression"] for r in diff_df.collect()])
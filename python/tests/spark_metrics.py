@@ -0,0 +1,257 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.spark_metrics import (
+  batch_job_group,
+  batch_spark_metrics,
+  batch_stage_attempts,
+  spark_cloudwatch_metrics_enabled,
+  spark_metric_data,
+  stage_attempts,
+  stage_settled,
+  stage_task_summary,
+  stage_totals,
+  summary_max,
+  task_time_skew
+)
+
+# the parts of the spark driver, reached through py4j, that metrics are
+# read from
+class Seq(list):
+  def size(self):
+    return len(self)
+
+  def apply(self, i):
+    return self[i]
+
+class Fields(object):
+  def __init__(self, fields):
+    for k in fields:
+      setattr(self, k, (lambda v: lambda: v)(fields[k]))
+
+class Status(object):
+  def __init__(self, name):
+    self.name = name
+
+  def toString(self):
+    return self.name
+
+class Option(object):
+  def __init__(self, value):
+    self.value = value
+
+  def isDefined(self):
+    return self.value != None
+
+  def get(self):
+    return self.value
+
+class Driver(object):
+  def __init__(self, stages={}, summaries={}, groups={}):
+    self.stages = stages
+    self.summaries = summaries
+    self.groups = groups
+    self._sc = self
+    self._jsc = self
+    self._gateway = self
+    self.jvm = Fields({"double": float})
+    self.waits = []
+    self.job_groups = []
+
+  def setJobGroup(self, group_id, description):
+    self.job_groups.append(group_id)
+
+  def clearJobGroup(self):
+    self.job_groups.append(None)
+
+  def sc(self):
+    return self
+
+  def new_array(self, kind, size):
+    return [None] * size
+
+  def listenerBus(self):
+    return self
+
+  def waitUntilEmpty(self, millis):
+    self.waits.append(millis)
+
+  def statusStore(self):
+    return self
+
+  def stageData(self, stage_id, details):
+    if not stage_id in self.stages:
+      raise Exception("stage not found")
+    return Seq([stage_data(a) for a in self.stages[stage_id]])
+
+  def taskSummary(self, stage_id, attempt_id, quantiles):
+    assert [0.5, 1.0] == quantiles
+    s = self.summaries.get((stage_id, attempt_id), None)
+    if s == None:
+      return Option(None)
+    return Option(Fields(dict([(k, Seq(s[k])) for k in s])))
+
+  def statusTracker(self):
+    return self
+
+  def getJobIdsForGroup(self, group):
+    return self.groups.get(group, [])
+
+  def getJobInfo(self, job_id):
+    info = Fields({})
+    info.stageIds = [job_id * 10, job_id * 10 + 1]
+    return info
+
+def stage_data(attempt):
+  fields = dict(attempt)
+  fields["status"] = Status(attempt["status"])
+  return Fields(fields)
+
+def attempt(status, attempt_id=0, **fields):
+  a = {
+    "status": status,
+    "attemptId": attempt_id,
+    "name": "save",
+    "numCompleteTasks": 1,
+    "inputBytes": 0,
+    "inputRecords": 0,
+    "outputBytes": 0,
+    "outputRecords": 0,
+    "shuffleReadBytes": 0,
+    "shuffleWriteBytes": 0,
+    "memoryBytesSpilled": 0,
+    "diskBytesSpilled": 0,
+    "executorRunTime": 0
+  }
+  a.update(fields)
+  return a
+
+def test_set_batch_job_group():
+  # requires a spark context
+  pass
+
+def test_batch_job_group():
+  d = Driver()
+  with pytest.raises(Exception):
+    with batch_job_group(d, "20181231235959000"):
+      assert ["20181231235959000"] == d.job_groups
+      raise Exception("write failed")
+  # the tag is cleared even when the write fails
+  assert ["20181231235959000", None] == d.job_groups
+
+def test_batch_stage_ids():
+  # requires a spark context
+  pass
+
+def test_stage_attempts():
+  d = Driver({3: [attempt("FAILED"), attempt("COMPLETE", 1, outputBytes=50)]})
+  t = stage_attempts(d, 3)
+  assert ["FAILED", "COMPLETE"] == [a["status"] for a in t]
+  assert attempt("COMPLETE", 1, outputBytes=50) == t[1]
+  # a stage the status store has not recorded yet
+  assert [] == stage_attempts(d, 4)
+
+def test_stage_task_summary():
+  d = Driver(summaries={(3, 0): {"executorRunTime": [10.0, 80.0], "peakExecutionMemory": [5.0, 9.0]}})
+  assert {"executorRunTime": [10.0, 80.0], "peakExecutionMemory": [5.0, 9.0]} == stage_task_summary(d, 3, 0)
+  assert {} == stage_task_summary(d, 3, 1)
+
+def test_stage_settled():
+  assert not stage_settled([])
+  assert not stage_settled([attempt("FAILED"), attempt("ACTIVE", 1)])
+  assert stage_settled([attempt("FAILED"), attempt("COMPLETE", 1)])
+  assert stage_settled([attempt("SKIPPED")])
+
+def test_batch_stage_attempts():
+  reads = {1: [[], [attempt("ACTIVE")], [attempt("COMPLETE")]], 2: [[attempt("COMPLETE")]]}
+  def attempts_stub(sql_context, stage_id):
+    return reads[stage_id].pop(0)
+  waits = []
+  sleeps = []
+  t = batch_stage_attempts(None, [1, 2], attempts_stub, waits.append, 3, sleeps.append)
+  assert {1: [attempt("COMPLETE")], 2: [attempt("COMPLETE")]} == t
+  # settled stages are not read again
+  assert {1: [], 2: []} == reads
+  assert [1, 1] == sleeps
+  assert 2 == len(waits)
+
+def test_stage_totals():
+  t = stage_totals(
+    [
+      {"inputBytes": 100, "inputRecords": 10, "outputBytes": 0},
+      {"inputBytes": 0, "outputBytes": 50, "outputRecords": 10, "memoryBytesSpilled": 5}
+    ]
+  )
+  assert t == {
+    "input_bytes": 100,
+    "input_records": 10,
+    "output_bytes": 50,
+    "output_records": 10,
+    "shuffle_read_bytes": 0,
+    "shuffle_write_bytes": 0,
+    "memory_bytes_spilled": 5,
+    "disk_bytes_spilled": 0,
+    "executor_run_time": 0
+  }
+
+def test_summary_max():
+  summaries = [
+    {"peakExecutionMemory": [10.0, 20.0]},
+    {"peakExecutionMemory": [15.0, 40.0]},
+    {"peakExecutionMemory": []}
+  ]
+  assert 40.0 == summary_max(summaries, "peakExecutionMemory")
+  assert None == summary_max([], "peakExecutionMemory")
+
+def test_batch_spark_metrics():
+  # metrics are never allowed to fail the load
+  assert {} == batch_spark_metrics(None, "20181231235959000")
+  d = Driver(
+    {
+      10: [attempt("COMPLETE", outputBytes=50, outputRecords=10)],
+      11: [attempt("SKIPPED")],
+      20: [attempt("ACTIVE", inputBytes=100)]
+    },
+    {(10, 0): {"executorRunTime": [10.0, 80.0], "peakExecutionMemory": [5.0, 9.0]}},
+    {"20181231235959000": [1, 2]}
+  )
+  sleeps = []
+  t = batch_spark_metrics(d, "20181231235959000", sleep=sleeps.append)
+  # stage 21 is never recorded and stage 20 never completes, so they are
+  # left out after the retries
+  assert [1, 1, 1] == sleeps
+  assert 4 == len(d.waits)
+  assert 50 == t["output_bytes"]
+  assert 0 == t["input_bytes"]
+  assert 9.0 == t["peak_execution_memory"]
+  assert 8.0 == t["task_time_skew"]
+
+def test_task_time_skew():
+  summaries = [
+    {"executorRunTime": [100.0, 150.0]},
+    {"executorRunTime": [10.0, 80.0]},
+    {"executorRunTime": [0.0, 5.0]},
+    {}
+  ]
+  assert 8.0 == task_time_skew(summaries)
+  assert None == task_time_skew([{"executorRunTime": [0.0, 0.0]}])
+
+def test_spark_cloudwatch_metrics_enabled():
+  assert not spark_cloudwatch_metrics_enabled({})
+  assert spark_cloudwatch_metrics_enabled({"spark_cloudwatch_metrics": "true"})
+
+def test_spark_metric_data():
+  t = spark_metric_data(
+    structure_1(),
+    {"output_records": 10, "files_written": 2, "task_time_skew": None, "duration": 5.0},
+    "20181231235959000"
+  )
+  relation = [{'Name': 'relation', 'Value': 'production.ecommerce.inventory.books'}]
+  assert t == [
+    {'MetricName': 'spark_output_records', 'Value': 10, 'Unit': 'Count', 'Dimensions': relation},
+    {'MetricName': 'spark_files_written', 'Value': 2, 'Unit': 'Count', 'Dimensions': relation}
+  ]
+
+def test_buffer_spark_metrics():
+  # queues metrics for the background sender
+  pass
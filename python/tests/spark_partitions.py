@@ -1,86 +1,98 @@
 from context import convergdb
 from structure import *
 from pyspark_fixtures import *
+from convergdb.spark_partitions import (
+  available_memory_in_this_cluster,
+  calculate_chunk_count,
+  calculate_spark_partitions,
+  coalesce_partition_target,
+  limited_chunk_count,
+  loadable_file_size,
+  output_partition_target,
+  planning_core_count,
+  split_file_count,
+  split_indices
+)
 import pytest
 
 def test_split_indices():
   expected = [(0, 1)]
-  assert expected == convergdb.split_indices(1, 1)
+  assert expected == split_indices(1, 1)
   
   expected = [(0, 1)]
-  assert expected == convergdb.split_indices(1, 2)
+  assert expected == split_indices(1, 2)
 
   expected = [(0, 1)]
-  assert expected == convergdb.split_indices(1, 100)
+  assert expected == split_indices(1, 100)
   
   expected = [(0, 1), (1, 2)]
-  assert expected == convergdb.split_indices(2, 1)
+  assert expected == split_indices(2, 1)
   
   expected = [(0, 2), (2, 4), (4, 5)]
-  assert expected == convergdb.split_indices(5, 2)
+  assert expected == split_indices(5, 2)
   
 def test_loadable_file_size():
   expected = 1000000
-  assert expected == convergdb.loadable_file_size(
+  assert expected == loadable_file_size(
     available_files_dict(),
     ['file1']
   )
 
   expected = 3000000
-  assert expected == convergdb.loadable_file_size(
+  assert expected == loadable_file_size(
     available_files_dict(),
     ['file1', 'file2', 'file3']
   )
   
 def test_coalesce_partition_target():
   expected = 1
-  assert expected == convergdb.coalesce_partition_target(
+  assert expected == coalesce_partition_target(
     1,
     1
   )
   
   expected = 1
-  assert expected == convergdb.coalesce_partition_target(
+  assert expected == coalesce_partition_target(
     4,
     256*(1024**2)-1
   )
 
   expected = 5.0
-  assert expected == convergdb.coalesce_partition_target(
+  assert expected == coalesce_partition_target(
     4,
     4*(1024**3)
   )
 
   expected = 8.0
-  assert expected == convergdb.coalesce_partition_target(
+  assert expected == coalesce_partition_target(
     4,
     30*(1024**3)
   )
   
 def test_calculate_spark_partitions():
   expected = 8
-  assert expected == convergdb.calculate_spark_partitions(
+  assert expected == calculate_spark_partitions(
     30*(1024**3),
     1,
     None
   )
   
   expected = 16
-  assert expected == convergdb.calculate_spark_partitions(
+  assert expected == calculate_spark_partitions(
     30*(1024**3),
     2,
     None
   )
   
   expected = 2
-  assert expected == convergdb.calculate_spark_partitions(
+  assert expected == calculate_spark_partitions(
     30*(1024**3),
     None,
     None
   ) 
 
   expected = 400
-  assert expected == convergdb.calculate_spark_partitions(
+  assert expected == calculate_spark_partitions(
     30*(1024**3),
     2,
     400
@@ -88,44 +100,104 @@ def test_calculate_spark_partitions():
 
 def test_available_memory_in_this_cluster():
   expected = 16 * (1024**3) * 0.25
-  assert expected == convergdb.available_memory_in_this_cluster(1)
+  assert expected == available_memory_in_this_cluster(1)
 
   expected = 4 * (1024**3) * 0.25
-  assert expected == convergdb.available_memory_in_this_cluster(None)
+  assert expected == available_memory_in_this_cluster(None)
 
 
 def test_calculate_chunk_count():
   expected = 1
-  assert expected == convergdb.calculate_chunk_count(
+  assert expected == calculate_chunk_count(
     100,
     1,
     1
   )
 
   expected = 1
-  assert expected == convergdb.calculate_chunk_count(
+  assert expected == calculate_chunk_count(
     100,
     1,
     None
   )
   
   expected = 100
-  assert expected == convergdb.calculate_chunk_count(
+  assert expected == calculate_chunk_count(
     100 * (10**3),
     100,
     1
   )
 
   expected = 1000
-  assert expected == convergdb.calculate_chunk_count(
+  assert expected == calculate_chunk_count(
     1000 * (10**3),
     1000,
     1
   )
 
   expected = 1000
-  assert expected == convergdb.calculate_chunk_count(
+  assert expected == calculate_chunk_count(
     1000 * (10**3),
     1000,
     None
-  )
\ No newline at end of file
+  )
+def test_limited_chunk_count():
+  assert 100 == limited_chunk_count(100, {})
+  assert 40 == limited_chunk_count(100, {"max_chunk_file_count": 40})
+  assert 10 == limited_chunk_count(10, {"max_chunk_file_count": 40})
+
+def test_split_file_count():
+  assert 1 == split_file_count(1)
+  assert 1 == split_file_count(2)
+  assert 3 == split_file_count(5)
+  assert 50 == split_file_count(100)
+
+def test_planning_core_count():
+  assert 1 == planning_core_count(None)
+  assert 8 == planning_core_count(2)
+
+def test_output_partition_target():
+  expected = 1
+  assert expected == output_partition_target(
+    4,
+    1
+  )
+
+  expected = 4.0
+  assert expected == output_partition_target(
+    4,
+    1024**3
+  )
+
+  expected = 8.0
+  assert expected == output_partition_target(
+    4,
+    10*(1024**3)
+  )
+
+def test_resource_aware_planning():
+  resources = {"cores": 4, "memory_bytes": 8 * (1024**3)}
+
+  assert 4 == planning_core_count(None, resources)
+
+  # dpu wins over local resources
+  assert 8 == planning_core_count(2, resources)
+
+  expected = 2 * (1024**3)
+  assert expected == available_memory_in_this_cluster(None, resources)
+
+  expected = 8
+  assert expected == calculate_spark_partitions(
+    30*(1024**3),
+    None,
+    None,
+    resources
+  )
+
+  expected = 100
+  assert expected == calculate_chunk_count(
+    4 * (1024**3),
+    200,
+    None,
+    resources
+  )
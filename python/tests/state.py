@@ -1,6 +1,16 @@
 from context import convergdb
 from structure import *
 import pytest
+from convergdb.state import (
+  current_state_key,
+  lowered_chunk_file_count,
+  sizing_state_key,
+  sql_utc_timestamp,
+  state_allows_load,
+  state_folder_prefix,
+  state_load_in_progress,
+  state_success
+)
 import json
 import time
 
@@ -13,20 +23,20 @@ def test_data_files_for_batch():
   pass
 
 def test_state_folder_prefix():
-  t = convergdb.state_folder_prefix(
+  t = state_folder_prefix(
     structure_1()
   )
   assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books"
   
 def test_current_state_key():
-  t = convergdb.current_state_key(
+  t = current_state_key(
     structure_1()
   )
   assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/state.json"
 
 def test_state_success():
-  this_time = convergdb.sql_utc_timestamp(time.gmtime())
-  t = convergdb.state_success(
+  this_time = sql_utc_timestamp(time.gmtime())
+  t = state_success(
     "201701011234123",
     this_time,
     this_time,
@@ -43,9 +53,22 @@ def test_state_success():
     "structure" : structure_1()
   }
   
+def test_state_success_with_metrics():
+  this_time = sql_utc_timestamp(time.gmtime())
+  t = state_success(
+    "201701011234123",
+    this_time,
+    this_time,
+    structure_1(),
+    this_time,
+    {"output_records": 10, "files_written": 2}
+  )
+  assert t["metrics"] == {"output_records": 10, "files_written": 2}
+  assert t["batch_id"] == "201701011234123"
+
 def test_state_load_in_progress():
-  this_time = convergdb.sql_utc_timestamp(time.gmtime())
-  t = convergdb.state_load_in_progress(
+  this_time = sql_utc_timestamp(time.gmtime())
+  t = state_load_in_progress(
     structure_1(),
     "201701011234123",
     this_time,
@@ -68,4 +91,38 @@ def test_write_success():
 
 def test_write_load_in_progress():
   # too much state for a unit test
-  pass
\ No newline at end of file
+  pass
+def test_sizing_state_key():
+  t = sizing_state_key(
+    structure_1()
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/sizing.json"
+
+def test_lowered_chunk_file_count():
+  # no limit stored yet
+  assert {"max_chunk_file_count": 50} == lowered_chunk_file_count(
+    {},
+    50
+  )
+
+  # smaller limit replaces the stored one
+  assert {"max_chunk_file_count": 25} == lowered_chunk_file_count(
+    {"max_chunk_file_count": 50},
+    25
+  )
+
+  # limit is never raised
+  assert {"max_chunk_file_count": 25} == lowered_chunk_file_count(
+    {"max_chunk_file_count": 25},
+    50
+  )
+
+def test_record_chunk_file_count():
+  # reads and writes s3
+  pass
+
+def test_state_allows_load():
+  assert state_allows_load({"state": "success"})
+  assert state_allows_load({"state": "unknown"})
+  assert not state_allows_load({"state": "failure"})
+  assert not state_allows_load({"state": "load_in_progress"})
@@ -0,0 +1,119 @@
+from context import convergdb
+from structure import *
+from pyspark_fixtures import *
+from convergdb.spark_diff import inventory_dataframe, latest_inventory_events
+from convergdb.streaming_snapshot import (
+  diff_inventory_function,
+  snapshot_listing_start,
+  snapshot_paths,
+  snapshot_pointer_key,
+  snapshot_version_key,
+  streaming_snapshot_dataframe,
+  streaming_snapshot_enabled,
+  streaming_snapshot_partition_count,
+  unmerged_keys,
+  unreferenced_snapshot_keys,
+  updated_snapshot_pointer
+)
+import pytest
+
+from pyspark.sql import Row
+
+def test_streaming_snapshot_enabled():
+  s = structure_2()
+  assert not streaming_snapshot_enabled(s)
+  s["streaming_inventory_snapshot"] = "true"
+  assert streaming_snapshot_enabled(s)
+  s = structure_1()
+  s["streaming_inventory_snapshot"] = "true"
+  assert not streaming_snapshot_enabled(s)
+
+def test_streaming_snapshot_partition_count():
+  s = structure_2()
+  assert 16 == streaming_snapshot_partition_count(s)
+  s["streaming_snapshot_partitions"] = 4
+  assert 4 == streaming_snapshot_partition_count(s)
+
+def test_snapshot_keys():
+  s = structure_2()
+  assert "e969ca618e222a58/state/production.ecommerce.inventory.books/streaming_snapshot.json" == snapshot_pointer_key(s)
+  assert "e969ca618e222a58/state/production.ecommerce.inventory.books/streaming_snapshot/version=1/" == snapshot_version_key(s, "1")
+
+def test_snapshot_listing_start():
+  assert None == snapshot_listing_start({}, 24)
+  assert "inv/2019/01/01/10" == snapshot_listing_start({"watermark": "inv/2019/01/02/10/b"}, 24)
+
+def test_unmerged_keys():
+  pointer = {"merged_keys": ["inv/2019/01/02/09/a"]}
+  # a late file that sorts before the newest merged key is still merged
+  assert ["inv/2019/01/02/08/late"] == unmerged_keys(pointer, ["inv/2019/01/02/08/late", "inv/2019/01/02/09/a"])
+  assert ["a"] == unmerged_keys({}, ["a"])
+
+def test_updated_snapshot_pointer():
+  t = updated_snapshot_pointer(
+    {},
+    ["inv/2019/01/01/01/a", "inv/2019/01/02/01/b"],
+    4,
+    "snap/version=1/",
+    [0, 2],
+    24
+  )
+  assert t["watermark"] == "inv/2019/01/02/01/b"
+  assert t["merged_keys"] == ["inv/2019/01/01/01/a", "inv/2019/01/02/01/b"]
+  assert t["partition_count"] == 4
+  assert t["partitions"] == {
+    "0": "snap/version=1/key_partition=0/",
+    "2": "snap/version=1/key_partition=2/"
+  }
+  # only the touched partitions move to the new version
+  t = updated_snapshot_pointer(
+    t,
+    ["inv/2019/01/03/00/c"],
+    4,
+    "snap/version=2/",
+    [2],
+    24
+  )
+  assert t["watermark"] == "inv/2019/01/03/00/c"
+  # keys before the next listing start are no longer kept
+  assert t["merged_keys"] == ["inv/2019/01/02/01/b", "inv/2019/01/03/00/c"]
+  assert t["partitions"] == {
+    "0": "snap/version=1/key_partition=0/",
+    "2": "snap/version=2/key_partition=2/"
+  }
+
+def test_unreferenced_snapshot_keys():
+  pointer = {"partitions": {"0": "snap/version=1/key_partition=0/"}}
+  keys = [
+    "snap/version=1/key_partition=0/part-0.parquet",
+    "snap/version=1/key_partition=2/part-0.parquet",
+    "snap/version=1/_SUCCESS"
+  ]
+  assert keys[1:] == unreferenced_snapshot_keys(keys, pointer)
+
+def test_snapshot_paths():
+  s = structure_2()
+  assert ["s3a://" + s["state_bucket"] + "/a/"] == snapshot_paths(s, {"partitions": {"0": "a/"}})
+  assert [] == snapshot_paths(s, {})
+
+def test_diff_inventory_function():
+  s = structure_2()
+  assert inventory_dataframe == diff_inventory_function(s)
+  s["streaming_inventory_snapshot"] = "true"
+  assert streaming_snapshot_dataframe == diff_inventory_function(s)
+
+def test_latest_inventory_events(sql_context):
+  df = sql_context.createDataFrame(
+    [
+      Row(key='a', sequencer='0001', size=1),
+      Row(key='a', sequencer='0003', size=3),
+      Row(key='a', sequencer='0002', size=2),
+      Row(key='b', sequencer='0001', size=5)
+    ]
+  )
+  t = sorted([(r["key"], r["sequencer"], r["size"]) for r in latest_inventory_events(df).collect()])
+  assert [('a', '0003', 3), ('b', '0001', 5)] == t
+
+def test_update_streaming_snapshot():
+  # reads and writes s3
+  pass
@@ -0,0 +1,132 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.tracing import (
+  current_trace,
+  new_span,
+  performance_report_key,
+  phase_totals,
+  write_performance_report
+)
+
+def fake_clock(times):
+  def clock():
+    return times.pop(0)
+  return clock
+
+def test_new_span():
+  assert new_span('a', 1.5) == {
+    "name": 'a',
+    "start": 1.5,
+    "duration": None,
+    "bytes": None,
+    "items": None,
+    "children": []
+  }
+
+def test_span():
+  convergdb.start_trace('run', fake_clock([100.0]))
+  with convergdb.span('outer', fake_clock([101.0, 105.0])) as outer:
+    with convergdb.span('inner', fake_clock([102.0, 103.5])) as inner:
+      convergdb.annotate_span(inner, bytes=10, items=2)
+  root = convergdb.finish_trace(fake_clock([106.0]))
+
+  assert root["duration"] == 6.0
+  assert len(root["children"]) == 1
+  assert root["children"][0]["name"] == 'outer'
+  assert root["children"][0]["start"] == 1.0
+  assert root["children"][0]["duration"] == 4.0
+  assert root["children"][0]["children"][0] == {
+    "name": 'inner',
+    "start": 2.0,
+    "duration": 1.5,
+    "bytes": 10,
+    "items": 2,
+    "children": []
+  }
+  assert current_trace() == None
+
+def test_span_error():
+  convergdb.start_trace('run')
+  with pytest.raises(ValueError):
+    with convergdb.span('failing'):
+      raise ValueError('test')
+  with convergdb.span('after'):
+    None
+  root = convergdb.finish_trace()
+  assert root["children"][0]["error"] == True
+  assert root["children"][0]["duration"] != None
+  # the failed span is closed, so the next span is a sibling
+  assert root["children"][1]["name"] == 'after'
+
+def test_span_without_trace():
+  convergdb.finish_trace()
+  with convergdb.span('untraced') as s:
+    convergdb.annotate_span(s, items=1)
+  assert s["duration"] != None
+  assert convergdb.finish_trace() == None
+
+def test_annotate_span():
+  s = new_span('a', 0.0)
+  convergdb.annotate_span(s, bytes=5)
+  convergdb.annotate_span(s, items=3)
+  assert s["bytes"] == 5
+  assert s["items"] == 3
+
+def test_phase_totals():
+  root = new_span('run', 0.0)
+  a = new_span('load_batch', 0.0)
+  a["duration"] = 2.0
+  a["bytes"] = 100
+  b = new_span('load_batch', 2.0)
+  b["duration"] = 3.0
+  b["bytes"] = 50
+  c = new_span('write_success', 4.0)
+  c["duration"] = 0.5
+  b["children"].append(c)
+  root["children"] = [a, b]
+
+  assert phase_totals(root) == {
+    'load_batch': {"count": 2, "duration": 5.0, "bytes": 150, "items": 0},
+    'write_success': {"count": 1, "duration": 0.5, "bytes": 0, "items": 0}
+  }
+
+def test_performance_report():
+  root = new_span('run', 0.0)
+  root["duration"] = 1.0
+  t = convergdb.performance_report(
+    structure_1(),
+    '20190101000000000',
+    'success',
+    root
+  )
+  assert t == {
+    "full_relation_name": "production.ecommerce.inventory.books",
+    "run_id": '20190101000000000',
+    "outcome": 'success',
+    "duration": 1.0,
+    "phases": {},
+    "s3_requests": {},
+    "spans": root
+  }
+
+def test_performance_report_key():
+  t = performance_report_key(
+    structure_1(),
+    '20190101000000000'
+  )
+  assert t == "e969ca618e222a58/state/production.ecommerce.inventory.books/performance/20190101000000000.json"
+
+def test_write_performance_report():
+  written = []
+  def write_stub(bucket, key, body):
+    written.append((bucket, key, body))
+  report = {"run_id": '20190101000000000', "duration": 1.0}
+  write_performance_report(structure_1(), report, write_stub)
+  assert len(written) == 1
+  assert written[0][1] == "e969ca618e222a58/state/production.ecommerce.inventory.books/performance/20190101000000000.json"
+
+  # failures are logged, not raised
+  def failing_stub(bucket, key, body):
+    raise IOError('test')
+  write_performance_report(structure_1(), report, failing_stub)
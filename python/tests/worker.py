@@ -0,0 +1,174 @@
+from context import convergdb
+from structure import *
+import pytest
+from convergdb.worker import (
+  lock_environment,
+  new_worker,
+  receive_message,
+  run_message,
+  trigger_run,
+  visibility_heartbeat,
+  worker_structures
+)
+
+import json
+import os
+import threading
+from botocore.exceptions import ClientError
+
+def streaming_structure():
+  s = structure_2()
+  s["full_relation_name"] = "production.ecommerce.inventory.streaming_books"
+  return s
+
+def structure_jsons():
+  return [json.dumps(structure_1()), json.dumps(streaming_structure())]
+
+class Runs(object):
+  def __init__(self, fail=[], locked=[]):
+    self.runs = []
+    self.fail = fail
+    self.locked = locked
+
+  def __call__(self, sql_context, structure_json):
+    name = json.loads(structure_json)["full_relation_name"]
+    self.runs.append((name, os.environ.get('LOCK_ID', None)))
+    if name in self.fail:
+      raise Exception("load failed")
+    if name in self.locked:
+      raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+
+def test_queue_from_url():
+  assert {"kind": "file", "path": "/tmp/triggers"} == convergdb.queue_from_url("file:///tmp/triggers")
+  q = convergdb.queue_from_url("https://sqs.us-west-2.amazonaws.com/1/q", "us-west-2")
+  assert "sqs" == q["kind"]
+  assert "us-west-2" == q["region"]
+
+def test_worker_structures():
+  s = worker_structures(structure_jsons())
+  assert sorted([structure_1()["full_relation_name"], streaming_structure()["full_relation_name"]]) == sorted(s.keys())
+
+def test_trigger_run():
+  s = worker_structures(structure_jsons())
+  name = structure_1()["full_relation_name"]
+  assert (s[name], None) == trigger_run(s, json.dumps({"relation": name}))
+  structure_json, lock_id = trigger_run(
+    {},
+    json.dumps({"structure": structure_2(), "lock_id": "job"})
+  )
+  assert structure_2() == json.loads(structure_json)
+  assert "job" == lock_id
+  with pytest.raises(Exception):
+    trigger_run(s, json.dumps({"relation": "unknown"}))
+
+def test_lock_environment():
+  e = {"LOCK_ID": "worker"}
+  with lock_environment("job", e):
+    assert "job" == e["LOCK_ID"]
+  assert {"LOCK_ID": "worker"} == e
+  with lock_environment(None, e):
+    assert "worker" == e["LOCK_ID"]
+  e = {}
+  with lock_environment("job", e):
+    assert "job" == e["LOCK_ID"]
+  assert {} == e
+
+def test_run_worker_memory_queue():
+  r1 = structure_1()["full_relation_name"]
+  r2 = streaming_structure()["full_relation_name"]
+  q = convergdb.memory_queue(
+    [
+      json.dumps({"relation": r1}),
+      json.dumps({"relation": r2, "lock_id": "job"}),
+      json.dumps({"relation": "unknown"})
+    ]
+  )
+  runs = Runs([r2])
+  w = convergdb.run_worker(None, q, structure_jsons(), max_runs=3, signals=[], run_function=runs)
+  assert 3 == w["runs"]
+  assert 2 == w["failures"]
+  # the worker process lock id is used unless the trigger has one
+  assert [(r1, 'tmp'), (r2, 'job')] == runs.runs
+  assert 'tmp' == os.environ['LOCK_ID']
+  # failed triggers are given back, successful ones are removed
+  assert ['1', '2'] == [m["id"] for m in q["failed"]]
+  assert {} == q["in_flight"]
+
+def test_run_worker_idle():
+  q = convergdb.memory_queue([])
+  times = [0.0, 0.0, 30.0, 61.0]
+  w = convergdb.run_worker(
+    None,
+    q,
+    [],
+    idle_seconds=60,
+    signals=[],
+    run_function=Runs(),
+    clock=lambda: times.pop(0),
+    sleep=lambda s: None
+  )
+  assert 0 == w["runs"]
+  assert [] == times
+
+def test_file_queue(tmpdir):
+  r1 = structure_1()["full_relation_name"]
+  tmpdir.join('1.json').write(json.dumps({"relation": r1}))
+  tmpdir.join('2.json').write(json.dumps({"relation": "unknown"}))
+  q = convergdb.file_queue(str(tmpdir))
+  runs = Runs()
+  w = convergdb.run_worker(None, q, structure_jsons(), max_runs=2, signals=[], run_function=runs)
+  assert 1 == w["failures"]
+  assert [(r1, 'tmp')] == runs.runs
+  assert [] == tmpdir.join('processing').listdir()
+  assert ['2.json'] == [p.basename for p in tmpdir.join('failed').listdir()]
+  assert [] == receive_message(q)
+
+def test_run_message_lock_conflict():
+  r1 = structure_1()["full_relation_name"]
+  q = convergdb.memory_queue([json.dumps({"relation": r1})])
+  w = new_worker(q, worker_structures(structure_jsons()))
+  m = receive_message(q)[0]
+  assert "locked" == run_message(w, None, m, Runs(locked=[r1]))
+  assert 0 == w["failures"]
+  assert 1 == w["lock_conflicts"]
+  # the trigger is given back to be run again, not failed
+  assert [] == q["failed"]
+  assert [m] == q["messages"]
+  assert "success" == run_message(w, None, receive_message(q)[0], Runs())
+  assert 2 == w["runs"]
+
+def test_file_queue_lock_conflict(tmpdir):
+  r1 = structure_1()["full_relation_name"]
+  tmpdir.join('1.json').write(json.dumps({"relation": r1}))
+  q = convergdb.file_queue(str(tmpdir))
+  sleeps = []
+  w = convergdb.run_worker(None, q, structure_jsons(), max_runs=1, signals=[], run_function=Runs(locked=[r1]), sleep=sleeps.append)
+  assert 0 == w["failures"]
+  assert 1 == w["lock_conflicts"]
+  assert [1] == sleeps
+  assert [] == tmpdir.join('processing').listdir()
+  assert not tmpdir.join('failed').check()
+  assert ['1.json'] == [m["id"] for m in receive_message(q)]
+
+def test_visibility_heartbeat():
+  q = convergdb.sqs_queue("https://sqs.us-west-2.amazonaws.com/1/q", "us-west-2", 0.02)
+  m = {"id": "receipt", "body": "{}"}
+  extended = threading.Event()
+  calls = []
+  def extend(queue, message, seconds):
+    calls.append((message["id"], seconds))
+    extended.set()
+  with visibility_heartbeat(q, m, extend):
+    assert extended.wait(5)
+  count = len(calls)
+  assert ("receipt", 0.02) == calls[0]
+  # the heartbeat stops with the run
+  threading.Event().wait(0.05)
+  assert count == len(calls)
+  # other queues have no visibility to extend
+  with visibility_heartbeat(convergdb.memory_queue([]), m, extend):
+    pass
+  assert count == len(calls)
+
+def test_sqs_queue_visibility():
+  assert 300 == convergdb.sqs_queue("https://sqs.us-west-2.amazonaws.com/1/q")["visibility_seconds"]